@@ -35,6 +35,8 @@ pipeline:
     config:
       mode: logging.entries
       format: with-timestamps
+      # Limit the number of log lines fetched for very chatty jobs
+      maxEntries: 10000
       resourceNames:
         - "projects/${project_id}"
       filter: |
@@ -11,55 +11,94 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-from .regex import regex_replace, regex_match, regex_search
-from .lists import split, index, merge_dict
-from .strings import add_links, urlencode, generate_signed_url, json_encode, json_decode, b64decode, csv_encode, re_escape, html_table_to_xlsx, make_list, read_gcs_object, filemagic, hash_string, yaml_encode, yaml_decode, read_file, read_file_b64, parse_string, parse_url, trim, ltrim, rtrim, remove_mrkdwn
-from .date import strftime, utc_strftime, recurring_date
-from .gcp import format_cost, get_cost, get_gcp_resource
-from .tests import test_contains
+import importlib
+
+# Filters and tests by name, with the filter module (and the function in it)
+# implementing them. Modules are only imported when a template uses one of
+# their filters, as some of them pull in heavy dependencies.
+FILTERS = {
+    'regex_replace': ('regex', 'regex_replace'),
+    'regex_match': ('regex', 'regex_match'),
+    'regex_search': ('regex', 'regex_search'),
+    'split': ('lists', 'split'),
+    'index': ('lists', 'index'),
+    'merge_dict': ('lists', 'merge_dict'),
+    'add_links': ('strings', 'add_links'),
+    'urlencode': ('strings', 'urlencode'),
+    'generate_signed_url': ('strings', 'generate_signed_url'),
+    'strftime': ('date', 'strftime'),
+    'utc_strftime': ('date', 'utc_strftime'),
+    'json_encode': ('strings', 'json_encode'),
+    'json_decode': ('strings', 'json_decode'),
+    'to_json': ('strings', 'json_encode'),
+    'from_json': ('strings', 'json_decode'),
+    'yaml_encode': ('strings', 'yaml_encode'),
+    'yaml_decode': ('strings', 'yaml_decode'),
+    'b64decode': ('strings', 'b64decode'),
+    'csv_encode': ('strings', 'csv_encode'),
+    're_escape': ('strings', 're_escape'),
+    'html_table_to_xlsx': ('strings', 'html_table_to_xlsx'),
+    'format_cost': ('gcp', 'format_cost'),
+    'get_cost': ('gcp', 'get_cost'),
+    'get_gcp_resource': ('gcp', 'get_gcp_resource'),
+    'recurring_date': ('date', 'recurring_date'),
+    'make_list': ('strings', 'make_list'),
+    'read_gcs_object': ('strings', 'read_gcs_object'),
+    'read_file': ('strings', 'read_file'),
+    'read_file_b64': ('strings', 'read_file_b64'),
+    'filemagic': ('strings', 'filemagic'),
+    'hash_string': ('strings', 'hash_string'),
+    'parse_string': ('strings', 'parse_string'),
+    'parse_url': ('strings', 'parse_url'),
+    'trim': ('strings', 'trim'),
+    'ltrim': ('strings', 'ltrim'),
+    'rtrim': ('strings', 'rtrim'),
+    'remove_mrkdwn': ('strings', 'remove_mrkdwn'),
+}
+
+TESTS = {
+    'contains': ('tests', 'test_contains'),
+}
+
+
+def load_filter(module, name):
+    return getattr(importlib.import_module('filters.%s' % module), name)
+
+
+class LazyFilters(dict):
+    """Filter (or test) map for a Jinja environment, which loads filters from
+    the registry the first time they are looked up.
+
+    Args:
+        registry (dict): Filter names to (module, function) tuples.
+        filters (dict, optional): Filters already loaded (eg. Jinja's
+          built-in filters).
+    """
+
+    def __init__(self, registry, filters=None):
+        super().__init__(filters if filters else {})
+        self.registry = registry
+
+    def __missing__(self, name):
+        if name not in self.registry:
+            raise KeyError(name)
+        func = load_filter(*self.registry[name])
+        self[name] = func
+        return func
+
+    def __contains__(self, name):
+        return super().__contains__(name) or name in self.registry
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
 
 
 def get_jinja_tests():
-    return {'contains': test_contains}
+    return {name: load_filter(*test) for name, test in TESTS.items()}
 
 
 def get_jinja_filters():
-    return {
-        'regex_replace': regex_replace,
-        'regex_match': regex_match,
-        'regex_search': regex_search,
-        'split': split,
-        'index': index,
-        'merge_dict': merge_dict,
-        'add_links': add_links,
-        'urlencode': urlencode,
-        'generate_signed_url': generate_signed_url,
-        'strftime': strftime,
-        'utc_strftime': utc_strftime,
-        'json_encode': json_encode,
-        'json_decode': json_decode,
-        'to_json': json_encode,
-        'from_json': json_decode,
-        'yaml_encode': yaml_encode,
-        'yaml_decode': yaml_decode,
-        'b64decode': b64decode,
-        'csv_encode': csv_encode,
-        're_escape': re_escape,
-        'html_table_to_xlsx': html_table_to_xlsx,
-        'format_cost': format_cost,
-        'get_cost': get_cost,
-        'get_gcp_resource': get_gcp_resource,
-        'recurring_date': recurring_date,
-        'make_list': make_list,
-        'read_gcs_object': read_gcs_object,
-        'read_file': read_file,
-        'read_file_b64': read_file_b64,
-        'filemagic': filemagic,
-        'hash_string': hash_string,
-        'parse_string': parse_string,
-        'parse_url': parse_url,
-        'trim': trim,
-        'ltrim': ltrim,
-        'rtrim': rtrim,
-        'remove_mrkdwn': remove_mrkdwn,
-    }
+    return {name: load_filter(*func) for name, func in FILTERS.items()}
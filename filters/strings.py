@@ -17,10 +17,10 @@ from datetime import datetime, timezone
 from time import mktime
 import parsedatetime
 from autolink import linkify
-from google.cloud import storage
+from helpers.base import get_storage_client, get_path
+from jinja2 import pass_environment
 import csv
 import io
-from tablepyxl import tablepyxl
 import base64
 import magic
 import re
@@ -99,6 +99,8 @@ def csv_encode(v, **kwargs):
 def html_table_to_xlsx(s):
     if s.strip() == '':
         return ''
+    from tablepyxl import tablepyxl
+
     workbook = tablepyxl.document_to_workbook(s)
     output = io.BytesIO()
     workbook.save(output)
@@ -111,7 +113,7 @@ def read_gcs_object(url, start=None, end=None):
         raise InvalidSchemeURLException(
             'Invalid scheme for read_gcs_object(%s): %s' %
             (url, parsed_url.scheme))
-    client = storage.Client()
+    client = get_storage_client()
 
     bucket = client.bucket(parsed_url.netloc)
     blob = bucket.get_blob(parsed_url.path[1:])
@@ -123,12 +125,14 @@ def read_gcs_object(url, start=None, end=None):
     return base64.encodebytes(contents).decode('utf-8')
 
 
-def read_file(filename):
-    return Path(filename).read_text()
+@pass_environment
+def read_file(environment, filename):
+    return Path(get_path(environment, filename)).read_text()
 
 
-def read_file_b64(filename):
-    return base64.b64encode(Path(filename).read_bytes())
+@pass_environment
+def read_file_b64(environment, filename):
+    return base64.b64encode(Path(get_path(environment, filename)).read_bytes())
 
 
 def filemagic(contents):
@@ -163,7 +167,7 @@ def generate_signed_url(url, expiration, **kwargs):
     if parsed_url.scheme != 'gs':
         raise InvalidSchemeSignedURLException(
             'Invalid scheme for generate_signed_url: %s' % parsed_url.scheme)
-    client = storage.Client()
+    client = get_storage_client()
 
     bucket = client.bucket(parsed_url.netloc)
     blob = bucket.get_blob(parsed_url.path[1:])
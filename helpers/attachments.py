@@ -0,0 +1,181 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import uuid
+import base64
+import tempfile
+import email.policy
+from datetime import timedelta
+from email.mime.base import MIMEBase
+
+DEFAULT_ATTACHMENT_SPOOL_SIZE = 8 * 1024 * 1024
+# Larger attachments are sent as signed URLs (0 always attaches them)
+DEFAULT_ATTACHMENT_LINK_THRESHOLD = 0
+# Maximum validity of V4 signed URLs (7 days)
+DEFAULT_ATTACHMENT_LINK_EXPIRATION = 604800
+# Base64 encodes 57 bytes into a 76 character line
+BASE64_LINE_BYTES = 57
+BASE64_CHUNK_LINES = 1024
+
+
+def get_spool_size():
+    if os.getenv('ATTACHMENT_SPOOL_SIZE') and os.getenv(
+            'ATTACHMENT_SPOOL_SIZE') != '':
+        return int(os.getenv('ATTACHMENT_SPOOL_SIZE'))
+    return DEFAULT_ATTACHMENT_SPOOL_SIZE
+
+
+def spooled_file(tempdir=None):
+    """Returns a file kept in memory until it grows over the spool size
+    (ATTACHMENT_SPOOL_SIZE), and then on disk."""
+    return tempfile.SpooledTemporaryFile(max_size=get_spool_size(), dir=tempdir)
+
+
+class Attachment:
+    """File attached to an email, read from a local file or spooled from
+    Cloud Storage, so that it is never held in memory as a whole.
+
+    Args:
+        filename (str): File name shown in the email.
+        fileobj (file): Binary file object with the contents.
+        size (int): Size in bytes.
+    """
+
+    def __init__(self, filename, fileobj, size):
+        self.filename = filename
+        self.fileobj = fileobj
+        self.size = size
+
+    @classmethod
+    def from_path(cls, path, filename=None):
+        return cls(filename if filename else os.path.basename(path),
+                   open(path, 'rb'), os.path.getsize(path))
+
+    @classmethod
+    def from_blob(cls, blob, tempdir=None):
+        """Downloads a Cloud Storage blob in chunks into a spooled file."""
+        fileobj = spooled_file(tempdir)
+        blob.download_to_file(fileobj)
+        return cls(os.path.basename(blob.name), fileobj, fileobj.tell())
+
+    def iter_chunks(self, chunk_size=BASE64_LINE_BYTES * BASE64_CHUNK_LINES):
+        self.fileobj.seek(0)
+        while True:
+            chunk = self.fileobj.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+
+    def read(self):
+        return b''.join(self.iter_chunks())
+
+    def iter_base64_lines(self):
+        """Yields the contents as base64 encoded MIME lines (CRLF
+        terminated)."""
+        for chunk in self.iter_chunks():
+            for pos in range(0, len(chunk), BASE64_LINE_BYTES):
+                yield base64.b64encode(chunk[pos:pos + BASE64_LINE_BYTES]) + \
+                    b'\r\n'
+
+    def to_base64(self):
+        """Returns the contents base64 encoded, without line breaks (for
+        JSON based APIs)."""
+        return ''.join(
+            base64.b64encode(chunk).decode('ascii')
+            for chunk in self.iter_chunks())
+
+    def close(self):
+        self.fileobj.close()
+
+
+def close_attachments(attachments):
+    for attachment in attachments:
+        try:
+            attachment.close()
+        except Exception:
+            pass
+
+
+def format_size(size):
+    for unit in ['bytes', 'KiB', 'MiB']:
+        if size < 1024:
+            return '%d %s' % (size, unit) if unit == 'bytes' else '%.1f %s' % (
+                size, unit)
+        size = size / 1024
+    return '%.1f GiB' % (size)
+
+
+def get_signed_url(blob, expiration):
+    """Returns a V4 signed URL for downloading a blob. Credentials without a
+    private key (eg. on Cloud Run) sign through the IAM Credentials API."""
+    expiration = timedelta(seconds=expiration)
+    try:
+        return blob.generate_signed_url(version='v4',
+                                        expiration=expiration,
+                                        method='GET')
+    except AttributeError:
+        import google.auth
+        from google.auth.transport import requests as auth_requests
+
+        credentials, project_id = google.auth.default()
+        credentials.refresh(auth_requests.Request())
+        return blob.generate_signed_url(
+            version='v4',
+            expiration=expiration,
+            method='GET',
+            service_account_email=credentials.service_account_email,
+            access_token=credentials.token)
+
+
+def attachment_part(attachment, maintype='application', subtype='octet-stream'):
+    """Returns a MIME part for an attachment, whose body is streamed in by
+    write_message()."""
+    part = MIMEBase(maintype, subtype)
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.set_payload('--attachment-%s--' % uuid.uuid4().hex)
+    part.streamed_attachment = attachment
+    return part
+
+
+def write_message(message, fileobj):
+    """Writes a MIME message with CRLF line endings, streaming the base64
+    encoded bodies of attachment parts (see attachment_part) from their
+    files."""
+    parts = {}
+    for part in message.walk():
+        attachment = getattr(part, 'streamed_attachment', None)
+        if attachment is not None:
+            parts[part.get_payload().encode('ascii')] = attachment
+
+    contents = message.as_bytes(policy=email.policy.SMTP)
+    pos = 0
+    while True:
+        next_part = None
+        for placeholder in parts:
+            index = contents.find(placeholder, pos)
+            if index >= 0 and (next_part is None or index < next_part[0]):
+                next_part = (index, placeholder)
+        if next_part is None:
+            fileobj.write(contents[pos:])
+            break
+        index, placeholder = next_part
+        fileobj.write(contents[pos:index])
+        for line in parts[placeholder].iter_base64_lines():
+            fileobj.write(line)
+        pos = index + len(placeholder)
+        # Line break following the placeholder was written with the body
+        if contents[pos:pos + 2] == b'\r\n':
+            pos += 2
+    fileobj.seek(0)
+    return fileobj
@@ -15,17 +15,26 @@ import logging
 import os
 import re
 import json
-from google.cloud.iam_credentials_v1 import IAMCredentialsClient
-from google.api_core.gapic_v1 import client_info as grpc_client_info
-import google_auth_httplib2
-import google.auth
-from googleapiclient import http
-from google.cloud import resourcemanager_v3
+import urllib.parse
 import json_fix  # noqa: F401
 import tempfile
+import threading
+import hashlib
+import weakref
+import asyncio
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from jinja2 import Environment, Template, nodes
+from jinja2.compiler import CodeGenerator
+from helpers.tokens import AccessTokenCredentials, get_token_cache
+from helpers.metrics import get_metrics_registry, instrument_http, instrument_session, current_handler, TEMPLATE_RENDER_DURATION
 
 PUBSUB2INBOX_VERSION = '1.8.2'
-TEMPORARY_DIRECTORY = None
+DEFAULT_TEMPLATE_CACHE_SIZE = 2000
+DEFAULT_CLIENT_CACHE_SIZE = 256
+DEFAULT_ASYNC_WORKER_THREADS = 64
 
 
 class NoCredentialsException(Exception):
@@ -40,6 +49,8 @@ class Context(object):
         self.event_type = eventType
         self.resource = resource
         self.http_response = None
+        # Set when the message was not (fully) processed, eg. "ignored"
+        self.outcome = None
 
     def __json__(self):
         return "{\"event_id\": \"%s\", \"timestamp\": \"%s\", \"event_type\": \"%s\", \"resource\": \"%s\"}" % (
@@ -63,41 +74,542 @@ def get_user_agent():
 
 
 def get_branded_http(credentials=None):
+    import google.auth
+    import google_auth_httplib2
+    from googleapiclient import http
+
     if not credentials:
         credentials, project_id = google.auth.default(
             ['https://www.googleapis.com/auth/cloud-platform'])
     branded_http = google_auth_httplib2.AuthorizedHttp(credentials)
     branded_http = http.set_user_agent(branded_http, get_user_agent())
-    return branded_http
+    return instrument_http(branded_http)
 
 
 def get_grpc_client_info():
+    from google.api_core.gapic_v1 import client_info as grpc_client_info
+
     client_info = grpc_client_info.ClientInfo(user_agent=get_user_agent())
     return client_info
 
 
+def get_credentials_key(credentials):
+    """Returns a hashable identity for credentials, so that clients created
+    with equivalent credentials (eg. repeated google.auth.default() calls)
+    can be shared."""
+    if credentials is None:
+        return None
+    key = ['%s.%s' % (type(credentials).__module__, type(credentials).__name__)]
+    for attr in [
+            'service_account_email', 'signer_email', 'client_id', 'audience',
+            'quota_project_id'
+    ]:
+        try:
+            value = getattr(credentials, attr, None)
+        except Exception:
+            value = None
+        key.append(value if isinstance(value, (str, int)) else None)
+    scopes = getattr(credentials, 'scopes', None)
+    key.append(tuple(sorted(scopes)) if scopes else None)
+    token = getattr(credentials, 'token', None)
+    if not any(key[1:]) and token:
+        # Plain access token credentials without any other identity (use
+        # BaseHelper.get_credentials_for_scopes() where possible, which is
+        # keyed by service account and scopes instead)
+        key.append(hashlib.sha256(token.encode('utf-8')).hexdigest())
+    return tuple(key)
+
+
+class _ThreadClients:
+    """Clients of a single thread, see ClientRegistry."""
+
+    def __init__(self, generation):
+        self.generation = generation
+        self.clients = OrderedDict()
+
+
+class ClientRegistry:
+    """Process-wide registry of Google API clients.
+
+    Clients are keyed by the caller (typically API, version, credentials
+    identity and endpoint) and reused for the life of the process, so that
+    discovery documents, credential lookups and HTTP connection pools are
+    not recreated for every message. Clients that are not safe to share
+    between threads (like httplib2 based discovery clients) are kept in
+    thread-local storage, each thread keeping at most max_size of them. When
+    a thread exits, its clients are handed back to the registry, so that
+    short-lived worker threads (eg. of per-message thread pools) reuse the
+    clients of earlier threads instead of building new ones."""
+
+    def __init__(self, max_size=DEFAULT_CLIENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._clients = OrderedDict()
+        # Per-thread clients of exited threads, waiting to be reused
+        self._idle_clients = OrderedDict()
+        # Number of clients held by running threads
+        self._thread_clients = 0
+        self._generation = 0
+        self._local = threading.local()
+        # Clients of exited threads may be released while this thread
+        # holds the lock
+        self._lock = threading.RLock()
+
+    def _evict(self):
+        while len(self._clients) + len(self._idle_clients) > self.max_size:
+            if len(self._idle_clients) > 0:
+                self._idle_clients.popitem(last=False)
+            else:
+                self._clients.popitem(last=False)
+
+    def _release_thread_clients(self, generation, clients):
+        with self._lock:
+            if generation != self._generation:
+                return
+            self._thread_clients -= len(clients)
+            for key, client in clients.items():
+                self._idle_clients[(key, id(client))] = (key, client)
+            self._evict()
+
+    def _get_thread_holder(self):
+        holder = getattr(self._local, 'holder', None)
+        if holder is None or holder.generation != self._generation:
+            holder = _ThreadClients(self._generation)
+            # Runs when the thread exits and its local storage is freed
+            weakref.finalize(holder, self._release_thread_clients,
+                             holder.generation, holder.clients)
+            self._local.holder = holder
+        return holder
+
+    def _get_thread_local_client(self, key, factory):
+        holder = self._get_thread_holder()
+        clients = holder.clients
+        with self._lock:
+            if key in clients:
+                clients.move_to_end(key)
+                self.hits += 1
+                return clients[key]
+            client = None
+            for idle_key, (client_key,
+                           idle_client) in self._idle_clients.items():
+                if client_key == key:
+                    del self._idle_clients[idle_key]
+                    self.hits += 1
+                    client = idle_client
+                    break
+            if client is None:
+                self.misses += 1
+
+        if client is None:
+            client = factory()
+        if self.max_size <= 0:
+            return client
+        with self._lock:
+            if holder.generation != self._generation:
+                # Registry was cleared meanwhile
+                return client
+            clients[key] = client
+            self._thread_clients += 1
+            while len(clients) > self.max_size:
+                clients.popitem(last=False)
+                self._thread_clients -= 1
+        return client
+
+    def get_client(self, key, factory, thread_local=False):
+        if thread_local:
+            return self._get_thread_local_client(key, factory)
+        with self._lock:
+            if key in self._clients:
+                self._clients.move_to_end(key)
+                self.hits += 1
+                return self._clients[key]
+            self.misses += 1
+
+        client = factory()
+        if self.max_size <= 0:
+            return client
+        with self._lock:
+            if key in self._clients:
+                # Another thread created the same client meanwhile
+                return self._clients[key]
+            self._clients[key] = client
+            self._evict()
+        return client
+
+    def clear(self):
+        with self._lock:
+            self._clients.clear()
+            self._idle_clients.clear()
+            # Thread-local clients of running threads are dropped on their
+            # next lookup
+            self._generation += 1
+            self._thread_clients = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size':
+                    len(self._clients) + len(self._idle_clients) +
+                    self._thread_clients,
+                'max_size':
+                    self.max_size,
+                'hits':
+                    self.hits,
+                'misses':
+                    self.misses,
+            }
+
+
+_CLIENT_REGISTRY = None
+_CLIENT_REGISTRY_LOCK = threading.Lock()
+
+
+def get_client_registry():
+    global _CLIENT_REGISTRY
+    if _CLIENT_REGISTRY is None:
+        with _CLIENT_REGISTRY_LOCK:
+            if _CLIENT_REGISTRY is None:
+                max_size = DEFAULT_CLIENT_CACHE_SIZE
+                if os.getenv('CLIENT_CACHE_SIZE') and os.getenv(
+                        'CLIENT_CACHE_SIZE') != '':
+                    max_size = int(os.getenv('CLIENT_CACHE_SIZE'))
+                _CLIENT_REGISTRY = ClientRegistry(max_size)
+    return _CLIENT_REGISTRY
+
+
+def _client_option_key(value):
+    if hasattr(value, '__dict__'):
+        return vars(value)
+    return str(value)
+
+
+def get_discovery_client(api, version, credentials=None, **kwargs):
+    """Returns a shared googleapiclient discovery client.
+
+    Args:
+        api (str): API name (eg. compute).
+        version (str): API version (eg. v1).
+        credentials (google.auth.credentials.Credentials, optional): Credentials
+            to use, defaults to application default credentials.
+        **kwargs: Additional arguments for discovery.build (eg. client_options).
+    """
+    key = ('discovery', api, version, get_credentials_key(credentials),
+           json.dumps(kwargs, sort_keys=True, default=_client_option_key))
+
+    def _build():
+        from googleapiclient import discovery
+
+        return discovery.build(api,
+                               version,
+                               http=get_branded_http(credentials),
+                               **kwargs)
+
+    return get_client_registry().get_client(key, _build, thread_local=True)
+
+
+def get_storage_client(credentials=None, project=None):
+    """Returns a shared Cloud Storage client (honours STORAGE_EMULATOR_HOST)."""
+    endpoint = os.getenv('STORAGE_EMULATOR_HOST')
+    key = ('storage', get_credentials_key(credentials), project, endpoint)
+
+    def _build():
+        from google.cloud import storage
+
+        if endpoint:
+            from google.auth.credentials import AnonymousCredentials
+
+            client = storage.Client(client_info=get_grpc_client_info(),
+                                    client_options={"api_endpoint": endpoint},
+                                    credentials=AnonymousCredentials(),
+                                    project=project)
+        else:
+            client = storage.Client(client_info=get_grpc_client_info(),
+                                    credentials=credentials,
+                                    project=project)
+        instrument_session(client._http)
+        return client
+
+    return get_client_registry().get_client(key, _build, thread_local=True)
+
+
+def _generate_access_token(service_account, scopes):
+    """Generates an access token for a service account, returns a
+    (token, expiry timestamp) tuple."""
+    from google.cloud.iam_credentials_v1 import IAMCredentialsClient
+
+    client = get_client_registry().get_client(('iamcredentials',),
+                                              IAMCredentialsClient)
+    name = 'projects/-/serviceAccounts/%s' % service_account
+    response = client.generate_access_token(name=name, scope=scopes)
+    return response.access_token, response.expire_time.timestamp()
+
+
+class TemplateCache:
+    """Process-wide LRU cache of compiled Jinja2 template code.
+
+    Only the compiled code objects are cached, never the template objects
+    themselves, so no per-request state (globals, variables) is shared
+    between messages."""
+
+    def __init__(self, max_size=DEFAULT_TEMPLATE_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            code = self._cache.get(key)
+            if code is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return code
+
+    def put(self, key, code):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = code
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._cache),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+_TEMPLATE_CACHE = None
+_TEMPLATE_CACHE_LOCK = threading.Lock()
+
+
+def get_template_cache():
+    global _TEMPLATE_CACHE
+    if _TEMPLATE_CACHE is None:
+        with _TEMPLATE_CACHE_LOCK:
+            if _TEMPLATE_CACHE is None:
+                max_size = DEFAULT_TEMPLATE_CACHE_SIZE
+                if os.getenv('TEMPLATE_CACHE_SIZE') and os.getenv(
+                        'TEMPLATE_CACHE_SIZE') != '':
+                    max_size = int(os.getenv('TEMPLATE_CACHE_SIZE'))
+                _TEMPLATE_CACHE = TemplateCache(max_size)
+    return _TEMPLATE_CACHE
+
+
+class CachingCodeGenerator(CodeGenerator):
+    """Code generator that does not evaluate filters and tests at compile
+    time.
+
+    Filters such as read_file or read_gcs_object depend on the message being
+    processed, so folding their results into code shared through the
+    template cache would leak them to other messages."""
+
+    def _output_child_to_const(self, node, frame, finalize):
+        if isinstance(node, (nodes.Filter, nodes.Test)) or node.find(
+            (nodes.Filter, nodes.Test)) is not None:
+            raise nodes.Impossible()
+        return super()._output_child_to_const(node, frame, finalize)
+
+
+class InstrumentedTemplate(Template):
+    """Template that records how long rendering takes."""
+
+    def render(self, *args, **kwargs):
+        with TEMPLATE_RENDER_DURATION.time(
+                handler=current_handler.get(),
+                template=self.name if self.name else ''):
+            return super().render(*args, **kwargs)
+
+
+class CachingEnvironment(Environment):
+    """Jinja2 environment that looks up compiled template code from the
+    process-wide template cache.
+
+    The environment itself is still created per message and carries the
+    per-request globals; templates are bound to it when they are created,
+    so cached code is rendered against the caller's variables.
+
+    Since the environment is the per-message scope, it also holds the
+    temporary directory of the message (see BaseHelper._init_tempdir) and
+    the functions to call once the message has been processed (see
+    BaseHelper._on_success)."""
+
+    temporary_directory = None
+    success_callbacks = None
+    code_generator_class = CachingCodeGenerator
+    template_class = InstrumentedTemplate
+
+    def __init__(self, *args, **kwargs):
+        # The optimizer folds filters with constant arguments at compile time
+        # (see CachingCodeGenerator), so it is disabled for cached templates.
+        kwargs.setdefault('optimized', False)
+        super().__init__(*args, **kwargs)
+
+    def _get_cached_code(self, source):
+        autoescape = self.autoescape(None) if callable(
+            self.autoescape) else self.autoescape
+        cache = get_template_cache()
+        key = (source, bool(autoescape))
+        code = cache.get(key)
+        if code is None:
+            code = self.compile(source)
+            cache.put(key, code)
+        return code
+
+    def precompile(self, source):
+        """Compiles a template source into the template cache ahead of time,
+        raising any syntax errors immediately."""
+        self._get_cached_code(source)
+
+    def from_string(self, source, globals=None, template_class=None):
+        if not isinstance(source, str):
+            return super().from_string(source, globals, template_class)
+
+        code = self._get_cached_code(source)
+        cls = template_class or self.template_class
+        return cls.from_code(self, code, self.make_globals(globals), None)
+
+
+def _collect_cache_metrics():
+    metrics = []
+    for cache, stats in [('template', get_template_cache().stats()),
+                         ('client', get_client_registry().stats())]:
+        hits = ({'result': 'hit'}, stats['hits'])
+        misses = ({'result': 'miss'}, stats['misses'])
+        metrics.append(
+            ('pubsub2inbox_%s_cache_size' % cache, 'gauge',
+             'Entries in the %s cache.' % cache, [({}, stats['size'])]))
+        metrics.append(
+            ('pubsub2inbox_%s_cache_requests_total' % cache, 'counter',
+             'Lookups in the %s cache, by result.' % cache, [hits, misses]))
+    return metrics
+
+
+get_metrics_registry().register_collector(_collect_cache_metrics)
+
+_ASYNC_EXECUTOR = None
+_ASYNC_EXECUTOR_LOCK = threading.Lock()
+_TEMPDIR_LOCK = threading.Lock()
+_SUCCESS_CALLBACKS_LOCK = threading.Lock()
+
+
+def get_async_executor():
+    """Returns the thread pool that runs synchronous (blocking) work for the
+    asyncio executor. The size can be set with ASYNC_WORKER_THREADS."""
+    global _ASYNC_EXECUTOR
+    if _ASYNC_EXECUTOR is None:
+        with _ASYNC_EXECUTOR_LOCK:
+            if _ASYNC_EXECUTOR is None:
+                max_workers = DEFAULT_ASYNC_WORKER_THREADS
+                if os.getenv('ASYNC_WORKER_THREADS') and os.getenv(
+                        'ASYNC_WORKER_THREADS') != '':
+                    max_workers = int(os.getenv('ASYNC_WORKER_THREADS'))
+                _ASYNC_EXECUTOR = ThreadPoolExecutor(
+                    max_workers=max_workers, thread_name_prefix='pubsub2inbox')
+    return _ASYNC_EXECUTOR
+
+
+async def run_in_executor(func, *args, **kwargs):
+    """Runs a blocking function in the async worker thread pool, keeping the
+    current context variables."""
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_async_executor(), partial(context.run, func, *args, **kwargs))
+
+
+def get_tempdir(jinja_environment):
+    """Returns the temporary directory path of the message being processed
+    with the environment, or None if it has not been created."""
+    temporary_directory = getattr(jinja_environment, 'temporary_directory',
+                                  None)
+    if temporary_directory:
+        return temporary_directory.name
+    return None
+
+
+def get_path(jinja_environment, filename):
+    """Resolves a relative file path against the temporary directory of the
+    message (if one has been created)."""
+    tempdir = get_tempdir(jinja_environment)
+    if tempdir and not os.path.isabs(filename):
+        return os.path.join(tempdir, filename)
+    return filename
+
+
 class BaseHelper:
     logger = None
 
     def __init__(self, jinja_environment):
-        self.project_number_cache = {}
         self.jinja_environment = jinja_environment
         self.logger = logging.getLogger('pubsub2inbox')
 
+    def _get_tempdir(self):
+        return get_tempdir(self.jinja_environment)
+
     def _init_tempdir(self):
-        global TEMPORARY_DIRECTORY
-        if not TEMPORARY_DIRECTORY:
-            TEMPORARY_DIRECTORY = tempfile.TemporaryDirectory()
-            self.logger.debug('Created temporary directory: %s' %
-                              (TEMPORARY_DIRECTORY.name))
-            os.chdir(TEMPORARY_DIRECTORY.name)
+        """Creates the temporary directory of the current message. Relative
+        file paths are resolved against it (see _get_path)."""
+        if not self._get_tempdir():
+            # Tasks of a parallel group share the message's directory
+            with _TEMPDIR_LOCK:
+                if not self._get_tempdir():
+                    tempdir = tempfile.TemporaryDirectory()
+                    self.jinja_environment.temporary_directory = tempdir
+                    self.logger.debug('Created temporary directory: %s' %
+                                      (tempdir.name))
+        return self._get_tempdir()
 
     def _clean_tempdir(self):
-        global TEMPORARY_DIRECTORY
-        if TEMPORARY_DIRECTORY:
+        temporary_directory = getattr(self.jinja_environment,
+                                      'temporary_directory', None)
+        if temporary_directory:
             self.logger.debug('Cleaning temporary directory: %s' %
-                              (TEMPORARY_DIRECTORY.name))
-            TEMPORARY_DIRECTORY = None
+                              (temporary_directory.name))
+            self.jinja_environment.temporary_directory = None
+            temporary_directory.cleanup()
+
+    def _on_success(self, callback):
+        """Registers a function to call once the whole pipeline has
+        processed the current message successfully, eg. to save state only
+        after later tasks have delivered the results."""
+        with _SUCCESS_CALLBACKS_LOCK:
+            if getattr(self.jinja_environment, 'success_callbacks',
+                       None) is None:
+                self.jinja_environment.success_callbacks = []
+            self.jinja_environment.success_callbacks.append(callback)
+
+    def _run_success_callbacks(self):
+        with _SUCCESS_CALLBACKS_LOCK:
+            callbacks = getattr(self.jinja_environment, 'success_callbacks',
+                                None)
+            self.jinja_environment.success_callbacks = None
+        for callback in callbacks if callbacks else []:
+            callback()
+
+    def _get_path(self, filename):
+        return get_path(self.jinja_environment, filename)
 
     def _get_user_agent(self):
         return get_user_agent()
@@ -108,22 +620,45 @@ class BaseHelper:
     def _get_grpc_client_info(self):
         return get_grpc_client_info()
 
+    def _get_discovery_client(self, api, version, credentials=None, **kwargs):
+        return get_discovery_client(api, version, credentials, **kwargs)
+
+    def _get_storage_client(self, credentials=None, project=None):
+        return get_storage_client(credentials, project)
+
+    def _open_file(self, path, mode='r'):
+        """Opens a local file or a Cloud Storage object (gs://bucket/object),
+        which is read or written in chunks."""
+        if path.startswith('gs://'):
+            parsed_url = urllib.parse.urlparse(path)
+            bucket = self._get_storage_client().bucket(parsed_url.netloc)
+            blob = bucket.blob(urllib.parse.unquote(parsed_url.path[1:]))
+            if 'b' in mode:
+                return blob.open(mode)
+            return blob.open(mode, encoding='utf-8')
+        if 'b' in mode:
+            return open(self._get_path(path), mode)
+        return open(self._get_path(path), mode, encoding='utf-8')
+
+    def _read_json_lines(self, path):
+        """Yields the objects of a JSON Lines file (local or on Cloud
+        Storage), one line at a time."""
+        with self._open_file(path) as json_file:
+            for line in json_file:
+                if line.strip() != '':
+                    yield json.loads(line)
+
     def get_project_number(self, project_id, credentials=None):
-        if project_id in self.project_number_cache:
-            return self.project_number_cache[project_id]
-
-        client = resourcemanager_v3.ProjectsClient(credentials=credentials)
-        request = resourcemanager_v3.SearchProjectsRequest(
-            query="projectId=%s" % (project_id),)
-        response = client.search_projects(request=request)
-        project = next(iter(response))
+        from helpers.projects import get_project_cache
+
+        project = get_project_cache().get_projects(
+            [project_id], lambda: self._get_discovery_client(
+                'cloudresourcemanager', 'v1', credentials=credentials))[0]
         if project:
-            self.project_number_cache[project_id] = int(
-                project.name.replace("projects/", ""))
-            return self.project_number_cache[project_id]
+            return int(project[1])
         return None
 
-    def get_token_for_scopes(self, scopes, service_account=None):
+    def _get_token_service_account(self, service_account=None):
         if not service_account:
             service_account = os.getenv('SERVICE_ACCOUNT')
 
@@ -131,11 +666,23 @@ class BaseHelper:
             raise NoCredentialsException(
                 'You need to specify a service account for Directory API credentials, either through SERVICE_ACCOUNT environment variable or serviceAccountEmail parameter.'
             )
+        return service_account
 
-        client = IAMCredentialsClient()
-        name = 'projects/-/serviceAccounts/%s' % service_account
-        response = client.generate_access_token(name=name, scope=scopes)
-        return response.access_token
+    def get_token_for_scopes(self, scopes, service_account=None):
+        service_account = self._get_token_service_account(service_account)
+        token_cache = get_token_cache()
+        return token_cache.get_token(
+            token_cache.get_key(service_account, scopes),
+            partial(_generate_access_token, service_account, scopes))
+
+    def get_credentials_for_scopes(self, scopes, service_account=None):
+        """Returns credentials for a service account (defaults to the
+        SERVICE_ACCOUNT environment variable) and scopes, which keep their
+        access token fresh through the token cache."""
+        service_account = self._get_token_service_account(service_account)
+        return AccessTokenCredentials(
+            service_account, scopes,
+            partial(_generate_access_token, service_account, scopes))
 
     def _jinja_expand_expr(self, contents, _tpl='config'):
         expr = self.jinja_environment.compile_expression(contents,
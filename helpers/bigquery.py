@@ -0,0 +1,152 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import time
+import threading
+from collections import OrderedDict
+from helpers.metrics import get_metrics_registry
+
+DEFAULT_QUERY_CACHE_SIZE = 100
+
+
+class QueryResults:
+    """Lazily iterable BigQuery query results. Rows are read from the
+    query's destination table as Arrow record batches (through the Storage
+    Read API when a read client is given) and converted to dicts one batch
+    at a time, so only a batch of rows is held in memory. Every iteration
+    reads the results again."""
+
+    def __init__(self,
+                 client,
+                 table,
+                 total_rows,
+                 selected_fields=None,
+                 max_rows=None,
+                 bqstorage_client=None):
+        self.client = client
+        self.table = table
+        self.total_rows = total_rows if total_rows is not None else 0
+        self.selected_fields = selected_fields
+        self.max_rows = max_rows
+        self.bqstorage_client = bqstorage_client
+
+    def batches(self):
+        """Yields the results as pyarrow.RecordBatch objects."""
+        rows = self.client.list_rows(self.table,
+                                     selected_fields=self.selected_fields)
+        remaining = self.max_rows
+        for batch in rows.to_arrow_iterable(
+                bqstorage_client=self.bqstorage_client):
+            if remaining is not None:
+                if remaining <= 0:
+                    return
+                if batch.num_rows > remaining:
+                    batch = batch.slice(0, remaining)
+                remaining -= batch.num_rows
+            yield batch
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield from batch.to_pylist()
+
+    def __len__(self):
+        if self.max_rows is not None:
+            return min(self.total_rows, self.max_rows)
+        return self.total_rows
+
+
+class QueryResultCache:
+    """Process-wide LRU cache of query results keyed by the rendered query,
+    so that identical queries from messages arriving within a time window
+    are not run again. Each entry has its own TTL."""
+
+    def __init__(self, max_size=DEFAULT_QUERY_CACHE_SIZE, now=time.monotonic):
+        self.max_size = max_size
+        self.now = now
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.now() >= entry[0]:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value, ttl):
+        if self.max_size <= 0 or ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.now() + ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_QUERY_RESULT_CACHE = None
+_QUERY_RESULT_CACHE_LOCK = threading.Lock()
+
+
+def get_query_result_cache():
+    global _QUERY_RESULT_CACHE
+    if _QUERY_RESULT_CACHE is None:
+        with _QUERY_RESULT_CACHE_LOCK:
+            if _QUERY_RESULT_CACHE is None:
+                max_size = DEFAULT_QUERY_CACHE_SIZE
+                if os.getenv('BIGQUERY_CACHE_SIZE') and os.getenv(
+                        'BIGQUERY_CACHE_SIZE') != '':
+                    max_size = int(os.getenv('BIGQUERY_CACHE_SIZE'))
+                _QUERY_RESULT_CACHE = QueryResultCache(max_size)
+    return _QUERY_RESULT_CACHE
+
+
+def _collect_query_result_cache_metrics():
+    if _QUERY_RESULT_CACHE is None:
+        return []
+    stats = _QUERY_RESULT_CACHE.stats()
+    return [('pubsub2inbox_bigquery_cache_size', 'gauge',
+             'Entries in the BigQuery query result cache.', [({}, stats['size'])
+                                                            ]),
+            ('pubsub2inbox_bigquery_cache_requests_total', 'counter',
+             'Lookups in the BigQuery query result cache, by result.', [({
+                 'result': 'hit'
+             }, stats['hits']), ({
+                 'result': 'miss'
+             }, stats['misses'])])]
+
+
+get_metrics_registry().register_collector(_collect_query_result_cache_metrics)
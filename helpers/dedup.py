@@ -0,0 +1,297 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import abc
+import os
+import threading
+import importlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+from time import mktime
+import parsedatetime
+from helpers.base import get_storage_client
+from helpers.metrics import DEDUP_CHECKS
+
+DEFAULT_DEDUP_CACHE_SIZE = 10000
+
+DEDUP_NEW = 'new'
+DEDUP_ELAPSED = 'elapsed'
+DEDUP_NOT_ELAPSED = 'not_elapsed'
+DEDUP_CACHED = 'cached'
+DEDUP_IN_PROGRESS = 'in_progress'
+
+
+class UnknownDedupBackendException(Exception):
+    pass
+
+
+def get_period_end(period, created):
+    """Returns the time after which a message marked at the created time can
+    be processed again, as a naive local datetime."""
+    period_parsed = parsedatetime.Calendar(
+        version=parsedatetime.VERSION_CONTEXT_STYLE).parse(period,
+                                                           sourceTime=created)
+    if len(period_parsed) > 1:
+        return datetime.fromtimestamp(mktime(period_parsed[0]))
+    return datetime.fromtimestamp(mktime(period_parsed))
+
+
+class DedupBackend(abc.ABC):
+    """Storage for deduplication markers, which are shared across instances.
+
+    Args:
+        config (dict): The ignoreOn configuration.
+    """
+
+    name = None
+
+    def __init__(self, config):
+        self.config = config
+
+    @abc.abstractmethod
+    def get(self, key):
+        """Returns the creation time of the marker, or None if it does not
+        exist."""
+
+    @abc.abstractmethod
+    def create(self, key):
+        """Creates the marker if it does not exist yet. Returns False if it
+        already existed (eg. created concurrently by another instance)."""
+
+    @abc.abstractmethod
+    def touch(self, key):
+        """Recreates the marker, returning its new creation time."""
+
+
+class GcsDedupBackend(DedupBackend):
+    """Stores markers as zero-length objects in a Cloud Storage bucket."""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.bucket = config['bucket']
+        self.name = 'gcs:%s' % (self.bucket)
+
+    def _get_blob(self, key):
+        return get_storage_client().bucket(self.bucket).blob(key)
+
+    def get(self, key):
+        blob = self._get_blob(key)
+        if not blob.exists():
+            return None
+        blob.reload()
+        return blob.time_created
+
+    def create(self, key):
+        try:
+            self._get_blob(key).upload_from_string('', if_generation_match=0)
+        except Exception as exc:
+            # Handle TOCTOU condition
+            if 'conditionNotMet' in str(exc):
+                return False
+            raise exc
+        return True
+
+    def touch(self, key):
+        blob = self._get_blob(key)
+        blob.upload_from_string('')
+        return blob.time_created if blob.time_created else datetime.now(
+            timezone.utc)
+
+
+class MemoryDedupBackend(DedupBackend):
+    """Keeps markers in process memory, for single instance deployments and
+    testing."""
+
+    _markers = {}
+    _lock = threading.Lock()
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.name = 'memory'
+
+    def get(self, key):
+        with self._lock:
+            return self._markers.get(key)
+
+    def create(self, key):
+        with self._lock:
+            if key in self._markers:
+                return False
+            self._markers[key] = datetime.now(timezone.utc)
+            return True
+
+    def touch(self, key):
+        with self._lock:
+            self._markers[key] = datetime.now(timezone.utc)
+            return self._markers[key]
+
+
+DEDUP_BACKENDS = {
+    'gcs': GcsDedupBackend,
+    'memory': MemoryDedupBackend,
+}
+
+
+def get_dedup_backend(config):
+    """Returns the deduplication backend for an ignoreOn configuration.
+
+    The backend is set with the `backend` key: `gcs` (default), `memory` or
+    the import path of a DedupBackend subclass (eg. `mymodule.RedisBackend`).
+    """
+    backend = config['backend'] if 'backend' in config else 'gcs'
+    if backend in DEDUP_BACKENDS:
+        return DEDUP_BACKENDS[backend](config)
+    if '.' in backend:
+        module_name, class_name = backend.rsplit('.', 1)
+        try:
+            backend_class = getattr(importlib.import_module(module_name),
+                                    class_name)
+        except (ImportError, AttributeError) as exc:
+            raise UnknownDedupBackendException(
+                'Unable to load deduplication backend %s: %s' %
+                (backend, str(exc)))
+        return backend_class(config)
+    raise UnknownDedupBackendException('Unknown deduplication backend: %s' %
+                                       (backend))
+
+
+class DedupCache:
+    """Process-wide LRU cache of the deduplication keys seen recently.
+
+    Keys are stored with the time their period ends. As markers are only
+    ever recreated later, a cached period end is never later than the one in
+    the backend, so messages can be rejected without checking the backend.
+    """
+
+    def __init__(self, max_size=DEFAULT_DEDUP_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, now):
+        with self._lock:
+            period_end = self._entries.get(key)
+            if period_end is not None and now >= period_end:
+                del self._entries[key]
+                period_end = None
+            if period_end is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return period_end
+
+    def put(self, key, period_end):
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[key] = period_end
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_DEDUP_CACHE = None
+_DEDUP_CACHE_LOCK = threading.Lock()
+
+
+def get_dedup_cache():
+    global _DEDUP_CACHE
+    if _DEDUP_CACHE is None:
+        with _DEDUP_CACHE_LOCK:
+            if _DEDUP_CACHE is None:
+                max_size = DEFAULT_DEDUP_CACHE_SIZE
+                if os.getenv('DEDUP_CACHE_SIZE') and os.getenv(
+                        'DEDUP_CACHE_SIZE') != '':
+                    max_size = int(os.getenv('DEDUP_CACHE_SIZE'))
+                _DEDUP_CACHE = DedupCache(max_size)
+    return _DEDUP_CACHE
+
+
+class DedupResult:
+    """Outcome of a deduplication check.
+
+    Attributes:
+        status (str): One of the DEDUP_* constants.
+        created (datetime): Creation time of the existing marker, if known.
+        period_end (datetime): Time after which the message can be processed
+          again, if known.
+    """
+
+    def __init__(self, status, created=None, period_end=None):
+        self.status = status
+        self.created = created
+        self.period_end = period_end
+
+    @property
+    def proceed(self):
+        return self.status in [DEDUP_NEW, DEDUP_ELAPSED]
+
+
+def check_and_mark(backend, key, period, now=datetime.utcnow):
+    """Checks whether a message with the deduplication key can be processed,
+    marking it as processed if so.
+
+    Args:
+        backend (DedupBackend): Backend storing the markers.
+        key (str): Deduplication key of the message.
+        period (str): Textual period after which a message can be
+          reprocessed (eg. "2 days").
+        now (callable): Returns the current time to compare against.
+
+    Returns:
+        DedupResult
+    """
+    result = _check_and_mark(backend, key, period, now)
+    DEDUP_CHECKS.inc(result=result.status)
+    return result
+
+
+def _check_and_mark(backend, key, period, now):
+    cache = get_dedup_cache()
+    cache_key = (backend.name, key, period)
+    period_end = cache.get(cache_key, now())
+    if period_end is not None:
+        return DedupResult(DEDUP_CACHED, period_end=period_end)
+
+    created = backend.get(key)
+    if created is not None:
+        period_end = get_period_end(period, created)
+        if now() < period_end:
+            cache.put(cache_key, period_end)
+            return DedupResult(DEDUP_NOT_ELAPSED, created, period_end)
+        touched = backend.touch(key)
+        cache.put(cache_key, get_period_end(period, touched))
+        return DedupResult(DEDUP_ELAPSED, created, period_end)
+
+    if not backend.create(key):
+        return DedupResult(DEDUP_IN_PROGRESS)
+    cache.put(cache_key, get_period_end(period, datetime.now(timezone.utc)))
+    return DedupResult(DEDUP_NEW)
@@ -0,0 +1,317 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import abc
+import time
+import random
+import logging
+import threading
+import importlib
+from datetime import datetime
+from helpers.base import get_storage_client
+from helpers.dedup import get_period_end
+from helpers.metrics import LOCK_ACQUISITIONS, LOCK_LEASES_LOST
+
+DEFAULT_RETRY_DELAY = 10
+MAX_RETRY_DELAY = 600
+
+
+class UnknownLockBackendException(Exception):
+    pass
+
+
+def parse_duration(value):
+    """Returns a duration in seconds, given either a number of seconds or a
+    textual period (eg. "5 minutes")."""
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str) and value.replace('.', '', 1).isdigit():
+        return float(value)
+    start = datetime.now().replace(microsecond=0)
+    return (get_period_end(value, start) - start).total_seconds()
+
+
+class Lease:
+    """State of a lock acquisition attempt.
+
+    Attributes:
+        name (str): Name of the lock.
+        acquired (bool): Whether the lock was acquired.
+        token (int): Fencing token of the lease, which increases every time
+          the lock changes hands. Only set if acquired.
+        expires (float): Time (in seconds since the epoch) when the lease (or
+          if not acquired, the current holder's lease) expires, None if it
+          never expires.
+    """
+
+    def __init__(self, name, acquired, token=None, expires=None):
+        self.name = name
+        self.acquired = acquired
+        self.token = token
+        self.expires = expires
+
+
+class LockBackend(abc.ABC):
+    """Storage for distributed locks.
+
+    Args:
+        config (dict): The concurrency configuration.
+    """
+
+    name = None
+
+    def __init__(self, config):
+        self.config = config
+
+    @abc.abstractmethod
+    def acquire(self, name, lease_seconds=None):
+        """Acquires the lock if it is free or its lease has expired. Locks
+        without a lease never expire.
+
+        Returns:
+            Lease
+        """
+
+    @abc.abstractmethod
+    def renew(self, lease, lease_seconds):
+        """Extends the lease. Returns False if the lock has been lost."""
+
+    @abc.abstractmethod
+    def release(self, lease):
+        """Releases the lock, unless it has been taken over by someone
+        else. Returns False if the lock had been lost."""
+
+
+def _get_expires(lease_seconds, start=None):
+    if not lease_seconds:
+        return None
+    return (start if start else time.time()) + lease_seconds
+
+
+class GcsLockBackend(LockBackend):
+    """Stores locks as zero-length objects in a Cloud Storage bucket. The
+    object generation is used as the fencing token, and the lease expiry is
+    kept in the object metadata."""
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.bucket = config['bucket']
+        self.name = 'gcs:%s' % (self.bucket)
+
+    def _upload(self, name, expires, generation):
+        blob = get_storage_client().bucket(self.bucket).blob(name)
+        blob.metadata = {'expires': str(expires) if expires else ''}
+        blob.upload_from_string('', if_generation_match=generation)
+        return Lease(name, True, blob.generation, expires)
+
+    def _get_holder_expires(self, blob, lease_seconds):
+        if blob.metadata and 'expires' in blob.metadata:
+            if blob.metadata['expires'] == '':
+                return None
+            return float(blob.metadata['expires'])
+        # Lock files created by earlier versions expire a period after
+        # their creation
+        if lease_seconds:
+            return blob.time_created.timestamp() + lease_seconds
+        return None
+
+    def acquire(self, name, lease_seconds=None):
+        from google.api_core.exceptions import PreconditionFailed
+
+        try:
+            return self._upload(name, _get_expires(lease_seconds), 0)
+        except PreconditionFailed:
+            pass
+
+        blob = get_storage_client().bucket(self.bucket).get_blob(name)
+        if not blob:
+            # Released in the meantime, retry the next time
+            return Lease(name, False)
+        holder_expires = self._get_holder_expires(blob, lease_seconds)
+        if holder_expires is None or time.time() < holder_expires:
+            return Lease(name, False, expires=holder_expires)
+
+        # Take over the expired lock, unless someone else does it first
+        try:
+            return self._upload(name, _get_expires(lease_seconds),
+                                blob.generation)
+        except PreconditionFailed:
+            return Lease(name, False)
+
+    def renew(self, lease, lease_seconds):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        blob = get_storage_client().bucket(self.bucket).blob(lease.name)
+        expires = _get_expires(lease_seconds)
+        blob.metadata = {'expires': str(expires)}
+        try:
+            blob.patch(if_generation_match=lease.token)
+        except (NotFound, PreconditionFailed):
+            return False
+        lease.expires = expires
+        return True
+
+    def release(self, lease):
+        from google.api_core.exceptions import NotFound, PreconditionFailed
+
+        blob = get_storage_client().bucket(self.bucket).blob(lease.name)
+        try:
+            blob.delete(if_generation_match=lease.token)
+        except (NotFound, PreconditionFailed):
+            return False
+        return True
+
+
+class MemoryLockBackend(LockBackend):
+    """Keeps locks in process memory, for single instance deployments and
+    testing."""
+
+    _locks = {}
+    _token = 0
+    _lock = threading.Lock()
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.name = 'memory'
+
+    def acquire(self, name, lease_seconds=None):
+        with self._lock:
+            if name in self._locks:
+                token, expires = self._locks[name]
+                if expires is None or time.time() < expires:
+                    return Lease(name, False, expires=expires)
+            MemoryLockBackend._token += 1
+            expires = _get_expires(lease_seconds)
+            self._locks[name] = (MemoryLockBackend._token, expires)
+            return Lease(name, True, MemoryLockBackend._token, expires)
+
+    def _get_token(self, name):
+        return self._locks[name][0] if name in self._locks else None
+
+    def renew(self, lease, lease_seconds):
+        with self._lock:
+            if self._get_token(lease.name) != lease.token:
+                return False
+            lease.expires = _get_expires(lease_seconds)
+            self._locks[lease.name] = (lease.token, lease.expires)
+            return True
+
+    def release(self, lease):
+        with self._lock:
+            if self._get_token(lease.name) != lease.token:
+                return False
+            del self._locks[lease.name]
+            return True
+
+
+LOCK_BACKENDS = {
+    'gcs': GcsLockBackend,
+    'memory': MemoryLockBackend,
+}
+
+
+def get_lock_backend(config):
+    """Returns the lock backend for a concurrency configuration.
+
+    The backend is set with the `backend` key: `gcs` (default), `memory` or
+    the import path of a LockBackend subclass (eg. `mymodule.RedisBackend`).
+    """
+    backend = config['backend'] if 'backend' in config else 'gcs'
+    if backend in LOCK_BACKENDS:
+        return LOCK_BACKENDS[backend](config)
+    if '.' in backend:
+        module_name, class_name = backend.rsplit('.', 1)
+        try:
+            backend_class = getattr(importlib.import_module(module_name),
+                                    class_name)
+        except (ImportError, AttributeError) as exc:
+            raise UnknownLockBackendException(
+                'Unable to load lock backend %s: %s' % (backend, str(exc)))
+        return backend_class(config)
+    raise UnknownLockBackendException('Unknown lock backend: %s' % (backend))
+
+
+class DistributedLock:
+    """A lock with an optional lease, which is renewed in the background
+    while the lock is held.
+
+    Args:
+        backend (LockBackend): Backend storing the lock.
+        name (str): Name of the lock.
+        lease_seconds (float): Lease duration, None if the lock should be
+          held until released.
+        heartbeat (bool): Renew the lease in the background (every third of
+          the lease duration) until the lock is released.
+    """
+
+    def __init__(self, backend, name, lease_seconds=None, heartbeat=True):
+        self.backend = backend
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.heartbeat = heartbeat and lease_seconds
+        self.lease = None
+        self.logger = logging.getLogger('pubsub2inbox')
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def token(self):
+        return self.lease.token if self.lease and self.lease.acquired else None
+
+    def acquire(self):
+        self.lease = self.backend.acquire(self.name, self.lease_seconds)
+        LOCK_ACQUISITIONS.inc(
+            result='acquired' if self.lease.acquired else 'contended')
+        if self.lease.acquired and self.heartbeat:
+            self._thread = threading.Thread(target=self._renew_lease,
+                                            daemon=True)
+            self._thread.start()
+        return self.lease.acquired
+
+    def _renew_lease(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            try:
+                if not self.backend.renew(self.lease, self.lease_seconds):
+                    LOCK_LEASES_LOST.inc()
+                    self.logger.warning('Lost concurrency lock %s.' %
+                                        (self.name),
+                                        extra={'token': self.lease.token})
+                    return
+            except Exception as exc:
+                self.logger.warning('Failed to renew concurrency lock %s.' %
+                                    (self.name),
+                                    extra={'exception': exc})
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def release(self):
+        self.stop_heartbeat()
+        if self.lease and self.lease.acquired:
+            if not self.backend.release(self.lease):
+                self.logger.warning(
+                    'Concurrency lock %s was taken over before release.' %
+                    (self.name),
+                    extra={'token': self.lease.token})
+            self.lease.acquired = False
+
+    def get_retry_after(self, retry_delay=DEFAULT_RETRY_DELAY):
+        """Returns a jittered delay (in seconds) after which acquiring the
+        lock should be retried, based on when the current lease expires."""
+        delay = retry_delay
+        if self.lease and not self.lease.acquired and self.lease.expires:
+            delay = max(self.lease.expires - time.time(), 1)
+        return min(random.uniform(delay / 2, delay * 1.5), MAX_RETRY_DELAY)
@@ -0,0 +1,376 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import abc
+import os
+import time
+import bisect
+import threading
+import contextvars
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from helpers.tracing import client_span, set_response_status
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+TEMPLATE_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+DEFAULT_METRICS_LOG_INTERVAL = 300
+
+# Handler (processor or output) of the pipeline task currently running, API
+# calls and template renders are attributed to it
+current_handler = contextvars.ContextVar('pubsub2inbox_handler', default='')
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"',
+                                                    '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (k, _escape(v)) for k, v in labels))
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(abc.ABC):
+    """Base class for metrics, which are kept per combination of label
+    values.
+
+    Args:
+        name (str): Metric name (eg. pubsub2inbox_messages_total).
+        description (str): Help text.
+        labels (list): Label names.
+    """
+
+    metric_type = None
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, '')) for label in self.labels)
+
+    def clear(self):
+        with self._lock:
+            self._series.clear()
+
+    @abc.abstractmethod
+    def collect(self):
+        """Returns the samples of the metric as (suffix, labels, value)
+        tuples."""
+
+    @abc.abstractmethod
+    def summarize(self):
+        """Returns the metric as a dictionary for log summaries."""
+
+    def _summary_key(self, key):
+        return ','.join(
+            '%s=%s' % (label, value) for label, value in zip(self.labels, key))
+
+
+class Counter(Metric):
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def get(self, **labels):
+        with self._lock:
+            return self._series.get(self._key(labels), 0)
+
+    def collect(self):
+        with self._lock:
+            return [('', list(zip(self.labels, key)), value)
+                    for key, value in self._series.items()]
+
+    def summarize(self):
+        with self._lock:
+            return {
+                self._summary_key(key): value
+                for key, value in self._series.items()
+            }
+
+
+class Histogram(Metric):
+    metric_type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            if key not in self._series:
+                self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series = self._series[key]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def get(self, **labels):
+        """Returns the (count, sum) of observations."""
+        with self._lock:
+            series = self._series.get(self._key(labels))
+            return (series[2], series[1]) if series else (0, 0.0)
+
+    def collect(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._series.items():
+                labels = list(zip(self.labels, key))
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                               counts):
+                    cumulative += bucket_count
+                    samples.append(
+                        ('_bucket', labels + [('le', _format_value(bound))],
+                         cumulative))
+                samples.append(('_sum', labels, total))
+                samples.append(('_count', labels, count))
+        return samples
+
+    def summarize(self):
+        with self._lock:
+            return {
+                self._summary_key(key): {
+                    'count': count,
+                    'sum': round(total, 6),
+                    'mean': round(total / count, 6) if count else 0.0,
+                } for key, (counts, total, count) in self._series.items()
+            }
+
+
+class MetricsRegistry:
+    """Process-wide collection of metrics, rendered in the Prometheus text
+    exposition format."""
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self.metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector):
+        """Registers a function returning additional metrics (eg. cache
+        sizes) as (name, type, description, [(labels, value)]) tuples, called
+        whenever metrics are rendered."""
+        with self._lock:
+            self.collectors.append(collector)
+
+    def _collected(self):
+        collected = []
+        for collector in list(self.collectors):
+            collected.extend(collector())
+        return collected
+
+    def render(self):
+        lines = []
+        for metric in list(self.metrics):
+            samples = metric.collect()
+            if not samples:
+                continue
+            lines.append('# HELP %s %s' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s' % (metric.name, metric.metric_type))
+            for suffix, labels, value in samples:
+                lines.append('%s%s%s %s' %
+                             (metric.name, suffix, _format_labels(labels),
+                              _format_value(value)))
+        for name, metric_type, description, samples in self._collected():
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for labels, value in samples:
+                lines.append('%s%s %s' %
+                             (name, _format_labels(list(
+                                 labels.items())), _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+    def summarize(self):
+        summary = {}
+        for metric in list(self.metrics):
+            metric_summary = metric.summarize()
+            if metric_summary:
+                summary[metric.name] = metric_summary
+        for name, metric_type, description, samples in self._collected():
+            summary[name] = {
+                ','.join('%s=%s' % (k, v) for k, v in labels.items()):
+                    value for labels, value in samples
+            }
+        return summary
+
+    def clear(self):
+        for metric in list(self.metrics):
+            metric.clear()
+
+
+_REGISTRY = MetricsRegistry()
+
+
+def get_metrics_registry():
+    return _REGISTRY
+
+
+MESSAGES = _REGISTRY.register(
+    Counter('pubsub2inbox_messages_total', 'Messages handled, by outcome.',
+            ['outcome']))
+MESSAGE_DURATION = _REGISTRY.register(
+    Histogram('pubsub2inbox_message_duration_seconds',
+              'Time spent processing a message, by outcome.', ['outcome']))
+TASK_DURATION = _REGISTRY.register(
+    Histogram('pubsub2inbox_task_duration_seconds',
+              'Time spent running a pipeline task.',
+              ['task', 'type', 'handler', 'status']))
+TEMPLATE_RENDER_DURATION = _REGISTRY.register(
+    Histogram('pubsub2inbox_template_render_seconds',
+              'Time spent rendering Jinja templates.', ['handler', 'template'],
+              buckets=TEMPLATE_BUCKETS))
+API_REQUESTS = _REGISTRY.register(
+    Counter('pubsub2inbox_api_requests_total',
+            'HTTP requests made to Google APIs, by handler and API.',
+            ['handler', 'api', 'code']))
+API_REQUEST_DURATION = _REGISTRY.register(
+    Histogram('pubsub2inbox_api_request_duration_seconds',
+              'Latency of HTTP requests made to Google APIs.',
+              ['handler', 'api']))
+DEDUP_CHECKS = _REGISTRY.register(
+    Counter('pubsub2inbox_dedup_checks_total',
+            'Deduplication (ignoreOn) checks, by result.', ['result']))
+LOCK_ACQUISITIONS = _REGISTRY.register(
+    Counter('pubsub2inbox_lock_acquisitions_total',
+            'Concurrency lock acquisition attempts, by result.', ['result']))
+ACCESS_TOKENS = _REGISTRY.register(
+    Counter(
+        'pubsub2inbox_access_tokens_total',
+        'Service account access token lookups, by result (hit, stale, wait, miss or refresh).',
+        ['result']))
+SMTP_CONNECTIONS = _REGISTRY.register(
+    Counter('pubsub2inbox_smtp_connections_total',
+            'SMTP connections used, by result (new, reused or reconnect).',
+            ['result']))
+LOCK_LEASES_LOST = _REGISTRY.register(
+    Counter('pubsub2inbox_lock_leases_lost_total',
+            'Concurrency lock leases lost while held.'))
+
+
+@contextmanager
+def handler_context(handler):
+    """Attributes API calls and template renders to a handler."""
+    token = current_handler.set(handler)
+    try:
+        yield
+    finally:
+        current_handler.reset(token)
+
+
+def observe_api_request(url, status, duration):
+    labels = {'handler': current_handler.get(), 'api': urlparse(url).netloc}
+    API_REQUESTS.inc(code=status, **labels)
+    API_REQUEST_DURATION.observe(duration, **labels)
+
+
+def instrument_http(http):
+    """Records (and traces) the requests made through an httplib2
+    compatible client (as used by discovery based API clients)."""
+    request_orig = http.request
+
+    def request(uri, method='GET', *args, **kwargs):
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            with client_span(method, uri) as span:
+                response, content = request_orig(uri, method, *args, **kwargs)
+                status = response.status
+                set_response_status(span, status)
+            return response, content
+        finally:
+            observe_api_request(uri, status, time.perf_counter() - start)
+
+    http.request = request
+    return http
+
+
+def instrument_session(session):
+    """Records the requests made through a requests session (as used by
+    the Cloud Storage client)."""
+
+    def on_response(response, *args, **kwargs):
+        observe_api_request(response.url, response.status_code,
+                            response.elapsed.total_seconds())
+
+    session.hooks['response'].append(on_response)
+    return session
+
+
+class MetricsLogger:
+    """Logs a summary of the metrics periodically, for environments where
+    they cannot be scraped (eg. Cloud Functions)."""
+
+    def __init__(self, interval=DEFAULT_METRICS_LOG_INTERVAL):
+        self.interval = interval
+        self.last_logged = time.monotonic()
+        self._lock = threading.Lock()
+
+    def maybe_log(self, logger):
+        if self.interval <= 0:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self.last_logged < self.interval:
+                return False
+            self.last_logged = now
+        logger.info('Metrics summary.',
+                    extra={'metrics': get_metrics_registry().summarize()})
+        return True
+
+
+_METRICS_LOGGER = None
+_METRICS_LOGGER_LOCK = threading.Lock()
+
+
+def get_metrics_logger():
+    global _METRICS_LOGGER
+    if _METRICS_LOGGER is None:
+        with _METRICS_LOGGER_LOCK:
+            if _METRICS_LOGGER is None:
+                interval = DEFAULT_METRICS_LOG_INTERVAL
+                if os.getenv('METRICS_LOG_INTERVAL') and os.getenv(
+                        'METRICS_LOG_INTERVAL') != '':
+                    interval = int(os.getenv('METRICS_LOG_INTERVAL'))
+                _METRICS_LOGGER = MetricsLogger(interval)
+    return _METRICS_LOGGER
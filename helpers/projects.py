@@ -0,0 +1,317 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import json
+import time
+import logging
+import tempfile
+import threading
+from helpers.metrics import get_metrics_registry
+
+DEFAULT_PROJECT_CACHE_TTL = 3600
+DEFAULT_PROJECT_CACHE_NEGATIVE_TTL = 300
+DEFAULT_PROJECT_LIST_THRESHOLD = 50
+DEFAULT_PROJECT_SNAPSHOT_INTERVAL = 60
+PROJECT_SNAPSHOT_VERSION = 1
+
+
+def project_from_response(response):
+    """Returns the (project ID, project number, name, labels) tuple of a
+    Cloud Resource Manager v1 project."""
+    return (response['projectId'], response['projectNumber'], response['name'],
+            response['labels'] if 'labels' in response else {})
+
+
+class ProjectCache:
+    """Process-wide cache of project metadata, keyed by both project ID and
+    project number.
+
+    Entries expire after a TTL and projects that could not be found are
+    cached for a shorter, negative TTL. Misses are resolved with targeted
+    projects.get calls; only when a lookup misses more than list_threshold
+    projects at once are all projects listed instead.
+
+    The cache can be snapshotted to a local file or a Cloud Storage object
+    (gs://bucket/object), so that new instances start warm.
+    """
+
+    def __init__(self,
+                 ttl=DEFAULT_PROJECT_CACHE_TTL,
+                 negative_ttl=DEFAULT_PROJECT_CACHE_NEGATIVE_TTL,
+                 list_threshold=DEFAULT_PROJECT_LIST_THRESHOLD,
+                 snapshot=None,
+                 snapshot_interval=DEFAULT_PROJECT_SNAPSHOT_INTERVAL,
+                 now=time.time):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.list_threshold = list_threshold
+        self.snapshot = snapshot
+        self.snapshot_interval = snapshot_interval
+        self.now = now
+        self.hits = 0
+        self.misses = 0
+        self.logger = logging.getLogger('pubsub2inbox')
+        # key -> (fetched at, project tuple or None)
+        self._entries = {}
+        self._dirty = False
+        self._last_snapshot = 0
+        self._lock = threading.Lock()
+
+    def _get(self, key, now):
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        fetched, project = entry
+        ttl = self.ttl if project is not None else self.negative_ttl
+        if now - fetched >= ttl:
+            del self._entries[key]
+            return False, None
+        return True, project
+
+    def get(self, key):
+        """Returns a (found, project) tuple, project is None for projects
+        known not to exist (or not to be accessible)."""
+        with self._lock:
+            found, project = self._get(str(key), self.now())
+            if found:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return found, project
+
+    def put(self, project, fetched=None):
+        if fetched is None:
+            fetched = self.now()
+        with self._lock:
+            self._entries[project[0]] = (fetched, project)
+            self._entries[str(project[1])] = (fetched, project)
+            self._dirty = True
+
+    def put_missing(self, key):
+        with self._lock:
+            self._entries[str(key)] = (self.now(), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._dirty = False
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+    def fetch(self, service, key):
+        """Fetches a single project (by ID or number) into the cache."""
+        from googleapiclient.errors import HttpError
+
+        try:
+            response = service.projects().get(projectId=key).execute()
+        except HttpError as exc:
+            if exc.resp.status not in [403, 404]:
+                raise
+            self.logger.debug('Project %s not found or not accessible.' % (key),
+                              extra={'status': exc.resp.status})
+            self.put_missing(key)
+            return None
+        project = project_from_response(response)
+        self.put(project)
+        return project
+
+    def fetch_all(self, service):
+        """Lists all accessible projects into the cache."""
+        fetched = self.now()
+        request = service.projects().list()
+        while request:
+            response = request.execute()
+            for p in response.get('projects', []):
+                self.put(project_from_response(p), fetched)
+            request = service.projects().list_next(request, response)
+
+    def get_projects(self, keys, get_service):
+        """Returns the projects for project IDs or numbers, None for
+        projects that do not exist.
+
+        Args:
+            keys (list): Project IDs or numbers.
+            get_service (callable): Returns a Cloud Resource Manager v1
+              discovery client.
+        """
+        projects = {}
+        missing = []
+        for key in keys:
+            found, project = self.get(key)
+            if found:
+                projects[key] = project
+            elif key not in missing:
+                missing.append(key)
+
+        if missing:
+            service = get_service()
+            if self.list_threshold > 0 and len(missing) > self.list_threshold:
+                self.logger.debug(
+                    'Listing all projects to resolve %d missing projects.' %
+                    len(missing))
+                self.fetch_all(service)
+                for key in missing:
+                    found, project = self.get(key)
+                    if not found:
+                        self.put_missing(key)
+                    projects[key] = project
+                self.save_snapshot()
+            else:
+                for key in missing:
+                    projects[key] = self.fetch(service, key)
+                self.maybe_save_snapshot()
+        return [projects[key] for key in keys]
+
+    def _snapshot_blob(self):
+        from helpers.base import get_storage_client
+
+        bucket, blob = self.snapshot[5:].split('/', 1)
+        return get_storage_client().bucket(bucket).blob(blob)
+
+    def load_snapshot(self):
+        """Loads the entries of a snapshot that have not expired yet."""
+        if not self.snapshot:
+            return False
+        try:
+            if self.snapshot.startswith('gs://'):
+                contents = self._snapshot_blob().download_as_bytes()
+            else:
+                with open(self.snapshot, 'rb') as f:
+                    contents = f.read()
+            snapshot = json.loads(contents)
+        except Exception as exc:
+            self.logger.info('Could not load project cache snapshot: %s' %
+                             (exc),
+                             extra={'snapshot': self.snapshot})
+            return False
+        if snapshot.get('version') != PROJECT_SNAPSHOT_VERSION:
+            return False
+
+        now = self.now()
+        with self._lock:
+            for fetched, project in snapshot['projects']:
+                if now - fetched < self.ttl:
+                    project = tuple(project)
+                    self._entries[project[0]] = (fetched, project)
+                    self._entries[str(project[1])] = (fetched, project)
+        self.logger.debug('Loaded project cache snapshot.',
+                          extra={
+                              'snapshot': self.snapshot,
+                              'projects': len(snapshot['projects'])
+                          })
+        return True
+
+    def save_snapshot(self):
+        if not self.snapshot:
+            return False
+        with self._lock:
+            projects = {}
+            for fetched, project in self._entries.values():
+                if project is not None:
+                    projects[project[0]] = [fetched, list(project)]
+            self._dirty = False
+            self._last_snapshot = self.now()
+        contents = json.dumps({
+            'version': PROJECT_SNAPSHOT_VERSION,
+            'projects': list(projects.values())
+        })
+        try:
+            if self.snapshot.startswith('gs://'):
+                self._snapshot_blob().upload_from_string(
+                    contents, content_type='application/json')
+            else:
+                # Write atomically, other instances may be reading it
+                directory = os.path.dirname(os.path.abspath(self.snapshot))
+                with tempfile.NamedTemporaryFile('w',
+                                                 dir=directory,
+                                                 delete=False) as f:
+                    f.write(contents)
+                os.replace(f.name, self.snapshot)
+        except Exception as exc:
+            self.logger.warning('Could not save project cache snapshot: %s' %
+                                (exc),
+                                extra={'snapshot': self.snapshot})
+            return False
+        return True
+
+    def maybe_save_snapshot(self):
+        """Saves a snapshot if the cache has changed and the previous
+        snapshot is older than the snapshot interval."""
+        with self._lock:
+            if not self.snapshot or not self._dirty:
+                return False
+            if self.now() - self._last_snapshot < self.snapshot_interval:
+                return False
+        return self.save_snapshot()
+
+
+_PROJECT_CACHE = None
+_PROJECT_CACHE_LOCK = threading.Lock()
+
+
+def _get_env_int(name, default):
+    if os.getenv(name) and os.getenv(name) != '':
+        return int(os.getenv(name))
+    return default
+
+
+def get_project_cache():
+    global _PROJECT_CACHE
+    if _PROJECT_CACHE is None:
+        with _PROJECT_CACHE_LOCK:
+            if _PROJECT_CACHE is None:
+                snapshot = None
+                if os.getenv('PROJECT_CACHE_SNAPSHOT') and os.getenv(
+                        'PROJECT_CACHE_SNAPSHOT') != '':
+                    snapshot = os.getenv('PROJECT_CACHE_SNAPSHOT')
+                project_cache = ProjectCache(
+                    ttl=_get_env_int('PROJECT_CACHE_TTL',
+                                     DEFAULT_PROJECT_CACHE_TTL),
+                    negative_ttl=_get_env_int(
+                        'PROJECT_CACHE_NEGATIVE_TTL',
+                        DEFAULT_PROJECT_CACHE_NEGATIVE_TTL),
+                    list_threshold=_get_env_int('PROJECT_LIST_THRESHOLD',
+                                                DEFAULT_PROJECT_LIST_THRESHOLD),
+                    snapshot=snapshot,
+                    snapshot_interval=_get_env_int(
+                        'PROJECT_CACHE_SNAPSHOT_INTERVAL',
+                        DEFAULT_PROJECT_SNAPSHOT_INTERVAL))
+                project_cache.load_snapshot()
+                _PROJECT_CACHE = project_cache
+    return _PROJECT_CACHE
+
+
+def _collect_project_cache_metrics():
+    if _PROJECT_CACHE is None:
+        return []
+    stats = _PROJECT_CACHE.stats()
+    return [('pubsub2inbox_project_cache_size', 'gauge',
+             'Entries in the project cache.', [({}, stats['size'])]),
+            ('pubsub2inbox_project_cache_requests_total', 'counter',
+             'Lookups in the project cache, by result.', [({
+                 'result': 'hit'
+             }, stats['hits']), ({
+                 'result': 'miss'
+             }, stats['misses'])])]
+
+
+get_metrics_registry().register_collector(_collect_project_cache_metrics)
@@ -0,0 +1,299 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import time
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from helpers.metrics import get_metrics_registry
+
+DEFAULT_RECIPIENT_CACHE_TTL = 600
+DEFAULT_RECIPIENT_CACHE_SIZE = 10000
+DEFAULT_EXPANSION_CONCURRENCY = 8
+DEFAULT_MAX_RECIPIENTS = 1000
+MEMBERSHIPS_PAGE_SIZE = 1000
+
+RECIPIENT_GROUP = 'group'
+RECIPIENT_USER = 'user'
+RECIPIENT_MISSING = 'missing'
+
+
+class RecipientCache:
+    """Process-wide LRU cache of resolved recipients (groups with their
+    direct members, users and addresses that were not found), expiring
+    after a TTL. Only definitive answers are cached: lookups failing with
+    other errors than 403 or 404 raise and are retried with the message."""
+
+    def __init__(self,
+                 ttl=DEFAULT_RECIPIENT_CACHE_TTL,
+                 max_size=DEFAULT_RECIPIENT_CACHE_SIZE,
+                 now=time.monotonic):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.now = now
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.now() - entry[0] >= self.ttl:
+                del self._entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_size <= 0 or self.ttl <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (self.now(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+            }
+
+
+_RECIPIENT_CACHE = None
+_RECIPIENT_CACHE_LOCK = threading.Lock()
+
+
+def get_recipient_cache():
+    global _RECIPIENT_CACHE
+    if _RECIPIENT_CACHE is None:
+        with _RECIPIENT_CACHE_LOCK:
+            if _RECIPIENT_CACHE is None:
+                ttl = DEFAULT_RECIPIENT_CACHE_TTL
+                if os.getenv('RECIPIENT_CACHE_TTL') and os.getenv(
+                        'RECIPIENT_CACHE_TTL') != '':
+                    ttl = int(os.getenv('RECIPIENT_CACHE_TTL'))
+                _RECIPIENT_CACHE = RecipientCache(ttl)
+    return _RECIPIENT_CACHE
+
+
+def _collect_recipient_cache_metrics():
+    if _RECIPIENT_CACHE is None:
+        return []
+    stats = _RECIPIENT_CACHE.stats()
+    return [('pubsub2inbox_recipient_cache_size', 'gauge',
+             'Entries in the recipient cache.', [({}, stats['size'])]),
+            ('pubsub2inbox_recipient_cache_requests_total', 'counter',
+             'Lookups in the recipient cache, by result.', [({
+                 'result': 'hit'
+             }, stats['hits']), ({
+                 'result': 'miss'
+             }, stats['misses'])])]
+
+
+get_metrics_registry().register_collector(_collect_recipient_cache_metrics)
+
+
+class RecipientExpander:
+    """Expands group recipients into their members using Cloud Identity.
+
+    Addresses are resolved concurrently (groups with groups.lookup and all
+    pages of memberships.list, other addresses with the Directory API's
+    users.get) and the results are cached. Nested groups can be expanded
+    recursively, groups already being expanded are skipped to break cycles.
+
+    Args:
+        get_group_service (callable): Returns a Cloud Identity v1beta1
+          client. Called from worker threads, as discovery clients are not
+          thread-safe.
+        get_user_service (callable): Returns a Directory API client.
+        cache_scope (str): Distinguishes cache entries resolved with
+          different credentials (eg. the service account).
+        max_workers (int): Number of concurrent lookups.
+        max_recipients (int): Maximum number of expanded recipients, 0 for
+          unlimited.
+        nested (bool): Expand members that are groups themselves.
+    """
+
+    def __init__(self,
+                 get_group_service,
+                 get_user_service,
+                 cache_scope=None,
+                 max_workers=DEFAULT_EXPANSION_CONCURRENCY,
+                 max_recipients=DEFAULT_MAX_RECIPIENTS,
+                 nested=False,
+                 cache=None):
+        self.get_group_service = get_group_service
+        self.get_user_service = get_user_service
+        self.cache_scope = cache_scope
+        self.max_workers = max(1, max_workers)
+        self.max_recipients = max_recipients
+        self.nested = nested
+        self.cache = cache if cache is not None else get_recipient_cache()
+        self.logger = logging.getLogger('pubsub2inbox')
+
+    def _lookup_group(self, address):
+        from googleapiclient import errors
+
+        group_service = self.get_group_service()
+        request = group_service.groups().lookup()
+        request.uri += '&groupKey.id=' + address
+        try:
+            response = request.execute()
+        except errors.HttpError as exc:
+            if exc.resp.status in [403, 404]:
+                self.logger.debug('Did not find group %s in Cloud Identity.' %
+                                  (address),
+                                  extra={'response': exc.resp})
+                return None
+            raise exc
+        if not response or 'name' not in response:
+            return None
+
+        members = []
+        request = group_service.groups().memberships().list(
+            parent=response['name'], pageSize=MEMBERSHIPS_PAGE_SIZE)
+        while request is not None:
+            m_response = request.execute()
+            # If memberships doesn't exist, it's probably an empty group
+            for membership in m_response.get('memberships', []):
+                members.append(
+                    (membership['memberKey']['id'], membership.get('type')))
+            request = group_service.groups().memberships().list_next(
+                request, m_response)
+        return members
+
+    def _lookup_user(self, address):
+        from googleapiclient import errors
+
+        try:
+            response = self.get_user_service().users().get(
+                userKey=address).execute()
+        except errors.HttpError as exc:
+            if exc.resp.status in [403, 404]:
+                self.logger.debug('Did not find user %s.' % (address),
+                                  extra={'response': exc.resp})
+                return False
+            # Transient errors (eg. quota or server errors) are not cached
+            raise exc
+        return True if response else False
+
+    def resolve(self, address):
+        """Returns a (kind, members) tuple for an address, where kind is
+        group, user or missing and members lists the direct members of a
+        group as (address, type) tuples."""
+        key = (self.cache_scope, address.lower())
+        resolved = self.cache.get(key)
+        if resolved is not None:
+            return resolved
+
+        members = self._lookup_group(address)
+        if members is not None:
+            resolved = (RECIPIENT_GROUP, members)
+        elif self._lookup_user(address):
+            resolved = (RECIPIENT_USER, None)
+        else:
+            resolved = (RECIPIENT_MISSING, None)
+        self.cache.put(key, resolved)
+        return resolved
+
+    def _resolve_all(self, addresses, executor):
+        if executor is None or len(addresses) < 2:
+            return [self.resolve(address) for address in addresses]
+        return list(
+            executor.map(
+                lambda address: contextvars.copy_context().run(
+                    self.resolve, address), addresses))
+
+    def expand(self, addresses):
+        """Expands addresses, returning (address, kind, recipients) for each
+        address. Recipients are the expanded members of groups, the address
+        itself for users and an empty list for addresses not found."""
+        executor = None
+        if self.max_workers > 1:
+            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        try:
+            results = []
+            for address, (kind, members) in zip(
+                    addresses, self._resolve_all(addresses, executor)):
+                if kind == RECIPIENT_GROUP:
+                    results.append(
+                        (address, kind,
+                         self._expand_members(address, members, executor)))
+                elif kind == RECIPIENT_USER:
+                    results.append((address, kind, [address]))
+                else:
+                    results.append((address, kind, []))
+            return results
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    def _expand_members(self, group, members, executor):
+        if not self.nested:
+            return [member for member, member_type in members]
+
+        recipients = []
+        seen = set([group.lower()])
+        pending = members
+        while pending:
+            groups = []
+            for member, member_type in pending:
+                if member.lower() in seen:
+                    continue
+                seen.add(member.lower())
+                if member_type == 'GROUP':
+                    groups.append(member)
+                else:
+                    recipients.append(member)
+            pending = []
+            for nested_group, (kind, nested_members) in zip(
+                    groups, self._resolve_all(groups, executor)):
+                if kind == RECIPIENT_GROUP:
+                    pending.extend(nested_members)
+                else:
+                    # Not visible to us, let the group deliver the email
+                    recipients.append(nested_group)
+        return recipients
+
+    def limit(self, recipients):
+        """Removes duplicates and applies the recipient limit."""
+        unique = []
+        seen = set()
+        for recipient in recipients:
+            if recipient.lower() not in seen:
+                seen.add(recipient.lower())
+                unique.append(recipient)
+        if self.max_recipients and len(unique) > self.max_recipients:
+            self.logger.warning(
+                'Group expansion produced %d recipients, only sending to the first %d.'
+                % (len(unique), self.max_recipients))
+            unique = unique[0:self.max_recipients]
+        return unique
@@ -0,0 +1,270 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import time
+import socket
+import logging
+import smtplib
+import threading
+from helpers.metrics import SMTP_CONNECTIONS, get_metrics_registry
+
+DEFAULT_SMTP_POOL_SIZE = 4
+DEFAULT_SMTP_POOL_IDLE_TIMEOUT = 60
+# Connections idle for longer than this are checked with NOOP before reuse
+SMTP_NOOP_AFTER = 5
+# Streamed messages are sent in chunks of this size
+SMTP_SEND_BUFFER_SIZE = 65536
+
+# Errors after which a message is retried on a new connection
+SMTP_CONNECTION_ERRORS = (smtplib.SMTPServerDisconnected, ConnectionError,
+                          socket.timeout)
+
+
+def is_connection_error(exc):
+    if isinstance(exc, SMTP_CONNECTION_ERRORS):
+        return True
+    # 421: service not available, closing transmission channel
+    return isinstance(exc,
+                      smtplib.SMTPResponseException) and exc.smtp_code == 421
+
+
+def _quit(server):
+    try:
+        server.quit()
+    except Exception:
+        try:
+            server.close()
+        except Exception:
+            pass
+
+
+def _reset_or_close(server, code):
+    if code == 421:
+        server.close()
+    else:
+        server._rset()
+
+
+def sendmail_file(server, sender, recipients, fileobj):
+    """Like smtplib.SMTP.sendmail(), but streams the message from a binary
+    file object (with CRLF line endings) instead of holding it in memory."""
+    server.ehlo_or_helo_if_needed()
+    options = []
+    if server.does_esmtp and server.has_extn('size'):
+        fileobj.seek(0, os.SEEK_END)
+        options.append('size=%d' % fileobj.tell())
+    fileobj.seek(0)
+
+    code, response = server.mail(sender, options)
+    if code != 250:
+        _reset_or_close(server, code)
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    if isinstance(recipients, str):
+        recipients = [recipients]
+    refused = {}
+    for recipient in recipients:
+        code, response = server.rcpt(recipient)
+        if code not in (250, 251):
+            refused[recipient] = (code, response)
+        if code == 421:
+            server.close()
+            raise smtplib.SMTPRecipientsRefused(refused)
+    if len(refused) == len(recipients):
+        server._rset()
+        raise smtplib.SMTPRecipientsRefused(refused)
+
+    server.putcmd('data')
+    code, response = server.getreply()
+    if code != 354:
+        _reset_or_close(server, code)
+        raise smtplib.SMTPDataError(code, response)
+    buffer = []
+    buffered = 0
+    line = b'\r\n'
+    for line in iter(fileobj.readline, b''):
+        if line.startswith(b'.'):
+            line = b'.' + line
+        if line.endswith(b'\n') and not line.endswith(b'\r\n'):
+            line = line[:-1] + b'\r\n'
+        buffer.append(line)
+        buffered += len(line)
+        if buffered >= SMTP_SEND_BUFFER_SIZE:
+            server.send(b''.join(buffer))
+            buffer = []
+            buffered = 0
+    if not line.endswith(b'\r\n'):
+        buffer.append(b'\r\n')
+    buffer.append(b'.\r\n')
+    server.send(b''.join(buffer))
+    code, response = server.getreply()
+    if code != 250:
+        _reset_or_close(server, code)
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+def _sendmail(server, sender, recipients, message):
+    if isinstance(message, str):
+        return server.sendmail(sender, recipients, message)
+    return sendmail_file(server, sender, recipients, message)
+
+
+class SmtpConnectionPool:
+    """Process-wide pool of authenticated SMTP connections, keyed by
+    transport (host, port, TLS settings and user).
+
+    Connections are returned to the pool after sending and reused by later
+    messages, saving the TLS handshake and authentication. Connections idle
+    for longer than idle_timeout are closed, and connections idle for more
+    than a few seconds are checked with NOOP before they are reused. If a
+    reused connection (or one that has already delivered messages) is closed
+    by the server, the message is retried on a new connection.
+    """
+
+    def __init__(self,
+                 max_size=DEFAULT_SMTP_POOL_SIZE,
+                 idle_timeout=DEFAULT_SMTP_POOL_IDLE_TIMEOUT,
+                 now=time.monotonic):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.now = now
+        self.logger = logging.getLogger('pubsub2inbox')
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def _is_alive(self, server):
+        try:
+            status, message = server.noop()
+            return status == 250
+        except Exception:
+            return False
+
+    def _checkout(self, key):
+        """Returns an idle connection that is still alive, or None."""
+        while True:
+            with self._lock:
+                idle = self._idle.get(key)
+                if not idle:
+                    return None
+                server, last_used = idle.pop()
+            idle_for = self.now() - last_used
+            if idle_for >= self.idle_timeout:
+                _quit(server)
+                continue
+            if idle_for >= SMTP_NOOP_AFTER and not self._is_alive(server):
+                _quit(server)
+                continue
+            return server
+
+    def _checkin(self, key, server):
+        if self.max_size > 0:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_size:
+                    idle.append((server, self.now()))
+                    return
+        _quit(server)
+
+    def send(self, key, connect, messages):
+        """Sends messages over a single (pooled) connection.
+
+        Args:
+            key (tuple): Transport identity.
+            connect (callable): Returns a new connected and authenticated
+              smtplib.SMTP instance.
+            messages (iterable): (sender, recipients, message) tuples, where
+              message is a string or a binary file object that is streamed
+              (see sendmail_file).
+        """
+        server = self._checkout(key)
+        if server is not None:
+            SMTP_CONNECTIONS.inc(result='reused')
+            can_reconnect = True
+        else:
+            server = connect()
+            SMTP_CONNECTIONS.inc(result='new')
+            can_reconnect = False
+
+        try:
+            for sender, recipients, message in messages:
+                try:
+                    _sendmail(server, sender, recipients, message)
+                except Exception as exc:
+                    if not can_reconnect or not is_connection_error(exc):
+                        raise
+                    self.logger.info(
+                        'SMTP connection was closed, reconnecting: %s' % (exc))
+                    _quit(server)
+                    server = None
+                    server = connect()
+                    SMTP_CONNECTIONS.inc(result='reconnect')
+                    _sendmail(server, sender, recipients, message)
+                # A connection that has delivered a message may still be
+                # dropped later (eg. on a per-session message limit)
+                can_reconnect = True
+        except Exception:
+            if server is not None:
+                _quit(server)
+            raise
+        self._checkin(key, server)
+        return True
+
+    def clear(self):
+        with self._lock:
+            idle = [
+                server for servers in self._idle.values()
+                for server, last_used in servers
+            ]
+            self._idle.clear()
+        for server in idle:
+            _quit(server)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': sum(len(servers) for servers in self._idle.values())
+            }
+
+
+_SMTP_POOL = None
+_SMTP_POOL_LOCK = threading.Lock()
+
+
+def get_smtp_pool():
+    global _SMTP_POOL
+    if _SMTP_POOL is None:
+        with _SMTP_POOL_LOCK:
+            if _SMTP_POOL is None:
+                max_size = DEFAULT_SMTP_POOL_SIZE
+                if os.getenv('SMTP_POOL_SIZE') and os.getenv(
+                        'SMTP_POOL_SIZE') != '':
+                    max_size = int(os.getenv('SMTP_POOL_SIZE'))
+                idle_timeout = DEFAULT_SMTP_POOL_IDLE_TIMEOUT
+                if os.getenv('SMTP_POOL_IDLE_TIMEOUT') and os.getenv(
+                        'SMTP_POOL_IDLE_TIMEOUT') != '':
+                    idle_timeout = int(os.getenv('SMTP_POOL_IDLE_TIMEOUT'))
+                _SMTP_POOL = SmtpConnectionPool(max_size, idle_timeout)
+    return _SMTP_POOL
+
+
+def _collect_smtp_pool_metrics():
+    if _SMTP_POOL is None:
+        return []
+    return [('pubsub2inbox_smtp_pool_idle_connections', 'gauge',
+             'Idle connections in the SMTP connection pool.', [
+                 ({}, _SMTP_POOL.stats()['size'])
+             ])]
+
+
+get_metrics_registry().register_collector(_collect_smtp_pool_metrics)
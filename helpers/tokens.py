@@ -0,0 +1,146 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import time
+import threading
+from google.auth import credentials
+from helpers.metrics import ACCESS_TOKENS, get_metrics_registry
+
+DEFAULT_TOKEN_REFRESH_MARGIN = 300
+# Tokens closer than this to expiry are never handed out
+MINIMUM_TOKEN_VALIDITY = 60
+
+
+class AccessTokenCache:
+    """Process-wide cache of access tokens generated for service accounts,
+    keyed by service account and scopes.
+
+    Tokens are refreshed once they are within refresh_margin seconds of
+    expiring. Only one thread refreshes a token at a time: while it does,
+    other threads keep using the current token if it is still valid, or
+    wait for the refreshed one.
+    """
+
+    def __init__(self,
+                 refresh_margin=DEFAULT_TOKEN_REFRESH_MARGIN,
+                 now=time.time):
+        self.refresh_margin = refresh_margin
+        self.now = now
+        self._tokens = {}
+        self._refreshing = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def get_key(service_account, scopes):
+        return (service_account, tuple(sorted(scopes)))
+
+    def get_token(self, key, fetch):
+        """Returns a cached token, or one fetched with fetch() (which returns
+        a (token, expiry timestamp) tuple)."""
+        while True:
+            with self._lock:
+                now = self.now()
+                entry = self._tokens.get(key)
+                if entry and now < entry[1] - self.refresh_margin:
+                    ACCESS_TOKENS.inc(result='hit')
+                    return entry[0]
+                refreshed = self._refreshing.get(key)
+                if refreshed is None:
+                    refreshed = threading.Event()
+                    self._refreshing[key] = refreshed
+                    break
+                if entry and now < entry[1] - MINIMUM_TOKEN_VALIDITY:
+                    ACCESS_TOKENS.inc(result='stale')
+                    return entry[0]
+            ACCESS_TOKENS.inc(result='wait')
+            refreshed.wait()
+
+        ACCESS_TOKENS.inc(result='refresh' if entry else 'miss')
+        try:
+            token, expiry = fetch()
+            with self._lock:
+                self._tokens[key] = (token, expiry)
+            return token
+        finally:
+            with self._lock:
+                del self._refreshing[key]
+            refreshed.set()
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._tokens)}
+
+
+class AccessTokenCredentials(credentials.Credentials):
+    """Credentials for a service account and scopes that take their access
+    token from the token cache on every request.
+
+    As the identity of these credentials does not change when the token is
+    refreshed, API clients built with them can be shared for the life of the
+    process (see ClientRegistry) and keep sending current tokens.
+
+    Args:
+        service_account (str): Service account email.
+        scopes (list): OAuth scopes of the token.
+        fetch (callable): Returns a new (token, expiry timestamp) tuple.
+    """
+
+    def __init__(self, service_account, scopes, fetch):
+        super().__init__()
+        self.service_account_email = service_account
+        self.scopes = list(scopes)
+        self._fetch = fetch
+
+    def refresh(self, request):
+        token_cache = get_token_cache()
+        self.token = token_cache.get_token(
+            token_cache.get_key(self.service_account_email, self.scopes),
+            self._fetch)
+
+    def before_request(self, request, method, url, headers):
+        self.refresh(request)
+        self.apply(headers)
+
+
+_TOKEN_CACHE = None
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def get_token_cache():
+    global _TOKEN_CACHE
+    if _TOKEN_CACHE is None:
+        with _TOKEN_CACHE_LOCK:
+            if _TOKEN_CACHE is None:
+                refresh_margin = DEFAULT_TOKEN_REFRESH_MARGIN
+                if os.getenv('TOKEN_REFRESH_MARGIN') and os.getenv(
+                        'TOKEN_REFRESH_MARGIN') != '':
+                    refresh_margin = int(os.getenv('TOKEN_REFRESH_MARGIN'))
+                _TOKEN_CACHE = AccessTokenCache(refresh_margin)
+    return _TOKEN_CACHE
+
+
+def _collect_token_cache_metrics():
+    if _TOKEN_CACHE is None:
+        return []
+    return [('pubsub2inbox_access_token_cache_size', 'gauge',
+             'Access tokens in the token cache.', [
+                 ({}, _TOKEN_CACHE.stats()['size'])
+             ])]
+
+
+get_metrics_registry().register_collector(_collect_token_cache_metrics)
@@ -0,0 +1,298 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import logging
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+DEFAULT_TRACING_SAMPLE_RATIO = 0.1
+TRACER_NAME = 'pubsub2inbox'
+
+# Message attributes that can carry the W3C trace context of the publisher
+# (the Pub/Sub client libraries use googclient_traceparent)
+TRACE_CONTEXT_ATTRIBUTES = {
+    'googclient_traceparent': 'traceparent',
+    'traceparent': 'traceparent',
+    'tracestate': 'tracestate',
+}
+
+
+class TracingNotAvailableException(Exception):
+    pass
+
+
+class TracingState:
+    """Configured tracer and its provider. The tracer is None when tracing
+    is disabled."""
+
+    def __init__(self, tracer=None, provider=None):
+        self.tracer = tracer
+        self.provider = provider
+
+
+_TRACING = None
+_TRACING_LOCK = threading.Lock()
+_REQUESTS_INSTRUMENTED = False
+
+
+def _get_exporter(exporter):
+    try:
+        if exporter == 'otlp':
+            from opentelemetry.exporter.otlp.proto.grpc.trace_exporter import OTLPSpanExporter
+            return OTLPSpanExporter()
+        if exporter == 'otlp-http':
+            from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+            return OTLPSpanExporter()
+        if exporter == 'console':
+            from opentelemetry.sdk.trace.export import ConsoleSpanExporter
+            return ConsoleSpanExporter()
+    except ImportError as exc:
+        raise TracingNotAvailableException(
+            'Span exporter %s is not installed: %s' % (exporter, exc))
+    raise TracingNotAvailableException('Unknown span exporter: %s' % (exporter))
+
+
+def _create_tracing(exporter=None, sample_ratio=None, span_processor=None):
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor
+        from opentelemetry.sdk.trace.sampling import ParentBased, TraceIdRatioBased
+    except ImportError as exc:
+        raise TracingNotAvailableException(
+            'OpenTelemetry SDK is not installed: %s' % (exc))
+
+    if sample_ratio is None:
+        sample_ratio = DEFAULT_TRACING_SAMPLE_RATIO
+    if span_processor is None:
+        span_processor = BatchSpanProcessor(_get_exporter(exporter))
+
+    resource = Resource.create(
+        {'service.name': os.getenv('K_SERVICE', TRACER_NAME)})
+    provider = TracerProvider(resource=resource,
+                              sampler=ParentBased(
+                                  TraceIdRatioBased(sample_ratio)))
+    provider.add_span_processor(span_processor)
+    _instrument_requests()
+    _instrument_grpc(provider)
+    return TracingState(provider.get_tracer(TRACER_NAME), provider)
+
+
+def setup_tracing(exporter=None, sample_ratio=None, span_processor=None):
+    """Configures tracing of message processing.
+
+    Args:
+        exporter (str): Span exporter (otlp, otlp-http or console). The OTLP
+          exporters are configured through the standard OTEL_EXPORTER_OTLP_*
+          environment variables (eg. OTEL_EXPORTER_OTLP_ENDPOINT).
+        sample_ratio (float): Fraction of messages traced (unless the
+          publisher has already made a sampling decision).
+        span_processor (opentelemetry.sdk.trace.SpanProcessor): Span processor
+          to use instead of batching spans to the exporter.
+
+    Returns:
+        TracingState
+    """
+    global _TRACING
+    tracing = _create_tracing(exporter, sample_ratio, span_processor)
+    with _TRACING_LOCK:
+        if _TRACING is not None and _TRACING.provider is not None:
+            _TRACING.provider.shutdown()
+        _TRACING = tracing
+    return tracing
+
+
+def _create_tracing_from_env():
+    exporter = None
+    if os.getenv('TRACING_EXPORTER') and os.getenv('TRACING_EXPORTER') != '':
+        exporter = os.getenv('TRACING_EXPORTER')
+    if not exporter:
+        return TracingState()
+
+    sample_ratio = None
+    if os.getenv('TRACING_SAMPLE_RATIO') and os.getenv(
+            'TRACING_SAMPLE_RATIO') != '':
+        sample_ratio = float(os.getenv('TRACING_SAMPLE_RATIO'))
+    try:
+        return _create_tracing(exporter, sample_ratio)
+    except TracingNotAvailableException as exc:
+        logging.getLogger('pubsub2inbox').warning('Tracing disabled: %s' %
+                                                  (exc))
+    return TracingState()
+
+
+def get_tracing():
+    """Returns the tracing state, configured from the TRACING_EXPORTER and
+    TRACING_SAMPLE_RATIO environment variables on first use."""
+    global _TRACING
+    if _TRACING is None:
+        with _TRACING_LOCK:
+            if _TRACING is None:
+                _TRACING = _create_tracing_from_env()
+    return _TRACING
+
+
+def shutdown_tracing():
+    """Flushes pending spans and disables tracing."""
+    global _TRACING
+    with _TRACING_LOCK:
+        if _TRACING is not None and _TRACING.provider is not None:
+            _TRACING.provider.shutdown()
+        _TRACING = None
+
+
+def tracing_enabled():
+    return get_tracing().tracer is not None
+
+
+def _get_span_kind(kind):
+    from opentelemetry.trace import SpanKind
+    return getattr(SpanKind, kind.upper())
+
+
+@contextmanager
+def start_span(name, kind='internal', attributes=None, carrier=None):
+    """Starts a span as a child of the current one (or of the trace context
+    found in the carrier). Yields None when tracing is disabled.
+
+    Args:
+        name (str): Span name.
+        kind (str): Span kind (internal, server, client, producer or
+          consumer).
+        attributes (dict): Span attributes.
+        carrier (dict): Propagated W3C trace context (eg. traceparent).
+    """
+    tracer = get_tracing().tracer
+    if tracer is None:
+        yield None
+        return
+
+    parent = None
+    if carrier:
+        from opentelemetry.trace.propagation.tracecontext import TraceContextTextMapPropagator
+        parent = TraceContextTextMapPropagator().extract(carrier)
+    with tracer.start_as_current_span(name,
+                                      context=parent,
+                                      kind=_get_span_kind(kind),
+                                      attributes=attributes) as span:
+        yield span
+
+
+def get_trace_carrier(attributes):
+    """Returns the trace context propagated in Pub/Sub message
+    attributes."""
+    carrier = {}
+    if attributes:
+        for attribute, header in TRACE_CONTEXT_ATTRIBUTES.items():
+            if attribute in attributes and header not in carrier:
+                carrier[header] = attributes[attribute]
+    return carrier
+
+
+@contextmanager
+def message_span(event, context):
+    """Root span of processing a Pub/Sub message."""
+    attributes = {
+        'messaging.system': 'gcp_pubsub',
+        'messaging.operation.type': 'process',
+    }
+    if context is not None and context.event_id:
+        attributes['messaging.message.id'] = context.event_id
+    carrier = None
+    if isinstance(event, dict) and isinstance(event.get('attributes'), dict):
+        carrier = get_trace_carrier(event['attributes'])
+    with start_span('pubsub2inbox process',
+                    kind='consumer',
+                    attributes=attributes,
+                    carrier=carrier) as span:
+        yield span
+
+
+@contextmanager
+def task_span(task_name, task_type, handler):
+    """Span of running a pipeline task (or a legacy processor/output)."""
+    with start_span('%s %s' % (task_type, handler),
+                    attributes={
+                        'pubsub2inbox.task.name': task_name,
+                        'pubsub2inbox.task.type': task_type,
+                        'pubsub2inbox.task.handler': handler,
+                    }) as span:
+        yield span
+
+
+def _sanitize_url(url):
+    parsed = urlparse(url)
+    return '%s://%s%s' % (parsed.scheme, parsed.netloc, parsed.path)
+
+
+@contextmanager
+def client_span(method, url):
+    """Client span of an outgoing HTTP request. Query strings are left out,
+    as they can contain API keys."""
+    parsed = urlparse(url)
+    with start_span('%s %s' % (method, parsed.netloc),
+                    kind='client',
+                    attributes={
+                        'http.request.method': method,
+                        'server.address': parsed.hostname or '',
+                        'url.full': _sanitize_url(url),
+                    }) as span:
+        yield span
+
+
+def set_response_status(span, status):
+    """Records the HTTP status of a client span, marking 4xx and 5xx
+    responses as errors."""
+    if span is None:
+        return
+    span.set_attribute('http.response.status_code', status)
+    if status >= 400:
+        from opentelemetry.trace import Status, StatusCode
+        span.set_status(Status(StatusCode.ERROR))
+
+
+def _instrument_requests():
+    """Wraps requests sessions (used by the Cloud Storage client and by
+    processors and outputs calling REST APIs) in client spans."""
+    global _REQUESTS_INSTRUMENTED
+    if _REQUESTS_INSTRUMENTED:
+        return
+    import requests
+
+    send_orig = requests.Session.send
+
+    def send(self, request, **kwargs):
+        with client_span(request.method, request.url) as span:
+            response = send_orig(self, request, **kwargs)
+            set_response_status(span, response.status_code)
+            return response
+
+    requests.Session.send = send
+    _REQUESTS_INSTRUMENTED = True
+
+
+def _instrument_grpc(provider):
+    """Traces gRPC based Google Cloud clients if the OpenTelemetry gRPC
+    instrumentation is installed."""
+    try:
+        from opentelemetry.instrumentation.grpc import GrpcInstrumentorClient
+    except ImportError:
+        logging.getLogger('pubsub2inbox').debug(
+            'opentelemetry-instrumentation-grpc is not installed, gRPC calls will not be traced.'
+        )
+        return
+    instrumentor = GrpcInstrumentorClient()
+    if not instrumentor.is_instrumented_by_opentelemetry:
+        instrumentor.instrument(tracer_provider=provider)
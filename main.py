@@ -17,6 +17,7 @@ import base64
 import yaml
 import json
 import argparse
+import importlib
 import logging
 import socket
 import hashlib
@@ -24,22 +25,74 @@ from time import mktime
 from datetime import datetime, timezone, timedelta
 import parsedatetime
 from dateutil import parser
-from filters import get_jinja_filters, get_jinja_tests
-from jinja2 import Environment, TemplateError
-from google.cloud import secretmanager, storage
+from filters import LazyFilters, FILTERS, TESTS
+from jinja2 import TemplateError
 from pythonjsonlogger import jsonlogger
 import traceback
-from helpers.base import get_grpc_client_info, Context, BaseHelper
+import threading
+import copy
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from helpers.dedup import get_dedup_backend, check_and_mark, GcsDedupBackend, DEDUP_ELAPSED, DEDUP_NOT_ELAPSED, DEDUP_CACHED, DEDUP_IN_PROGRESS
+from helpers.lock import get_lock_backend, parse_duration, DistributedLock, DEFAULT_RETRY_DELAY
+from helpers.base import get_grpc_client_info, Context, BaseHelper, CachingEnvironment, run_in_executor
+from helpers.metrics import get_metrics_registry, get_metrics_logger, handler_context, MESSAGES, MESSAGE_DURATION, TASK_DURATION
+from helpers.tracing import message_span, task_span
 import random
 import uuid
+import math
+import time
 from functools import partial
-from flask import Response
+from collections import OrderedDict
 
 config_file_name = 'config.yaml'
 execution_count = 0
 configuration = None
 logger = None
 extra_vars = []
+# Guards the module-level state above, as messages may be processed from
+# multiple threads concurrently (webserver threads or pull workers)
+_state_lock = threading.RLock()
+# Set when metrics are served on /metrics, otherwise they are logged
+metrics_endpoint = False
+
+# Message outcomes, for the pubsub2inbox_messages_total metric
+OUTCOME_PROCESSED = 'processed'
+OUTCOME_IGNORED = 'ignored'
+OUTCOME_STOPPED = 'stopped'
+OUTCOME_CONCURRENCY = 'concurrency'
+OUTCOME_DEFERRED = 'deferred'
+OUTCOME_TOO_OLD = 'too_old'
+OUTCOME_FAILED = 'failed'
+
+
+def get_logger():
+    """Returns the shared logger, setting it up on first use."""
+    global logger
+    if not logger:
+        with _state_lock:
+            if not logger:
+                logger = setup_logging()
+    return logger
+
+
+def get_configuration():
+    """Returns the shared configuration, loading it on first use."""
+    global configuration
+    if not configuration:
+        with _state_lock:
+            if not configuration:
+                configuration = load_configuration(config_file_name)
+    return configuration
+
+
+def increment_execution_count():
+    """Increments the execution counter and returns the new value."""
+    global execution_count
+    with _state_lock:
+        execution_count += 1
+        return execution_count
 
 
 def load_configuration(file_name):
@@ -47,6 +100,8 @@ def load_configuration(file_name):
         logger = logging.getLogger('pubsub2inbox')
         secret_manager_url = os.getenv('CONFIG')
         if secret_manager_url.startswith('projects/'):
+            from google.cloud import secretmanager
+
             logger.debug('Loading configuration from Secret Manager: %s' %
                          (secret_manager_url))
             client = secretmanager.SecretManagerServiceClient(
@@ -63,6 +118,9 @@ def load_configuration(file_name):
             configuration = config_file.read()
 
     cfg = yaml.load(configuration, Loader=yaml.SafeLoader)
+    if 'pipeline' in cfg and isinstance(cfg['pipeline'], list):
+        # Validate the pipeline and resolve its tasks at load time
+        get_pipeline_plan(cfg)
     return cfg
 
 
@@ -73,9 +131,11 @@ def get_jinja_escaping(template_name):
 
 
 def get_jinja_environment():
-    env = Environment(autoescape=get_jinja_escaping,
-                      cache_size=0,
-                      extensions=['jinja2.ext.do'])
+    # Compiled templates are shared through the process-wide template cache,
+    # so the environment's own (per-instance) cache is not needed.
+    env = CachingEnvironment(autoescape=get_jinja_escaping,
+                             cache_size=0,
+                             extensions=['jinja2.ext.do'])
     env.globals = {**env.globals, **{'env': os.environ}}
     env.globals['req_random_int'] = random.randrange(0, 9223372036854775807)
     request_uuid = uuid.uuid4()
@@ -92,13 +152,18 @@ def get_jinja_environment():
                 env.globals[v[0]] = json.loads(v[1])
             else:
                 env.globals[v[0]] = v[1]
-    env.filters.update(get_jinja_filters())
-    env.tests.update(get_jinja_tests())
+    # Filter modules are imported when a template first uses them
+    env.filters = LazyFilters(FILTERS, env.filters)
+    env.tests = LazyFilters(TESTS, env.tests)
     return env
 
 
 class ConcurrencyRetryException(Exception):
-    pass
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        # Suggested (jittered) delay in seconds before retrying the message
+        self.retry_after = retry_after
 
 
 class MessageTooOldException(Exception):
@@ -149,6 +214,259 @@ class MalformedMacrosException(Exception):
     pass
 
 
+class MalformedParallelTaskException(Exception):
+    pass
+
+
+_PIPELINE_PLANS = OrderedDict()
+_PIPELINE_PLANS_MAX = 16
+_PIPELINE_PLANS_LOCK = threading.Lock()
+
+# Processor and output classes loaded so far. Handler modules are only
+# imported when a configuration references them.
+_HANDLER_CLASSES = {}
+
+
+def _get_handler_class(package, name, suffix):
+    key = (package, name)
+    if key not in _HANDLER_CLASSES:
+        handler_module = importlib.import_module('%s.%s' % (package, name))
+        _HANDLER_CLASSES[key] = getattr(handler_module,
+                                        '%s%s' % (name.capitalize(), suffix))
+    return _HANDLER_CLASSES[key]
+
+
+def get_processor_class(processor):
+    return _get_handler_class('processors', processor, 'Processor')
+
+
+def get_output_class(output_type):
+    return _get_handler_class('output', output_type, 'Output')
+
+
+def _collect_template_sources(value, sources):
+    if isinstance(value, str):
+        sources.append(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _collect_template_sources(v, sources)
+    elif isinstance(value, list):
+        for v in value:
+            _collect_template_sources(v, sources)
+    return sources
+
+
+class PipelineTask:
+    """A validated pipeline task with its processor or output class resolved.
+
+    Args:
+        task (dict): Task configuration from the pipeline.
+        task_number (int): Position of the task in the pipeline (1-based).
+        task_name (str): Name of the task for error messages.
+        group_number (int): Position of the parallel group in the pipeline,
+          if the task is part of one.
+    """
+
+    def __init__(self, task, task_number, task_name=None, group_number=None):
+        if group_number:
+            self.name = '#%d.%d' % (group_number, task_number)
+        else:
+            self.name = '#%d' % task_number
+        if not task_name:
+            task_name = 'task %s' % self.name
+        if not isinstance(task, dict) or 'type' not in task or not task['type']:
+            raise NoTypeInPipelineException('No type in pipeline %s: %s' %
+                                            (task_name, str(task)))
+
+        type_parts = task['type'].split('.')
+        if len(type_parts) != 2 or not type_parts[0] or not type_parts[
+                1] or type_parts[0] not in ['processor', 'output']:
+            raise NoTypeInPipelineException(
+                'Malformed type in pipeline %s: %s' % (task_name, str(task)))
+
+        self.number = task_number
+        self.type = task['type']
+        self.task_type, self.handler = type_parts
+        self.description = ' "%s" ' % (
+            task['description']) if 'description' in task else ' '
+        self.config = task['config'] if 'config' in task else {}
+        self.ignore_on = task['ignoreOn'] if 'ignoreOn' in task else None
+        self.stop_if = task['stopIf'] if 'stopIf' in task else None
+        self.run_if = task['runIf'] if 'runIf' in task else None
+        self.variables = task[
+            'variables'] if 'variables' in task and task['variables'] else None
+        self.output = task['output'] if 'output' in task else None
+        self.can_fail = True if 'canFail' in task and task['canFail'] else False
+
+        try:
+            if self.task_type == 'processor':
+                self.handler_class = get_processor_class(self.handler)
+            else:
+                self.handler_class = get_output_class(self.handler)
+        except (ImportError, AttributeError) as exc:
+            raise MalformedTypeInPipelineException(
+                'Unknown %s in pipeline %s (%s): %s' %
+                (self.task_type, task_name, self.type, str(exc)))
+
+    def get_template_sources(self):
+        sources = []
+        for template in [self.stop_if, self.run_if]:
+            if isinstance(template, str):
+                sources.append(template)
+        if isinstance(self.output, (str, dict)):
+            _collect_template_sources(self.output, sources)
+        if self.variables:
+            _collect_template_sources(self.variables, sources)
+        return sources
+
+
+class PipelineTaskGroup:
+    """A validated group of pipeline tasks that are run concurrently.
+
+    Child tasks support runIf, variables, output and canFail; their output
+    variables are merged into the template scope in the order of the tasks.
+
+    Args:
+        task (dict): Group configuration from the pipeline.
+        task_number (int): Position of the group in the pipeline (1-based).
+    """
+
+    def __init__(self, task, task_number):
+        task_name = 'task #%d' % task_number
+        if not isinstance(task['parallel'], list) or len(task['parallel']) == 0:
+            raise MalformedParallelTaskException(
+                'Parallel tasks should be a non-empty list in pipeline %s.' %
+                (task_name))
+
+        self.number = task_number
+        self.name = '#%d' % task_number
+        self.type = 'parallel'
+        self.task_type = 'parallel'
+        self.handler = None
+        self.description = ' "%s" ' % (
+            task['description']) if 'description' in task else ' '
+        self.ignore_on = task['ignoreOn'] if 'ignoreOn' in task else None
+        self.stop_if = task['stopIf'] if 'stopIf' in task else None
+        self.run_if = task['runIf'] if 'runIf' in task else None
+        self.variables = task[
+            'variables'] if 'variables' in task and task['variables'] else None
+        self.output = None
+        self.can_fail = False
+        self.max_workers = int(
+            task['maxWorkers']) if 'maxWorkers' in task else len(
+                task['parallel'])
+
+        tasks = []
+        for child_number, child in enumerate(task['parallel'], start=1):
+            child_name = 'task #%d.%d' % (task_number, child_number)
+            if isinstance(child, dict):
+                for unsupported in ['parallel', 'stopIf', 'ignoreOn']:
+                    if unsupported in child:
+                        raise MalformedParallelTaskException(
+                            '%s is not supported in parallel pipeline %s.' %
+                            (unsupported, child_name))
+            tasks.append(
+                PipelineTask(child, child_number, child_name, task_number))
+        self.tasks = tuple(tasks)
+
+    def get_template_sources(self):
+        sources = []
+        for template in [self.stop_if, self.run_if]:
+            if isinstance(template, str):
+                sources.append(template)
+        if self.variables:
+            _collect_template_sources(self.variables, sources)
+        for task in self.tasks:
+            sources.extend(task.get_template_sources())
+        return sources
+
+
+class PipelinePlan:
+    """Validated execution plan of a pipeline configuration.
+
+    The plan is built once per configuration, so that configuration errors
+    surface when the configuration is loaded and the per-message processing
+    only has to execute the already resolved tasks.
+
+    Args:
+        config (dict): The pipeline configuration.
+    """
+
+    def __init__(self, config):
+        if 'pipeline' not in config or not isinstance(config['pipeline'], list):
+            raise NoPipelineConfiguredException('No pipeline configured!')
+        if len(config['pipeline']) == 0:
+            raise NoPipelineConfiguredException('Empty pipeline configured!')
+
+        self.macros = ()
+        if 'macros' in config:
+            if not isinstance(config['macros'], list):
+                raise MalformedMacrosException(
+                    '"macros" in configuration should be a list.')
+            self.macros = tuple(
+                macro['macro'].strip() for macro in config['macros'])
+
+        self.globals = None
+        if 'globals' in config:
+            if not isinstance(config['globals'], dict):
+                raise MalformedGlobalsException(
+                    '"globals" in configuration should be a dictionary.')
+            self.globals = config['globals']
+
+        self.concurrency = config[
+            'concurrency'] if 'concurrency' in config else None
+        self.ignore_on = config['ignoreOn'] if 'ignoreOn' in config else None
+        self.can_fail = True if 'canFail' in config and config[
+            'canFail'] else False
+
+        self.tasks = tuple(
+            PipelineTaskGroup(task, task_number) if isinstance(task, dict) and
+            'parallel' in task else PipelineTask(task, task_number)
+            for task_number, task in enumerate(config['pipeline'], start=1))
+
+        self.on_error = None
+        if 'onError' in config:
+            self.on_error = PipelineTask(config['onError'], 0, 'onError task')
+            if self.on_error.task_type != 'output':
+                raise NoTypeInPipelineException(
+                    'Pipeline onError task has to be an output: %s' %
+                    (self.on_error.type))
+
+    def precompile(self, jinja_environment):
+        """Compiles all pipeline level templates into the template cache."""
+        sources = list(self.macros)
+        if self.globals:
+            _collect_template_sources(self.globals, sources)
+        for task in self.tasks:
+            sources.extend(task.get_template_sources())
+        for source in sources:
+            jinja_environment.precompile(source)
+
+
+def get_pipeline_plan(config):
+    plan_key = id(config)
+    with _PIPELINE_PLANS_LOCK:
+        entry = _PIPELINE_PLANS.get(plan_key)
+        if entry is not None and entry[0] is config:
+            _PIPELINE_PLANS.move_to_end(plan_key)
+            return entry[1]
+
+    # Compiled outside the lock, if another thread got there first its
+    # plan is used instead
+    plan = PipelinePlan(config)
+    plan.precompile(get_jinja_environment())
+    with _PIPELINE_PLANS_LOCK:
+        entry = _PIPELINE_PLANS.get(plan_key)
+        if entry is not None and entry[0] is config:
+            _PIPELINE_PLANS.move_to_end(plan_key)
+            return entry[1]
+        # Keep a reference to the configuration, so its id cannot be reused
+        _PIPELINE_PLANS[plan_key] = (config, plan)
+        while len(_PIPELINE_PLANS) > _PIPELINE_PLANS_MAX:
+            _PIPELINE_PLANS.popitem(last=False)
+    return plan
+
+
 def check_retry_period(config, context, logger):
     # Ignore messages submitted before our retry period
     retry_period = '2 days ago'
@@ -222,10 +540,7 @@ def process_message_legacy(logger, config, data, event, context):
 
             logger.debug('Processing message using input processor: %s' %
                          processor)
-            mod = __import__('processors.%s' % processor)
-            processor_module = getattr(mod, processor)
-            processor_class = getattr(processor_module,
-                                      '%sProcessor' % processor.capitalize())
+            processor_class = get_processor_class(processor)
             if not config_key:
                 config_key = processor_class.get_default_config_key()
 
@@ -237,11 +552,12 @@ def process_message_legacy(logger, config, data, event, context):
                                                  jinja_environment, data, event,
                                                  context)
 
-            if output_var:
-                processor_variables = processor_instance.process(
-                    output_var=output_var)
-            else:
-                processor_variables = processor_instance.process()
+            with task_span('processor', 'processor', processor):
+                if output_var:
+                    processor_variables = processor_instance.process(
+                        output_var=output_var)
+                else:
+                    processor_variables = processor_instance.process()
             template_variables.update(processor_variables)
             jinja_environment.globals = {
                 **jinja_environment.globals,
@@ -255,6 +571,7 @@ def process_message_legacy(logger, config, data, event, context):
         if processif_contents.strip() == '':
             logger.info(
                 'Will not send message because processIf evaluated to empty.')
+            BaseHelper(jinja_environment)._run_success_callbacks()
             return
 
     if 'resendBucket' in config:
@@ -281,50 +598,32 @@ def process_message_legacy(logger, config, data, event, context):
                          'blob': resend_file
                      })
 
-        storage_client = storage.Client(client_info=get_grpc_client_info())
-        bucket = storage_client.bucket(config['resendBucket'])
-        resend_blob = bucket.blob(resend_file)
-        if resend_blob.exists():
-            resend_blob.reload()
-            resend_period = config['resendPeriod']
-            resend_period_parsed = parsedatetime.Calendar(
-                version=parsedatetime.VERSION_CONTEXT_STYLE).parse(
-                    resend_period, sourceTime=resend_blob.time_created)
-            if len(resend_period_parsed) > 1:
-                resend_earliest = datetime.fromtimestamp(
-                    mktime(resend_period_parsed[0]))
-            else:
-                resend_earliest = datetime.fromtimestamp(
-                    mktime(resend_period_parsed))
-
-            if datetime.now() >= resend_earliest:
-                logger.debug('Resending the message now.',
-                             extra={
-                                 'resend_earliest': resend_earliest,
-                                 'blob_time_created': resend_blob.time_created
-                             })
-                resend_blob.upload_from_string('')
-            else:
-                logger.info(
-                    'Can\'t resend the message now, resend period not elapsed.',
-                    extra={
-                        'resend_earliest': resend_earliest,
-                        'blob_time_created': resend_blob.time_created
-                    })
-                return
-        else:
-            try:
-                resend_blob.upload_from_string('', if_generation_match=0)
-            except Exception as exc:
-                # Handle TOCTOU condition
-                if 'conditionNotMet' in str(exc):
-                    logger.warning(
-                        'Message (re)sending already in progress (resend key already exist).',
-                        extra={'exception': exc})
-                    return
-                else:
-                    raise exc
-                return
+        resend_backend = GcsDedupBackend({'bucket': config['resendBucket']})
+        result = check_and_mark(resend_backend,
+                                resend_file,
+                                config['resendPeriod'],
+                                now=datetime.now)
+        if result.status == DEDUP_ELAPSED:
+            logger.debug('Resending the message now.',
+                         extra={
+                             'resend_earliest': result.period_end,
+                             'blob_time_created': result.created
+                         })
+        elif result.status in [DEDUP_NOT_ELAPSED, DEDUP_CACHED]:
+            logger.info(
+                'Can\'t resend the message now, resend period not elapsed.',
+                extra={
+                    'resend_earliest': result.period_end,
+                    'blob_time_created': result.created
+                })
+            context.outcome = OUTCOME_IGNORED
+            return
+        elif result.status == DEDUP_IN_PROGRESS:
+            logger.warning(
+                'Message (re)sending already in progress (resend key already exist).'
+            )
+            context.outcome = OUTCOME_IGNORED
+            return
 
     if 'outputs' in config:
         for output_config in config['outputs']:
@@ -347,15 +646,13 @@ def process_message_legacy(logger, config, data, event, context):
                          output_config['type'])
 
             output_type = output_config['type']
-            mod = __import__('output.%s' % output_type)
-            output_module = getattr(mod, output_type)
-            output_class = getattr(output_module,
-                                   '%sOutput' % output_type.capitalize())
+            output_class = get_output_class(output_type)
             output_instance = output_class(config, output_config,
                                            jinja_environment, data, event,
                                            context)
             try:
-                output_instance.output()
+                with task_span('output', 'output', output_type):
+                    output_instance.output()
             except Exception as exc:
                 if len(config['outputs']) > 1:
                     logger.error('Output processor %s failed, trying next...' %
@@ -371,11 +668,13 @@ def process_message_legacy(logger, config, data, event, context):
 
     else:
         raise NoOutputsConfiguredException('No outputs configured!')
+    BaseHelper(jinja_environment)._run_success_callbacks()
 
 
 def handle_ignore_on(logger, ignore_config, jinja_environment,
                      template_variables):
-    if 'bucket' not in ignore_config:
+    backend = ignore_config['backend'] if 'backend' in ignore_config else 'gcs'
+    if backend == 'gcs' and 'bucket' not in ignore_config:
         raise NoResendConfigException(
             'No Cloud Storage bucket configured, even though ignoreOn is set!')
 
@@ -395,78 +694,52 @@ def handle_ignore_on(logger, ignore_config, jinja_environment,
         resend_key_hash.update(key_contents.encode('utf-8'))
 
     resend_file = resend_key_hash.hexdigest()
-    logger.debug('Checking for ignore object in bucket...',
+    dedup_backend = get_dedup_backend(ignore_config)
+    logger.debug('Checking for ignore marker...',
                  extra={
-                     'bucket': ignore_config['bucket'],
+                     'backend': dedup_backend.name,
                      'blob': resend_file
                  })
 
-    if os.getenv('STORAGE_EMULATOR_HOST'):
-        from google.auth.credentials import AnonymousCredentials
-
-        anon_credentials = AnonymousCredentials()
-        storage_client = storage.Client(
-            client_info=get_grpc_client_info(),
-            client_options={"api_endpoint": os.getenv('STORAGE_EMULATOR_HOST')},
-            credentials=anon_credentials)
-    else:
-        storage_client = storage.Client(client_info=get_grpc_client_info())
-    bucket = storage_client.bucket(ignore_config['bucket'])
-    resend_blob = bucket.blob(resend_file)
-    if resend_blob.exists():
-        resend_blob.reload()
-        resend_period = ignore_config['period']
-        resend_period_parsed = parsedatetime.Calendar(
-            version=parsedatetime.VERSION_CONTEXT_STYLE).parse(
-                resend_period, sourceTime=resend_blob.time_created)
-        if len(resend_period_parsed) > 1:
-            resend_earliest = datetime.fromtimestamp(
-                mktime(resend_period_parsed[0]))
-        else:
-            resend_earliest = datetime.fromtimestamp(
-                mktime(resend_period_parsed))
-
-        if datetime.utcnow() >= resend_earliest:
-            logger.info('Ignore period elapsed, reprocessing the message now.',
-                        extra={
-                            'resend_earliest': resend_earliest,
-                            'blob_time_created': resend_blob.time_created
-                        })
-            resend_blob.upload_from_string('')
-        else:
-            logger.info(
-                'Ignore period not elapsed, not reprocessing the message.',
-                extra={
-                    'resend_earliest': resend_earliest,
-                    'blob_time_created': resend_blob.time_created
-                })
-            return False
-    else:
-        try:
-            resend_blob.upload_from_string('', if_generation_match=0)
-        except Exception as exc:
-            # Handle TOCTOU condition
-            if 'conditionNotMet' in str(exc):
-                logger.warning(
-                    'Message processing already in progress (message ignore key already exist).',
-                    extra={'exception': exc})
-                return False
-            else:
-                raise exc
-    return True
+    result = check_and_mark(dedup_backend, resend_file, ignore_config['period'])
+    if result.status == DEDUP_ELAPSED:
+        logger.info('Ignore period elapsed, reprocessing the message now.',
+                    extra={
+                        'resend_earliest': result.period_end,
+                        'blob_time_created': result.created
+                    })
+    elif result.status == DEDUP_NOT_ELAPSED:
+        logger.info('Ignore period not elapsed, not reprocessing the message.',
+                    extra={
+                        'resend_earliest': result.period_end,
+                        'blob_time_created': result.created
+                    })
+    elif result.status == DEDUP_CACHED:
+        logger.info(
+            'Ignore period not elapsed (recently seen), not reprocessing the message.',
+            extra={'resend_earliest': result.period_end})
+    elif result.status == DEDUP_IN_PROGRESS:
+        logger.warning(
+            'Message processing already in progress (message ignore key already exist).'
+        )
+    return result.proceed
 
 
 def get_concurrency_params(concurrency_config, jinja_environment,
                            template_variables):
-    if 'bucket' not in concurrency_config:
+    backend = concurrency_config[
+        'backend'] if 'backend' in concurrency_config else 'gcs'
+    concurrency_bucket = None
+    if 'bucket' in concurrency_config:
+        bucket_template = jinja_environment.from_string(
+            concurrency_config['bucket'])
+        bucket_template.name = 'concurrency'
+        concurrency_bucket = bucket_template.render()
+    elif backend == 'gcs':
         raise NoResendConfigException(
             'No Cloud Storage bucket configured, even though concurrency is set!'
         )
 
-    bucket_template = jinja_environment.from_string(
-        concurrency_config['bucket'])
-    bucket_template.name = 'concurrency'
-    concurrency_bucket = bucket_template.render()
     if 'file' in concurrency_config:
         file_template = jinja_environment.from_string(
             concurrency_config['file'])
@@ -477,111 +750,71 @@ def get_concurrency_params(concurrency_config, jinja_environment,
     return concurrency_bucket, concurrency_file
 
 
-def handle_concurrency_post(logger, concurrency_config, jinja_environment,
-                            template_variables):
-    concurrency_bucket, concurrency_file = get_concurrency_params(
-        concurrency_config, jinja_environment, template_variables)
-    logger.debug('Removing concurrency lock object from bucket...',
+def handle_concurrency_post(logger,
+                            concurrency_config,
+                            jinja_environment,
+                            template_variables,
+                            concurrency_lock=None):
+    if not concurrency_lock:
+        return
+    logger.debug('Releasing concurrency lock...',
                  extra={
-                     'bucket': concurrency_bucket,
-                     'blob': concurrency_file
+                     'backend': concurrency_lock.backend.name,
+                     'lock': concurrency_lock.name,
+                     'token': concurrency_lock.token
                  })
-
-    if os.getenv('STORAGE_EMULATOR_HOST'):
-        from google.auth.credentials import AnonymousCredentials
-
-        anon_credentials = AnonymousCredentials()
-        storage_client = storage.Client(
-            client_info=get_grpc_client_info(),
-            client_options={"api_endpoint": os.getenv('STORAGE_EMULATOR_HOST')},
-            credentials=anon_credentials)
-    else:
-        storage_client = storage.Client(client_info=get_grpc_client_info())
-
-    bucket = storage_client.bucket(concurrency_bucket)
-    concurrency_blob = bucket.blob(concurrency_file)
-    concurrency_blob.delete()
+    concurrency_lock.release()
 
 
 def handle_concurrency_pre(logger, concurrency_config, jinja_environment,
                            template_variables):
+    """Acquires the concurrency lock. Returns the held DistributedLock, or
+    False if the message should not be processed."""
     concurrency_bucket, concurrency_file = get_concurrency_params(
         concurrency_config, jinja_environment, template_variables)
-    logger.debug('Checking if concurrency lock file exists in bucket...',
+    lock_backend = get_lock_backend({
+        **concurrency_config, 'bucket': concurrency_bucket
+    })
+    logger.debug('Acquiring concurrency lock...',
                  extra={
-                     'bucket': concurrency_bucket,
-                     'blob': concurrency_file
+                     'backend': lock_backend.name,
+                     'lock': concurrency_file
                  })
 
-    if os.getenv('STORAGE_EMULATOR_HOST'):
-        from google.auth.credentials import AnonymousCredentials
-
-        anon_credentials = AnonymousCredentials()
-        storage_client = storage.Client(
-            client_info=get_grpc_client_info(),
-            client_options={"api_endpoint": os.getenv('STORAGE_EMULATOR_HOST')},
-            credentials=anon_credentials)
-    else:
-        storage_client = storage.Client(client_info=get_grpc_client_info())
-
-    bucket = storage_client.bucket(concurrency_bucket)
-    concurrency_blob = bucket.blob(concurrency_file)
-    if concurrency_blob.exists():
-        if 'period' in concurrency_config:
-            concurrency_blob.reload()
-            concurrency_period = concurrency_config['period']
-            concurrency_period_parsed = parsedatetime.Calendar(
-                version=parsedatetime.VERSION_CONTEXT_STYLE).parse(
-                    concurrency_period,
-                    sourceTime=concurrency_blob.time_created)
-            if len(concurrency_period_parsed) > 1:
-                concurrency_earliest = datetime.fromtimestamp(
-                    mktime(concurrency_period_parsed[0]))
-            else:
-                concurrency_earliest = datetime.fromtimestamp(
-                    mktime(concurrency_period_parsed))
-
-            if datetime.utcnow() >= concurrency_earliest:
-                logger.info(
-                    'Concurrency lock period elapsed, continuing with message processing.',
-                    extra={
-                        'process_earliest': concurrency_earliest,
-                        'blob_time_created': concurrency_blob.time_created
-                    })
-                concurrency_blob.upload_from_string('')
-                return True
-            else:
-                logger.info(
-                    'Concurrency lock period not elapsed, not processing the message.',
-                    extra={
-                        'process_earliest': concurrency_earliest,
-                        'blob_time_created': concurrency_blob.time_created
-                    })
-        else:
-            logger.info(
-                'Concurrency lock file exists, not processing the message.',
+    # A lease is renewed while the message is being processed, while the
+    # period only limits how long a lock file is valid after its creation
+    lease_seconds = None
+    heartbeat = False
+    if 'lease' in concurrency_config:
+        lease_seconds = parse_duration(concurrency_config['lease'])
+        heartbeat = concurrency_config[
+            'heartbeat'] if 'heartbeat' in concurrency_config else True
+    elif 'period' in concurrency_config:
+        lease_seconds = parse_duration(concurrency_config['period'])
+
+    concurrency_lock = DistributedLock(lock_backend, concurrency_file,
+                                       lease_seconds, heartbeat)
+    if concurrency_lock.acquire():
+        jinja_environment.globals['concurrency_token'] = concurrency_lock.token
+        return concurrency_lock
+
+    holder_expires = datetime.fromtimestamp(
+        concurrency_lock.lease.expires,
+        tz=timezone.utc) if concurrency_lock.lease.expires else None
+    logger.info('Concurrency lock is held, not processing the message.',
                 extra={
-                    'bucket': concurrency_bucket,
-                    'blob': concurrency_file
+                    'backend': lock_backend.name,
+                    'lock': concurrency_file,
+                    'process_earliest': holder_expires
                 })
-        if 'defer' in concurrency_config and concurrency_config['defer']:
-            raise ConcurrencyRetryException(
-                'Failing message processing due to concurrency control, allowing retry.'
-            )
-        return False
-    else:
-        try:
-            concurrency_blob.upload_from_string('', if_generation_match=0)
-        except Exception as exc:
-            # Handle TOCTOU condition
-            if 'conditionNotMet' in str(exc):
-                logger.warning(
-                    'Message processing already in progress (concurrency lock file exists).',
-                    extra={'exception': exc})
-                return False
-            else:
-                raise exc
-    return True
+    if 'defer' in concurrency_config and concurrency_config['defer']:
+        retry_delay = concurrency_config[
+            'retryDelay'] if 'retryDelay' in concurrency_config else DEFAULT_RETRY_DELAY
+        raise ConcurrencyRetryException(
+            'Failing message processing due to concurrency control, allowing retry.',
+            retry_after=concurrency_lock.get_retry_after(
+                parse_duration(retry_delay)))
+    return False
 
 
 def macro_helper(macro_func, *args, **kwargs):
@@ -596,268 +829,501 @@ def macro_helper(macro_func, *args, **kwargs):
         return r
 
 
-def process_message_pipeline(logger,
-                             config,
-                             data,
-                             event,
-                             context,
-                             using_webserver=False):
-    template_variables = {
-        'data': data,
-        'event': event,
-        'context': context,
-        'using_webserver': using_webserver
-    }
-    if len(config['pipeline']) == 0:
-        raise NoPipelineConfiguredException('Empty pipeline configured!')
+class PipelineStep:
+    """Blocking work requested by the pipeline runner (see pipeline_steps).
 
-    jinja_environment = get_jinja_environment()
-    jinja_environment.globals = {
-        **jinja_environment.globals,
-        **template_variables
+    The synchronous executor calls run(), the asyncio executor awaits
+    run_async(), which uses the native coroutine if one is available and
+    otherwise runs the function in the async worker thread pool."""
+
+    def __init__(self, func, async_func=None):
+        self.func = func
+        self.async_func = async_func
+
+    def run(self):
+        return self.func()
+
+    async def run_async(self):
+        if self.async_func:
+            return await self.async_func()
+        return await run_in_executor(self.func)
+
+
+def get_processor_step(processor_instance, output_var=None):
+    if output_var:
+        return PipelineStep(
+            partial(processor_instance.process, output_var=output_var),
+            partial(processor_instance.process_async, output_var=output_var))
+    return PipelineStep(processor_instance.process,
+                        processor_instance.process_async)
+
+
+def get_output_step(output_task, jinja_environment, data, event, context):
+    output_instance = output_task.handler_class(output_task.config,
+                                                output_task.config,
+                                                jinja_environment, data, event,
+                                                context)
+
+    def run_output():
+        output_instance.output()
+        return output_instance
+
+    async def run_output_async():
+        await output_instance.output_async()
+        return output_instance
+
+    return PipelineStep(run_output, run_output_async)
+
+
+def instrument_step(step, task):
+    """Records the duration of a pipeline task in a metric and a span,
+    attributing the API calls and template renders made while it runs to its
+    handler."""
+    labels = {
+        'task': task.name,
+        'type': task.task_type,
+        'handler': task.handler,
     }
 
-    helper = BaseHelper(jinja_environment)
-
-    if 'macros' in config:
-        if not isinstance(config['macros'], list):
-            raise MalformedMacrosException(
-                '"macros" in configuration should be a list.')
-        macros = {}
-        for macro in config['macros']:
-            macro_template = jinja_environment.from_string(
-                macro['macro'].strip())
-            macro_template.name = 'macro'
-            macro_template.render()
-            macro_module = macro_template.module
-
-            for f in dir(macro_module):
-                if not f.startswith("_") and callable(getattr(macro_module, f)):
-                    macro_func = getattr(macro_module, f)
-                    macros[f] = partial(macro_helper, macro_func)
-
-        jinja_environment.globals.update(macros)
-
-    if 'globals' in config:
-        if not isinstance(config['globals'], dict):
-            raise MalformedGlobalsException(
-                '"globals" in configuration should be a dictionary.')
-
-        template_globals = helper._jinja_expand_dict_all(
-            config['globals'], 'globals')
-        jinja_environment.globals = {
-            **jinja_environment.globals,
-            **template_globals
-        }
+    def run():
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            with handler_context(task.handler), task_span(
+                    task.name, task.task_type, task.handler):
+                result = step.func()
+            status = 'ok'
+            return result
+        finally:
+            TASK_DURATION.observe(time.perf_counter() - start,
+                                  status=status,
+                                  **labels)
+
+    async def run_async():
+        start = time.perf_counter()
+        status = 'error'
+        try:
+            with handler_context(task.handler), task_span(
+                    task.name, task.task_type, task.handler):
+                result = await step.async_func()
+            status = 'ok'
+            return result
+        finally:
+            TASK_DURATION.observe(time.perf_counter() - start,
+                                  status=status,
+                                  **labels)
 
-    if 'concurrency' in config:
-        if not handle_concurrency_pre(logger, config['concurrency'],
-                                      jinja_environment, template_variables):
-            return
-    if 'ignoreOn' in config:
-        if not handle_ignore_on(logger, config['ignoreOn'], jinja_environment,
-                                template_variables):
-            return
+    return PipelineStep(run, run_async if step.async_func else None)
 
-    task_number = 1
-    for task in config['pipeline']:
-        if 'type' not in task or not task['type']:
-            raise NoTypeInPipelineException('No type in pipeline task #%d: %s' %
-                                            (task_number, str(task)))
 
-        description = ' '
-        if 'description' in task:
-            description = ' "%s" ' % (task['description'])
+def _run_captured(func):
+    try:
+        return func(), None, None
+    except Exception as exc:
+        return None, exc, traceback.format_exc()
 
-        task_type, task_handler = task['type'].split('.', 2)
-        if not task_type or not task_handler or task_type not in [
-                'processor', 'output'
-        ]:
-            raise NoTypeInPipelineException(
-                'Malformed type in pipeline task #%d: %s' %
-                (task_number, str(task)))
 
-        task_config = {}
-        if 'config' in task:
-            task_config = task['config']
+def run_parallel_steps(steps, max_workers):
+    """Runs pipeline steps in a thread pool, returning a (result, exception,
+    traceback) tuple for each step in order."""
+    with ThreadPoolExecutor(
+            max_workers=min(max_workers, len(steps))) as executor:
+        futures = [
+            executor.submit(contextvars.copy_context().run, _run_captured,
+                            step.run) for step in steps
+        ]
+    return [future.result() for future in futures]
 
-        # Handle resend prevention mechanism
-        if 'ignoreOn' in task:
-            if not handle_ignore_on(logger, task['ignoreOn'], jinja_environment,
-                                    template_variables):
-                return
 
+async def run_parallel_steps_async(steps, max_workers):
+    """Asynchronous variant of run_parallel_steps()."""
+    semaphore = asyncio.Semaphore(max_workers)
+
+    async def run_step(step):
+        async with semaphore:
+            try:
+                return await step.run_async(), None, None
+            except Exception as exc:
+                return None, exc, traceback.format_exc()
+
+    return list(await asyncio.gather(*[run_step(step) for step in steps]))
+
+
+class PipelineRun:
+    """Processing state of a single message going through the pipeline.
+
+    steps() runs the pipeline as a generator: handler calls and other
+    blocking work (including template rendering, like conditions, variables
+    and handler construction) are yielded as PipelineSteps and their results
+    (or exceptions) are sent back by the executor, so the same pipeline
+    logic serves both the synchronous and the asyncio executor without
+    blocking the event loop.
+    """
+
+    def __init__(self, logger, config, data, event, context, using_webserver):
+        self.logger = logger
+        self.data = data
+        self.event = event
+        self.context = context
+        self.template_variables = {
+            'data': data,
+            'event': event,
+            'context': context,
+            'using_webserver': using_webserver
+        }
+        self.plan = get_pipeline_plan(config)
+
+        self.jinja_environment = get_jinja_environment()
+        self.jinja_environment.globals = {
+            **self.jinja_environment.globals,
+            **self.template_variables
+        }
+
+        self.helper = BaseHelper(self.jinja_environment)
+        self.concurrency_lock = None
+
+    def setup_globals(self):
+        plan = self.plan
+        jinja_environment = self.jinja_environment
+        if len(plan.macros) > 0:
+            macros = {}
+            for macro in plan.macros:
+                macro_template = jinja_environment.from_string(macro)
+                macro_template.name = 'macro'
+                macro_template.render()
+                macro_module = macro_template.module
+
+                for f in dir(macro_module):
+                    if not f.startswith("_") and callable(
+                            getattr(macro_module, f)):
+                        macro_func = getattr(macro_module, f)
+                        macros[f] = partial(macro_helper, macro_func)
+
+            jinja_environment.globals.update(macros)
+
+        if plan.globals is not None:
+            template_globals = self.helper._jinja_expand_dict_all(
+                copy.deepcopy(plan.globals), 'globals')
+            jinja_environment.globals = {
+                **jinja_environment.globals,
+                **template_globals
+            }
+
+    def ignore_on(self, ignore_config):
+        return PipelineStep(
+            partial(handle_ignore_on, self.logger, ignore_config,
+                    self.jinja_environment, self.template_variables))
+
+    def concurrency_pre(self):
+        return PipelineStep(
+            partial(handle_concurrency_pre, self.logger, self.plan.concurrency,
+                    self.jinja_environment, self.template_variables))
+
+    def concurrency_post(self):
+        return PipelineStep(
+            partial(handle_concurrency_post, self.logger, self.plan.concurrency,
+                    self.jinja_environment, self.template_variables,
+                    self.concurrency_lock))
+
+    def stop_if(self, task):
         # Handle stop processing mechanism
-        if 'stopIf' in task:
-            stopif_template = jinja_environment.from_string(task['stopIf'])
+        if task.stop_if is not None:
+            stopif_template = self.jinja_environment.from_string(task.stop_if)
             stopif_template.name = 'stopif'
             stopif_contents = stopif_template.render()
             if stopif_contents.strip() != '':
-                jinja_environment.globals['previous_run'] = False
-                logger.info(
-                    'Pipeline task%s#%d (%s) stop-if condition evaluated to true (non-empty), stopping processing.'
-                    % (description, task_number, task['type']))
-                helper._clean_tempdir()
-                return
+                self.jinja_environment.globals['previous_run'] = False
+                self.logger.info(
+                    'Pipeline task%s%s (%s) stop-if condition evaluated to true (non-empty), stopping processing.'
+                    % (task.description, task.name, task.type))
+                return True
+        return False
 
+    def run_if(self, task):
         # Handle conditional execution mechanism
-        if 'runIf' in task:
-            runif_template = jinja_environment.from_string(task['runIf'])
+        if task.run_if is not None:
+            runif_template = self.jinja_environment.from_string(task.run_if)
             runif_template.name = 'runif'
             runif_contents = runif_template.render()
             if runif_contents.strip() == '':
-                jinja_environment.globals['previous_run'] = False
-                logger.info(
-                    'Pipeline task%s#%d (%s) run-if condition evaluated to false (empty), skipping task.'
-                    % (description, task_number, task['type']))
-                task_number += 1
-                continue
+                self.jinja_environment.globals['previous_run'] = False
+                self.logger.info(
+                    'Pipeline task%s%s (%s) run-if condition evaluated to false (empty), skipping task.'
+                    % (task.description, task.name, task.type))
+                return False
+        return True
 
+    def set_variables(self, task):
         # Process task wide variables
-        if 'variables' in task:
-            for k, v in task['variables'].items():
+        if task.variables is not None:
+            helper = self.helper
+            jinja_globals = self.jinja_environment.globals
+            for k, v in copy.deepcopy(task.variables).items():
                 if isinstance(v, dict):
-                    jinja_environment.globals[
-                        k] = helper._jinja_expand_dict_all(v, 'variable')
-                elif isinstance(v, list):
-                    jinja_environment.globals[k] = helper._jinja_expand_list(
+                    jinja_globals[k] = helper._jinja_expand_dict_all(
                         v, 'variable')
+                elif isinstance(v, list):
+                    jinja_globals[k] = helper._jinja_expand_list(v, 'variable')
                 elif isinstance(v, int):
-                    jinja_environment.globals[k] = helper._jinja_expand_int(
-                        v, 'variable')
+                    jinja_globals[k] = helper._jinja_expand_int(v, 'variable')
                 else:
-                    jinja_environment.globals[k] = helper._jinja_expand_string(
+                    jinja_globals[k] = helper._jinja_expand_string(
                         v, 'variable')
 
-        try:
-            # Handle output variable expansion
-            output_var = task['output'] if 'output' in task else None
-            if output_var:
-                if isinstance(output_var, str):
-                    # Expand output variable if it's a Jinja expression
-                    output_var_template = jinja_environment.from_string(
-                        output_var)
+    def get_output_var(self, task):
+        # Handle output variable expansion
+        output_var = task.output
+        if output_var:
+            if isinstance(output_var, str):
+                # Expand output variable if it's a Jinja expression
+                output_var_template = self.jinja_environment.from_string(
+                    output_var)
+                output_var_template.name = 'output'
+                output_var = output_var_template.render()
+            elif isinstance(output_var, dict):
+                new_output_var = {}
+                for k, v in output_var.items():
+                    output_var_template = self.jinja_environment.from_string(v)
                     output_var_template.name = 'output'
-                    output_var = output_var_template.render()
-                elif isinstance(output_var, dict):
-                    new_output_var = {}
-                    for k, v in output_var.items():
-                        output_var_template = jinja_environment.from_string(v)
-                        output_var_template.name = 'output'
-                        new_output_var[k] = output_var_template.render()
-                    output_var = new_output_var
-
-            # Handle the actual work
-            if task_type == 'processor':  # Handle processor
-                processor = task_handler
-                logger.debug(
-                    'Pipeline task%s#%d (%s), running processor: %s' %
-                    (description, task_number, task['type'], processor))
-                mod = __import__('processors.%s' % processor)
-                processor_module = getattr(mod, processor)
-                processor_class = getattr(
-                    processor_module, '%sProcessor' % processor.capitalize())
-
-                processor_instance = processor_class(task_config,
-                                                     jinja_environment, data,
-                                                     event, context)
-                if output_var:
-                    processor_variables = processor_instance.process(
-                        output_var=output_var)
-                else:
-                    processor_variables = processor_instance.process()
-                template_variables.update(processor_variables)
-                template_variables['previous_run'] = True
-                jinja_environment.globals = {
-                    **jinja_environment.globals,
-                    **template_variables
-                }
-            elif task_type == 'output':  # Handle output
-                output_type = task_handler
-                logger.debug(
-                    'Pipeline task%s#%d (%s), running output: %s' %
-                    (description, task_number, task['type'], output_type))
-                mod = __import__('output.%s' % output_type)
-                output_module = getattr(mod, output_type)
-                output_class = getattr(output_module,
-                                       '%sOutput' % output_type.capitalize())
-                output_instance = output_class(task_config, task_config,
-                                               jinja_environment, data, event,
-                                               context)
-                output_instance.output()
-                # HTTP response
-                if output_instance.status_code and output_instance.body:
-                    context.http_response = (output_instance.status_code,
-                                             output_instance.headers,
-                                             output_instance.body)
-                jinja_environment.globals['previous_run'] = True
-        except Exception as exc:
-            jinja_environment.globals['previous_run'] = False
-            if 'canFail' not in task or not task['canFail']:
-
-                # Global output if a task fails
-                if 'onError' in config:
-                    error_task = config['onError']
-                    if 'type' not in error_task or not error_task['type']:
-                        raise NoTypeInPipelineException(
-                            'No type in pipeline onError task')
-
-                    jinja_environment.globals['exception'] = str(exc)
-
-                    error_task_type, error_task_handler = error_task[
-                        'type'].split('.', 2)
-
-                    error_task_config = {}
-                    if 'config' in error_task:
-                        error_task_config = error_task['config']
-
-                    output_type = error_task_handler
-                    logger.debug(
-                        'Pipeline onError task (%s), running output: %s' %
-                        (error_task['type'], output_type))
-                    mod = __import__('output.%s' % output_type)
-                    output_module = getattr(mod, output_type)
-                    output_class = getattr(
-                        output_module, '%sOutput' % output_type.capitalize())
-                    output_instance = output_class(error_task_config,
-                                                   error_task_config,
-                                                   jinja_environment, data,
-                                                   event, context)
-                    output_instance.output()
+                    new_output_var[k] = output_var_template.render()
+                output_var = new_output_var
+        return output_var
+
+    def get_task_step(self, task):
+        output_var = self.get_output_var(task)
+        if task.task_type == 'processor':  # Handle processor
+            self.logger.debug(
+                'Pipeline task%s%s (%s), running processor: %s' %
+                (task.description, task.name, task.type, task.handler))
+            processor_instance = task.handler_class(task.config,
+                                                    self.jinja_environment,
+                                                    self.data, self.event,
+                                                    self.context)
+            return instrument_step(
+                get_processor_step(processor_instance, output_var), task)
+        # Handle output
+        self.logger.debug(
+            'Pipeline task%s%s (%s), running output: %s' %
+            (task.description, task.name, task.type, task.handler))
+        return instrument_step(
+            get_output_step(task, self.jinja_environment, self.data, self.event,
+                            self.context), task)
+
+    def set_result(self, task, result):
+        if task.task_type == 'processor':
+            self.template_variables.update(result)
+            self.template_variables['previous_run'] = True
+            self.jinja_environment.globals = {
+                **self.jinja_environment.globals,
+                **self.template_variables
+            }
+        else:
+            # HTTP response
+            if result.status_code and result.body:
+                self.context.http_response = (result.status_code,
+                                              result.headers, result.body)
+            self.jinja_environment.globals['previous_run'] = True
+
+    def handle_failure(self, task, exc, exc_traceback):
+        """Handles a failed task. Returns True if processing should continue,
+        False if it should stop, or raises the exception."""
+        plan = self.plan
+        self.jinja_environment.globals['previous_run'] = False
+        if task.can_fail:
+            self.logger.warning(
+                'Pipeline task%s%s (%s) failed, but continuing...' %
+                (task.description, task.name, task.type),
+                extra={'exception': exc_traceback})
+            return True
+
+        # Global output if a task fails
+        if plan.on_error is not None:
+            self.jinja_environment.globals['exception'] = str(exc)
+
+            self.logger.debug('Pipeline onError task (%s), running output: %s' %
+                              (plan.on_error.type, plan.on_error.handler))
+            on_error_step = yield PipelineStep(
+                partial(get_output_step, plan.on_error, self.jinja_environment,
+                        self.data, self.event, self.context))
+            yield on_error_step
+
+        self.logger.error(
+            'Pipeline task%s%s (%s) failed, stopping processing.' %
+            (task.description, task.name, task.type),
+            extra={'exception': exc_traceback})
+        if plan.concurrency is not None:
+            yield self.concurrency_post()
+        self.helper._clean_tempdir()
+        if plan.can_fail:
+            self.logger.warn(
+                'Pipeline failed, but it is allowed to fail. Message processed.'
+            )
+            return False
+        raise exc
+
+    def get_parallel_steps(self, group):
+        """Prepares the tasks of a parallel group. Returns the tasks to run,
+        their steps and the outcomes of tasks that failed to start."""
+        tasks = [task for task in group.tasks if self.run_if(task)]
+        for task in tasks:
+            self.set_variables(task)
+
+        outcomes = []
+        steps = []
+        for task in tasks:
+            try:
+                steps.append(self.get_task_step(task))
+                outcomes.append(None)
+            except Exception as exc:
+                outcomes.append((None, exc, traceback.format_exc()))
+        return tasks, steps, outcomes
+
+    def run_parallel(self, group):
+        """Runs the tasks of a parallel group concurrently. Returns True if
+        processing should continue."""
+        tasks, steps, outcomes = yield PipelineStep(
+            partial(self.get_parallel_steps, group))
+        if len(steps) > 0:
+            self.logger.debug(
+                'Pipeline task%s%s (%s), running %d tasks.' %
+                (group.description, group.name, group.type, len(steps)))
+            results = iter((yield PipelineStep(
+                partial(run_parallel_steps, steps, group.max_workers),
+                partial(run_parallel_steps_async, steps, group.max_workers))))
+            outcomes = [
+                outcome if outcome else next(results) for outcome in outcomes
+            ]
+
+        # Merge the results in task order, so the template scope does not
+        # depend on which task finished first
+        failed = None
+        for task, (result, exc, exc_traceback) in zip(tasks, outcomes):
+            if exc is None:
+                self.set_result(task, result)
+            elif task.can_fail:
+                yield from self.handle_failure(task, exc, exc_traceback)
+            elif not failed:
+                failed = (task, exc, exc_traceback)
+        if failed:
+            return (yield from self.handle_failure(*failed))
+        return True
+
+    def steps(self):
+        plan = self.plan
+        if len(plan.macros) > 0 or plan.globals is not None:
+            yield PipelineStep(self.setup_globals)
+
+        if plan.concurrency is not None:
+            self.concurrency_lock = yield self.concurrency_pre()
+            if not self.concurrency_lock:
+                self.context.outcome = OUTCOME_CONCURRENCY
+                return
+        try:
+            yield from self.run_tasks()
+        finally:
+            # Stop renewing the lease even if processing ended without
+            # releasing the lock, so that it eventually expires
+            if self.concurrency_lock:
+                self.concurrency_lock.stop_heartbeat()
+
+    def run_tasks(self):
+        plan = self.plan
+        if plan.ignore_on is not None:
+            if not (yield self.ignore_on(plan.ignore_on)):
+                self.context.outcome = OUTCOME_IGNORED
+                return
 
-                logger.error(
-                    'Pipeline task%s#%d (%s) failed, stopping processing.' %
-                    (description, task_number, task['type']),
-                    extra={'exception': traceback.format_exc()})
-                if 'canFail' in config and config['canFail']:
-                    logger.warn(
-                        'Pipeline failed, but it is allowed to fail. Message processed.'
-                    )
-                    if 'concurrency' in config:
-                        handle_concurrency_post(logger, config['concurrency'],
-                                                jinja_environment,
-                                                template_variables)
-
-                    helper._clean_tempdir()
+        for task in plan.tasks:
+            # Handle resend prevention mechanism
+            if task.ignore_on is not None:
+                if not (yield self.ignore_on(task.ignore_on)):
+                    self.context.outcome = OUTCOME_IGNORED
                     return
-                else:
-                    if 'concurrency' in config:
-                        handle_concurrency_post(logger, config['concurrency'],
-                                                jinja_environment,
-                                                template_variables)
-                    helper._clean_tempdir()
-                    raise exc
-            else:
-                logger.warning(
-                    'Pipeline task%s#%d (%s) failed, but continuing...' %
-                    (description, task_number, task['type']),
-                    extra={'exception': traceback.format_exc()})
 
-        task_number += 1
-    if 'concurrency' in config:
-        handle_concurrency_post(logger, config['concurrency'],
-                                jinja_environment, template_variables)
-    helper._clean_tempdir()
+            if task.stop_if is not None and (yield PipelineStep(
+                    partial(self.stop_if, task))):
+                yield PipelineStep(self.helper._run_success_callbacks)
+                self.helper._clean_tempdir()
+                self.context.outcome = OUTCOME_STOPPED
+                return
+
+            if task.run_if is not None and not (yield PipelineStep(
+                    partial(self.run_if, task))):
+                continue
+
+            if task.variables is not None:
+                yield PipelineStep(partial(self.set_variables, task))
+
+            if task.task_type == 'parallel':
+                if not (yield from self.run_parallel(task)):
+                    return
+                continue
+
+            try:
+                step = yield PipelineStep(partial(self.get_task_step, task))
+                result = yield step
+                self.set_result(task, result)
+            except Exception as exc:
+                if not (yield from self.handle_failure(task, exc,
+                                                       traceback.format_exc())):
+                    return
+
+        yield PipelineStep(self.helper._run_success_callbacks)
+        if plan.concurrency is not None:
+            yield self.concurrency_post()
+        self.helper._clean_tempdir()
+
+
+def pipeline_steps(logger, config, data, event, context, using_webserver):
+    """Returns the generator running the message pipeline (see
+    PipelineRun)."""
+    return PipelineRun(logger, config, data, event, context,
+                       using_webserver).steps()
+
+
+def process_message_pipeline(logger,
+                             config,
+                             data,
+                             event,
+                             context,
+                             using_webserver=False):
+    steps = pipeline_steps(logger, config, data, event, context,
+                           using_webserver)
+    try:
+        step = next(steps)
+        while True:
+            try:
+                result = step.run()
+            except Exception as exc:
+                step = steps.throw(exc)
+            else:
+                step = steps.send(result)
+    except StopIteration:
+        pass
+
+
+async def process_message_pipeline_async(logger,
+                                         config,
+                                         data,
+                                         event,
+                                         context,
+                                         using_webserver=False):
+    """Runs the message pipeline on the asyncio event loop. Handlers with a
+    native process_async()/output_async() are awaited directly, others are
+    run in the async worker thread pool."""
+    steps = pipeline_steps(logger, config, data, event, context,
+                           using_webserver)
+    try:
+        step = next(steps)
+        while True:
+            try:
+                result = await step.run_async()
+            except Exception as exc:
+                step = steps.throw(exc)
+            else:
+                step = steps.send(result)
+    except StopIteration:
+        pass
 
 
 def process_message(config, data, event, context, using_webserver=False):
@@ -872,7 +1338,24 @@ def process_message(config, data, event, context, using_webserver=False):
         process_message_legacy(logger, config, data, event, context)
 
 
-def decode_and_process(logger, config, event, context, using_webserver=False):
+async def process_message_async(config,
+                                data,
+                                event,
+                                context,
+                                using_webserver=False):
+    logger = logging.getLogger('pubsub2inbox')
+
+    check_retry_period(config, context, logger)
+
+    if 'pipeline' in config and isinstance(config['pipeline'], list):
+        await process_message_pipeline_async(logger, config, data, event,
+                                             context, using_webserver)
+    else:
+        await run_in_executor(process_message_legacy, logger, config, data,
+                              event, context)
+
+
+def decode_message(logger, event, context):
     if 'data' not in event:
         raise NoDataFieldException('No data field in Pub/Sub message!')
 
@@ -894,7 +1377,57 @@ def decode_and_process(logger, config, event, context, using_webserver=False):
                      'data': data,
                      'attributes': event['attributes']
                  })
-    process_message(config, data, event, context, using_webserver)
+    return data
+
+
+def get_message_outcome(context, exc=None):
+    if isinstance(exc, MessageTooOldException):
+        return OUTCOME_TOO_OLD
+    if isinstance(exc, ConcurrencyRetryException):
+        return OUTCOME_DEFERRED
+    if exc is not None:
+        return OUTCOME_FAILED
+    outcome = getattr(context, 'outcome', None)
+    return outcome if outcome else OUTCOME_PROCESSED
+
+
+def observe_message(context, start, exc=None, span=None):
+    outcome = get_message_outcome(context, exc)
+    MESSAGES.inc(outcome=outcome)
+    MESSAGE_DURATION.observe(time.perf_counter() - start, outcome=outcome)
+    if span is not None:
+        span.set_attribute('pubsub2inbox.outcome', outcome)
+
+
+def decode_and_process(logger, config, event, context, using_webserver=False):
+    start = time.perf_counter()
+    with message_span(event, context) as span:
+        try:
+            data = decode_message(logger, event, context)
+            process_message(config, data, event, context, using_webserver)
+        except Exception as exc:
+            observe_message(context, start, exc, span)
+            raise
+        observe_message(context, start, span=span)
+    logger.debug('Pub/Sub message processing finished.',
+                 extra={'event_id': context.event_id})
+
+
+async def decode_and_process_async(logger,
+                                   config,
+                                   event,
+                                   context,
+                                   using_webserver=False):
+    start = time.perf_counter()
+    with message_span(event, context) as span:
+        try:
+            data = decode_message(logger, event, context)
+            await process_message_async(config, data, event, context,
+                                        using_webserver)
+        except Exception as exc:
+            observe_message(context, start, exc, span)
+            raise
+        observe_message(context, start, span=span)
     logger.debug('Pub/Sub message processing finished.',
                  extra={'event_id': context.event_id})
 
@@ -912,11 +1445,56 @@ def process_pubsub(event,
          metadata. The `event_id` field contains the Pub/Sub message ID. The
          `timestamp` field contains the publish time.
     """
-    global execution_count, configuration, logger
-    execution_count += 1
+    logger, configuration = prepare_processing(context, using_webserver)
+    try:
+        decode_and_process(logger, configuration, event, context,
+                           using_webserver)
+    except TemplateError as exc:
+        logger.error('Error while evaluating a Jinja2 template!',
+                     extra={
+                         'error_message': exc,
+                         'error': str(exc),
+                     })
+        raise exc
+    except MessageTooOldException as mtoe:
+        if not message_too_old_exception:
+            pass
+        else:
+            raise (mtoe)
+    finally:
+        if not metrics_endpoint:
+            get_metrics_logger().maybe_log(logger)
 
-    if not logger:
-        logger = setup_logging()
+
+async def process_pubsub_async(event,
+                               context,
+                               message_too_old_exception=False,
+                               using_webserver=False):
+    """Asynchronous variant of process_pubsub(), for the asyncio executor."""
+    logger, configuration = prepare_processing(context, using_webserver)
+    try:
+        await decode_and_process_async(logger, configuration, event, context,
+                                       using_webserver)
+    except TemplateError as exc:
+        logger.error('Error while evaluating a Jinja2 template!',
+                     extra={
+                         'error_message': exc,
+                         'error': str(exc),
+                     })
+        raise exc
+    except MessageTooOldException as mtoe:
+        if not message_too_old_exception:
+            pass
+        else:
+            raise (mtoe)
+    finally:
+        if not metrics_endpoint:
+            get_metrics_logger().maybe_log(logger)
+
+
+def prepare_processing(context, using_webserver=False):
+    current_execution = increment_execution_count()
+    logger = get_logger()
     if using_webserver:
         logger.debug('Received an API call.',
                      extra={
@@ -924,7 +1502,7 @@ def process_pubsub(event,
                          'timestamp': context.timestamp,
                          'hostname': socket.gethostname(),
                          'pid': os.getpid(),
-                         'execution_count': execution_count
+                         'execution_count': current_execution
                      })
     else:
         logger.debug('Received a Pub/Sub message.',
@@ -933,27 +1511,11 @@ def process_pubsub(event,
                          'timestamp': context.timestamp,
                          'hostname': socket.gethostname(),
                          'pid': os.getpid(),
-                         'execution_count': execution_count
+                         'execution_count': current_execution
                      })
 
     socket.setdefaulttimeout(10)
-    if not configuration:
-        configuration = load_configuration(config_file_name)
-    try:
-        decode_and_process(logger, configuration, event, context,
-                           using_webserver)
-    except TemplateError as exc:
-        logger.error('Error while evaluating a Jinja2 template!',
-                     extra={
-                         'error_message': exc,
-                         'error': str(exc),
-                     })
-        raise exc
-    except MessageTooOldException as mtoe:
-        if not message_too_old_exception:
-            pass
-        else:
-            raise (mtoe)
+    return logger, get_configuration()
 
 
 def process_pubsub_v2(event, context, message_too_old_exception=False):
@@ -966,10 +1528,7 @@ def process_pubsub_v2(event, context, message_too_old_exception=False):
          metadata. The `event_id` field contains the Pub/Sub message ID. The
          `timestamp` field contains the publish time.
     """
-    global logger
-
-    if not logger:
-        logger = setup_logging()
+    get_logger()
 
     new_context = Context(eventId=context.event_id,
                           timestamp=context.timestamp,
@@ -985,10 +1544,9 @@ def process_pubsub_v2(event, context, message_too_old_exception=False):
 def process_api_v2(request):
     """Function that is triggered by API request for functions V2.
     """
-    global logger
+    from flask import Response
 
-    if not logger:
-        logger = setup_logging()
+    get_logger()
 
     request_headers = json.loads(json.dumps({**request.headers}))
     if 'authorization' in request_headers:
@@ -1026,87 +1584,251 @@ class CloudRunServer:
                 'Falcon is required for web server mode, run: pip install falcon'
             )
 
+    def get_event(self, req, envelope):
+        # Check if this is an API call
+        if req.url[-4:] != '/api':
+            if not isinstance(envelope, dict) or 'message' not in envelope:
+                raise InvalidMessageFormatException(
+                    'Invalid Pub/Sub message format')
+
+            event = {
+                'data':
+                    envelope['message']['data'],
+                'attributes':
+                    envelope['message']['attributes']
+                    if 'attributes' in envelope['message'] else {}
+            }
+            context = Context(eventId=envelope['message']['messageId'],
+                              timestamp=envelope['message']['publishTime'])
+            return event, context, False
+
+        request_headers = req.headers
+        if 'authorization' in request_headers:
+            del request_headers['authorization']
+        event = {
+            'data': base64.b64encode(json.dumps(envelope).encode('utf-8')),
+            'attributes': {
+                'headers': request_headers
+            }
+        }
+        context = Context(
+            timestamp=datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'))
+        return event, context, True
+
+    def get_media_exception(self, req, exc):
+        import falcon
+
+        if isinstance(exc, falcon.MediaNotFoundError):
+            if req.url[-4:] != '/api':
+                return NoMessageReceivedException('No Pub/Sub message received')
+            return NoMessageReceivedException('No request received')
+        return InvalidMessageFormatException('Invalid Pub/Sub JSON')
+
+    def set_response(self, res, context):
+        import falcon
+
+        if context.http_response:
+            res.status = context.http_response[0]
+            res.set_headers(context.http_response[1])
+            res.text = context.http_response[2]
+        else:
+            res.status = falcon.HTTP_200
+            res.text = 'Message processed.'
+
+    def set_error_response(self, res, exc):
+        import falcon
+
+        if isinstance(
+                exc,
+            (NoMessageReceivedException, InvalidMessageFormatException)):
+            # Do not attempt to retry malformed messages
+            logger.error('%s' % (exc),
+                         extra={'exception': traceback.format_exc()})
+            res.status = falcon.HTTP_204
+            res.text = 'Bad Request: %s' % (str(exc))
+        elif isinstance(exc, MessageTooOldException):
+            res.status = falcon.HTTP_202
+            res.text = 'Message ignored: %s' % (exc)
+        elif isinstance(exc, ConcurrencyRetryException):
+            res.status = falcon.HTTP_429
+            if exc.retry_after:
+                res.set_header('Retry-After', str(math.ceil(exc.retry_after)))
+            res.text = 'Message deferred: %s' % (exc)
+        else:
+            traceback.print_exc()
+            res.status = falcon.HTTP_500
+            res.text = 'Internal Server Error: %s' % (exc)
+
     def on_post(self, req, res):
         try:
             import falcon
             res.content_type = falcon.MEDIA_TEXT
 
-            # Check if this is an API call
-            context = None
-            event = None
-            using_webserver = False
-            if req.url[-4:] != '/api':
-                try:
-                    envelope = req.media
-                except falcon.MediaNotFoundError:
-                    raise NoMessageReceivedException(
-                        'No Pub/Sub message received')
-                except falcon.MediaMalformedError:
-                    raise InvalidMessageFormatException('Invalid Pub/Sub JSON')
-
-                if not isinstance(envelope, dict) or 'message' not in envelope:
-                    raise InvalidMessageFormatException(
-                        'Invalid Pub/Sub message format')
-
-                event = {
-                    'data':
-                        envelope['message']['data'],
-                    'attributes':
-                        envelope['message']['attributes']
-                        if 'attributes' in envelope['message'] else {}
-                }
-                context = Context(eventId=envelope['message']['messageId'],
-                                  timestamp=envelope['message']['publishTime'])
-            else:
-                try:
-                    envelope = req.media
-                except falcon.MediaNotFoundError:
-                    raise NoMessageReceivedException('No request received')
-                except falcon.MediaMalformedError:
-                    raise InvalidMessageFormatException('Invalid Pub/Sub JSON')
-                request_headers = req.headers
-                if 'authorization' in request_headers:
-                    del request_headers['authorization']
-                event = {
-                    'data':
-                        base64.b64encode(json.dumps(envelope).encode('utf-8')),
-                    'attributes': {
-                        'headers': request_headers
-                    }
-                }
-                context = Context(
-                    timestamp=datetime.now().strftime('%Y-%m-%dT%H:%M:%SZ'))
-                using_webserver = True
+            try:
+                envelope = req.media
+            except (falcon.MediaNotFoundError,
+                    falcon.MediaMalformedError) as exc:
+                raise self.get_media_exception(req, exc)
+            event, context, using_webserver = self.get_event(req, envelope)
 
             process_pubsub(event,
                            context,
                            message_too_old_exception=True,
                            using_webserver=using_webserver)
-            if context.http_response:
-                res.status = context.http_response[0]
-                res.set_headers(context.http_response[1])
-                res.text = context.http_response[2]
-            else:
-                res.status = falcon.HTTP_200
-                res.text = 'Message processed.'
-        except (NoMessageReceivedException,
-                InvalidMessageFormatException) as me:
-            # Do not attempt to retry malformed messages
-            logger.error('%s' % (me),
-                         extra={'exception': traceback.format_exc()})
-            res.status = falcon.HTTP_204
-            res.text = 'Bad Request: %s' % (str(me))
-        except MessageTooOldException as mtoe:
-            res.status = falcon.HTTP_202
-            res.text = 'Message ignored: %s' % (mtoe)
+            self.set_response(res, context)
         except ImportError:
             logger.error(
                 'Falcon is required for web server mode, run: pip install falcon'
             )
         except Exception as e:
-            traceback.print_exc()
-            res.status = falcon.HTTP_500
-            res.text = 'Internal Server Error: %s' % (e)
+            self.set_error_response(res, e)
+
+
+class MetricsResource:
+    """Serves the metrics in the Prometheus text exposition format."""
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def on_get(self, req, res):
+        res.content_type = self.content_type
+        res.text = get_metrics_registry().render()
+
+
+class AsyncMetricsResource(MetricsResource):
+
+    async def on_get(self, req, res):
+        super().on_get(req, res)
+
+
+class CloudRunAsyncServer(CloudRunServer):
+    """ASGI variant of CloudRunServer, processing messages with the asyncio
+    pipeline executor."""
+
+    async def on_get(self, req, res):
+        super().on_get(req, res)
+
+    async def on_post(self, req, res):
+        try:
+            import falcon
+            res.content_type = falcon.MEDIA_TEXT
+
+            try:
+                envelope = await req.get_media()
+            except (falcon.MediaNotFoundError,
+                    falcon.MediaMalformedError) as exc:
+                raise self.get_media_exception(req, exc)
+            event, context, using_webserver = self.get_event(req, envelope)
+
+            await process_pubsub_async(event,
+                                       context,
+                                       message_too_old_exception=True,
+                                       using_webserver=using_webserver)
+            self.set_response(res, context)
+        except ImportError:
+            logger.error(
+                'Falcon is required for web server mode, run: pip install falcon'
+            )
+        except Exception as e:
+            self.set_error_response(res, e)
+
+
+def process_pulled_message(config, message):
+    """Processes a message received through a streaming pull subscription.
+
+    Messages are acknowledged when processed or too old, and negatively
+    acknowledged (to be redelivered) on concurrency control and other
+    failures, matching the retry semantics of push deliveries.
+
+    Args:
+        config (dict): The loaded configuration.
+        message (google.cloud.pubsub_v1.subscriber.message.Message): The
+          received message.
+    """
+    increment_execution_count()
+    logger = get_logger()
+
+    event = {
+        'data': base64.b64encode(message.data).decode('utf-8'),
+        'attributes': dict(message.attributes) if message.attributes else {}
+    }
+    context = Context(eventId=message.message_id,
+                      timestamp=message.publish_time.isoformat())
+    try:
+        decode_and_process(logger, config, event, context)
+        message.ack()
+    except MessageTooOldException:
+        message.ack()
+    except ConcurrencyRetryException as cre:
+        logger.info('Deferring message processing: %s' % (cre),
+                    extra={
+                        'event_id': context.event_id,
+                        'retry_after': cre.retry_after
+                    })
+        if cre.retry_after:
+            # Keep the message leased for a jittered delay before it is
+            # redelivered, to avoid retry storms on a contended lock
+            timer = threading.Timer(cre.retry_after, message.nack)
+            timer.daemon = True
+            timer.start()
+        else:
+            message.nack()
+    except Exception as exc:
+        logger.error('Failed to process pulled message: %s' % (exc),
+                     extra={
+                         'event_id': context.event_id,
+                         'exception': traceback.format_exc()
+                     })
+        message.nack()
+    get_metrics_logger().maybe_log(logger)
+
+
+def run_pull_worker(subscription,
+                    max_messages=100,
+                    max_workers=10,
+                    timeout=None):
+    """Runs a long-running streaming pull worker on a Pub/Sub subscription.
+
+    Messages are dispatched to a pool of worker threads that share the
+    configuration loaded at startup. Set PUBSUB_EMULATOR_HOST to run against
+    the Pub/Sub emulator.
+
+    Args:
+        subscription (str): Subscription in the format of
+          projects/PROJECT/subscriptions/SUBSCRIPTION.
+        max_messages (int): Maximum number of outstanding (unacknowledged)
+          messages, used for flow control.
+        max_workers (int): Number of worker threads processing messages.
+        timeout (float, optional): Stop pulling after this many seconds.
+    """
+    from concurrent.futures import ThreadPoolExecutor, TimeoutError
+    from google.cloud import pubsub_v1
+
+    logger = get_logger()
+    configuration = get_configuration()
+
+    socket.setdefaulttimeout(10)
+    subscriber = pubsub_v1.SubscriberClient()
+    flow_control = pubsub_v1.types.FlowControl(max_messages=max_messages)
+    scheduler = pubsub_v1.subscriber.scheduler.ThreadScheduler(
+        executor=ThreadPoolExecutor(max_workers=max_workers))
+    streaming_pull = subscriber.subscribe(subscription,
+                                          callback=partial(
+                                              process_pulled_message,
+                                              configuration),
+                                          flow_control=flow_control,
+                                          scheduler=scheduler)
+    logger.info('Listening for messages on subscription.',
+                extra={
+                    'subscription': subscription,
+                    'max_messages': max_messages,
+                    'max_workers': max_workers
+                })
+    with subscriber:
+        try:
+            streaming_pull.result(timeout=timeout)
+        except (TimeoutError, KeyboardInterrupt):
+            streaming_pull.cancel()
+            streaming_pull.result()
 
 
 def setup_logging():
@@ -1123,20 +1845,24 @@ def setup_logging():
 
 
 def run_webserver(run_locally=False):
-    global logger
-    if not logger:
-        logger = setup_logging()
+    global metrics_endpoint
+    logger = get_logger()
     try:
         import falcon
         app = falcon.App()
         server = CloudRunServer()
         app.add_route('/', server)
         app.add_route('/api', server)
+        app.add_route('/metrics', MetricsResource())
+        metrics_endpoint = True
         if run_locally:
             from waitress import serve
             port = 8080 if not os.getenv('PORT') or os.getenv(
                 'PORT') == '' else int(os.getenv('PORT'))
-            serve(app, listen='*:%d' % (port))
+            threads = 8 if not os.getenv('WEBSERVER_THREADS') or os.getenv(
+                'WEBSERVER_THREADS') == '' else int(
+                    os.getenv('WEBSERVER_THREADS'))
+            serve(app, listen='*:%d' % (port), threads=threads)
         return app
     except ImportError:
         logger.error(
@@ -1144,9 +1870,101 @@ def run_webserver(run_locally=False):
         )
 
 
+def run_asgi_webserver():
+    """Returns an ASGI application that processes messages with the asyncio
+    pipeline executor. Serve it with any ASGI server, eg.:
+    WEBSERVER=asgi uvicorn main:app"""
+    global metrics_endpoint
+    logger = get_logger()
+    try:
+        import falcon.asgi
+        app = falcon.asgi.App()
+        server = CloudRunAsyncServer()
+        app.add_route('/', server)
+        app.add_route('/api', server)
+        app.add_route('/metrics', AsyncMetricsResource())
+        metrics_endpoint = True
+        return app
+    except ImportError:
+        logger.error(
+            'Falcon is required for ASGI web server mode, run: pip install falcon'
+        )
+
+
+def prewarm():
+    """Loads the configuration ahead of the first message, importing the
+    processors, outputs and filters it references. Enabled at instance
+    startup by setting PREWARM=1."""
+    logger = get_logger()
+    try:
+        config = get_configuration()
+        # Pipelines have their tasks resolved and templates compiled when
+        # the configuration is loaded
+        if 'pipeline' not in config:
+            for processor in config.get('processors', []):
+                get_processor_class(processor['processor'] if isinstance(
+                    processor, dict) else processor)
+            for output_config in config.get('outputs', []):
+                get_output_class(output_config['type'])
+    except Exception as exc:
+        logger.warning('Failed to pre-warm instance: %s' % (exc),
+                       extra={'exception': traceback.format_exc()})
+        return False
+    logger.debug('Instance pre-warmed.',
+                 extra={'handlers': ['%s.%s' % k for k in _HANDLER_CLASSES]})
+    return True
+
+
+def parse_import_profile(output, max_depth=1):
+    """Parses the output of python -X importtime into a list of
+    (module, cumulative microseconds, self microseconds) tuples, sorted by
+    cumulative time. Only modules nested at most max_depth levels deep are
+    returned."""
+    modules = []
+    for line in output.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[0].strip().isdigit():
+            continue
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth > max_depth:
+            continue
+        modules.append(
+            (name.strip(), int(fields[1].strip()), int(fields[0].strip())))
+    return sorted(modules, key=lambda module: module[1], reverse=True)
+
+
+def print_import_profile(top=30):
+    """Prints where startup time goes: the slowest imports when loading this
+    module and pre-warming it with the current configuration."""
+    import subprocess
+    import sys
+
+    code = 'import main; main.config_file_name = %s; main.prewarm()' % (
+        repr(config_file_name))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                            cwd=os.path.dirname(os.path.abspath(__file__)),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE,
+                            universal_newlines=True)
+    modules = parse_import_profile(result.stderr)
+    total = sum(module[1] for module in parse_import_profile(result.stderr, 0))
+    print('%-60s %12s %12s' % ('module', 'cumulative', 'self'))
+    for name, cumulative, self_time in modules[:top]:
+        print('%-60s %10.1fms %10.1fms' %
+              (name, cumulative / 1000, self_time / 1000))
+    print('%-60s %10.1fms' % ('total', total / 1000))
+
+
 app = None
+if os.getenv('PREWARM') == '1':
+    prewarm()
 if os.getenv('WEBSERVER') == '1':
     app = run_webserver()
+elif os.getenv('WEBSERVER') == 'asgi':
+    app = run_asgi_webserver()
 
 if __name__ == '__main__':
     arg_parser = argparse.ArgumentParser(
@@ -1159,6 +1977,25 @@ if __name__ == '__main__':
     arg_parser.add_argument('--webserver',
                             action='store_true',
                             help='Run the function as a web server')
+    arg_parser.add_argument(
+        '--pull',
+        type=str,
+        help=
+        'Run as a streaming pull worker on a subscription (projects/PROJECT/subscriptions/SUBSCRIPTION)'
+    )
+    arg_parser.add_argument(
+        '--max-messages',
+        type=int,
+        default=100,
+        help='Maximum outstanding messages in pull worker mode')
+    arg_parser.add_argument('--workers',
+                            type=int,
+                            default=10,
+                            help='Number of worker threads in pull worker mode')
+    arg_parser.add_argument(
+        '--import-profile',
+        action='store_true',
+        help='Show which imports take the most time when starting up')
     arg_parser.add_argument('message',
                             type=str,
                             nargs='?',
@@ -1172,7 +2009,13 @@ if __name__ == '__main__':
         config_file_name = args.config
     if args.set:
         extra_vars = args.set
-    if args.webserver or os.getenv('WEBSERVER') == '1':
+    pull_subscription = args.pull if args.pull else os.getenv(
+        'PULL_SUBSCRIPTION')
+    if args.import_profile:
+        print_import_profile()
+    elif pull_subscription:
+        run_pull_worker(pull_subscription, args.max_messages, args.workers)
+    elif args.webserver or os.getenv('WEBSERVER') == '1':
         run_webserver(True)
     else:
         if not args.message:
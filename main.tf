@@ -421,9 +421,9 @@ resource "google_cloudfunctions2_function" "function" {
   service_config {
     service_account_email            = var.create_service_account ? google_service_account.service-account[0].email : var.service_account
     max_instance_count               = var.instance_limits.max_instances
-    max_instance_request_concurrency = 1
+    max_instance_request_concurrency = var.function_concurrency
     available_memory                 = format("%dM", var.available_memory_mb)
-    available_cpu                    = var.available_cpu != null ? var.available_cpu : "0.333"
+    available_cpu                    = var.available_cpu != null ? var.available_cpu : (var.function_concurrency > 1 ? "1" : "0.333")
     timeout_seconds                  = var.function_timeout
     vpc_connector                    = var.vpc_connector
     ingress_settings                 = var.ingress_settings
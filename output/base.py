@@ -12,7 +12,7 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 import abc
-from helpers.base import BaseHelper, Context
+from helpers.base import BaseHelper, Context, run_in_executor
 import copy
 
 
@@ -43,4 +43,10 @@ class Output(BaseHelper):
 
     @abc.abstractmethod
     def output(self):
-        pass
\ No newline at end of file
+        pass
+
+    async def output_async(self):
+        """Asynchronous variant of output(), used by the asyncio pipeline
+        executor. Outputs doing network I/O can override this with a native
+        implementation; by default output() is run in a worker thread."""
+        return await run_in_executor(self.output)
\ No newline at end of file
@@ -12,14 +12,144 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
+from helpers.base import get_client_registry
+import os
 import re
+import json
+import queue
+import base64
+from datetime import datetime, date, timezone
 from google.cloud import bigquery
 
+DEFAULT_STREAM_BATCH_SIZE = 500
+# AppendRows requests are limited to 10 MB
+MAX_STREAM_BATCH_BYTES = 9 * 1024 * 1024
+# Number of append requests sent before waiting for their responses
+DEFAULT_STREAM_INFLIGHT = 4
+# Number of rejected rows that are logged individually
+MAX_LOGGED_ROW_ERRORS = 10
+STREAM_TYPES = ['default', 'committed', 'pending']
+
 
 class InvalidJobOptionException(Exception):
     pass
 
 
+class StreamingWriteException(Exception):
+    pass
+
+
+def _get_proto_types():
+    from google.protobuf import descriptor_pb2
+
+    field = descriptor_pb2.FieldDescriptorProto
+    return {
+        'STRING': field.TYPE_STRING,
+        'BYTES': field.TYPE_BYTES,
+        'INTEGER': field.TYPE_INT64,
+        'INT64': field.TYPE_INT64,
+        'FLOAT': field.TYPE_DOUBLE,
+        'FLOAT64': field.TYPE_DOUBLE,
+        'BOOLEAN': field.TYPE_BOOL,
+        'BOOL': field.TYPE_BOOL,
+        # Microseconds since the epoch
+        'TIMESTAMP': field.TYPE_INT64,
+    }
+
+
+def schema_to_descriptor(schema, name='Row'):
+    """Builds a self-contained protocol buffer descriptor for rows of a
+    BigQuery table schema. Types without a native protocol buffer type
+    (DATE, DATETIME, TIME, NUMERIC, JSON, GEOGRAPHY, ...) are sent as
+    strings."""
+    from google.protobuf import descriptor_pb2
+
+    proto_types = _get_proto_types()
+    descriptor = descriptor_pb2.DescriptorProto(name=name)
+    for number, schema_field in enumerate(schema, start=1):
+        field = descriptor.field.add(name=schema_field.name, number=number)
+        field.label = field.LABEL_REPEATED if schema_field.mode == 'REPEATED' else field.LABEL_OPTIONAL
+        if schema_field.field_type in ['RECORD', 'STRUCT']:
+            nested = schema_to_descriptor(schema_field.fields,
+                                          '%s_%d' % (name, number))
+            descriptor.nested_type.append(nested)
+            field.type = field.TYPE_MESSAGE
+            field.type_name = nested.name
+        else:
+            field.type = proto_types.get(schema_field.field_type,
+                                         field.TYPE_STRING)
+    return descriptor
+
+
+def descriptor_to_class(descriptor):
+    """Returns a message class for a descriptor built by
+    schema_to_descriptor()."""
+    from google.protobuf import descriptor_pb2, descriptor_pool, message_factory
+
+    pool = descriptor_pool.DescriptorPool()
+    file_descriptor = descriptor_pb2.FileDescriptorProto(
+        name='pubsub2inbox_row.proto', package='pubsub2inbox')
+    file_descriptor.message_type.append(descriptor)
+    pool.Add(file_descriptor)
+    return message_factory.GetMessageClass(
+        pool.FindMessageTypeByName('pubsub2inbox.%s' % descriptor.name))
+
+
+def _to_timestamp(value):
+    if isinstance(value, (int, float)):  # Seconds since the epoch
+        return int(value * 1000000)
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp() * 1000000)
+
+
+def _to_field_value(field_type, value):
+    if field_type in ['INTEGER', 'INT64']:
+        return int(value)
+    if field_type in ['FLOAT', 'FLOAT64']:
+        return float(value)
+    if field_type in ['BOOLEAN', 'BOOL']:
+        if isinstance(value, str):
+            return value.lower() in ['true', '1']
+        return bool(value)
+    if field_type == 'BYTES':
+        return base64.b64decode(value) if isinstance(value, str) else value
+    if field_type == 'TIMESTAMP':
+        return _to_timestamp(value)
+    if field_type == 'JSON' and not isinstance(value, str):
+        return json.dumps(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+def row_to_proto(message, schema, row):
+    """Fills a message with the values of a row (a dict in the same format
+    as for insertAll), ignoring columns not in the schema."""
+    for schema_field in schema:
+        value = row.get(schema_field.name)
+        if value is None:
+            continue
+        is_record = schema_field.field_type in ['RECORD', 'STRUCT']
+        if schema_field.mode == 'REPEATED':
+            target = getattr(message, schema_field.name)
+            for item in value:
+                if is_record:
+                    row_to_proto(target.add(), schema_field.fields, item)
+                else:
+                    target.append(_to_field_value(schema_field.field_type,
+                                                  item))
+        elif is_record:
+            row_to_proto(getattr(message, schema_field.name),
+                         schema_field.fields, value)
+        else:
+            setattr(message, schema_field.name,
+                    _to_field_value(schema_field.field_type, value))
+    return message
+
+
 class BigqueryOutput(Output):
     """
     BigQuery output processors can write data into BigQuery tables.
@@ -30,12 +160,204 @@ class BigqueryOutput(Output):
         location (str): Dataset location (eg. "europe-west4")
         job (dict, optional): Job configuration, eg. skipLeadingRows, see: https://cloud.google.com/bigquery/docs/reference/rest/v2/Job#JobConfigurationLoad
         project (str, optional): Google Cloud project to issue BigQuery API calls against.
+        rows (str, optional): Instead of running a load job, stream rows rendered from this template
+          (a JSON list of objects) into the table using the Storage Write API.
+        rowsExpr (str, optional): Expression evaluating to a list or other iterable of rows to stream
+          (eg. a processor variable).
+        streamType (str, optional): Write stream used for streaming: "pending" (all rows are
+          committed atomically at the end, so a redelivered message does not write any row twice),
+          "committed" (rows are visible as soon as their batch is appended) or "default" (the
+          table's shared default stream). Committed and default streams are at-least-once: if the
+          output fails after some batches were appended, the message is retried and those rows
+          are written again. Defaults to "pending".
+        batchSize (int, optional): Number of rows appended per request (defaults to 500).
     """
 
+    def _get_bigquery_client(self, project=None):
+        endpoint = os.getenv('BIGQUERY_EMULATOR_HOST')
+        if endpoint:
+            from google.auth.credentials import AnonymousCredentials
+
+            return bigquery.Client(project=project if project else os.getenv(
+                'GOOGLE_CLOUD_PROJECT', 'emulator'),
+                                   credentials=AnonymousCredentials(),
+                                   client_options={'api_endpoint': endpoint})
+        return bigquery.Client(client_info=self._get_grpc_client_info(),
+                               project=project)
+
+    def _get_write_client(self):
+        """Returns a shared Storage Write API client (honours
+        BIGQUERY_STORAGE_EMULATOR_HOST)."""
+        endpoint = os.getenv('BIGQUERY_STORAGE_EMULATOR_HOST')
+
+        def _create_write_client():
+            from google.cloud import bigquery_storage_v1
+
+            if endpoint:
+                import grpc
+
+                transport_class = bigquery_storage_v1.BigQueryWriteClient.get_transport_class(
+                    'grpc')
+                return bigquery_storage_v1.BigQueryWriteClient(
+                    transport=transport_class(
+                        channel=grpc.insecure_channel(endpoint)))
+            return bigquery_storage_v1.BigQueryWriteClient(
+                client_info=self._get_grpc_client_info())
+
+        return get_client_registry().get_client(('bigquery.write', endpoint),
+                                                _create_write_client)
+
+    def _get_rows(self):
+        if 'rowsExpr' in self.output_config:
+            return self._jinja_expand_expr(self.output_config['rowsExpr'],
+                                           'rows')
+        return json.loads(
+            self._jinja_expand_string(self.output_config['rows'], 'rows'))
+
+    def _get_batches(self, rows, message_class, schema, batch_size):
+        """Yields lists of serialized rows, limited by row count and
+        request size."""
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            serialized = row_to_proto(message_class(), schema,
+                                      row).SerializeToString()
+            if batch and (len(batch) >= batch_size or batch_bytes +
+                          len(serialized) > MAX_STREAM_BATCH_BYTES):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(serialized)
+            batch_bytes += len(serialized)
+        if batch:
+            yield batch
+
+    def stream(self, bigquery_client, table_name):
+        """Appends rows to a table with the Storage Write API, in batches.
+        Rows of batches that are rejected are reported and the output fails
+        at the end (for pending streams, nothing is committed then)."""
+        from google.cloud.bigquery_storage_v1 import types
+
+        stream_type = self._jinja_expand_string(
+            self.output_config['streamType'], 'stream_type').lower(
+            ) if 'streamType' in self.output_config else 'pending'
+        if stream_type not in STREAM_TYPES:
+            raise NotConfiguredException(
+                'Unknown BigQuery stream type %s, use one of: %s' %
+                (stream_type, ', '.join(STREAM_TYPES)))
+        batch_size = self._jinja_expand_int(
+            self.output_config['batchSize'], 'batch_size'
+        ) if 'batchSize' in self.output_config else DEFAULT_STREAM_BATCH_SIZE
+
+        table = bigquery_client.get_table(table_name)
+        table_path = 'projects/%s/datasets/%s/tables/%s' % (
+            table.project, table.dataset_id, table.table_id)
+        descriptor = schema_to_descriptor(table.schema)
+        message_class = descriptor_to_class(descriptor)
+
+        write_client = self._get_write_client()
+        if stream_type == 'default':
+            stream_name = '%s/streams/_default' % (table_path)
+        else:
+            stream_name = write_client.create_write_stream(
+                parent=table_path,
+                write_stream=types.WriteStream(
+                    type_=types.WriteStream.Type.COMMITTED if stream_type ==
+                    'committed' else types.WriteStream.Type.PENDING)).name
+
+        self.logger.info('BigQuery streaming starting...',
+                         extra={
+                             'dataset': table_name,
+                             'stream': stream_name,
+                             'stream_type': stream_type,
+                         })
+        results = {'batches': 0, 'rows': 0, 'failed_batches': 0}
+        row_errors = []
+
+        def check_response(batch_number, batch_rows, response):
+            errors = [(row_error.index, row_error.message)
+                      for row_error in response.row_errors]
+            if response.error.code != 0 and not errors:
+                errors = [(None, response.error.message)]
+            if not errors:
+                results['rows'] += batch_rows
+                return
+            results['failed_batches'] += 1
+            for index, message in errors:
+                if len(row_errors) < MAX_LOGGED_ROW_ERRORS:
+                    self.logger.error('BigQuery rejected row: %s' % (message),
+                                      extra={
+                                          'dataset': table_name,
+                                          'batch': batch_number,
+                                          'row': index
+                                      })
+                row_errors.append(message)
+
+        # Requests are queued from this thread and sent by the gRPC stream,
+        # a few batches are in flight while the next ones are rendered
+        requests = queue.Queue()
+        responses = None
+        pending = []
+        try:
+            for batch in self._get_batches(self._get_rows(), message_class,
+                                           table.schema, batch_size):
+                request = types.AppendRowsRequest(
+                    proto_rows=types.AppendRowsRequest.ProtoData(
+                        rows=types.ProtoRows(serialized_rows=batch)))
+                if responses is None:
+                    # The first request sets the stream and the row schema
+                    request.write_stream = stream_name
+                    request.proto_rows.writer_schema = types.ProtoSchema(
+                        proto_descriptor=descriptor)
+                requests.put(request)
+                if responses is None:
+                    responses = write_client.append_rows(
+                        iter(requests.get, None),
+                        metadata=(('x-goog-request-params',
+                                   'write_stream=%s' % (stream_name)),))
+                results['batches'] += 1
+                pending.append((results['batches'], len(batch)))
+                if len(pending) >= DEFAULT_STREAM_INFLIGHT:
+                    check_response(*pending.pop(0), next(responses))
+            while pending:
+                check_response(*pending.pop(0), next(responses))
+        finally:
+            requests.put(None)
+
+        if stream_type != 'default':
+            write_client.finalize_write_stream(name=stream_name)
+        if row_errors:
+            raise StreamingWriteException(
+                'BigQuery rejected %d batches (%d rows appended), first error: %s'
+                % (results['failed_batches'], results['rows'], row_errors[0]))
+        if stream_type == 'pending':
+            commit_response = write_client.batch_commit_write_streams(
+                types.BatchCommitWriteStreamsRequest(
+                    parent=table_path, write_streams=[stream_name]))
+            if commit_response.stream_errors:
+                raise StreamingWriteException(
+                    'Failed to commit BigQuery write stream: %s' %
+                    (commit_response.stream_errors[0].error_message))
+
+        self.logger.info('BigQuery streaming finished.',
+                         extra=dict(results,
+                                    dataset=table_name,
+                                    stream=stream_name))
+
     def output(self):
         if 'datasetWithTable' not in self.output_config:
             raise NotConfiguredException(
                 'No destination dataset specified in BigQuery output.')
+
+        project = self.output_config[
+            'project'] if 'project' in self.output_config else None
+        if 'rows' in self.output_config or 'rowsExpr' in self.output_config:
+            self.stream(
+                self._get_bigquery_client(project),
+                self._jinja_expand_string(
+                    self.output_config['datasetWithTable']))
+            return
+
         if 'source' not in self.output_config:
             raise NotConfiguredException(
                 'No GCS source specified in BigQuery output.')
@@ -46,10 +368,7 @@ class BigqueryOutput(Output):
             raise NotConfiguredException(
                 'No load job location specified in BigQuery output.')
 
-        project = self.output_config[
-            'project'] if 'project' in self.output_config else None
-        bigquery_client = bigquery.Client(
-            client_info=self._get_grpc_client_info(), project=project)
+        bigquery_client = self._get_bigquery_client(project)
 
         job_config = {}
         job_field_type = {
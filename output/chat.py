@@ -12,8 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
-from googleapiclient import discovery
-from google.oauth2.credentials import Credentials
 
 
 class ChatOutput(Output):
@@ -45,11 +43,9 @@ class ChatOutput(Output):
         ) if 'serviceAccountEmail' in self.output_config else None
 
         scope = 'https://www.googleapis.com/auth/chat.messages'
-        credentials = Credentials(
-            self.get_token_for_scopes([scope], service_account=service_account))
-        branded_http = self._get_branded_http(credentials)
-
-        chat_service = discovery.build('chat', 'v1', http=branded_http)
+        credentials = self.get_credentials_for_scopes(
+            [scope], service_account=service_account)
+        chat_service = self._get_discovery_client('chat', 'v1', credentials)
         chat_response = chat_service.spaces().messages().create(
             parent=chat_parent, body=chat_body).execute()
 
@@ -12,9 +12,63 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
-from google.cloud import storage
-import base64
 import os
+import base64
+import hashlib
+import tempfile
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+DEFAULT_UPLOAD_CONCURRENCY = 8
+# Rendered contents larger than this are streamed into a resumable upload in
+# chunks of this size (must be a multiple of 256 KiB)
+STREAMING_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class UploadFailedException(Exception):
+    pass
+
+
+def _base64_decode(chunks):
+    """Decodes a stream of base64 encoded chunks."""
+    pending = b''
+    for chunk in chunks:
+        pending += b''.join(chunk.split())
+        complete = len(pending) - len(pending) % 4
+        if complete > 0:
+            yield base64.b64decode(pending[0:complete])
+            pending = pending[complete:]
+    if pending:
+        yield base64.b64decode(pending)
+
+
+class ContentHasher:
+    """Calculates the MD5 and CRC32C checksums of contents, to compare
+    them with an existing object."""
+
+    def __init__(self):
+        import google_crc32c
+
+        self.md5 = hashlib.md5()
+        self.crc32c = google_crc32c.Checksum()
+        self.size = 0
+
+    def update(self, chunk):
+        self.md5.update(chunk)
+        self.crc32c.update(chunk)
+        self.size += len(chunk)
+
+    def matches(self, blob):
+        if blob is None or blob.size != self.size:
+            return False
+        if blob.md5_hash:
+            return blob.md5_hash == base64.b64encode(
+                self.md5.digest()).decode('ascii')
+        # Composite objects only have a CRC32C checksum
+        if blob.crc32c:
+            return blob.crc32c == base64.b64encode(
+                self.crc32c.digest()).decode('ascii')
+        return False
 
 
 class GcsOutput(Output):
@@ -24,13 +78,149 @@ class GcsOutput(Output):
     Args:
         bucket (str): Target bucket name.
         object (str, optional): Target object name. Either specify object or objects.
-        objects (list, optional): Target objects when writing multiple files. Contents template will be 
+        objects (list, optional): Target objects when writing multiple files. Contents template will be
           called multiple times with `filename` and `key` variables.
         contents (str, optional): Contents to write to target file. Either specify contents or file.
-        file (str, optional): File to write. 
+        file (str, optional): File to write.
         project (str, optional): Google Cloud project to issue Cloud Storage API calls against.
+        concurrency (int, optional): Number of objects rendered and uploaded in parallel when
+          writing multiple files (defaults to 8).
+        skipUnchanged (bool, optional): Don't rewrite objects whose contents have not changed
+          (compared by MD5 or CRC32C checksum).
     """
 
+    def _render_chunks(self, template, variables=None):
+        """Renders a template as a stream of byte chunks."""
+        chunks = (
+            chunk.encode('utf-8')
+            for chunk in template.generate(variables if variables else {}))
+        if self._base64decode():
+            return _base64_decode(chunks)
+        return chunks
+
+    def _base64decode(self):
+        return 'base64decode' in self.output_config and self.output_config[
+            'base64decode']
+
+    def _is_unchanged(self, bucket, destination_object, hasher):
+        return hasher.matches(bucket.get_blob(destination_object))
+
+    def upload(self, bucket, destination_object, chunks, skip_unchanged=False):
+        """Uploads contents from a stream of chunks. Small contents are
+        uploaded in a single request, larger contents are streamed into a
+        resumable upload.
+
+        Returns:
+            tuple: Size of the contents and whether they were uploaded
+              (False if skipped as unchanged).
+        """
+        content_type = 'application/octet-stream' if self._base64decode(
+        ) else 'text/plain'
+        blob = bucket.blob(destination_object)
+        if skip_unchanged:
+            hasher = ContentHasher()
+            with tempfile.SpooledTemporaryFile(
+                    max_size=STREAMING_CHUNK_SIZE) as contents:
+                for chunk in chunks:
+                    hasher.update(chunk)
+                    contents.write(chunk)
+                if self._is_unchanged(bucket, destination_object, hasher):
+                    return hasher.size, False
+                contents.seek(0)
+                blob.upload_from_file(contents,
+                                      size=hasher.size,
+                                      content_type=content_type)
+            return hasher.size, True
+
+        buffer = []
+        size = 0
+        writer = None
+        for chunk in chunks:
+            size += len(chunk)
+            if writer is not None:
+                writer.write(chunk)
+                continue
+            buffer.append(chunk)
+            if size > STREAMING_CHUNK_SIZE:
+                # Not closing the writer on errors abandons the upload
+                writer = blob.open('wb',
+                                   chunk_size=STREAMING_CHUNK_SIZE,
+                                   ignore_flush=True,
+                                   content_type=content_type)
+                writer.write(b''.join(buffer))
+                buffer = []
+        if writer is not None:
+            writer.close()
+        else:
+            blob.upload_from_string(b''.join(buffer), content_type=content_type)
+        return size, True
+
+    def upload_objects(self, project, destination_bucket, all_objects,
+                       skip_unchanged):
+        contents_template = self.jinja_environment.from_string(
+            self.output_config['contents'])
+        contents_template.name = 'contents'
+
+        def upload_object(destination_object, destination_key):
+            self.logger.debug('Creating destination file in bucket.',
+                              extra={
+                                  'url':
+                                      'gs://%s/%s' %
+                                      (destination_bucket, destination_object)
+                              })
+            # Storage clients are not shared between the upload threads
+            bucket = self._get_storage_client(
+                project=project).bucket(destination_bucket)
+            size, uploaded = self.upload(
+                bucket, destination_object,
+                self._render_chunks(contents_template, {
+                    'filename': destination_object,
+                    'key': destination_key
+                }), skip_unchanged)
+            self.logger.debug(
+                'Object created in Cloud Storage bucket.'
+                if uploaded else 'Object unchanged in Cloud Storage bucket.',
+                extra={
+                    'url':
+                        'gs://%s/%s' % (destination_bucket, destination_object),
+                    'size':
+                        size
+                })
+            return uploaded
+
+        concurrency = self._jinja_expand_int(
+            self.output_config['concurrency'], 'concurrency'
+        ) if 'concurrency' in self.output_config else DEFAULT_UPLOAD_CONCURRENCY
+        results = {'uploaded': 0, 'unchanged': 0, 'failed': 0}
+        first_error = None
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+            uploads = {}
+            for destination_object, destination_key in all_objects.items():
+                uploads[executor.submit(contextvars.copy_context().run,
+                                        upload_object, destination_object,
+                                        destination_key)] = destination_object
+            for upload in as_completed(uploads):
+                try:
+                    results['uploaded' if upload.result() else 'unchanged'] += 1
+                except Exception as exc:
+                    results['failed'] += 1
+                    first_error = first_error if first_error else exc
+                    self.logger.error(
+                        'Failed to write object: %s' % (exc),
+                        extra={
+                            'url':
+                                'gs://%s/%s' %
+                                (destination_bucket, uploads[upload])
+                        })
+
+        self.logger.info('Objects created in Cloud Storage bucket.',
+                         extra=dict(results, bucket=destination_bucket))
+        if results['failed'] > 0:
+            raise UploadFailedException(
+                'Failed to write %d of %d objects to %s, first error: %s' %
+                (results['failed'], len(uploads), destination_bucket,
+                 first_error))
+
     def output(self):
         if 'bucket' not in self.output_config:
             raise NotConfiguredException(
@@ -48,45 +238,18 @@ class GcsOutput(Output):
 
         project = self.output_config[
             'project'] if 'project' in self.output_config else None
-        storage_client = storage.Client(
-            client_info=self._get_grpc_client_info(), project=project)
+        storage_client = self._get_storage_client(project=project)
 
         bucket = storage_client.bucket(destination_bucket)
 
+        skip_unchanged = self._jinja_expand_bool(
+            self.output_config['skipUnchanged'], 'skip_unchanged'
+        ) if 'skipUnchanged' in self.output_config else False
+
         if 'objects' in self.output_config:
             all_objects = self._jinja_var_to_list(self.output_config['objects'])
-            for destination_object, destination_key in all_objects.items():
-                self.logger.debug(
-                    'Creating destination file in bucket.',
-                    extra={
-                        'url':
-                            'gs://%s/%s' %
-                            (destination_bucket, destination_object)
-                    })
-
-                contents_template = self.jinja_environment.from_string(
-                    self.output_config['contents'])
-                contents_template.name = 'contents'
-                contents = contents_template.render({
-                    'filename': destination_object,
-                    'key': destination_key
-                })
-                if 'base64decode' in self.output_config and self.output_config[
-                        'base64decode']:
-                    contents = base64.decodebytes(contents.encode('ascii'))
-
-                blob = bucket.blob(destination_object)
-                blob.upload_from_string(contents)
-
-                self.logger.info(
-                    'Object created in Cloud Storage bucket.',
-                    extra={
-                        'url':
-                            'gs://%s/%s' %
-                            (destination_bucket, destination_object),
-                        'size':
-                            len(contents)
-                    })
+            self.upload_objects(project, destination_bucket, all_objects,
+                                skip_unchanged)
 
         else:  # Single object
             object_template = self.jinja_environment.from_string(
@@ -101,36 +264,47 @@ class GcsOutput(Output):
                                       (destination_bucket, destination_object)
                               })
 
-            blob = bucket.blob(destination_object)
             if 'contents' in self.output_config:
                 contents_template = self.jinja_environment.from_string(
                     self.output_config['contents'])
                 contents_template.name = 'contents'
-                contents = contents_template.render()
-                if 'base64decode' in self.output_config and self.output_config[
-                        'base64decode']:
-                    contents = base64.decodebytes(contents.encode('ascii'))
-
-                blob.upload_from_string(contents)
+                size, uploaded = self.upload(
+                    bucket, destination_object,
+                    self._render_chunks(contents_template), skip_unchanged)
 
                 self.logger.info(
-                    'Object created in Cloud Storage bucket.',
+                    'Object created in Cloud Storage bucket.' if uploaded else
+                    'Object unchanged in Cloud Storage bucket.',
                     extra={
                         'url':
                             'gs://%s/%s' %
                             (destination_bucket, destination_object),
                         'size':
-                            len(contents)
+                            size
                     })
             else:
                 filename = self._jinja_expand_string(self.output_config['file'],
                                                      'file')
-                blob.upload_from_filename(filename)
+                file_path = self._get_path(filename)
+                uploaded = True
+                if skip_unchanged:
+                    hasher = ContentHasher()
+                    with open(file_path, 'rb') as source_file:
+                        for chunk in iter(
+                                lambda: source_file.read(STREAMING_CHUNK_SIZE),
+                                b''):
+                            hasher.update(chunk)
+                    uploaded = not self._is_unchanged(
+                        bucket, destination_object, hasher)
+                if uploaded:
+                    bucket.blob(destination_object).upload_from_filename(
+                        file_path)
 
-                file_stats = os.stat(filename)
+                file_stats = os.stat(file_path)
 
                 self.logger.info(
-                    'Object created in Cloud Storage bucket.',
+                    'Object created in Cloud Storage bucket.' if uploaded else
+                    'Object unchanged in Cloud Storage bucket.',
                     extra={
                         'url':
                             'gs://%s/%s' %
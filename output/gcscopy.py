@@ -12,22 +12,192 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
-from google.cloud import storage
+import re
+import time
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+DEFAULT_COPY_CONCURRENCY = 8
+# Only the fields needed to copy and compare objects are listed
+LIST_FIELDS = 'items(name,size,md5Hash,crc32c),nextPageToken'
+
+
+class CopyFailedException(Exception):
+    pass
+
+
+def glob_prefix(pattern):
+    """Returns the literal prefix of a glob pattern (up to the first
+    wildcard)."""
+    match = re.search(r'[\*\?\[\{]', pattern)
+    return pattern[0:match.start()] if match else pattern
 
 
 class GcscopyOutput(Output):
+    """
+    Copies objects in Google Cloud Storage.
+
+    Args:
+        sourceBucket (str): Source bucket name.
+        sourceObject (str, optional): Source object name, when copying a single object.
+        sourcePrefix (str, optional): Copy all objects starting with this prefix.
+        sourceGlob (str, optional): Copy all objects matching a glob pattern (eg. `exports/**.json`).
+        destinationBucket (str): Destination bucket name.
+        destinationObject (str, optional): Destination object name, when copying a single object.
+        destinationPrefix (str, optional): When copying a prefix or glob, the part of the source
+          object names before the first wildcard is replaced with this prefix (defaults to keeping
+          the names unchanged).
+        concurrency (int, optional): Number of objects copied in parallel (defaults to 8).
+        skipUnchanged (bool, optional): When copying a prefix or glob, skip objects whose size and
+          MD5 (or CRC32C) checksum match the destination object (defaults to true).
+        project (str, optional): Google Cloud project to issue Cloud Storage API calls against.
+    """
+
+    def rewrite(self, source_blob, destination_blob):
+        """Copies an object, returns the number of bytes copied."""
+        token = None
+        while True:
+            self.logger.debug(
+                'Copying file...',
+                extra={
+                    'token':
+                        token,
+                    'source_url':
+                        'gs://%s/%s' %
+                        (source_blob.bucket.name, source_blob.name),
+                    'destination_url':
+                        'gs://%s/%s' %
+                        (destination_blob.bucket.name, destination_blob.name)
+                })
+            ret = destination_blob.rewrite(source_blob, token=token)
+            token = ret[0]
+            if token is None:
+                return ret[2]
+
+    def _is_unchanged(self, source_blob, destination):
+        if destination is None or destination['size'] != source_blob.size:
+            return False
+        if source_blob.md5_hash and destination['md5Hash']:
+            return source_blob.md5_hash == destination['md5Hash']
+        # Composite objects only have a CRC32C checksum
+        if source_blob.crc32c and destination['crc32c']:
+            return source_blob.crc32c == destination['crc32c']
+        return False
+
+    def copy_objects(self, project, source_bucket, destination_bucket):
+        source_prefix = ''
+        source_glob = None
+        if 'sourceGlob' in self.output_config:
+            source_glob = self._jinja_expand_string(
+                self.output_config['sourceGlob'], 'source_glob')
+            source_prefix = glob_prefix(source_glob)
+        else:
+            source_prefix = self._jinja_expand_string(
+                self.output_config['sourcePrefix'], 'source_prefix')
+        destination_prefix = self._jinja_expand_string(
+            self.output_config['destinationPrefix'], 'destination_prefix'
+        ) if 'destinationPrefix' in self.output_config else source_prefix
+        concurrency = self._jinja_expand_int(
+            self.output_config['concurrency'], 'concurrency'
+        ) if 'concurrency' in self.output_config else DEFAULT_COPY_CONCURRENCY
+        concurrency = max(1, concurrency)
+        skip_unchanged = self._jinja_expand_bool(
+            self.output_config['skipUnchanged'],
+            'skip_unchanged') if 'skipUnchanged' in self.output_config else True
+
+        storage_client = self._get_storage_client(project=project)
+        # Existing destination objects are listed once, instead of fetching
+        # the metadata of every object separately
+        existing = {}
+        if skip_unchanged:
+            for blob in storage_client.list_blobs(destination_bucket,
+                                                  prefix=destination_prefix,
+                                                  fields=LIST_FIELDS):
+                existing[blob.name] = {
+                    'size': blob.size,
+                    'md5Hash': blob.md5_hash,
+                    'crc32c': blob.crc32c
+                }
+
+        results = {'copied': 0, 'skipped': 0, 'failed': 0, 'bytes': 0}
+        errors = []
+
+        def copy_object(source_blob, destination_object):
+            # Storage clients are not shared between the copy threads
+            destination = self._get_storage_client(
+                project=project).bucket(destination_bucket)
+            return self.rewrite(source_blob,
+                                destination.blob(destination_object))
+
+        def collect(done):
+            for copy in done:
+                source_name = running.pop(copy)
+                try:
+                    results['bytes'] += copy.result()
+                    results['copied'] += 1
+                except Exception as exc:
+                    results['failed'] += 1
+                    errors.append(exc)
+                    self.logger.error('Failed to copy object: %s' % (exc),
+                                      extra={
+                                          'source_url':
+                                              'gs://%s/%s' %
+                                              (source_bucket, source_name)
+                                      })
+
+        start = time.monotonic()
+        running = {}
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            # Sources are listed page by page while earlier pages are copied
+            for source_blob in storage_client.list_blobs(source_bucket,
+                                                         prefix=source_prefix,
+                                                         match_glob=source_glob,
+                                                         fields=LIST_FIELDS):
+                if source_blob.name.endswith('/') and source_blob.size == 0:
+                    continue  # Folder placeholder
+                destination_object = destination_prefix + source_blob.name[
+                    len(source_prefix):]
+                if skip_unchanged and self._is_unchanged(
+                        source_blob, existing.get(destination_object)):
+                    results['skipped'] += 1
+                    continue
+                while len(running) >= concurrency * 2:
+                    done, pending = wait(running, return_when=FIRST_COMPLETED)
+                    collect(done)
+                running[executor.submit(contextvars.copy_context().run,
+                                        copy_object, source_blob,
+                                        destination_object)] = source_blob.name
+            collect(wait(running).done)
+
+        elapsed = time.monotonic() - start
+        self.logger.info(
+            'Objects copied from source to destination.',
+            extra=dict(
+                results,
+                source_url='gs://%s/%s' %
+                (source_bucket, source_glob if source_glob else source_prefix),
+                destination_url='gs://%s/%s' %
+                (destination_bucket, destination_prefix),
+                seconds=round(elapsed, 3),
+                bytes_per_second=int(results['bytes'] /
+                                     elapsed) if elapsed > 0 else 0))
+        if results['failed'] > 0:
+            raise CopyFailedException(
+                'Failed to copy %d of %d objects to gs://%s, first error: %s' %
+                (results['failed'], results['failed'] + results['copied'],
+                 destination_bucket, errors[0]))
 
     def output(self):
         if 'sourceBucket' not in self.output_config:
             raise NotConfiguredException(
                 'No source bucket defined in GCS output.')
-        if 'sourceObject' not in self.output_config:
+        if 'sourceObject' not in self.output_config and 'sourcePrefix' not in self.output_config and 'sourceGlob' not in self.output_config:
             raise NotConfiguredException(
-                'No source object defined in GCS output.')
+                'No source object, prefix or glob defined in GCS output.')
         if 'destinationBucket' not in self.output_config:
             raise NotConfiguredException(
                 'No destination bucket defined in GCS output.')
-        if 'destinationObject' not in self.output_config:
+        if 'sourceObject' in self.output_config and 'destinationObject' not in self.output_config:
             raise NotConfiguredException(
                 'No destination object defined in GCS output.')
 
@@ -36,16 +206,22 @@ class GcscopyOutput(Output):
         bucket_template.name = 'bucket'
         source_bucket = bucket_template.render()
 
-        object_template = self.jinja_environment.from_string(
-            self.output_config['sourceObject'])
-        object_template.name = 'object'
-        source_object = object_template.render()
-
         bucket_template = self.jinja_environment.from_string(
             self.output_config['destinationBucket'])
         bucket_template.name = 'bucket'
         destination_bucket = bucket_template.render()
 
+        project = self.output_config[
+            'project'] if 'project' in self.output_config else None
+        if 'sourceObject' not in self.output_config:
+            self.copy_objects(project, source_bucket, destination_bucket)
+            return
+
+        object_template = self.jinja_environment.from_string(
+            self.output_config['sourceObject'])
+        object_template.name = 'object'
+        source_object = object_template.render()
+
         object_template = self.jinja_environment.from_string(
             self.output_config['destinationObject'])
         object_template.name = 'object'
@@ -60,39 +236,18 @@ class GcscopyOutput(Output):
                                   (destination_bucket, destination_object)
                           })
 
-        project = self.output_config[
-            'project'] if 'project' in self.output_config else None
-        storage_client = storage.Client(
-            client_info=self._get_grpc_client_info(), project=project)
-
+        storage_client = self._get_storage_client(project=project)
         bucket = storage_client.bucket(source_bucket)
         source_blob = bucket.blob(source_object)
 
         bucket = storage_client.bucket(destination_bucket)
         destination_blob = bucket.blob(destination_object)
-        token = None
-        while True:
-            self.logger.debug(
-                'Copying file...',
-                extra={
-                    'token':
-                        token,
-                    'source_url':
-                        'gs://%s/%s' % (source_bucket, source_object),
-                    'destination_url':
-                        'gs://%s/%s' % (destination_bucket, destination_object)
-                })
-            ret = destination_blob.rewrite(source_blob, token=token)
-            token = ret[0]
-            if token is None:
-                break
+        total_bytes = self.rewrite(source_blob, destination_blob)
 
         self.logger.info('Object copied from source to destination.',
                          extra={
-                             'bytes_rewritten':
-                                 ret[1],
                              'total_bytes':
-                                 ret[2],
+                                 total_bytes,
                              'source_url':
                                  'gs://%s/%s' % (source_bucket, source_object),
                              'destination_url':
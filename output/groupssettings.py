@@ -12,8 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
-from googleapiclient import discovery
-from google.oauth2.credentials import Credentials
 
 
 class GroupssettingsOutput(Output):
@@ -37,13 +35,10 @@ class GroupssettingsOutput(Output):
             'serviceAccountEmail'] if 'serviceAccountEmail' in self.output_config else None
 
         scope = 'https://www.googleapis.com/auth/apps.groups.settings'
-        credentials = Credentials(
-            self.get_token_for_scopes([scope], service_account=service_account))
-        branded_http = self._get_branded_http(credentials)
-
-        group_service = discovery.build('groupssettings',
-                                        'v1',
-                                        http=branded_http)
+        credentials = self.get_credentials_for_scopes(
+            [scope], service_account=service_account)
+        group_service = self._get_discovery_client('groupssettings', 'v1',
+                                                   credentials)
         request = group_service.groups().update(groupUniqueId=group,
                                                 body=settings)
         request.execute()
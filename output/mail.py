@@ -12,24 +12,20 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
+from helpers.smtp import get_smtp_pool
+from helpers.recipients import RecipientExpander, RECIPIENT_MISSING, DEFAULT_EXPANSION_CONCURRENCY, DEFAULT_MAX_RECIPIENTS
+from helpers.attachments import Attachment, attachment_part, close_attachments, format_size, get_signed_url, spooled_file, write_message, DEFAULT_ATTACHMENT_LINK_THRESHOLD, DEFAULT_ATTACHMENT_LINK_EXPIRATION
 import os
 import email
-import base64
-from email import encoders
+import html
+import mimetypes
 import smtplib
 import ssl
 import urllib
-from googleapiclient import discovery, errors
-from email.mime.base import MIMEBase
+import hashlib
+from functools import partial
 from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
 from email.mime.multipart import MIMEMultipart
-import sendgrid
-from sendgrid.helpers.mail import Attachment, SandBoxMode
-from google.oauth2.credentials import Credentials
-from google.cloud import storage
-from python_http_client import exceptions
-from msal import ConfidentialClientApplication
 import requests
 import json
 
@@ -60,26 +56,123 @@ class OAuthTokenFetchException(Exception):
 
 class MailOutput(Output):
 
-    def _get_attachment(self, url):
+    def _get_blob(self, url):
         parsed_url = urllib.parse.urlparse(url)
         if parsed_url.scheme != 'gs':
             raise InvalidSchemeException(
                 'Invalid scheme for generate_signed_url: %s' %
                 parsed_url.scheme)
-        client = storage.Client()
+        client = self._get_storage_client()
         bucket = client.bucket(parsed_url.netloc)
         blob = bucket.get_blob(urllib.parse.unquote(parsed_url.path[1:]))
         if not blob:
             raise DownloadFailedException('Unable to download attachment.')
-        blob_string = blob.download_as_string()
-        if len(blob_string) == 0:
+        return blob
+
+    def _get_attachment(self, url):
+        """Downloads an attachment from Cloud Storage into a spooled file
+        (see helpers.attachments.Attachment), returns None for empty
+        files."""
+        blob = self._get_blob(url)
+        if blob.size == 0:
             self.logger.warning(
                 'Empty attachment (0 bytes) detected, skipping...',
                 extra={'url': url})
-            return None, None
-        return os.path.basename(blob.name), blob_string
+            return None
+        return Attachment.from_blob(blob)
+
+    def get_attachments(self, config):
+        """Fetches the attachments configured in body.attachments.
+
+        If attachmentLinkThreshold is set, attachments larger than that many
+        bytes are not attached, but linked with a signed URL valid for
+        attachmentLinkExpiration seconds instead.
+
+        Returns:
+            tuple: List of Attachments and list of (filename, size, url)
+              links.
+        """
+        link_threshold = DEFAULT_ATTACHMENT_LINK_THRESHOLD
+        if 'attachmentLinkThreshold' in config:
+            link_threshold = self._jinja_expand_int(
+                config['attachmentLinkThreshold'])
+        link_expiration = DEFAULT_ATTACHMENT_LINK_EXPIRATION
+        if 'attachmentLinkExpiration' in config:
+            link_expiration = self._jinja_expand_int(
+                config['attachmentLinkExpiration'])
+
+        attachments = []
+        links = []
+        try:
+            for attachment in config['body']['attachments']:
+                attachment_template = self.jinja_environment.from_string(
+                    attachment)
+                attachment_template.name = 'attachment'
+                attachment_url = attachment_template.render()
+                self.logger.debug('Fetching attachment...',
+                                  extra={'attachment': attachment_url})
+
+                blob = self._get_blob(attachment_url)
+                if blob.size == 0:
+                    self.logger.warning(
+                        'Empty attachment (0 bytes) detected, skipping...',
+                        extra={'url': attachment_url})
+                    continue
+                filename = os.path.basename(blob.name)
+                if link_threshold > 0 and blob.size is not None and blob.size > link_threshold:
+                    try:
+                        links.append((filename, blob.size,
+                                      get_signed_url(blob, link_expiration)))
+                        self.logger.info(
+                            'Attachment is too large, linking it instead.',
+                            extra={
+                                'attachment_filename': filename,
+                                'attachment_size': blob.size
+                            })
+                        continue
+                    except Exception as exc:
+                        self.logger.warning(
+                            'Failed to sign URL for large attachment, attaching it instead: %s'
+                            % (exc),
+                            extra={'attachment': attachment_url})
+
+                attachments.append(Attachment.from_blob(blob))
+                self.logger.debug('Fetched attachment.',
+                                  extra={
+                                      'attachment_filename': filename,
+                                      'attachment_size': blob.size
+                                  })
+        except Exception:
+            close_attachments(attachments)
+            raise
+        return attachments, links
+
+    def add_attachment_links(self, mail, links):
+        """Adds links to attachments to the text and HTML bodies."""
+        if mail['text_body'] != '':
+            text_links = [
+                '%s (%s): %s' % (filename, format_size(size), url)
+                for filename, size, url in links
+            ]
+            mail['text_body'] = '%s\n\nAttachments:\n%s\n' % (
+                mail['text_body'].rstrip('\n'), '\n'.join(text_links))
+        if mail['html_body'] != '':
+            html_links = '<p>Attachments:</p><ul>%s</ul>' % ''.join([
+                '<li><a href="%s">%s</a> (%s)</li>' %
+                (html.escape(url), html.escape(filename), format_size(size))
+                for filename, size, url in links
+            ])
+            body_end = mail['html_body'].lower().rfind('</body>')
+            if body_end >= 0:
+                mail['html_body'] = mail['html_body'][
+                    0:body_end] + html_links + mail['html_body'][body_end:]
+            else:
+                mail['html_body'] += html_links
+        return mail
 
     def _fetch_ms_access_token(self, client_id, client_secret, tenant_id):
+        from msal import ConfidentialClientApplication
+
         authority = 'https://login.microsoftonline.com/%s' % urllib.parse.quote_plus(
             tenant_id)
         app = ConfidentialClientApplication(client_id,
@@ -92,7 +185,8 @@ class MailOutput(Output):
         return result['access_token']
 
     def expand_recipients(self, mail, config):
-        """Expands group recipients using the Directory API"""
+        """Expands group recipients using the Directory API (see
+        helpers.recipients.RecipientExpander)"""
         to_emails = []
         try:
             to_emails = email.utils.getaddresses([mail['mail_to']],
@@ -104,88 +198,70 @@ class MailOutput(Output):
 
         service_account = config[
             'serviceAccountEmail'] if 'serviceAccountEmail' in config else None
-        user_credentials = Credentials(
-            self.get_token_for_scopes([
-                'https://www.googleapis.com/auth/admin.directory.user.readonly'
-            ],
-                                      service_account=service_account))
-        group_credentials = Credentials(
-            self.get_token_for_scopes([
-                'https://www.googleapis.com/auth/cloud-identity.groups.readonly'
-            ],
-                                      service_account=service_account))
-
-        user_service = discovery.build('admin',
-                                       'directory_v1',
-                                       credentials=user_credentials)
-        group_service = discovery.build('cloudidentity',
-                                        'v1beta1',
-                                        credentials=group_credentials)
+
+        def get_user_service():
+            scope = 'https://www.googleapis.com/auth/admin.directory.user.readonly'
+            user_credentials = self.get_credentials_for_scopes(
+                [scope], service_account=service_account)
+            return self._get_discovery_client('admin', 'directory_v1',
+                                              user_credentials)
+
+        def get_group_service():
+            scope = 'https://www.googleapis.com/auth/cloud-identity.groups.readonly'
+            group_credentials = self.get_credentials_for_scopes(
+                [scope], service_account=service_account)
+            return self._get_discovery_client('cloudidentity', 'v1beta1',
+                                              group_credentials)
+
+        expander = RecipientExpander(
+            get_group_service,
+            get_user_service,
+            cache_scope=service_account,
+            max_workers=self._jinja_expand_int(config['expansionConcurrency'],
+                                               'expansion_concurrency') if
+            'expansionConcurrency' in config else DEFAULT_EXPANSION_CONCURRENCY,
+            max_recipients=self._jinja_expand_int(config['maxRecipients'],
+                                                  'max_recipients')
+            if 'maxRecipients' in config else DEFAULT_MAX_RECIPIENTS,
+            nested=self._jinja_expand_bool(config['expandNestedGroups'])
+            if 'expandNestedGroups' in config else False)
+
         new_emails = []
-        for e in to_emails:
-            request = group_service.groups().lookup()
-            request.uri += "&groupKey.id=" + e[1]
-            try:
-                response = request.execute()
-            except errors.HttpError as exc:
-                if exc.resp.status == 404 or exc.resp.status == 403:
-                    self.logger.debug(
-                        'Did not find group %s in Cloud Identity.' % (e[1]),
-                        extra={'response': exc.resp})
-                    response = None
-                else:
-                    raise exc
-            if response and 'name' in response:
-                m_request = group_service.groups().memberships().list(
-                    parent=response['name'])
-                m_response = m_request.execute()
-                if 'memberships' in m_response:  # If this field doesn't exist, it's probably an empty group
-                    for membership in m_response['memberships']:
-                        new_emails.append(
-                            email.utils.formataddr(
-                                ('', membership['memberKey']['id'])))
-            else:
-                try:
-                    u_response = user_service.users().get(
-                        userKey=e[1]).execute()
-                    if u_response:
-                        new_emails.append(e[1])
-                except errors.HttpError as exc:
-                    if 'ignoreNonexistentGroups' not in config or not config[
-                            'ignoreNonexistentGroups']:
-                        raise GroupNotFoundException(
-                            'Failed to find group %s in Cloud Identity!' % e[1])
-                    elif 'ignoreNonexistentGroups' in config and isinstance(
-                            config['ignoreNonexistentGroups'],
-                            str) and not e[1].endswith(
+        for address, kind, recipients in expander.expand(
+            [e[1] for e in to_emails]):
+            if kind != RECIPIENT_MISSING:
+                new_emails.extend(recipients)
+            elif 'ignoreNonexistentGroups' not in config or not config[
+                    'ignoreNonexistentGroups']:
+                raise GroupNotFoundException(
+                    'Failed to find group %s in Cloud Identity!' % address)
+            elif isinstance(config['ignoreNonexistentGroups'],
+                            str) and not address.endswith(
                                 config['ignoreNonexistentGroups']):
-                        new_emails.append(e[1])
-                    else:
-                        self.logger.debug('Non-existent user %s skipped.' %
-                                          (e[1]),
-                                          extra={'response': exc.resp})
-
-        new_to = ''
-        for e in new_emails:
-            new_to += ', ' if new_to != '' else ''
-            new_to += e
+                new_emails.append(address)
+            else:
+                self.logger.debug('Non-existent user %s skipped.' % (address))
+
+        new_to = ', '.join(expander.limit(new_emails))
         mail['mail_to'] = new_to
         self.logger.debug('Finished expanding group recipients.',
                           extra={'to': new_to})
         return mail
 
-    def send_via_smtp(self, transport, mail, embedded_images, config):
-        if 'host' not in transport:
-            raise NotConfiguredException(
-                'No host configured for SMTP transport.')
-
-        port = int(transport['port']) if 'port' in transport else 25
-        self.logger.debug('Trying transport.',
-                          extra={
-                              'host': transport['host'],
-                              'port': port
-                          })
-
+    def get_smtp_pool_key(self, transport, port):
+        password_hash = None
+        if 'password' in transport:
+            password_hash = hashlib.sha256(
+                transport['password'].encode('utf-8')).hexdigest()
+        return (transport['host'], port,
+                bool(transport['ssl']) if 'ssl' in transport else False,
+                bool(transport['starttls']) if 'starttls' in transport else
+                False, transport['verifyCertificate']
+                if 'verifyCertificate' in transport else True,
+                transport['user'] if 'user' in transport else None,
+                password_hash)
+
+    def connect_smtp(self, transport, port):
         server = None
         if 'verifyCertificate' in transport and transport[
                 'verifyCertificate'] is False:
@@ -203,6 +279,19 @@ class MailOutput(Output):
         if 'user' in transport and 'password' in transport:
             self.logger.debug('Logging into SMTP server.')
             server.login(transport['user'], transport['password'])
+        return server
+
+    def send_via_smtp(self, transport, mail, embedded_images, config):
+        if 'host' not in transport:
+            raise NotConfiguredException(
+                'No host configured for SMTP transport.')
+
+        port = int(transport['port']) if 'port' in transport else 25
+        self.logger.debug('Trying transport.',
+                          extra={
+                              'host': transport['host'],
+                              'port': port
+                          })
 
         message = MIMEMultipart('alternative')
         message['Subject'] = mail['mail_subject']
@@ -216,37 +305,29 @@ class MailOutput(Output):
             html_part = MIMEText(mail['html_body'], 'html')
             message.attach(html_part)
 
-        if 'attachments' in config['body']:
-            for attachment in config['body']['attachments']:
-                attachment_template = self.jinja_environment.from_string(
-                    attachment)
-                attachment_template.name = 'attachment'
-                attachment_url = attachment_template.render()
-                self.logger.debug('Fetching attachment...',
-                                  extra={'attachment': attachment_url})
-
-                filename, content = self._get_attachment(attachment_url)
-                if filename:
-                    file_part = MIMEBase('application', 'octet-stream')
-                    file_part.set_payload(content)
-                    encoders.encode_base64(file_part)
-                    file_part.add_header('Content-Disposition',
-                                         'attachment; filename="%s"' % filename)
-                    self.logger.debug('Attached file.',
-                                      extra={
-                                          'attachment_filename': filename,
-                                          'attachment_size': len(content)
-                                      })
-                    message.attach(file_part)
-
-        if len(embedded_images) > 0:
-            for file_name, content in embedded_images.items():
-                image = MIMEImage(content)
-                image.add_header('Content-ID', '<%s>' % file_name)
-                image.add_header(
+        # Attachment bodies are streamed into the message when it is written
+        streamed = False
+        for attachment in mail.get('attachments', []):
+            file_part = attachment_part(attachment)
+            file_part.add_header(
+                'Content-Disposition',
+                'attachment; filename="%s"' % attachment.filename)
+            message.attach(file_part)
+            streamed = True
+
+        if embedded_images:
+            for file_name, image in embedded_images.items():
+                mime_type = mimetypes.guess_type(file_name)[0]
+                image_part = attachment_part(
+                    image, 'image',
+                    mime_type.split('/')[1] if mime_type and
+                    mime_type.startswith('image/') else 'octet-stream')
+                image_part.add_header('Content-ID', '<%s>' % file_name)
+                image_part.add_header(
                     'Content-Disposition', 'inline; filename="%s"; size="%d";' %
-                    (file_name, len(content)))
-                message.attach(image)
+                    (file_name, image.size))
+                message.attach(image_part)
+                streamed = True
 
         parsed_recipients = []
         try:
@@ -258,14 +339,48 @@ class MailOutput(Output):
         for r in parsed_recipients:
             recipients.append(r[1])
 
+        def render_message():
+            if not streamed:
+                return message.as_string()
+            # Messages with attachments are written into a spooled file and
+            # streamed to the server
+            return write_message(message, spooled_file())
+
+        def get_messages():
+            # Messages are rendered one at a time, as they are sent
+            per_recipient = [(email.utils.formataddr(recipient), [recipient[1]])
+                             for recipient in parsed_recipients]
+            if 'perRecipient' not in config or not self._jinja_expand_bool(
+                    config['perRecipient']):
+                per_recipient = [(None, recipients)]
+            for to, message_recipients in per_recipient:
+                if to is not None:
+                    # Fan out a separate message to each recipient, all sent
+                    # over the same session
+                    del message['To']
+                    message['To'] = to
+                rendered = render_message()
+                try:
+                    yield (mail['mail_from'], message_recipients, rendered)
+                finally:
+                    if not isinstance(rendered, str):
+                        rendered.close()
+
         self.logger.debug('Sending email thru SMTP.',
                           extra={'recipients': recipients})
-        server.sendmail(mail['mail_from'], recipients, message.as_string())
-
-        server.quit()
-        return True
+        messages = get_messages()
+        try:
+            return get_smtp_pool().send(
+                self.get_smtp_pool_key(transport, port),
+                partial(self.connect_smtp, transport, port), messages)
+        finally:
+            messages.close()
 
     def send_via_sendgrid(self, transport, mail, embedded_images, config):
+        import sendgrid
+        from sendgrid.helpers.mail import Attachment as SendgridAttachment, SandBoxMode
+        from python_http_client import exceptions
+
         api_key = None
         if 'apiKey' in transport:
             api_key = transport['apiKey']
@@ -291,40 +406,25 @@ class MailOutput(Output):
         if mail['html_body'] != '':
             html_content = sendgrid.Content('text/html', mail['html_body'])
             sendgrid_mail.add_content(html_content)
-        if len(embedded_images) > 0:
-            for file_name, content in embedded_images.items():
-                attachment = Attachment()
-                attachment.file_content = base64.b64encode(content).decode()
+        # The v3 API only accepts inline base64 content
+        if embedded_images:
+            for file_name, image in embedded_images.items():
+                attachment = SendgridAttachment()
+                attachment.file_content = image.to_base64()
                 attachment.file_type = 'application/octet-stream'
                 attachment.file_name = file_name
                 attachment.disposition = 'inline'
                 attachment.content_id = file_name
                 sendgrid_mail.attachment = attachment
 
-        if 'attachments' in config['body']:
-            for attachment in config['body']['attachments']:
-                attachment_template = self.jinja_environment.from_string(
-                    attachment)
-                attachment_template.name = 'attachment'
-                attachment_url = attachment_template.render()
-                self.logger.debug('Fetching attachment...',
-                                  extra={'attachment': attachment_url})
-
-                filename, content = self._get_attachment(attachment_url)
-                if filename:
-                    attachment = Attachment()
-                    attachment.file_content = base64.b64encode(content).decode()
-                    attachment.file_type = 'application/octet-stream'
-                    attachment.file_name = filename
-                    attachment.disposition = 'attachment'
-                    attachment.content_id = filename
-                    sendgrid_mail.attachment = attachment
-
-                    self.logger.debug('Attached file.',
-                                      extra={
-                                          'attachment_filename': filename,
-                                          'attachment_size': len(content)
-                                      })
+        for file in mail.get('attachments', []):
+            attachment = SendgridAttachment()
+            attachment.file_content = file.to_base64()
+            attachment.file_type = 'application/octet-stream'
+            attachment.file_name = file.filename
+            attachment.disposition = 'attachment'
+            attachment.content_id = file.filename
+            sendgrid_mail.attachment = attachment
 
         self.logger.debug('Sending email through SendGrid.')
         try:
@@ -394,34 +494,82 @@ class MailOutput(Output):
         return False
 
     def embed_images(self, config):
+        """Opens the images configured in body.images, returns a dict of
+        file names to Attachments."""
         embedded_images = {}
-        for image in config['body']['images']:
-            image_template = self.jinja_environment.from_string(image)
-            image_template.name = 'image'
-            image_url = image_template.render()
-            self.logger.debug('Fetching attached image...',
-                              extra={'image': image_url})
-
-            image_filename = None
-            if image_url.startswith('gs://'):  # Cloud Storage file
-                image_filename, image_content = self._get_attachment(image_url)
-            else:
-                if os.path.exists(image_url):  # Local file
-                    image_filename = os.path.basename(image_url)
-                    image_content = open(image_url, 'rb').read()
+        try:
+            for image in config['body']['images']:
+                image_template = self.jinja_environment.from_string(image)
+                image_template.name = 'image'
+                image_url = image_template.render()
+                self.logger.debug('Fetching attached image...',
+                                  extra={'image': image_url})
+
+                image_file = None
+                if image_url.startswith('gs://'):  # Cloud Storage file
+                    image_file = self._get_attachment(image_url)
                 else:
-                    self.logger.error('Could not find image attachment.',
-                                      extra={'image': image_url})
-            if image_filename:
-                embedded_images[image_filename] = image_content
-                self.logger.debug('Attaching embedded image.',
-                                  extra={
-                                      'image': image_url,
-                                      'image_name': image_filename,
-                                      'size': len(image_content)
-                                  })
+                    image_path = self._get_path(image_url)
+                    if os.path.exists(image_path):  # Local file
+                        image_file = Attachment.from_path(
+                            image_path, os.path.basename(image_url))
+                    else:
+                        self.logger.error('Could not find image attachment.',
+                                          extra={'image': image_url})
+                if image_file:
+                    if image_file.filename in embedded_images:
+                        embedded_images[image_file.filename].close()
+                    embedded_images[image_file.filename] = image_file
+                    self.logger.debug('Attaching embedded image.',
+                                      extra={
+                                          'image': image_url,
+                                          'image_name': image_file.filename,
+                                          'size': image_file.size
+                                      })
+        except Exception:
+            close_attachments(embedded_images.values())
+            raise
         return embedded_images
 
+    def send(self, mail, embedded_images):
+        """Tries the configured transports in order until one succeeds."""
+        sent_successfully = False
+        for transport in self.output_config['transports']:
+            try:
+                if transport['type'] == 'smtp':
+                    sent_successfully = self.send_via_smtp(
+                        transport, mail, embedded_images, self.output_config)
+                    if sent_successfully:
+                        break
+                elif transport['type'] == 'sendgrid':
+                    sent_successfully = self.send_via_sendgrid(
+                        transport, mail, embedded_images, self.output_config)
+                    if sent_successfully:
+                        break
+                elif transport['type'] == 'msgraphapi':
+                    sent_successfully = self.send_via_msgraphapi(
+                        transport, mail, embedded_images, self.output_config)
+                    if sent_successfully:
+                        break
+                else:
+                    self.logger.exception(
+                        'Unknown transport type %s in configuration.' %
+                        transport['type'])
+            except Exception:
+                transport_sanitized = transport
+                transport_sanitized.pop('apiKey', None)
+                transport_sanitized.pop('user', None)
+                transport_sanitized.pop('password', None)
+                self.logger.exception(
+                    'Error when attempting to use transport.',
+                    extra={
+                        'transport': transport_sanitized,
+                        'mail': {
+                            k: v for k, v in mail.items() if k != 'attachments'
+                        }
+                    })
+        return sent_successfully
+
     def output(self):
         mail = {
             'html_body': '',
@@ -481,48 +629,28 @@ class MailOutput(Output):
 
         if 'expandGroupRecipients' in self.output_config and self.output_config[
                 'expandGroupRecipients']:
-            mail = self.expand_recipients(self, mail, self.output_config)
+            mail = self.expand_recipients(mail, self.output_config)
 
         if 'transports' not in self.output_config:
             raise NotConfiguredException(
                 'No transports configured for sending email.')
 
         embedded_images = {}
-        if 'images' in self.output_config['body']:
-            embedded_images = self.embed_images(self.output_config)
+        mail['attachments'] = []
+        try:
+            if 'attachments' in self.output_config['body']:
+                mail['attachments'], links = self.get_attachments(
+                    self.output_config)
+                if len(links) > 0:
+                    mail = self.add_attachment_links(mail, links)
+            if 'images' in self.output_config['body']:
+                embedded_images = self.embed_images(self.output_config)
+
+            sent_successfully = self.send(mail, embedded_images)
+        finally:
+            close_attachments(mail['attachments'])
+            close_attachments(embedded_images.values())
 
-        sent_successfully = False
-        for transport in self.output_config['transports']:
-            try:
-                if transport['type'] == 'smtp':
-                    sent_successfully = self.send_via_smtp(
-                        transport, mail, embedded_images, self.output_config)
-                    if sent_successfully:
-                        break
-                elif transport['type'] == 'sendgrid':
-                    sent_successfully = self.send_via_sendgrid(
-                        transport, mail, embedded_images, self.output_config)
-                    if sent_successfully:
-                        break
-                elif transport['type'] == 'msgraphapi':
-                    sent_successfully = self.send_via_msgraphapi(
-                        transport, mail, embedded_images, self.output_config)
-                    if sent_successfully:
-                        break
-                else:
-                    self.logger.exception(
-                        'Unknown transport type %s in configuration.' %
-                        transport['type'])
-            except Exception:
-                transport_sanitized = transport
-                transport_sanitized.pop('apiKey', None)
-                transport_sanitized.pop('user', None)
-                transport_sanitized.pop('password', None)
-                self.logger.exception('Error when attempting to use transport.',
-                                      extra={
-                                          'transport': transport_sanitized,
-                                          'mail': mail
-                                      })
         if not sent_successfully:
             self.logger.error(
                 'Unable to send email, none of the transports worked.')
@@ -12,17 +12,136 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Output, NotConfiguredException
+from helpers.base import get_client_registry
 import json
+import threading
 from google.cloud import pubsub_v1
 from concurrent import futures
+from jinja2 import meta
 import hashlib
 
+DEFAULT_FLOW_CONTROL_MAX_MESSAGES = 1000
+DEFAULT_FLOW_CONTROL_MAX_BYTES = 10 * 1024 * 1024
+# Number of failed publishes that are logged individually
+MAX_LOGGED_ERRORS = 10
+
+
+class PublishFailedException(Exception):
+    pass
+
+
+class PublishResults:
+    """Keeps track of outstanding publish futures, so that fan-outs of large
+    numbers of messages don't hold on to every future."""
+
+    def __init__(self, publisher, topic, logger):
+        self.publisher = publisher
+        self.topic = topic
+        self.logger = logger
+        self.published = 0
+        self.failed = 0
+        self.first_error = None
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    def add(self, future, key, ordering_key):
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(
+            lambda future: self.done(future, key, ordering_key))
+
+    def done(self, future, key, ordering_key):
+        exc = future.exception()
+        with self._lock:
+            self._pending.discard(future)
+            if exc is None:
+                self.published += 1
+                return
+            self.failed += 1
+            if self.first_error is None:
+                self.first_error = exc
+            log_error = self.failed <= MAX_LOGGED_ERRORS
+        if log_error:
+            self.logger.error('Failed to publish message: %s' % (exc),
+                              extra={
+                                  'key': key,
+                                  'topic': self.topic,
+                                  'ordering_key': ordering_key
+                              })
+        if ordering_key:
+            # Publishing is paused for an ordering key after a failure
+            self.publisher.resume_publish(self.topic, ordering_key)
+
+    def wait(self):
+        while True:
+            with self._lock:
+                pending = list(self._pending)
+            if not pending:
+                return
+            futures.wait(pending, return_when=futures.ALL_COMPLETED)
+
 
 class PubsubOutput(Output):
 
     def callback(self, future):
         pass
 
+    def _get_int_option(self, option, default=None):
+        if option in self.output_config:
+            return self._jinja_expand_int(self.output_config[option], option)
+        return default
+
+    def _get_float_option(self, option, default=None):
+        if option in self.output_config:
+            value = self.output_config[option]
+            return self._jinja_expand_float(
+                float(value) if isinstance(value, int) else value, option)
+        return default
+
+    def _get_template(self, option):
+        """Compiles a template once and returns it with a flag telling
+        whether it references the message key."""
+        source = self.output_config[option]
+        template = self.jinja_environment.from_string(source)
+        template.name = option
+        uses_key = 'key' in meta.find_undeclared_variables(
+            self.jinja_environment.parse(source))
+        return template, uses_key
+
+    def get_messages(self, uses_key):
+        """Returns an iterator of (key, value) tuples for the messages to
+        publish, from messages (JSON template), messagesExpr (expression
+        evaluating to a dict, list or other iterable, eg. a generator) or
+        messagesFile (JSON Lines file). List items are keyed by a hash of
+        their JSON representation and identical items are published once."""
+        if 'messagesFile' in self.output_config:
+            messages = self._read_json_lines(
+                self._jinja_expand_string(self.output_config['messagesFile'],
+                                          'messages_file'))
+        elif 'messagesExpr' in self.output_config:
+            messages = self._jinja_expand_expr(
+                self.output_config['messagesExpr'], 'messages')
+        elif 'messages' in self.output_config:
+            messages = json.loads(
+                self._jinja_expand_string(self.output_config['messages'],
+                                          'messages'))
+        else:
+            messages = {'single': 'message'}
+
+        if isinstance(messages, dict):
+            return iter(messages.items())
+        return self._unique_messages(messages, uses_key)
+
+    def _unique_messages(self, messages, uses_key):
+        # Only the hashes of the messages seen so far are kept in memory
+        seen = set()
+        for message in messages:
+            message_hash = hashlib.md5(json.dumps(message).encode())
+            if message_hash.digest() in seen:
+                continue
+            seen.add(message_hash.digest())
+            yield (message_hash.hexdigest() if uses_key else None, message)
+
     def output(self):
         if 'topic' not in self.output_config:
             raise NotConfiguredException(
@@ -36,53 +155,70 @@ class PubsubOutput(Output):
             raise NotConfiguredException(
                 'No Pub/Sub message content defined in configuration.')
 
-        messages = {'single': 'message'}
-        if 'messages' in self.output_config:
-            messages_template = self.jinja_environment.from_string(
-                self.output_config['messages'])
-            messages_template.name = 'messages'
-            messages_output = messages_template.render()
-            messages = json.loads(messages_output)
+        # Templates are compiled once for all messages
+        content_template, uses_key = self._get_template('content')
+        attributes_template = None
+        if 'attributes' in self.output_config:
+            attributes_template, attributes_key = self._get_template(
+                'attributes')
+            uses_key = uses_key or attributes_key
+        ordering_key_template = None
+        if 'ordering_key' in self.output_config:
+            ordering_key_template, ordering_key_key = self._get_template(
+                'ordering_key')
+            uses_key = uses_key or ordering_key_key
 
+        default_batch_settings = pubsub_v1.types.BatchSettings()
+        batch_settings = pubsub_v1.types.BatchSettings(
+            max_messages=self._get_int_option(
+                'batchMaxMessages', default_batch_settings.max_messages),
+            max_bytes=self._get_int_option('batchMaxBytes',
+                                           default_batch_settings.max_bytes),
+            max_latency=self._get_float_option(
+                'batchMaxLatency', default_batch_settings.max_latency))
+        # Publishing blocks when too many messages are outstanding
+        flow_control = pubsub_v1.types.PublishFlowControl(
+            message_limit=self._get_int_option(
+                'flowControlMaxMessages', DEFAULT_FLOW_CONTROL_MAX_MESSAGES),
+            byte_limit=self._get_int_option('flowControlMaxBytes',
+                                            DEFAULT_FLOW_CONTROL_MAX_BYTES),
+            limit_exceeded_behavior=pubsub_v1.types.LimitExceededBehavior.BLOCK)
         publisher_options = pubsub_v1.types.PublisherOptions(
-            enable_message_ordering=True if 'ordering_key' in
-            self.output_config else False)
+            enable_message_ordering=True
+            if 'ordering_key' in self.output_config else False,
+            flow_control=flow_control)
         client_options = {}
         if 'api_endpoint' in self.output_config:
             client_options = {
                 "api_endpoint": self.output_config['api_endpoint']
             }
-        publisher = pubsub_v1.PublisherClient(
-            publisher_options=publisher_options, client_options=client_options)
-
-        publish_futures = []
-        if isinstance(messages, list):
-            new_messages = {}
-            for message in messages:
-                new_messages[hashlib.md5(
-                    json.dumps(message).encode()).hexdigest()] = message
-            messages = new_messages
-        for message_key, message_value in messages.items():
+
+        def _create_publisher():
+            return pubsub_v1.PublisherClient(
+                batch_settings=batch_settings,
+                publisher_options=publisher_options,
+                client_options=client_options)
+
+        # Publisher clients are thread-safe and shared across messages
+        publisher = get_client_registry().get_client(
+            ('pubsub.publisher', publisher_options.enable_message_ordering,
+             client_options.get('api_endpoint'), tuple(batch_settings),
+             flow_control.message_limit, flow_control.byte_limit),
+            _create_publisher)
+
+        results = PublishResults(publisher, topic_output, self.logger)
+        for message_key, message_value in self.get_messages(uses_key):
             attributes = {}
-            if 'attributes' in self.output_config:
-                attributes_template = self.jinja_environment.from_string(
-                    self.output_config['attributes'])
-                attributes_template.name = 'attributes'
-                attributes_output = attributes_template.render(
-                    key=message_key, value=message_value)
-                attributes = json.loads(attributes_output)
+            if attributes_template:
+                attributes = json.loads(
+                    attributes_template.render(key=message_key,
+                                               value=message_value))
 
             ordering_key = None
-            if 'ordering_key' in self.output_config:
-                ordering_key_template = self.jinja_environment.from_string(
-                    self.output_config['ordering_key'])
-                ordering_key_template.name = 'ordering_key'
+            if ordering_key_template:
                 ordering_key = ordering_key_template.render(key=message_key,
                                                             value=message_value)
 
-            content_template = self.jinja_environment.from_string(
-                self.output_config['content'])
-            content_template.name = 'content'
             content = content_template.render(key=message_key,
                                               value=message_value)
 
@@ -95,19 +231,25 @@ class PubsubOutput(Output):
                 future = publisher.publish(topic_output,
                                            data=content.encode('utf-8'),
                                            **attributes)
-            self.logger.info('Message published.',
-                             extra={
-                                 'key': message_key,
-                                 'topic': topic_output,
-                                 'attributes': attributes,
-                                 'ordering_key': ordering_key
-                             })
+            self.logger.debug('Message published.',
+                              extra={
+                                  'key': message_key,
+                                  'topic': topic_output,
+                                  'attributes': attributes,
+                                  'ordering_key': ordering_key
+                              })
             future.add_done_callback(self.callback)
-            publish_futures.append(future)
+            results.add(future, message_key, ordering_key)
 
-        futures.wait(publish_futures, return_when=futures.ALL_COMPLETED)
+        results.wait()
         self.logger.info('Message sending finished!',
                          extra={
-                             'count': len(publish_futures),
+                             'count': results.published,
+                             'failed': results.failed,
                              'topic': topic_output,
                          })
+        if results.failed > 0:
+            raise PublishFailedException(
+                'Failed to publish %d of %d messages to %s, first error: %s' %
+                (results.failed, results.published + results.failed,
+                 topic_output, results.first_error))
@@ -13,7 +13,7 @@
 #   limitations under the License.
 from .base import Output, NotConfiguredException
 import json
-from googleapiclient import discovery, errors
+from googleapiclient import errors
 
 
 class SccOutput(Output):
@@ -76,9 +76,7 @@ class SccOutput(Output):
                               'finding': finding
                           })
 
-        scc_service = discovery.build('securitycenter',
-                                      'v1',
-                                      http=self._get_branded_http())
+        scc_service = self._get_discovery_client('securitycenter', 'v1')
         request = scc_service.organizations().sources().findings().create(
             parent=source, findingId=finding_id, body=finding)
         try:
@@ -11,14 +11,11 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-from googleapiclient import discovery, http
 import abc
-from helpers.base import BaseHelper, Context
+from helpers.base import BaseHelper, Context, run_in_executor
+from helpers.projects import get_project_cache
 import copy
 
-_PROJECT_NUM_CACHE = {}
-_PROJECT_ID_CACHE = {}
-
 
 class NotConfiguredException(Exception):
     pass
@@ -48,58 +45,30 @@ class Processor(BaseHelper):
         super().__init__(jinja_environment)
 
     def expand_projects(self, projects):
+        """Returns (project ID, project number, name, labels) tuples for a
+        list of project IDs or numbers (see helpers.projects.ProjectCache)."""
         ret = []
         self.logger.debug('Expanding projects list.',
                           extra={'projects': projects})
 
+        keys = []
         for project in projects:
             if project.startswith('projects/'):
                 project = project[9:]
             if project.endswith('/'):
                 project = project[0:len(project) - 1]
-
-            if project.isdecimal():
-                if len(_PROJECT_NUM_CACHE) == 0:
-                    service = discovery.build('cloudresourcemanager', 'v1')
-                    service._http = http.set_user_agent(service._http,
-                                                        self._get_user_agent())
-
-                    request = service.projects().list()
-                    response = request.execute()
-                    while request:
-                        for p in response['projects']:
-                            _PROJECT_NUM_CACHE[p['projectNumber']] = (
-                                p['projectId'], p['projectNumber'], p['name'],
-                                p['labels'] if 'labels' in p else {})
-                        request = service.projects().list_next(
-                            request, response)
-                        if request:
-                            response = request.execute()
-
-                project_parts = project.split('/')
-                if len(project_parts) == 1:
-                    project_num = project_parts[0]
-                else:
-                    project_num = project_parts[1]
-                if project_num not in _PROJECT_NUM_CACHE:
-                    raise UnknownProjectException('Unknown project ID %s!' %
-                                                  project_num)
-
-                ret.append(_PROJECT_NUM_CACHE[project_num])
-            else:
-                if '/' not in project and project not in _PROJECT_ID_CACHE:
-                    service = discovery.build('cloudresourcemanager', 'v1')
-                    service._http = http.set_user_agent(service._http,
-                                                        self._get_user_agent())
-                    request = service.projects().get(projectId=project)
-                    response = request.execute()
-                    _PROJECT_ID_CACHE[response['projectId']] = (
-                        response['projectId'], response['projectNumber'],
-                        response['name'],
-                        response['labels'] if 'labels' in response else {})
-
-                if project in _PROJECT_ID_CACHE:
-                    ret.append(_PROJECT_ID_CACHE[project])
+            if '/' not in project:
+                keys.append(project)
+
+        project_cache = get_project_cache()
+        for key, project in zip(
+                keys,
+                project_cache.get_projects(
+                    keys, lambda: self._get_discovery_client(
+                        'cloudresourcemanager', 'v1'))):
+            if project is None:
+                raise UnknownProjectException('Unknown project ID %s!' % key)
+            ret.append(project)
         self.logger.debug('Expanding projects list finished.',
                           extra={'projects': ret})
         return ret
@@ -108,6 +77,14 @@ class Processor(BaseHelper):
     def process(self, output_var=None):
         pass
 
+    async def process_async(self, output_var=None):
+        """Asynchronous variant of process(), used by the asyncio pipeline
+        executor. Processors doing network I/O can override this with a native
+        implementation; by default process() is run in a worker thread."""
+        if output_var:
+            return await run_in_executor(self.process, output_var=output_var)
+        return await run_in_executor(self.process)
+
     @staticmethod
     @abc.abstractmethod
     def get_default_config_key():
@@ -12,15 +12,88 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
+from helpers.base import get_client_registry
+from helpers.bigquery import QueryResults, get_query_result_cache
 import json
 from google.cloud import bigquery
 
 
 class BigqueryProcessor(Processor):
+    """
+    Runs a BigQuery query and returns the results.
+
+    Args:
+        query (str): Query to run.
+        dialect (str, optional): Query dialect, "standard" (default) or "legacy".
+        labels (dict, optional): Labels for the query job.
+        project (str, optional): Google Cloud project to issue BigQuery API calls against.
+        streaming (bool, optional): Return the results as a lazy iterable instead of a list. Rows
+          are read as Arrow record batches through the BigQuery Storage Read API while the
+          template iterates over them, so large results are never held in memory at once
+          (the number of rows is available via the length filter).
+        maxRows (int, optional): Maximum number of rows to return.
+        columns (list, optional): Only return these columns (read through the Storage Read API
+          in streaming mode).
+        cacheTtl (int, optional): Cache results by query text for this many seconds, so
+          identical queries from other messages are not run again (defaults to 0, no caching).
+          Streaming results refer to the query's temporary results table, which is kept by
+          BigQuery for about 24 hours.
+    """
 
     def get_default_config_key():
         return 'bigquery'
 
+    def _get_read_client(self):
+        """Returns a shared BigQuery Storage Read API client."""
+
+        def _create_read_client():
+            from google.cloud import bigquery_storage_v1
+
+            return bigquery_storage_v1.BigQueryReadClient(
+                client_info=self._get_grpc_client_info())
+
+        return get_client_registry().get_client(('bigquery.read',),
+                                                _create_read_client)
+
+    def _get_bigquery_client(self, project=None):
+        return bigquery.Client(client_info=self._get_grpc_client_info(),
+                               project=project)
+
+    def get_results(self, client, query_job, streaming, max_rows, columns):
+        results = query_job.result(
+            max_results=max_rows if not streaming else None)
+        selected_fields = None
+        if columns:
+            unknown = set(columns) - set(
+                [field.name for field in results.schema])
+            if len(unknown) > 0:
+                raise NotConfiguredException(
+                    'Unknown columns in BigQuery results: %s' %
+                    (', '.join(sorted(unknown))))
+            selected_fields = [
+                field for field in results.schema if field.name in columns
+            ]
+
+        # Scripts and DML statements have no destination table to read from
+        if streaming and query_job.destination is not None:
+            return QueryResults(client,
+                                query_job.destination,
+                                results.total_rows,
+                                selected_fields=selected_fields,
+                                max_rows=max_rows,
+                                bqstorage_client=self._get_read_client())
+
+        records = []
+        for row in results:
+            record = dict(row.items())
+            if columns:
+                record = dict([(k, v) for k, v in record.items() if k in columns
+                              ])
+            records.append(record)
+            if max_rows is not None and len(records) >= max_rows:
+                break
+        return records
+
     def process(self, output_var='records'):
         bigquery_config = self.config
         if 'query' not in bigquery_config:
@@ -40,12 +113,37 @@ class BigqueryProcessor(Processor):
 
         dialect = 'legacy' if 'dialect' in bigquery_config and bigquery_config[
             'dialect'].lower() == 'legacy' else 'standard'
-        self.logger.debug('Running BigQuery query.', extra={'query': query})
+        streaming = self._jinja_expand_bool(
+            bigquery_config['streaming'],
+            'streaming') if 'streaming' in bigquery_config else False
+        max_rows = self._jinja_expand_int(
+            bigquery_config['maxRows'],
+            'max_rows') if 'maxRows' in bigquery_config else None
+        columns = self._jinja_var_to_list(
+            bigquery_config['columns'],
+            'columns') if 'columns' in bigquery_config else None
+        cache_ttl = self._jinja_expand_int(
+            bigquery_config['cacheTtl'],
+            'cache_ttl') if 'cacheTtl' in bigquery_config else 0
 
         project = bigquery_config[
             'project'] if 'project' in bigquery_config else None
-        client = bigquery.Client(client_info=self._get_grpc_client_info(),
-                                 project=project)
+        cache_key = (project, dialect, query, streaming, max_rows,
+                     tuple(columns) if columns else None)
+        if cache_ttl > 0:
+            records = get_query_result_cache().get(cache_key)
+            if records is not None:
+                self.logger.debug('Using cached BigQuery results.',
+                                  extra={
+                                      'query': query,
+                                      'count': len(records)
+                                  })
+                return {
+                    output_var: records,
+                }
+
+        self.logger.debug('Running BigQuery query.', extra={'query': query})
+        client = self._get_bigquery_client(project)
         labels = {}
         if 'labels' in bigquery_config:
             labels = bigquery_config['labels']
@@ -54,15 +152,15 @@ class BigqueryProcessor(Processor):
             labels=labels)
 
         query_job = client.query(query, job_config=job_options)
-        results = query_job.result()
-        records = []
-        for row in results:
-            record = {}
-            for k in row.keys():
-                record[k] = row.get(k)
-            records.append(record)
+        records = self.get_results(client, query_job, streaming, max_rows,
+                                   columns)
+        if cache_ttl > 0:
+            get_query_result_cache().put(cache_key, records, cache_ttl)
         self.logger.debug('BigQuery execution finished.',
-                          extra={'count': len(records)})
+                          extra={
+                              'count': len(records),
+                              'streaming': isinstance(records, QueryResults)
+                          })
         return {
             output_var: records,
         }
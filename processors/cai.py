@@ -11,27 +11,223 @@
 #   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
-from .base import Processor, NotConfiguredException
-from googleapiclient import discovery
+from .base import Processor, NotConfiguredException, ProcessorException
+import re
+import json
+import time
+from datetime import datetime, timezone
+from functools import partial
+from dateutil import parser as date_parser
+
+DEFAULT_EXPORT_TIMEOUT = 1800
+EXPORT_POLL_INTERVAL = 5
+INDEXES = ['name', 'assetType', 'project', 'ancestor', 'label', 'location']
+
+
+def _camel_case(key):
+    return re.sub(r'_([a-z])', lambda m: m.group(1).upper(), key)
+
+
+def normalize_asset(asset):
+    """Renames the snake_case fields of exported assets to the camelCase
+    fields returned by assets.list (resource data is left untouched)."""
+    normalized = {}
+    for key, value in asset.items():
+        if key == 'resource' and isinstance(value, dict):
+            value = dict([(k if k == 'data' else _camel_case(k), v)
+                          for k, v in value.items()])
+        normalized[_camel_case(key)] = value
+    return normalized
+
+
+class AssetIndexes:
+    """In-memory lookup tables of assets. The name index maps asset names
+    to assets, the other indexes map keys to lists of assets:
+
+      - assetType: asset type
+      - project: projects/NUMBER of the asset's project
+      - ancestor: every ancestor (projects/, folders/ and organizations/)
+      - label: both "key" and "key=value" of the resource labels
+      - location: resource location
+    """
+
+    def __init__(self, indexes):
+        self.indexes = dict([(index, {}) for index in indexes])
+
+    def _keys(self, index, asset):
+        if index == 'assetType':
+            return [asset['assetType']] if 'assetType' in asset else []
+        ancestors = asset.get('ancestors', [])
+        if index == 'project':
+            return [a for a in ancestors if a.startswith('projects/')]
+        if index == 'ancestor':
+            return ancestors
+        resource = asset.get('resource', {})
+        if index == 'location':
+            return [resource['location']] if 'location' in resource else []
+        keys = []
+        labels = resource.get('data', {}).get('labels', {})
+        if isinstance(labels, dict):
+            for label, value in labels.items():
+                keys.append(label)
+                keys.append('%s=%s' % (label, value))
+        return keys
+
+    def add(self, asset):
+        for index, entries in self.indexes.items():
+            if index == 'name':
+                entries[asset['name']] = asset
+                continue
+            for key in self._keys(index, asset):
+                if key not in entries:
+                    entries[key] = []
+                entries[key].append(asset)
+
+    def get_variables(self, output_var):
+        """Returns the indexes as template variables (eg. assets_by_name,
+        assets_by_asset_type)."""
+        return dict([
+            ('%s_by_%s' %
+             (output_var, re.sub(r'([A-Z])', r'_\1', index).lower()), entries)
+            for index, entries in self.indexes.items()
+        ])
+
+
+class AssetStream:
+    """Lazily iterable assets, fetched or read again on every iteration."""
+
+    def __init__(self, reader):
+        self.reader = reader
+
+    def __iter__(self):
+        return self.reader()
 
 
 class CaiProcessor(Processor):
+    """
+    Retrieves assets from Cloud Asset Inventory.
+
+    Args:
+        parent (str): Parent to list assets under (eg. organizations/123).
+        assetTypes (list, optional): Asset types to retrieve.
+        contentType (str, optional): Content type (eg. RESOURCE, IAM_POLICY).
+        readTime (str, optional): Retrieve assets at this point in time.
+        pageSize (int, optional): Page size when listing assets.
+        exportUri (str, optional): Export the assets to this Cloud Storage object
+          (gs://bucket/object) using exportAssets and read them from the export as a stream,
+          instead of listing them. Recommended for large inventories.
+        exportTimeout (int, optional): Seconds to wait for the export (defaults to 1800).
+        assetsFile (str, optional): Read assets from an existing export (a local file or
+          Cloud Storage object in JSON Lines format) instead of calling the API.
+        indexing (str, optional): Return assets as a dict of lists by asset type ("asset_type",
+          the default), a single list ("list") or as a lazy iterable that fetches or reads
+          the assets again whenever it's iterated over ("stream").
+        indexes (list, optional): Build lookup tables of the assets, available as
+          variables named after the output variable (eg. assets_by_name, assets_by_asset_type,
+          assets_by_project, assets_by_ancestor, assets_by_label, assets_by_location).
+        incremental (bool, optional): Only return assets updated since the previous run
+          (deleted assets are not returned).
+        stateFile (str, optional): Local file or Cloud Storage object (gs://bucket/object) where
+          the read time of the previous incremental run is stored. The new read time is saved
+          only after the whole pipeline has processed the message successfully.
+        since (str, optional): For incremental runs, return assets updated after this time
+          instead of the time stored in stateFile (eg. when saving the read time with
+          another output).
+
+    The read time of the assets is available in the <output>_read_time variable (eg.
+    assets_read_time) and, for incremental runs, the time assets were compared against in
+    <output>_since.
+    """
 
     def get_default_config_key():
         return 'cai'
 
+    def list_assets(self, cai_service, request_parameters):
+        request_parameters = dict(request_parameters)
+        page_token = None
+        while True:
+            if page_token is not None:
+                request_parameters['pageToken'] = page_token
+            request = cai_service.assets().list(**request_parameters)
+            response = request.execute()
+            if 'assets' in response:
+                for asset in response['assets']:
+                    yield asset
+
+            if 'nextPageToken' in response:
+                page_token = response['nextPageToken']
+            else:
+                break
+
+    def export_assets(self, cai_service, request_parameters, export_uri):
+        body = {'outputConfig': {'gcsDestination': {'uri': export_uri}}}
+        for k in ['readTime', 'contentType', 'assetTypes']:
+            if k in request_parameters:
+                body[k] = request_parameters[k]
+        operation = cai_service.v1().exportAssets(
+            parent=request_parameters['parent'], body=body).execute()
+        self.logger.info('Started Cloud Asset Inventory export.',
+                         extra={
+                             'operation': operation['name'],
+                             'uri': export_uri
+                         })
+
+        timeout = self._jinja_expand_int(
+            self.config['exportTimeout'], 'export_timeout'
+        ) if 'exportTimeout' in self.config else DEFAULT_EXPORT_TIMEOUT
+        start_time = time.monotonic()
+        while not operation.get('done', False):
+            if time.monotonic() - start_time > timeout:
+                raise ProcessorException(
+                    'Timed out waiting for Cloud Asset Inventory export %s.' %
+                    (operation['name']))
+            time.sleep(EXPORT_POLL_INTERVAL)
+            operation = cai_service.operations().get(
+                name=operation['name']).execute()
+        if 'error' in operation:
+            raise ProcessorException(
+                'Cloud Asset Inventory export failed: %s' %
+                (operation['error'].get('message', operation['error'])))
+        self.logger.info('Cloud Asset Inventory export finished.',
+                         extra={
+                             'operation': operation['name'],
+                             'uri': export_uri,
+                             'seconds': round(time.monotonic() - start_time)
+                         })
+
+    def read_export(self, path):
+        for asset in self._read_json_lines(path):
+            yield normalize_asset(asset)
+
+    def load_read_time(self, state_file):
+        try:
+            with self._open_file(state_file) as f:
+                return json.load(f)['readTime']
+        except Exception as exc:
+            self.logger.info(
+                'No previous read time for incremental assets: %s' % (exc),
+                extra={'state_file': state_file})
+        return None
+
+    def save_read_time(self, state_file, since, read_time):
+        with self._open_file(state_file, 'w') as f:
+            f.write(json.dumps({'readTime': read_time}))
+        self.logger.debug('Saved read time for incremental assets.',
+                          extra={
+                              'state_file': state_file,
+                              'since': since,
+                              'read_time': read_time
+                          })
+
     def process(self, output_var='assets'):
         cai_config = self.config
-        if 'parent' not in cai_config:
+        if 'parent' not in cai_config and 'assetsFile' not in cai_config:
             raise NotConfiguredException('No parent configured!')
 
-        cai_service = discovery.build('cloudasset',
-                                      'v1',
-                                      http=self._get_branded_http())
-
         request_parameters = {}
-        request_parameters['parent'] = self._jinja_expand_string(
-            cai_config['parent'])
+        if 'parent' in cai_config:
+            request_parameters['parent'] = self._jinja_expand_string(
+                cai_config['parent'])
 
         for k in ['readTime', 'pageSize', 'contentType']:
             if k in cai_config:
@@ -42,30 +238,94 @@ class CaiProcessor(Processor):
 
         indexing = 'asset_type'
         if 'indexing' in cai_config:
-            if cai_config['indexing'] == 'list':
-                indexing = 'list'
-        if indexing == 'asset_type':
-            assets = {}
-        else:
-            assets = []
-        page_token = None
-        while True:
-            if page_token is not None:
-                request_parameters['pageToken'] = page_token
-            request = cai_service.assets().list(**request_parameters)
-            response = request.execute()
-            if 'assets' in response:
-                for asset in response['assets']:
-                    if indexing == 'asset_type':
-                        if asset['assetType'] not in assets:
-                            assets[asset['assetType']] = []
-                        assets[asset['assetType']].append(asset)
-                    elif indexing == 'list':
-                        assets.append(asset)
+            if cai_config['indexing'] in ['list', 'stream']:
+                indexing = cai_config['indexing']
+        indexes = None
+        if 'indexes' in cai_config:
+            indexes = self._jinja_var_to_list(cai_config['indexes'], 'indexes')
+            unknown = set(indexes) - set(INDEXES)
+            if len(unknown) > 0:
+                raise NotConfiguredException(
+                    'Unknown asset indexes: %s (use one of: %s)' %
+                    (', '.join(sorted(unknown)), ', '.join(INDEXES)))
+            indexes = AssetIndexes(indexes)
 
-            if 'nextPageToken' in response:
-                page_token = response['nextPageToken']
+        # Assets changed while this run is in progress are returned again
+        # by the next incremental run
+        read_time = request_parameters.get(
+            'readTime',
+            datetime.now(timezone.utc).isoformat().replace('+00:00', 'Z'))
+        state_file = None
+        since = None
+        incremental = 'incremental' in cai_config and self._jinja_expand_bool(
+            cai_config['incremental'], 'incremental')
+        if incremental:
+            if 'since' not in cai_config and 'stateFile' not in cai_config:
+                raise NotConfiguredException(
+                    'No since or state file configured for incremental assets!')
+            if 'stateFile' in cai_config:
+                state_file = self._jinja_expand_string(cai_config['stateFile'],
+                                                       'state_file')
+            if 'since' in cai_config:
+                since = self._jinja_expand_string(cai_config['since'], 'since')
             else:
-                break
+                since = self.load_read_time(state_file)
+            if since == '':
+                since = None
+
+        if 'assetsFile' in cai_config:
+            assets_file = self._jinja_expand_string(cai_config['assetsFile'],
+                                                    'assets_file')
+            reader = partial(self.read_export, assets_file)
+        else:
+            cai_service = self._get_discovery_client('cloudasset', 'v1')
+            if 'exportUri' in cai_config:
+                export_uri = self._jinja_expand_string(cai_config['exportUri'],
+                                                       'export_uri')
+                self.export_assets(cai_service, request_parameters, export_uri)
+                reader = partial(self.read_export, export_uri)
+            else:
+                reader = partial(self.list_assets, cai_service,
+                                 request_parameters)
+
+        def read_assets():
+            since_time = date_parser.isoparse(since) if since else None
+            for asset in reader():
+                if since_time and 'updateTime' in asset and date_parser.isoparse(
+                        asset['updateTime']) <= since_time:
+                    continue
+                yield asset
+
+        if indexing == 'stream':
+            assets = AssetStream(read_assets)
+            if indexes:
+                for asset in read_assets():
+                    indexes.add(asset)
+        else:
+            assets = {} if indexing == 'asset_type' else []
+            for asset in read_assets():
+                if indexing == 'asset_type':
+                    if asset['assetType'] not in assets:
+                        assets[asset['assetType']] = []
+                    assets[asset['assetType']].append(asset)
+                elif indexing == 'list':
+                    assets.append(asset)
+                if indexes:
+                    indexes.add(asset)
+
+        if state_file:
+            # The read time is only saved once the whole pipeline has
+            # processed the message, so that assets are returned again if a
+            # later task fails and the message is retried
+            self._on_success(
+                partial(self.save_read_time, state_file, since, read_time))
 
-        return {output_var: assets}
+        ret = {
+            output_var: assets,
+            '%s_read_time' % (output_var): read_time,
+        }
+        if incremental:
+            ret['%s_since' % (output_var)] = since
+        if indexes:
+            ret.update(indexes.get_variables(output_var))
+        return ret
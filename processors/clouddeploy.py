@@ -13,7 +13,6 @@
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
 import google.auth
-from googleapiclient import discovery
 import time
 
 
@@ -71,8 +70,8 @@ class ClouddeployProcessor(Processor):
         pipeline_full_name = "projects/%s/locations/%s/deliveryPipelines/%s" % (
             project, region_name, pipeline_name)
 
-        deploy_service = discovery.build(
-            'clouddeploy', 'v1', http=self._get_branded_http(credentials))
+        deploy_service = self._get_discovery_client('clouddeploy', 'v1',
+                                                    credentials)
         deploy_base_request = deploy_service.projects().locations(
         ).deliveryPipelines()
 
@@ -13,7 +13,6 @@
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
 import google.auth
-from googleapiclient import discovery
 
 
 class CloudrunProcessor(Processor):
@@ -46,9 +45,7 @@ class CloudrunProcessor(Processor):
         if not project:
             project = credentials.quota_project_id
 
-        run_service = discovery.build('run',
-                                      'v2',
-                                      http=self._get_branded_http(credentials))
+        run_service = self._get_discovery_client('run', 'v2', credentials)
 
         location = self._jinja_expand_string(self.config['location'])
         job = self._jinja_expand_string(self.config['job'])
@@ -50,15 +50,22 @@ class CompressProcessor(Processor):
         if 'strip' in self.config:
             strip = int(self._jinja_expand_int(self.config['strip'], 'strip'))
 
-        self._init_tempdir()
-        directory = os.path.dirname(output)
+        tempdir = self._init_tempdir()
+        directory = os.path.dirname(self._get_path(output))
         if directory and not os.path.exists(directory):
             self.logger.debug(
                 'Creating directory under temporary directory: %s' %
                 (directory))
             os.makedirs(directory, exist_ok=True)
 
-        files_to_consider = glob.glob(glob_spec, recursive=True)
+        if os.path.isabs(glob_spec):
+            files_to_consider = glob.glob(glob_spec, recursive=True)
+        else:
+            files_to_consider = list(
+                map(
+                    lambda f: os.path.relpath(f, tempdir),
+                    glob.glob(os.path.join(glob.escape(tempdir), glob_spec),
+                              recursive=True)))
         if len(files_to_consider) == 0:
             self.logger.error('No files found to compress: %s' % (glob_spec),
                               extra={'glob': glob_spec})
@@ -99,13 +106,14 @@ class CompressProcessor(Processor):
 
             self.logger.info('Compressing %d files to ZIP: %s' %
                              (len(files), output))
-            zip_file = zipfile.ZipFile(output, 'x', zip_compression)
+            zip_file = zipfile.ZipFile(self._get_path(output), 'x',
+                                       zip_compression)
             for fname in files:
                 target_name = fname
                 if strip:
                     file_parts = fname.split(os.path.sep)
                     target_name = os.path.sep.join(file_parts[strip:])
-                zip_file.write(fname, target_name)
+                zip_file.write(self._get_path(fname), target_name)
             zip_file.close()
         elif format_spec == 'tar' or format_spec == 'tar.gz' or format_spec == 'tar.bz2' or format_spec == 'tar.xz':
             tar_mode = 'x:'
@@ -119,16 +127,16 @@ class CompressProcessor(Processor):
             self.logger.info('Compressing %d files to %s: %s' %
                              (len(files), format_spec.upper(), output))
 
-            tar_file = tarfile.open(output, tar_mode)
+            tar_file = tarfile.open(self._get_path(output), tar_mode)
             for fname in files:
                 target_name = fname
                 if strip:
                     file_parts = fname.split(os.path.sep)
                     target_name = os.path.sep.join(file_parts[strip:])
-                tar_file.add(fname, target_name)
+                tar_file.add(self._get_path(fname), target_name)
             tar_file.close()
 
-        file_stats = os.stat(output)
+        file_stats = os.stat(self._get_path(output))
         return {
             output_var: {
                 'path': output,
@@ -13,7 +13,6 @@
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
 import google.auth
-from googleapiclient import discovery
 import time
 import re
 
@@ -111,8 +110,8 @@ class ComputeengineProcessor(Processor):
         if not project:
             project = credentials.quota_project_id
 
-        compute_service = discovery.build(
-            'compute', 'v1', http=self._get_branded_http(credentials))
+        compute_service = self._get_discovery_client('compute', 'v1',
+                                                     credentials)
 
         timeout = self._jinja_expand_int(
             self.config['timeout']) if 'timeout' in self.config else 30
@@ -430,13 +429,14 @@ class ComputeengineProcessor(Processor):
             snapshot_name = self._jinja_expand_string(
                 self.config['snapshotName'], 'snapshot_name')
 
-            compute_service_beta = discovery.build(
+            compute_service_beta = self._get_discovery_client(
                 'compute',
                 'beta',
+                credentials,
                 cache_discovery=False,
                 discoveryServiceUrl=
-                'https://www.googleapis.com/discovery/v1/apis/compute/beta/rest',
-                http=self._get_branded_http(credentials))
+                'https://www.googleapis.com/discovery/v1/apis/compute/beta/rest'
+            )
 
             if self.config['mode'].lower() == 'disks.instantsnapshots.create':
                 request_body = {
@@ -13,7 +13,6 @@
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
 import google.auth
-from googleapiclient import discovery
 
 
 class ContaineranalysisProcessor(Processor):
@@ -40,8 +39,8 @@ class ContaineranalysisProcessor(Processor):
         if not project:
             project = credentials.quota_project_id
 
-        container_service = discovery.build(
-            'containeranalysis', 'v1', http=self._get_branded_http(credentials))
+        container_service = self._get_discovery_client('containeranalysis',
+                                                       'v1', credentials)
 
         if '/occurrences/' in name:
             request = container_service.projects().occurrences().get(name=name)
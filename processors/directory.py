@@ -12,8 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
-from googleapiclient import discovery
-from google.oauth2.credentials import Credentials
 
 
 class DirectoryProcessor(Processor):
@@ -52,18 +50,15 @@ class DirectoryProcessor(Processor):
         if directory_config['api'] == 'users':
             scope = 'https://www.googleapis.com/auth/admin.directory.user.readonly'
 
-        credentials = Credentials(
-            self.get_token_for_scopes([scope], service_account=service_account))
+        credentials = self.get_credentials_for_scopes(
+            [scope], service_account=service_account)
 
-        branded_http = self._get_branded_http(credentials)
         if directory_config['api'] != 'groupsettings':
-            directory_service = discovery.build('admin',
-                                                'directory_v1',
-                                                http=branded_http)
+            directory_service = self._get_discovery_client(
+                'admin', 'directory_v1', credentials)
         else:
-            groups_service = discovery.build('groupssettings',
-                                             'v1',
-                                             http=branded_http)
+            groups_service = self._get_discovery_client('groupssettings', 'v1',
+                                                        credentials)
 
         query = directory_config['query'] if 'query' in directory_config else ''
         query_template = self.jinja_environment.from_string(query)
@@ -12,7 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
-from googleapiclient import discovery
 import google.auth
 
 
@@ -49,9 +48,7 @@ class DnsProcessor(Processor):
                                                   'changes')
         dns_changes['kind'] = 'dns#change'
 
-        dns_service = discovery.build('dns',
-                                      'v1',
-                                      http=self._get_branded_http(credentials))
+        dns_service = self._get_discovery_client('dns', 'v1', credentials)
 
         dns_request = dns_service.changes().create(project=project,
                                                    managedZone=zone,
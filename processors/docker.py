@@ -13,7 +13,6 @@
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
 import google.auth
-from googleapiclient import discovery
 import time
 from _vendor.python_docker.registry import Registry
 
@@ -197,10 +196,8 @@ class DockerProcessor(Processor):
                                  'tag': tag
                              })
             if '.pkg.dev' in hostname:
-                ar_service = discovery.build(
-                    'artifactregistry',
-                    'v1',
-                    http=self._get_branded_http(credentials))
+                ar_service = self._get_discovery_client('artifactregistry',
+                                                        'v1', credentials)
 
                 location = hostname.replace('https://',
                                             '').replace('-docker.pkg.dev', '')
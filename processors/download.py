@@ -14,9 +14,9 @@
 from .base import Processor, NotConfiguredException
 import urllib
 import os
-import paramiko
 from io import StringIO
 import base64
+import shutil
 
 
 class DownloadProcessor(Processor):
@@ -60,11 +60,11 @@ class DownloadProcessor(Processor):
             self.logger.debug('Removed %d path parts, saving file to: %s/%s' %
                               (strip_components, directory, filename))
 
-        if directory and not os.path.exists(directory):
+        if directory and not os.path.exists(self._get_path(directory)):
             self.logger.debug(
                 'Creating directory under temporary directory: %s' %
                 (directory))
-            os.makedirs(directory, exist_ok=True)
+            os.makedirs(self._get_path(directory), exist_ok=True)
 
         self.logger.info('Downloading from %s to %s' % (url, filename),
                          extra={
@@ -78,31 +78,34 @@ class DownloadProcessor(Processor):
                 request_body = self._jinja_expand_string(
                     self.config['body'], 'body')
 
+            # Use a per-request opener instead of installing a global one,
+            # so concurrent messages do not share request headers
+            opener = urllib.request.build_opener()
             if 'headers' in self.config:
                 request_headers = self._jinja_expand_dict(
                     self.config['headers'], 'headers')
-                opener = urllib.request.build_opener()
                 for k, v in request_headers.items():
                     opener.addheaders.append((k, v))
-                urllib.request.install_opener(opener)
 
-            local_filename, headers = urllib.request.urlretrieve(
-                url,
-                filename=filename,
-                data=request_body,
-            )
+            local_filename = filename
+            with opener.open(url, data=request_body) as response:
+                headers = response.info()
+                with open(self._get_path(filename), 'wb') as local_file:
+                    shutil.copyfileobj(response, local_file)
 
             response_headers = {}
             for k, v in headers.items():
                 if k.lower() != 'set-cookie':
                     response_headers[k] = v
-            file_stats = os.stat(local_filename)
+            file_stats = os.stat(self._get_path(local_filename))
             output = {
                 'filename': local_filename,
                 'headers': response_headers,
                 'size': file_stats.st_size,
             }
         else:
+            import paramiko
+
             ssh_client = paramiko.SSHClient()
             if 'hostKey' not in self.config:
                 ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
@@ -173,12 +176,12 @@ class DownloadProcessor(Processor):
             sftp = paramiko.SFTPClient.from_transport(
                 ssh_client.get_transport())
 
-            sftp.get(filename, filename)
+            sftp.get(filename, self._get_path(filename))
 
             sftp.close()
             ssh_client.close()
 
-            file_stats = os.stat(filename)
+            file_stats = os.stat(self._get_path(filename))
             output = {
                 'filename': filename,
                 'headers': {},
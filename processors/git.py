@@ -42,11 +42,11 @@ class GitProcessor(Processor):
         if 'directory' in self.config:
             directory = self._jinja_expand_string(self.config['directory'],
                                                   'url')
-            if directory and not os.path.exists(directory):
+            if directory and not os.path.exists(self._get_path(directory)):
                 self.logger.debug(
                     'Creating directory under temporary directory: %s' %
                     (directory))
-                os.makedirs(directory, exist_ok=True)
+                os.makedirs(self._get_path(directory), exist_ok=True)
         else:
             directory = './'
 
@@ -70,9 +70,10 @@ class GitProcessor(Processor):
             key_file.write(private_key['key'].encode('utf-8'))
             git_ssh_cmd = 'ssh -i %s' % (key_file.name)
             with Git().custom_environment(GIT_SSH_COMMAND=git_ssh_cmd):
-                repo = Repo.clone_from(url, directory, **clone_args)
+                repo = Repo.clone_from(url, self._get_path(directory),
+                                       **clone_args)
         else:
-            repo = Repo.clone_from(url, directory, **clone_args)
+            repo = Repo.clone_from(url, self._get_path(directory), **clone_args)
 
         if 'branch' in self.config:
             branch = self._jinja_expand_string(self.config['branch'], 'branch')
@@ -12,8 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor
-from googleapiclient import discovery
-from google.oauth2.credentials import Credentials
 from urllib.parse import urlencode
 import re
 
@@ -34,16 +32,12 @@ class GroupsProcessor(Processor):
         service_account = groups_config[
             'serviceAccountEmail'] if 'serviceAccountEmail' in groups_config else None
 
-        group_credentials = Credentials(
-            self.get_token_for_scopes([
-                'https://www.googleapis.com/auth/cloud-identity.groups.readonly'
-            ],
-                                      service_account=service_account))
+        group_credentials = self.get_credentials_for_scopes(
+            ['https://www.googleapis.com/auth/cloud-identity.groups.readonly'],
+            service_account=service_account)
 
-        group_service = discovery.build(
-            'cloudidentity',
-            'v1',
-            http=self._get_branded_http(group_credentials))
+        group_service = self._get_discovery_client('cloudidentity', 'v1',
+                                                   group_credentials)
         query = groups_config['query'] if 'query' in groups_config else ""
 
         query_template = self.jinja_environment.from_string(query)
@@ -13,7 +13,6 @@
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
 import google.auth
-from googleapiclient import discovery
 import time
 
 
@@ -105,8 +104,8 @@ class LoadbalancingProcessor(Processor):
         if not project:
             project = credentials.quota_project_id
 
-        compute_service = discovery.build(
-            'compute', 'v1', http=self._get_branded_http(credentials))
+        compute_service = self._get_discovery_client('compute', 'v1',
+                                                     credentials)
 
         timeout = self._jinja_expand_int(
             self.config['timeout']) if 'timeout' in self.config else 30
@@ -12,8 +12,18 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
+import os
+import json
+import shutil
+import contextvars
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from dateutil import parser as date_parser
 import google.auth
-from googleapiclient import discovery
+
+# Maximum page size of entries.list
+DEFAULT_PAGE_SIZE = 1000
+MAX_SLICE_CONCURRENCY = 8
 
 
 class LoggingProcessor(Processor):
@@ -26,12 +36,94 @@ class LoggingProcessor(Processor):
         filter (str, optional): Logging filter.
         orderBy (str, optional): How to order log entries.
         format (str, optional): One of: full, text-only, with-timestamps (default full)
-        mode (str): One of: entries.list
+        mode (str): One of: logging.entries
+        pageSize (int, optional): Number of entries fetched per request (defaults to 1000).
+        maxEntries (int, optional): Maximum number of entries to return (entries skipped by
+          the text formats are not counted).
+        startTime (str, optional): Only fetch entries from this time onwards (eg.
+          2024-01-01T00:00:00Z).
+        endTime (str, optional): Only fetch entries before this time (defaults to now when
+          startTime is set).
+        slices (int, optional): Split the time range between startTime and endTime into this
+          many slices, which are fetched in parallel (up to 8 at a time).
+        outputFile (str, optional): Write the entries to this file instead of returning them
+          (one JSON object per line for the full format, otherwise one line per entry). The
+          output variable is then set to a dict with filename, count and size.
     """
 
     def get_default_config_key():
         return 'logging'
 
+    def _format_entry(self, msg_format, entry):
+        if msg_format == 'text-only' or msg_format == 'with-timestamps':
+            if 'textPayload' not in entry:
+                return None
+            if msg_format == 'with-timestamps':
+                return '%s %s' % (entry['receiveTimestamp'],
+                                  entry['textPayload'])
+            return entry['textPayload']
+        return entry
+
+    def _get_time_slices(self, start_time, end_time, slices):
+        """Returns (start, end) timestamps splitting a time range."""
+        start = date_parser.isoparse(start_time)
+        end = date_parser.isoparse(end_time) if end_time else datetime.now(
+            timezone.utc)
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=timezone.utc)
+        if end.tzinfo is None:
+            end = end.replace(tzinfo=timezone.utc)
+        step = (end - start) / max(1, slices)
+        boundaries = [start + step * i for i in range(max(1, slices))] + [end]
+        return [(boundaries[i].isoformat().replace('+00:00', 'Z'),
+                 boundaries[i + 1].isoformat().replace('+00:00', 'Z'))
+                for i in range(len(boundaries) - 1)]
+
+    def fetch_entries(self, credentials, request_params, msg_format,
+                      max_entries):
+        """Yields the formatted entries of an entries.list request, page by
+        page. Entries without a text payload are skipped in the text formats
+        and not counted towards max_entries."""
+        logging_service = self._get_discovery_client('logging', 'v2',
+                                                     credentials)
+        request_params = dict(request_params)
+        page_size = request_params['pageSize']
+        count = 0
+        while True:
+            if max_entries is not None:
+                request_params['pageSize'] = min(page_size, max_entries - count)
+            log_request = logging_service.entries().list(body=request_params)
+            log_response = log_request.execute()
+            if 'entries' in log_response:
+                for entry in log_response['entries']:
+                    item = self._format_entry(msg_format, entry)
+                    if item is None:
+                        continue
+                    yield item
+                    count += 1
+                    if max_entries is not None and count >= max_entries:
+                        return
+            if 'nextPageToken' in log_response:
+                request_params['pageToken'] = log_response['nextPageToken']
+            else:
+                break
+
+    def fetch_slice(self, credentials, request_params, msg_format, max_entries,
+                    output_file):
+        """Fetches the entries of a slice into a list, or into a file when
+        output_file is set. Returns the list or the number of entries."""
+        entries = self.fetch_entries(credentials, request_params, msg_format,
+                                     max_entries)
+        if output_file is None:
+            return list(entries)
+        count = 0
+        with open(output_file, 'w', encoding='utf-8') as f:
+            for item in entries:
+                f.write((json.dumps(item) if msg_format == 'full' else item) +
+                        '\n')
+                count += 1
+        return count
+
     def process(self, output_var='logging'):
         if 'mode' not in self.config:
             raise NotConfiguredException(
@@ -47,9 +139,6 @@ class LoggingProcessor(Processor):
         if not project:
             project = credentials.quota_project_id
 
-        logging_service = discovery.build(
-            'logging', 'v2', http=self._get_branded_http(credentials))
-
         resource_names = self._jinja_expand_list(self.config['resourceNames'])
         log_filter = self._jinja_expand_string(
             self.config['filter']) if 'filter' in self.config else ''
@@ -58,34 +147,112 @@ class LoggingProcessor(Processor):
         ) if 'orderBy' in self.config else 'timestamp asc'
 
         if self.config['mode'] == 'logging.entries':
-            request_params = {
-                "resourceNames": resource_names,
-                "filter": log_filter,
-                "orderBy": order_by,
-            }
             msg_format = self._jinja_expand_string(
                 self.config['format']) if 'format' in self.config else 'full'
-            ret = []
-            while True:
-                log_request = logging_service.entries().list(
-                    body=request_params)
-                log_response = log_request.execute()
-                if 'entries' in log_response:
-                    if msg_format == 'text-only' or msg_format == 'with-timestamps':
-                        for entry in log_response['entries']:
-                            if 'textPayload' in entry:
-                                if msg_format == 'with-timestamps':
-                                    ret.append('%s %s' %
-                                               (entry['receiveTimestamp'],
-                                                entry['textPayload']))
-                                else:
-                                    ret.append(entry['textPayload'])
-                    else:
-                        ret += log_response['entries']
-                if 'nextPageToken' in log_response:
-                    request_params['pageToken'] = log_response['nextPageToken']
-                else:
-                    break
-            return {output_var: ret}
+            page_size = self._jinja_expand_int(
+                self.config['pageSize'],
+                'page_size') if 'pageSize' in self.config else DEFAULT_PAGE_SIZE
+            max_entries = self._jinja_expand_int(
+                self.config['maxEntries'],
+                'max_entries') if 'maxEntries' in self.config else None
+
+            time_slices = [(None, None)]
+            if 'startTime' in self.config:
+                slices = self._jinja_expand_int(
+                    self.config['slices'],
+                    'slices') if 'slices' in self.config else 1
+                time_slices = self._get_time_slices(
+                    self._jinja_expand_string(self.config['startTime'],
+                                              'start_time'),
+                    self._jinja_expand_string(self.config['endTime'],
+                                              'end_time')
+                    if 'endTime' in self.config else None, slices)
+                # Slices are returned in the requested order
+                if 'desc' in order_by.lower():
+                    time_slices.reverse()
+
+            output_file = None
+            if 'outputFile' in self.config:
+                self._init_tempdir()
+                output_file = self._jinja_expand_string(
+                    self.config['outputFile'], 'output_file')
+
+            slice_requests = []
+            for slice_start, slice_end in time_slices:
+                slice_filter = log_filter
+                if slice_start is not None:
+                    time_filter = 'timestamp >= "%s" AND timestamp < "%s"' % (
+                        slice_start, slice_end)
+                    slice_filter = '(%s) AND %s' % (
+                        log_filter, time_filter) if log_filter else time_filter
+                slice_requests.append({
+                    "resourceNames": resource_names,
+                    "filter": slice_filter,
+                    "orderBy": order_by,
+                    "pageSize": page_size,
+                })
+
+            def fetch(index, request_params):
+                return self.fetch_slice(
+                    credentials, request_params, msg_format, max_entries,
+                    '%s.%d' % (self._get_path(output_file), index)
+                    if output_file is not None else None)
+
+            # Each slice is limited to maxEntries, so that the slices
+            # combined contain the first maxEntries entries
+            with ThreadPoolExecutor(max_workers=min(len(
+                    slice_requests), MAX_SLICE_CONCURRENCY)) as executor:
+                slice_fetches = [
+                    executor.submit(contextvars.copy_context().run, fetch,
+                                    index, request_params)
+                    for index, request_params in enumerate(slice_requests)
+                ]
+                results = [
+                    slice_fetch.result() for slice_fetch in slice_fetches
+                ]
+
+            if output_file is None:
+                ret = []
+                for entries in results:
+                    ret += entries
+                if max_entries is not None:
+                    ret = ret[0:max_entries]
+                self.logger.debug('Fetched log entries.',
+                                  extra={
+                                      'count': len(ret),
+                                      'slices': len(slice_requests)
+                                  })
+                return {output_var: ret}
+
+            count = 0
+            with open(self._get_path(output_file), 'w', encoding='utf-8') as f:
+                for index, slice_count in enumerate(results):
+                    slice_file = '%s.%d' % (self._get_path(output_file), index)
+                    with open(slice_file, 'r', encoding='utf-8') as slice_f:
+                        if max_entries is None:
+                            shutil.copyfileobj(slice_f, f)
+                            count += slice_count
+                        else:
+                            for line in slice_f:
+                                if count >= max_entries:
+                                    break
+                                f.write(line)
+                                count += 1
+                    os.unlink(slice_file)
+            file_stats = os.stat(self._get_path(output_file))
+            self.logger.info('Wrote log entries to file.',
+                             extra={
+                                 'file_name': output_file,
+                                 'count': count,
+                                 'size': file_stats.st_size,
+                                 'slices': len(slice_requests)
+                             })
+            return {
+                output_var: {
+                    'filename': output_file,
+                    'count': count,
+                    'size': file_stats.st_size,
+                }
+            }
 
         return {output_var: None}
@@ -12,7 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
-from googleapiclient import discovery
 
 
 class MonitoringProcessor(Processor):
@@ -25,9 +24,7 @@ class MonitoringProcessor(Processor):
         if 'timeSeries' not in monitoring_config:
             raise NotConfiguredException('No time series configured!')
 
-        monitoring_service = discovery.build('monitoring',
-                                             'v3',
-                                             http=self._get_branded_http())
+        monitoring_service = self._get_discovery_client('monitoring', 'v3')
 
         time_series = self._jinja_var_to_list(monitoring_config['timeSeries'])
 
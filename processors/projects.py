@@ -12,7 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor
-from googleapiclient import discovery
 
 
 class ProjectsProcessor(Processor):
@@ -23,9 +22,7 @@ class ProjectsProcessor(Processor):
     def process(self, output_var='projects'):
         projects_config = self.config
 
-        service = discovery.build('cloudresourcemanager',
-                                  'v1',
-                                  http=self._get_branded_http())
+        service = self._get_discovery_client('cloudresourcemanager', 'v1')
 
         projects = []
         if 'get' in projects_config:
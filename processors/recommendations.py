@@ -19,7 +19,6 @@ from google.cloud.recommender_v1.services.recommender import RecommenderClient
 from google.cloud.recommender_v1.types.recommendation import Recommendation
 from google.cloud.recommender_v1.types.insight import Insight
 from google.cloud.recommender_v1.types.recommender_service import ListInsightsRequest
-from googleapiclient import discovery
 from google.api_core.gapic_v1 import client_info as grpc_client_info
 from google.api_core.client_options import ClientOptions
 import fnmatch
@@ -433,10 +432,8 @@ class RecommendationsProcessor(Processor):
         client = RecommenderClient(client_info=client_info,
                                    client_options=client_options)
 
-        compute_service = discovery.build('compute',
-                                          'v1',
-                                          http=self._get_branded_http(),
-                                          client_options=client_options)
+        compute_service = self._get_discovery_client(
+            'compute', 'v1', client_options=client_options)
         if len(projects) == 0 and not quota_project_id:
             raise NotConfiguredException(
                 'Please specify at least one project (or quota project ID) to fetch regions and zones.'
@@ -77,6 +77,7 @@ class ShellscriptProcessor(Processor):
             capture_output=True,
             input=stdin,
             text=True,
+            cwd=self._get_tempdir(),
             env={
                 **os.environ,
                 **environment
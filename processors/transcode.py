@@ -12,7 +12,6 @@
 #   See the License for the specific language governing permissions and
 #   limitations under the License.
 from .base import Processor, NotConfiguredException
-from googleapiclient import discovery
 import google.auth
 
 
@@ -62,12 +61,12 @@ class TranscodeProcessor(Processor):
 
         job = self._jinja_expand_dict_all(self.config['job'], 'job')
 
-        transcoder_service = discovery.build(
+        transcoder_service = self._get_discovery_client(
             'transcoder',
             'v1',
+            credentials,
             discoveryServiceUrl=
-            'https://transcoder.googleapis.com/$discovery/rest?version=v1',
-            http=self._get_branded_http(credentials))
+            'https://transcoder.googleapis.com/$discovery/rest?version=v1')
         job_response = None
         if mode == 'create':
             job_request = transcoder_service.projects().locations().jobs(
@@ -0,0 +1,1011 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+"""Benchmarks message processing by replaying the test fixtures through
+process_pubsub() with the test and example configurations.
+
+Google APIs are replaced with local stand-ins: Cloud Storage with an
+in-memory storage emulator, Pub/Sub with a publisher that resolves
+immediately, discovery based APIs and plain HTTP calls (requests, httplib2
+and urllib) with canned responses, service account tokens and project
+numbers with fixed values, and SMTP with a mock. Connections to anything but
+the local host are refused, so nothing reaches the network. Configurations
+using gRPC based APIs that have no stand-in are skipped, as are
+configurations that fail with the stand-ins (eg. examples that need real
+resources or credentials): only configurations processing every message
+successfully are measured.
+
+Comparisons are relative to the speed of the host: every run times a fixed
+workload, and the baseline numbers are scaled by how much faster or slower
+it ran than when the baseline was recorded. This only compensates for CPU
+speed, so for reliable comparisons regenerate the baseline on the host
+that runs the comparison (eg. before making changes).
+
+Run with:
+
+    python3 -m test.benchmark --output test/benchmark-baseline.json
+    python3 -m test.benchmark --compare test/benchmark-baseline.json
+"""
+import argparse
+import errno
+import glob
+import io
+import json
+import math
+import os
+import platform
+import re
+import socket
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.parse
+import uuid
+from concurrent import futures
+from contextlib import contextmanager, redirect_stdout
+from datetime import datetime
+from functools import partial
+from unittest import mock
+
+import yaml
+
+import main
+from helpers.base import Context, get_client_registry
+
+DEFAULT_ITERATIONS = 20
+DEFAULT_MAX_REGRESSION = 20.0
+DEFAULT_MIN_DURATION = 1.0
+CALIBRATION_ROUNDS = 50
+DEFAULT_RETRIES = 1
+
+# Placeholders in the test configurations, as filled in by the unit tests
+DEFAULT_PARAMS = {
+    '%{BUCKET}': 'benchmark-bucket',
+    '%{PROJECT}': 'benchmark',
+}
+CONFIG_PARAMS = {
+    'parallel': {
+        'PARALLEL_EXIT_CODE': '0'
+    },
+}
+
+# Fixtures for configurations not named after their fixture
+CONFIG_FIXTURES = {
+    'container-analysis': 'container-analysis-occurrence',
+    'container-analysis-slack': 'container-analysis-occurrence',
+    'groups-settings': 'groupssettings',
+}
+
+# Processors and outputs using gRPC based APIs, which have no stand-in
+UNSUPPORTED_HANDLERS = ['budget', 'recommendations', 'secret']
+
+
+def percentile(values, pct):
+    """Returns the nearest-rank percentile of a list of values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(math.ceil(pct / 100.0 * len(ordered)), 1)
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def summarize(values):
+    """Returns latency statistics (in milliseconds) for durations in
+    seconds."""
+    if not values:
+        return {}
+    return {
+        'mean': round(sum(values) / len(values) * 1000, 3),
+        'p50': round(percentile(values, 50) * 1000, 3),
+        'p95': round(percentile(values, 95) * 1000, 3),
+        'p99': round(percentile(values, 99) * 1000, 3),
+        'max': round(max(values) * 1000, 3),
+    }
+
+
+def calibrate(rounds=CALIBRATION_ROUNDS):
+    """Times a fixed workload (rendering a Jinja template and encoding and
+    decoding JSON), as a measure of the speed of the host. Returns the
+    fastest round in milliseconds, which is the least affected by other
+    load on the host."""
+    from jinja2 import Environment
+
+    template = Environment().from_string(
+        '{% for item in items %}{{ item.name|upper }} {{ item|tojson }}\n'
+        '{% endfor %}')
+    items = [{
+        'name': 'item-%d' % (i),
+        'labels': {
+            'index': str(i)
+        },
+        'values': list(range(10))
+    } for i in range(500)]
+    durations = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        json.loads(json.dumps(items))
+        template.render(items=items)
+        durations.append(time.perf_counter() - start)
+    return round(min(durations) * 1000, 3)
+
+
+def load_benchmark_config(config_file, params=None):
+    with open(config_file) as f:
+        configuration = f.read()
+    if params:
+        for k, v in params.items():
+            configuration = configuration.replace(k, v)
+    return yaml.load(configuration, Loader=yaml.SafeLoader)
+
+
+def load_messages(fixture_file):
+    """Returns the Pub/Sub messages in a fixture as (event, context)
+    tuples."""
+    with open(fixture_file) as f:
+        data = json.loads(f.read())
+    messages = []
+    for message in data:
+        event = {
+            'data':
+                message['message']['data']
+                if 'data' in message['message'] else '',
+            'attributes':
+                message['message']['attributes']
+                if 'attributes' in message['message'] else {}
+        }
+        messages.append((event, message['message']['messageId']))
+    return messages
+
+
+def get_fixture_name(config_name, fixtures):
+    """Finds the fixture best matching a configuration name (eg.
+    "budget-config" uses the "budget" fixture)."""
+    if config_name in CONFIG_FIXTURES:
+        return CONFIG_FIXTURES[config_name]
+    name = re.sub(r'-(example|config)(-\d+)?$', '', config_name)
+    if name in fixtures:
+        return name
+    contained = [fixture for fixture in fixtures if fixture in name]
+    if contained:
+        return max(contained, key=len)
+    if name.split('-')[0] in fixtures:
+        return name.split('-')[0]
+    return 'generic'
+
+
+def get_handlers(config):
+    """Returns the names of the processors and outputs a configuration
+    uses."""
+    handlers = []
+    tasks = list(config['pipeline']) if 'pipeline' in config else []
+    if 'onError' in config:
+        tasks.append(config['onError'])
+    while tasks:
+        task = tasks.pop()
+        if isinstance(task, dict) and 'parallel' in task:
+            tasks.extend(task['parallel'])
+        elif isinstance(task, dict) and 'type' in task:
+            handlers.append(task['type'].split('.', 1)[-1])
+    for processor in config.get('processors', []):
+        handlers.append(processor['processor'] if isinstance(processor, dict
+                                                            ) else processor)
+    for output in config.get('outputs', []):
+        if isinstance(output, dict) and 'type' in output:
+            handlers.append(output['type'])
+    return handlers
+
+
+def get_buckets(value, buckets=None):
+    """Returns the (non-templated) bucket names used in a configuration, so
+    they can be created in the storage emulator."""
+    buckets = set() if buckets is None else buckets
+    if isinstance(value, dict):
+        for k, v in value.items():
+            if k in ['bucket', 'resendBucket'] and isinstance(
+                    v, str) and '{' not in v:
+                buckets.add(v)
+            else:
+                get_buckets(v, buckets)
+    elif isinstance(value, list):
+        for v in value:
+            get_buckets(v, buckets)
+    return buckets
+
+
+# Project number returned for every project
+PROJECT_NUMBER = '123456789012'
+# Schema and row returned for every BigQuery query (the bigquery test
+# configuration expects this title)
+BIGQUERY_SCHEMA = {
+    'fields': [{
+        'name': 'title',
+        'type': 'STRING',
+        'mode': 'NULLABLE'
+    }]
+}
+BIGQUERY_ROWS = [{'f': [{'v': 'Y Combinator'}]}]
+BIGQUERY_API = r'^https://bigquery\.googleapis\.com/bigquery/v2/projects/([^/]+)'
+
+TRANSCODER_API = r'^https://transcoder\.googleapis\.com/v1/'
+TRANSCODER_LOCATION = r'projects/[^/]+/locations/[^/]+'
+
+LOCAL_HOSTS = ['localhost', '127.0.0.1', '::1']
+
+
+def _discovery_document(match, body):
+    from googleapiclient import discovery_cache
+
+    return discovery_cache.get_static_doc(match.group(1), match.group(2))
+
+
+def _project(match, body):
+    return {
+        'projectId': match.group(1),
+        'projectNumber': PROJECT_NUMBER,
+        'name': 'projects/%s' % (PROJECT_NUMBER),
+        'lifecycleState': 'ACTIVE',
+        'state': 'ACTIVE',
+    }
+
+
+def _cai_assets(match, body):
+    query = urllib.parse.parse_qs(urllib.parse.urlparse(match.string).query)
+    assets = []
+    for asset_type in query.get('assetTypes',
+                                ['storage.googleapis.com/Bucket']):
+        asset_id = DEFAULT_PARAMS['%{BUCKET}'] if asset_type.startswith(
+            'storage.') else DEFAULT_PARAMS['%{PROJECT}']
+        assets.append({
+            'name': '//%s/%s' % (asset_type.split('/')[0], asset_id),
+            'assetType': asset_type,
+            'updateTime': '2024-01-01T00:00:00Z',
+            'ancestors': ['projects/%s' % (PROJECT_NUMBER)],
+            'resource': {
+                'location': 'us',
+                'data': {
+                    'id':
+                        asset_id,
+                    'name':
+                        asset_id,
+                    'email':
+                        '%s@benchmark.iam.gserviceaccount.com' % (asset_id),
+                    'uniqueId':
+                        PROJECT_NUMBER,
+                }
+            }
+        })
+    return {'assets': assets}
+
+
+def _transcoder_create_job(match, body):
+    return dict(json.loads(body) if body else {},
+                name='%s/jobs/benchmark' % (match.group(1)),
+                state='PENDING')
+
+
+def _transcoder_get_job(match, body):
+    return {'name': match.group(1), 'state': 'SUCCEEDED'}
+
+
+def _bigquery_job(project, job_id, configuration=None):
+    configuration = dict(configuration) if configuration else {
+        'jobType': 'QUERY',
+        'query': {
+            'query': ''
+        }
+    }
+    if 'query' in configuration:
+        configuration['query'] = dict(configuration['query'],
+                                      destinationTable={
+                                          'projectId': project,
+                                          'datasetId': '_benchmark',
+                                          'tableId': job_id,
+                                      })
+    now = str(int(time.time() * 1000))
+    return {
+        'kind': 'bigquery#job',
+        'id': '%s:US.%s' % (project, job_id),
+        'jobReference': {
+            'projectId': project,
+            'jobId': job_id,
+            'location': 'US'
+        },
+        'configuration': configuration,
+        'status': {
+            'state': 'DONE'
+        },
+        'statistics': {
+            'creationTime': now,
+            'startTime': now,
+            'endTime': now,
+            'query': {
+                'totalBytesProcessed': '0',
+                'statementType': 'SELECT'
+            }
+        },
+    }
+
+
+def _bigquery_insert_job(match, body):
+    job = json.loads(body) if body else {}
+    job_id = job.get('jobReference', {}).get('jobId', uuid.uuid4().hex)
+    return _bigquery_job(match.group(1), job_id, job.get('configuration'))
+
+
+def _bigquery_get_job(match, body):
+    return _bigquery_job(match.group(1), match.group(2))
+
+
+def _bigquery_query_results(match, body):
+    return {
+        'kind': 'bigquery#getQueryResultsResponse',
+        'jobReference': {
+            'projectId': match.group(1),
+            'jobId': match.group(2),
+            'location': 'US'
+        },
+        'jobComplete': True,
+        'schema': BIGQUERY_SCHEMA,
+        'totalRows': str(len(BIGQUERY_ROWS)),
+        'rows': BIGQUERY_ROWS,
+    }
+
+
+def _bigquery_table_data(match, body):
+    return {'totalRows': str(len(BIGQUERY_ROWS)), 'rows': BIGQUERY_ROWS}
+
+
+# Canned API responses as (method, URL pattern, handler), anything else is
+# answered with an empty JSON object
+API_RESPONSES = [
+    ('GET', r'^https://(\w+)\.googleapis\.com/\$discovery/rest\?version=(\w+)',
+     _discovery_document),
+    ('GET', r'^https://www\.googleapis\.com/discovery/v1/apis/(\w+)/(\w+)/rest',
+     _discovery_document),
+    ('GET',
+     r'^https://cloudresourcemanager\.googleapis\.com/v\d/projects/([^/:?]+)(\?|$)',
+     _project),
+    ('GET', r'^https://cloudasset\.googleapis\.com/v1/[^/]+/[^/]+/assets(\?|$)',
+     _cai_assets),
+    ('POST', TRANSCODER_API + r'(%s)/jobs(\?|$)' % (TRANSCODER_LOCATION),
+     _transcoder_create_job),
+    ('GET', TRANSCODER_API + r'(%s/jobs/[^/?]+)' % (TRANSCODER_LOCATION),
+     _transcoder_get_job),
+    ('POST', BIGQUERY_API + r'/jobs(\?|$)', _bigquery_insert_job),
+    ('GET', BIGQUERY_API + r'/jobs/([^/?]+)', _bigquery_get_job),
+    ('GET', BIGQUERY_API + r'/queries/([^/?]+)', _bigquery_query_results),
+    ('GET', BIGQUERY_API + r'/datasets/[^/]+/tables/[^/]+/data',
+     _bigquery_table_data),
+]
+
+
+def api_response(method, uri, body=None):
+    """Returns the canned response body (as bytes) for an API request."""
+    if isinstance(body, bytes):
+        body = body.decode('utf-8')
+    for response_method, pattern, handler in API_RESPONSES:
+        match = re.match(pattern, uri)
+        if match and method.upper() == response_method:
+            response = handler(match, body)
+            if response is not None:
+                return (response if isinstance(response, str) else
+                        json.dumps(response)).encode('utf-8')
+    return b'{}'
+
+
+class StubHttp:
+    """Stand-in for httplib2.Http, answering requests with the canned API
+    responses."""
+
+    def __init__(self, *args, **kwargs):
+        self.requests = 0
+        self.timeout = None
+        self.connections = {}
+        self.follow_redirects = True
+        self.redirect_codes = set()
+
+    def request(self, uri, method='GET', body=None, headers=None, **kwargs):
+        import httplib2
+
+        self.requests += 1
+        return httplib2.Response({
+            'status': '200',
+            'content-type': 'application/json'
+        }), api_response(method, uri, body)
+
+    def add_certificate(self, *args, **kwargs):
+        pass
+
+    def close(self):
+        pass
+
+
+def _requests_callback(request):
+    return (200, {
+        'content-type': 'application/json'
+    }, api_response(request.method, request.url, request.body))
+
+
+def _urllib_open(opener, fullurl, data=None, timeout=None):
+    import email.message
+    import urllib.request
+    import urllib.response
+
+    request = fullurl if isinstance(
+        fullurl, urllib.request.Request) else urllib.request.Request(
+            fullurl, data)
+    headers = email.message.Message()
+    headers['Content-Type'] = 'application/json'
+    return urllib.response.addinfourl(
+        io.BytesIO(
+            api_response(request.get_method(), request.full_url,
+                         data if data is not None else request.data)), headers,
+        request.full_url, 200)
+
+
+def _emulator_rewrite(real_rewrite, request, response, storage, *args,
+                      **kwargs):
+    """Storage emulator object rewrite, answering with the fields of the
+    real API (totalBytesRewritten and objectSize)."""
+    real_rewrite(request, response, storage, *args, **kwargs)
+    if response.status.value == 200:
+        result = json.loads(response._content)
+        response.json({
+            'kind': 'storage#rewriteResponse',
+            'totalBytesRewritten': str(result['written']),
+            'objectSize': str(result['size']),
+            'done': True,
+            'resource': result['resource'],
+        })
+
+
+def _is_local_address(address):
+    if not isinstance(address, tuple):
+        return True  # Unix domain socket
+    return address[0] in LOCAL_HOSTS or str(address[0]).startswith('127.')
+
+
+@contextmanager
+def block_network():
+    """Refuses connections and name lookups to anything but the local
+    host, so that requests that slip past the stand-ins fail instead of
+    reaching the internet."""
+    real_connect = socket.socket.connect
+    real_connect_ex = socket.socket.connect_ex
+    real_getaddrinfo = socket.getaddrinfo
+
+    def connect(sock, address):
+        if not _is_local_address(address):
+            raise ConnectionRefusedError(
+                'Network access blocked by the benchmark: %s' % (address,))
+        return real_connect(sock, address)
+
+    def connect_ex(sock, address):
+        if not _is_local_address(address):
+            return errno.ECONNREFUSED
+        return real_connect_ex(sock, address)
+
+    def getaddrinfo(host, *args, **kwargs):
+        if host is not None and not _is_local_address((host,)):
+            raise socket.gaierror(
+                socket.EAI_NONAME,
+                'Network access blocked by the benchmark: %s' % (host))
+        return real_getaddrinfo(host, *args, **kwargs)
+
+    with mock.patch.object(socket.socket, 'connect', connect), \
+            mock.patch.object(socket.socket, 'connect_ex', connect_ex), \
+            mock.patch('socket.getaddrinfo', getaddrinfo):
+        yield
+
+
+class StubPublisherClient:
+    """Stand-in for the Pub/Sub publisher, resolving every publish
+    immediately."""
+
+    def __init__(self, *args, **kwargs):
+        self.published = 0
+
+    def publish(self, topic, data, ordering_key=None, **attrs):
+        self.published += 1
+        future = futures.Future()
+        future.set_result(str(self.published))
+        return future
+
+    def resume_publish(self, topic, ordering_key):
+        pass
+
+
+def _get_free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+@contextmanager
+def local_stand_ins():
+    """Replaces Google APIs (and other network calls) with local
+    stand-ins."""
+    import responses
+    from google.auth.credentials import AnonymousCredentials
+    from googleapiclient import discovery
+    from gcp_storage_emulator import server as emulator
+    from gcp_storage_emulator.handlers import objects
+
+    port = _get_free_port()
+    rewrite_handlers = [
+        handlers for _, handlers in emulator.HANDLERS
+        if handlers.get(emulator.POST) is objects.rewrite
+    ][0]
+    server = emulator.create_server('localhost', port, in_memory=True)
+    server.start()
+    environment = {
+        'STORAGE_EMULATOR_HOST': 'http://localhost:%d' % (port),
+        'GOOGLE_CLOUD_PROJECT': 'benchmark',
+        'SERVICE_ACCOUNT': 'benchmark@benchmark.iam.gserviceaccount.com',
+    }
+
+    real_build = discovery.build
+
+    def build(*args, **kwargs):
+        kwargs.pop('credentials', None)
+        kwargs['http'] = StubHttp()
+        return real_build(*args, **kwargs)
+
+    # Everything but the storage emulator (which also links to itself as
+    # 127.0.0.1) gets the canned responses
+    local_url = r'https?://(localhost|127\.0\.0\.1):%d/' % (port)
+    http_stub = responses.RequestsMock(assert_all_requests_are_fired=False)
+    http_stub.add_passthru(re.compile('^' + local_url))
+    for method in [
+            responses.GET, responses.POST, responses.PUT, responses.PATCH,
+            responses.DELETE
+    ]:
+        http_stub.add_callback(method,
+                               re.compile('^(?!%s)' % (local_url)),
+                               callback=_requests_callback)
+
+    get_client_registry().clear()
+    try:
+        with mock.patch.dict(os.environ, environment), \
+                mock.patch('google.auth.default',
+                           return_value=(AnonymousCredentials(), 'benchmark')), \
+                mock.patch('googleapiclient.discovery.build', build), \
+                mock.patch('httplib2.Http', StubHttp), \
+                mock.patch.dict(rewrite_handlers, {
+                    emulator.POST: partial(_emulator_rewrite, objects.rewrite)
+                }), \
+                mock.patch('urllib.request.OpenerDirector.open',
+                           _urllib_open), \
+                mock.patch(
+                    'oauth2client.client.GoogleCredentials.get_application_default',
+                    return_value=mock.MagicMock(authorize=lambda http: http)), \
+                mock.patch('google.cloud.pubsub_v1.PublisherClient',
+                           StubPublisherClient), \
+                mock.patch('helpers.base._generate_access_token',
+                           return_value=('benchmark-token', 4102444800.0)), \
+                mock.patch('helpers.base.BaseHelper.get_project_number',
+                           return_value=int(PROJECT_NUMBER)), \
+                mock.patch('smtplib.SMTP'), mock.patch('smtplib.SMTP_SSL'), \
+                http_stub, block_network():
+            yield
+    finally:
+        get_client_registry().clear()
+        server.stop()
+
+
+@contextmanager
+def quiet():
+    """Discards the output of the configurations and the log messages."""
+    sink = io.StringIO()
+    logger = main.get_logger()
+    streams = [handler.setStream(sink) for handler in logger.handlers]
+    try:
+        with redirect_stdout(sink):
+            yield
+    finally:
+        for handler, stream in zip(logger.handlers, streams):
+            handler.setStream(stream)
+
+
+class TaskTimer:
+    """Records how long each pipeline task takes."""
+
+    def __init__(self):
+        self.durations = {}
+        self._lock = threading.Lock()
+        self._get_task_step = main.PipelineRun.get_task_step
+
+    def _record(self, name, duration):
+        with self._lock:
+            self.durations.setdefault(name, []).append(duration)
+
+    @contextmanager
+    def patch(self):
+        timer = self
+
+        def get_task_step(pipeline_run, task):
+            step = timer._get_task_step(pipeline_run, task)
+            name = '%s %s' % (task.name, task.type)
+            func = step.func
+
+            def timed():
+                start = time.perf_counter()
+                try:
+                    return func()
+                finally:
+                    timer._record(name, time.perf_counter() - start)
+
+            step.func = timed
+            step.async_func = None
+            return step
+
+        with mock.patch.object(main.PipelineRun, 'get_task_step',
+                               get_task_step):
+            yield
+
+    def summarize(self):
+        tasks = {}
+        for name, durations in self.durations.items():
+            tasks[name] = {
+                'calls': len(durations),
+                'total_ms': round(sum(durations) * 1000, 3),
+                **summarize(durations)
+            }
+        return tasks
+
+
+def process(event, message_id):
+    # Use the current time, so the retry period never applies
+    context = Context(
+        eventId='%s-%s' % (message_id, uuid.uuid4().hex),
+        timestamp=datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ'))
+    start = time.perf_counter()
+    try:
+        main.process_pubsub(dict(event), context)
+        return time.perf_counter() - start, None
+    except Exception as exc:
+        return time.perf_counter() - start, '%s: %s' % (type(exc).__name__, exc)
+
+
+def run_config(config,
+               messages,
+               iterations,
+               concurrency=1,
+               min_duration=DEFAULT_MIN_DURATION):
+    """Replays the messages through a configuration.
+
+    Args:
+        config (dict): The configuration.
+        messages (list): (event, message ID) tuples to process.
+        iterations (int): How many times to replay the messages, after an
+          untimed warm-up round.
+        concurrency (int): Number of messages processed concurrently.
+        min_duration (float): Keep replaying the messages (iterations times
+          at a time) for at least this many seconds.
+
+    Returns:
+        dict: Benchmark results, or the number of errors and the first error
+          if processing any message failed.
+    """
+    main.configuration = config
+    try:
+        with quiet():
+            # Configurations that fail are not measured
+            errors = [
+                error for _, error in [process(*m) for m in messages] if error
+            ]
+            if errors:
+                return {'errors': len(errors), 'error': errors[0]}
+
+            replay = messages * iterations
+            timer = TaskTimer()
+            results = []
+            with timer.patch(), futures.ThreadPoolExecutor(
+                    concurrency) as executor:
+                start = time.perf_counter()
+                # Fast configurations are replayed for longer, so that the
+                # percentiles are based on enough messages
+                while not results or time.perf_counter() - start < min_duration:
+                    if concurrency > 1:
+                        results.extend(
+                            executor.map(lambda m: process(*m), replay))
+                    else:
+                        results.extend([process(*m) for m in replay])
+                elapsed = time.perf_counter() - start
+
+            # Memory use is measured separately, as tracing slows down
+            # processing considerably
+            peaks = []
+            tracemalloc.start()
+            try:
+                for event, message_id in messages:
+                    tracemalloc.reset_peak()
+                    baseline = tracemalloc.get_traced_memory()[0]
+                    process(event, message_id)
+                    peaks.append(tracemalloc.get_traced_memory()[1] - baseline)
+            finally:
+                tracemalloc.stop()
+    finally:
+        main.configuration = None
+
+    errors = [error for _, error in results if error]
+    if errors:
+        return {'errors': len(errors), 'error': errors[0]}
+    return {
+        'messages': len(results),
+        'throughput': round(len(results) / elapsed, 3) if elapsed else None,
+        'latency_ms': summarize([duration for duration, _ in results]),
+        'alloc_peak_kib': {
+            'mean': round(sum(peaks) / len(peaks) / 1024, 1),
+            'max': round(max(peaks) / 1024, 1),
+        },
+        'tasks': timer.summarize(),
+    }
+
+
+def find_configs(include_examples=True):
+    configs = sorted(glob.glob('test/configs/*.yaml'))
+    configs.extend(sorted(glob.glob('test/configs/legacy/*.yaml')))
+    if include_examples:
+        configs.extend(sorted(glob.glob('examples/*.yaml')))
+    return configs
+
+
+def run_benchmark(configs,
+                  iterations=DEFAULT_ITERATIONS,
+                  concurrency=1,
+                  all_fixtures=False,
+                  progress=None,
+                  min_duration=DEFAULT_MIN_DURATION):
+    """Runs the benchmark for a list of configuration files.
+
+    Returns:
+        dict: Results per configuration, the skipped configurations and the
+          speed of the host (see calibrate()).
+    """
+    fixtures = {
+        os.path.basename(f)[:-5]: f
+        for f in sorted(glob.glob('test/fixtures/*.json'))
+    }
+    report = {
+        'created': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'iterations': iterations,
+        'min_duration': min_duration,
+        'concurrency': concurrency,
+        'calibration_ms': calibrate(),
+        'configs': {},
+        'skipped': {},
+    }
+    with local_stand_ins():
+        from helpers.base import get_storage_client
+
+        created_buckets = set()
+        for config_file in configs:
+            config_name = os.path.basename(config_file)[:-5]
+            try:
+                config = load_benchmark_config(config_file, {
+                    **DEFAULT_PARAMS,
+                    **CONFIG_PARAMS.get(config_name, {})
+                })
+                if 'pipeline' in config:
+                    main.get_pipeline_plan(config)
+            except Exception as exc:
+                report['skipped'][config_file] = 'Invalid configuration: %s' % (
+                    exc)
+                continue
+            unsupported = set(get_handlers(config)) & set(UNSUPPORTED_HANDLERS)
+            if unsupported:
+                report['skipped'][config_file] = 'No stand-in for: %s' % (
+                    ', '.join(sorted(unsupported)))
+                continue
+
+            for bucket in get_buckets(config) - created_buckets:
+                get_storage_client().create_bucket(bucket)
+                created_buckets.add(bucket)
+
+            fixture_names = list(fixtures.keys()) if all_fixtures else [
+                get_fixture_name(config_name, fixtures)
+            ]
+            for fixture_name in fixture_names:
+                key = config_file if not all_fixtures else '%s:%s' % (
+                    config_file, fixture_name)
+                if progress:
+                    progress(key)
+                result = run_config(config,
+                                    load_messages(fixtures[fixture_name]),
+                                    iterations, concurrency, min_duration)
+                if 'error' in result:
+                    report['skipped'][key] = 'Fails with the stand-ins: %s' % (
+                        result['error'])
+                    continue
+                report['configs'][key] = {
+                    'fixture': fixtures[fixture_name],
+                    **result
+                }
+    # Calibrated again, in case the host was busy at the start
+    report['calibration_ms'] = min(report['calibration_ms'], calibrate())
+    return report
+
+
+def compare(report, baseline, max_regression=DEFAULT_MAX_REGRESSION):
+    """Compares results against a baseline, returning lines describing the
+    changes and the configurations that regressed more than
+    max_regression percent (in throughput or p95 latency), or no longer
+    run. The baseline is scaled by the speed of this host relative to the
+    host that recorded it (see calibrate())."""
+
+    def change(new, old):
+        if not old or new is None:
+            return None
+        return (new - old) / old * 100.0
+
+    lines = []
+    regressed = []
+    # Above 1 when this host is slower than the baseline host
+    scale = 1.0
+    if baseline.get('calibration_ms') and report.get('calibration_ms'):
+        scale = report['calibration_ms'] / baseline['calibration_ms']
+        lines.append('Host speed relative to the baseline: %.2fx' % (1 / scale))
+    else:
+        lines.append('Baseline has no calibration, comparing absolute numbers')
+    for key, result in report['configs'].items():
+        if key not in baseline['configs']:
+            lines.append('%-60s new' % (key))
+            continue
+        old = baseline['configs'][key]
+        throughput = change(result['throughput'], old['throughput'] / scale)
+        p95 = change(
+            result['latency_ms'].get('p95'), old['latency_ms'].get('p95') *
+            scale if old['latency_ms'].get('p95') else None)
+        flag = ''
+        if (throughput is not None and
+                throughput < -max_regression) or (p95 is not None and
+                                                  p95 > max_regression):
+            flag = ' REGRESSION'
+            regressed.append(key)
+        lines.append('%-60s throughput %+7.1f%%  p95 %+7.1f%%%s' %
+                     (key, throughput or 0.0, p95 or 0.0, flag))
+    for key, reason in report['skipped'].items():
+        if key in baseline['configs']:
+            lines.append('%-60s no longer runs (%s) REGRESSION' % (key, reason))
+            regressed.append(key)
+    return lines, regressed
+
+
+def retry_regressed(report, regressed, retries, iterations, concurrency,
+                    all_fixtures, min_duration):
+    """Runs regressed configurations again, keeping the best throughput and
+    p95 latency of the runs, so that a momentarily busy host does not fail
+    the comparison."""
+    report = dict(report,
+                  configs=dict(report['configs']),
+                  skipped=dict(report['skipped']))
+    configs = sorted(set([key.split(':')[0] for key in regressed]))
+    for _ in range(retries):
+        retry = run_benchmark(configs,
+                              iterations,
+                              concurrency,
+                              all_fixtures,
+                              progress=lambda key: print('Running %s again...' %
+                                                         (key),
+                                                         file=sys.stderr),
+                              min_duration=min_duration)
+        for key in regressed:
+            result = retry['configs'].get(key)
+            old = report['configs'].get(key)
+            if result is None:
+                continue
+            if old is not None:
+                best = result if result['throughput'] > old[
+                    'throughput'] else old
+                report['configs'][key] = dict(
+                    best,
+                    latency_ms=min([result['latency_ms'], old['latency_ms']],
+                                   key=lambda latency: latency.get('p95', 0.0)))
+            else:
+                report['configs'][key] = result
+                report['skipped'].pop(key, None)
+    return report
+
+
+def print_report(report):
+    print('Calibration workload: %.2f ms' % (report['calibration_ms']))
+    print('%-60s %10s %9s %9s %9s %10s' %
+          ('config', 'msgs/s', 'p50 ms', 'p95 ms', 'p99 ms', 'peak KiB'))
+    for key, result in report['configs'].items():
+        latency = result['latency_ms']
+        print('%-60s %10.1f %9.2f %9.2f %9.2f %10.1f' %
+              (key, result['throughput'] or 0.0, latency.get(
+                  'p50', 0.0), latency.get('p95', 0.0), latency.get(
+                      'p99', 0.0), result['alloc_peak_kib']['mean']))
+        for name, task in result['tasks'].items():
+            print('    %-56s %10s %9.2f %9.2f %9.2f' %
+                  (name, '', task['p50'], task['p95'], task['p99']))
+    for key, reason in report['skipped'].items():
+        print('%-60s skipped (%s)' % (key, reason))
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(
+        description='Benchmark message processing with the test fixtures')
+    arg_parser.add_argument('configs',
+                            nargs='*',
+                            help='Configuration files (defaults to all)')
+    arg_parser.add_argument('--iterations',
+                            type=int,
+                            default=DEFAULT_ITERATIONS,
+                            help='How many times to replay each fixture')
+    arg_parser.add_argument(
+        '--min-duration',
+        type=float,
+        default=DEFAULT_MIN_DURATION,
+        help='Minimum number of seconds to replay each fixture for')
+    arg_parser.add_argument('--concurrency',
+                            type=int,
+                            default=1,
+                            help='Messages processed concurrently')
+    arg_parser.add_argument('--no-examples',
+                            action='store_true',
+                            help='Only use the test configurations')
+    arg_parser.add_argument(
+        '--all-fixtures',
+        action='store_true',
+        help='Replay every fixture through every configuration')
+    arg_parser.add_argument('--output',
+                            type=str,
+                            help='Write the results to a JSON file')
+    arg_parser.add_argument('--compare',
+                            type=str,
+                            help='Compare the results to a JSON baseline')
+    arg_parser.add_argument(
+        '--max-regression',
+        type=float,
+        default=DEFAULT_MAX_REGRESSION,
+        help='Allowed regression (in percent) when comparing')
+    arg_parser.add_argument(
+        '--retries',
+        type=int,
+        default=DEFAULT_RETRIES,
+        help='How many times to run regressed configurations again')
+    args = arg_parser.parse_args()
+
+    configs = args.configs if args.configs else find_configs(
+        not args.no_examples)
+    report = run_benchmark(
+        configs,
+        args.iterations,
+        args.concurrency,
+        args.all_fixtures,
+        progress=lambda key: print('Running %s...' % (key), file=sys.stderr),
+        min_duration=args.min_duration)
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write('\n')
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.loads(f.read())
+        lines, regressed = compare(report, baseline, args.max_regression)
+        if regressed and args.retries > 0:
+            report = retry_regressed(report, regressed, args.retries,
+                                     args.iterations, args.concurrency,
+                                     args.all_fixtures, args.min_duration)
+            lines, regressed = compare(report, baseline, args.max_regression)
+        print()
+        print('\n'.join(lines))
+        if regressed:
+            sys.exit(1)
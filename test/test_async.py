@@ -0,0 +1,124 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import io
+import json
+import asyncio
+import threading
+from unittest import mock
+from contextlib import redirect_stdout
+from .helpers import fixture_to_pubsub, load_config
+import unittest
+import logging
+from falcon import testing
+from processors import shellscript
+
+
+class TestAsyncExecutor(unittest.TestCase):
+
+    def test_async_pipeline(self):
+        logger = logging.getLogger('test')
+        config = load_config('message-handling')
+
+        async def process_messages():
+            messages = [fixture_to_pubsub('message-handling') for i in range(5)]
+            await asyncio.gather(*[
+                main.decode_and_process_async(logger, config, event, context)
+                for event, context in messages
+            ])
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            asyncio.run(process_messages())
+
+        self.assertEqual(['OK1'] * 5, buf.getvalue().split())
+
+    def test_async_pipeline_failure(self):
+        logger = logging.getLogger('test')
+        config = load_config('shellscript-fail')
+        event, context = fixture_to_pubsub('generic')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            with self.assertRaises(shellscript.CommandFailedException):
+                asyncio.run(
+                    main.decode_and_process_async(logger, config, event,
+                                                  context))
+
+    def test_templates_are_rendered_off_the_event_loop(self):
+        logger = logging.getLogger('test')
+        config = load_config('message-handling')
+        event, context = fixture_to_pubsub('message-handling')
+        threads = {}
+
+        def record(name):
+            original = getattr(main.PipelineRun, name)
+
+            def wrapper(*args, **kwargs):
+                threads.setdefault(name, set()).add(threading.get_ident())
+                return original(*args, **kwargs)
+
+            return mock.patch.object(main.PipelineRun, name, wrapper)
+
+        async def process_message():
+            threads['loop'] = threading.get_ident()
+            await main.decode_and_process_async(logger, config, event, context)
+
+        buf = io.StringIO()
+        with redirect_stdout(buf), record('stop_if'), record('run_if'), \
+                record('get_task_step'):
+            asyncio.run(process_message())
+
+        self.assertEqual(['OK1'], buf.getvalue().split())
+        loop_thread = threads.pop('loop')
+        self.assertEqual(['get_task_step', 'run_if', 'stop_if'],
+                         sorted(threads.keys()))
+        for name, idents in threads.items():
+            self.assertNotIn(loop_thread, idents, name)
+
+    def test_native_coroutine_is_awaited(self):
+        calls = []
+
+        async def run_async():
+            calls.append(threading.get_ident())
+            return 'async'
+
+        step = main.PipelineStep(lambda: 'sync', run_async)
+        self.assertEqual('async', asyncio.run(step.run_async()))
+        self.assertEqual([threading.get_ident()], calls)
+        self.assertEqual(
+            'sync', asyncio.run(main.PipelineStep(lambda: 'sync').run_async()))
+
+    def test_asgi_server(self):
+        main.configuration = load_config('message-handling')
+        try:
+            with open('test/fixtures/message-handling.json') as f:
+                envelope = json.loads(f.read())[0]
+
+            client = testing.TestClient(main.run_asgi_webserver())
+            buf = io.StringIO()
+            with redirect_stdout(buf):
+                result = client.simulate_post('/', json=envelope)
+            self.assertEqual(200, result.status_code)
+            self.assertEqual('Message processed.', result.text)
+            self.assertEqual('OK1', buf.getvalue().rstrip())
+
+            result = client.simulate_post('/', body='not json')
+            self.assertEqual(204, result.status_code)
+        finally:
+            main.configuration = None
+
+
+if __name__ == '__main__':
+    unittest.main()
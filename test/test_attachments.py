@@ -0,0 +1,220 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import io
+import os
+import email
+import unittest
+from unittest import mock
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from helpers import smtp
+from helpers.attachments import Attachment, attachment_part, close_attachments, write_message
+from helpers.smtp import SmtpConnectionPool, sendmail_file
+from output.mail import MailOutput
+from main import get_jinja_environment
+
+CONTENTS = os.urandom(100000)
+
+
+class FakeBlob:
+
+    def __init__(self, name, contents):
+        self.name = name
+        self.contents = contents
+        self.size = len(contents)
+
+    def download_to_file(self, fileobj):
+        for pos in range(0, len(self.contents), 4096):
+            fileobj.write(self.contents[pos:pos + 4096])
+
+    def generate_signed_url(self, **kwargs):
+        return 'https://storage.googleapis.com/bucket/%s?X-Goog-Signature=x' % (
+            self.name)
+
+
+class FakeStorageClient:
+
+    def __init__(self, blobs):
+        self.blobs = blobs
+
+    def bucket(self, name):
+        return self
+
+    def get_blob(self, name):
+        return self.blobs.get(name)
+
+
+class FakeSMTP:
+    """Records the raw commands and data sent by sendmail_file()."""
+
+    def __init__(self):
+        self.does_esmtp = True
+        self.data = b''
+        self.commands = []
+        self.replies = []
+
+    def ehlo_or_helo_if_needed(self):
+        pass
+
+    def has_extn(self, extension):
+        return extension == 'size'
+
+    def mail(self, sender, options):
+        self.commands.append(('mail', sender, options))
+        return (250, b'OK')
+
+    def rcpt(self, recipient):
+        self.commands.append(('rcpt', recipient))
+        return (250, b'OK')
+
+    def putcmd(self, command):
+        self.commands.append((command,))
+        self.replies.append((354, b'Go ahead'))
+
+    def send(self, data):
+        self.data += data
+        if data.endswith(b'\r\n.\r\n'):
+            self.replies.append((250, b'Queued'))
+
+    def getreply(self):
+        return self.replies.pop(0)
+
+    def noop(self):
+        return (250, b'OK')
+
+    def quit(self):
+        pass
+
+
+class TestAttachments(unittest.TestCase):
+
+    def test_write_message(self):
+        message = MIMEMultipart()
+        message['Subject'] = 'Test'
+        message.attach(MIMEText('Hello\n.\nWorld', 'plain'))
+        attachment = Attachment('report.bin', io.BytesIO(CONTENTS),
+                                len(CONTENTS))
+        part = attachment_part(attachment)
+        part.add_header('Content-Disposition',
+                        'attachment; filename="report.bin"')
+        message.attach(part)
+
+        contents = write_message(message, io.BytesIO()).read()
+        self.assertNotIn(b'--attachment-', contents)
+        for line in contents.split(b'\r\n'):
+            self.assertLessEqual(len(line), 78)
+        parsed = email.message_from_bytes(contents)
+        parts = parsed.get_payload()
+        self.assertEqual('Hello\r\n.\r\nWorld', parts[0].get_payload())
+        self.assertEqual('report.bin', parts[1].get_filename())
+        self.assertEqual(CONTENTS, parts[1].get_payload(decode=True))
+
+    def test_sendmail_file(self):
+        server = FakeSMTP()
+        message = io.BytesIO(b'Subject: Test\r\n\r\n.hidden\r\nlast line')
+        sendmail_file(server, 'from@example.com', 'to@example.com', message)
+        self.assertEqual(('mail', 'from@example.com', ['size=35']),
+                         server.commands[0])
+        self.assertEqual(('rcpt', 'to@example.com'), server.commands[1])
+        self.assertEqual(b'Subject: Test\r\n\r\n..hidden\r\nlast line\r\n.\r\n',
+                         server.data)
+
+    def test_attachment_links(self):
+        output = MailOutput({}, {}, get_jinja_environment(), None, None, None)
+        storage = FakeStorageClient({
+            'small.bin': FakeBlob('small.bin', CONTENTS),
+            'large.bin': FakeBlob('large.bin', CONTENTS * 2),
+            'empty.bin': FakeBlob('empty.bin', b''),
+        })
+        config = {
+            'attachmentLinkThreshold': len(CONTENTS),
+            'body': {
+                'attachments': [
+                    'gs://bucket/small.bin', 'gs://bucket/large.bin',
+                    'gs://bucket/empty.bin'
+                ]
+            }
+        }
+        with mock.patch.object(output,
+                               '_get_storage_client',
+                               return_value=storage):
+            attachments, links = output.get_attachments(config)
+        self.assertEqual(['small.bin'], [a.filename for a in attachments])
+        self.assertEqual(CONTENTS, attachments[0].read())
+        close_attachments(attachments)
+        self.assertEqual([('large.bin', len(CONTENTS) * 2,
+                           storage.blobs['large.bin'].generate_signed_url())],
+                         links)
+
+        mail = output.add_attachment_links(
+            {
+                'text_body': 'Report\n',
+                'html_body': '<html><body>Report</body></html>'
+            }, links)
+        self.assertEqual(
+            'Report\n\nAttachments:\nlarge.bin (195.3 KiB): %s\n' % links[0][2],
+            mail['text_body'])
+        self.assertIn(
+            '<li><a href="%s">large.bin</a> (195.3 KiB)</li></ul></body>' %
+            links[0][2].replace('&', '&amp;'), mail['html_body'])
+
+        # Linking is disabled by default
+        del config['attachmentLinkThreshold']
+        with mock.patch.object(output,
+                               '_get_storage_client',
+                               return_value=storage):
+            attachments, links = output.get_attachments(config)
+        self.assertEqual(['small.bin', 'large.bin'],
+                         [a.filename for a in attachments])
+        self.assertEqual([], links)
+        close_attachments(attachments)
+
+    def test_send_via_smtp(self):
+        output = MailOutput({}, {}, get_jinja_environment(), None, None, None)
+        server = FakeSMTP()
+        mail = {
+            'mail_from':
+                'from@example.com',
+            'mail_to':
+                'to@example.com',
+            'mail_subject':
+                'Test',
+            'text_body':
+                'Test',
+            'html_body':
+                '',
+            'attachments': [
+                Attachment('report.bin', io.BytesIO(CONTENTS), len(CONTENTS))
+            ]
+        }
+        pool = SmtpConnectionPool()
+        with mock.patch.object(smtp, '_SMTP_POOL', pool), \
+                mock.patch.object(output, 'connect_smtp', return_value=server):
+            output.send_via_smtp(
+                {'host': 'smtp.example.com'}, mail,
+                {'logo.png': Attachment('logo.png', io.BytesIO(b'PNG'), 3)},
+                {'body': {}})
+
+        self.assertEqual(b'\r\n.\r\n', server.data[-5:])
+        parsed = email.message_from_bytes(server.data[:-3])
+        parts = parsed.get_payload()
+        self.assertEqual(CONTENTS, parts[1].get_payload(decode=True))
+        self.assertEqual('image/png', parts[2].get_content_type())
+        self.assertEqual('<logo.png>', parts[2]['Content-ID'])
+        self.assertEqual(b'PNG', parts[2].get_payload(decode=True))
+        self.assertEqual(1, pool.stats()['size'])
+
+
+if __name__ == '__main__':
+    unittest.main()
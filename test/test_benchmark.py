@@ -0,0 +1,82 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import copy
+import unittest
+from . import benchmark
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(50, benchmark.percentile(values, 50))
+        self.assertEqual(95, benchmark.percentile(values, 95))
+        self.assertEqual(100, benchmark.percentile(values, 100))
+        self.assertEqual(7, benchmark.percentile([7], 99))
+        self.assertIsNone(benchmark.percentile([], 50))
+
+    def test_fixture_names(self):
+        fixtures = ['budget', 'cloud-ids', 'scc', 'generic']
+        self.assertEqual('budget',
+                         benchmark.get_fixture_name('budget-config', fixtures))
+        self.assertEqual('cloud-ids',
+                         benchmark.get_fixture_name('scc-cloud-ids', fixtures))
+        self.assertEqual('generic',
+                         benchmark.get_fixture_name('shellscript', fixtures))
+
+    def test_run_and_compare(self):
+        report = benchmark.run_benchmark([
+            'test/configs/message-handling.yaml', 'test/configs/budget.yaml',
+            'test/configs/shellscript-fail.yaml'
+        ],
+                                         iterations=2,
+                                         min_duration=0)
+
+        result = report['configs']['test/configs/message-handling.yaml']
+        self.assertEqual('test/fixtures/message-handling.json',
+                         result['fixture'])
+        self.assertEqual(2, result['messages'])
+        self.assertIn('p99', result['latency_ms'])
+        self.assertEqual(2,
+                         result['tasks']['#1 processor.genericjson']['calls'])
+        self.assertIn('test/configs/budget.yaml', report['skipped'])
+        # Configurations that fail are not measured
+        self.assertNotIn('test/configs/shellscript-fail.yaml',
+                         report['configs'])
+        self.assertIn('CommandFailedException',
+                      report['skipped']['test/configs/shellscript-fail.yaml'])
+        self.assertGreater(report['calibration_ms'], 0)
+
+        baseline = copy.deepcopy(report)
+        lines, regressed = benchmark.compare(report, baseline)
+        self.assertFalse(regressed)
+
+        baseline['configs']['test/configs/message-handling.yaml'][
+            'throughput'] *= 2
+        lines, regressed = benchmark.compare(report, baseline)
+        self.assertEqual(['test/configs/message-handling.yaml'], regressed)
+        self.assertIn('REGRESSION', lines[1])
+
+        # Baselines recorded on a faster host are scaled
+        baseline['calibration_ms'] = report['calibration_ms'] / 2
+        lines, regressed = benchmark.compare(report, baseline)
+        self.assertFalse(regressed)
+
+        baseline['configs']['test/configs/shellscript-fail.yaml'] = result
+        lines, regressed = benchmark.compare(report, baseline)
+        self.assertEqual(['test/configs/shellscript-fail.yaml'], regressed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,180 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import json
+import unittest
+from unittest import mock
+from google.cloud import bigquery
+from google.cloud.bigquery_storage_v1 import types
+from output import bigquery as bigquery_output
+from output.bigquery import BigqueryOutput, StreamingWriteException
+from main import get_jinja_environment
+
+SCHEMA = [
+    bigquery.SchemaField('name', 'STRING', mode='REQUIRED'),
+    bigquery.SchemaField('count', 'INTEGER'),
+    bigquery.SchemaField('created', 'TIMESTAMP'),
+    bigquery.SchemaField('labels', 'STRING', mode='REPEATED'),
+    bigquery.SchemaField('owner',
+                         'RECORD',
+                         fields=[
+                             bigquery.SchemaField('email', 'STRING'),
+                             bigquery.SchemaField('active', 'BOOLEAN'),
+                         ]),
+]
+
+
+class FakeWriteClient:
+    """Stand-in for the Storage Write API: decodes appended rows with the
+    writer schema and rejects rows named "invalid"."""
+
+    def __init__(self):
+        self.streams = {}
+        self.rows = []
+        self.requests = []
+        self.finalized = []
+        self.committed = []
+
+    def create_write_stream(self, parent, write_stream):
+        name = '%s/streams/stream-%d' % (parent, len(self.streams))
+        self.streams[name] = write_stream.type_
+        return types.WriteStream(name=name, type_=write_stream.type_)
+
+    def append_rows(self, requests, metadata=None):
+        message_class = None
+        for request in requests:
+            self.requests.append(request)
+            if message_class is None:
+                message_class = bigquery_output.descriptor_to_class(
+                    request.proto_rows.writer_schema.proto_descriptor)
+            response = types.AppendRowsResponse()
+            rows = []
+            for index, serialized in enumerate(
+                    request.proto_rows.rows.serialized_rows):
+                row = message_class.FromString(serialized)
+                if row.name == 'invalid':
+                    response.row_errors.append(
+                        types.RowError(index=index,
+                                       message='invalid row %d' % index))
+                rows.append(row)
+            if not response.row_errors:
+                self.rows.extend(rows)
+            yield response
+
+    def finalize_write_stream(self, name):
+        self.finalized.append(name)
+
+    def batch_commit_write_streams(self, request):
+        self.committed.extend(request.write_streams)
+        return types.BatchCommitWriteStreamsResponse()
+
+
+class TestBigqueryOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.write_client = FakeWriteClient()
+        self.bigquery_client = mock.MagicMock()
+        self.bigquery_client.get_table.return_value = bigquery.Table(
+            'example-project.dataset.table', schema=SCHEMA)
+
+    def run_output(self, output_config, rows=None):
+        jinja_environment = get_jinja_environment()
+        jinja_environment.globals['rows'] = rows
+        output = BigqueryOutput({},
+                                dict(output_config,
+                                     datasetWithTable='dataset.table'),
+                                jinja_environment, None, None, None)
+        with mock.patch.object(output,
+                               '_get_bigquery_client',
+                               return_value=self.bigquery_client):
+            with mock.patch.object(output,
+                                   '_get_write_client',
+                                   return_value=self.write_client):
+                output.output()
+
+    def test_row_to_proto(self):
+        message_class = bigquery_output.descriptor_to_class(
+            bigquery_output.schema_to_descriptor(SCHEMA))
+        message = bigquery_output.row_to_proto(
+            message_class(), SCHEMA, {
+                'name': 'a',
+                'count': '3',
+                'created': '2024-01-01T00:00:01Z',
+                'labels': ['x', 'y'],
+                'owner': {
+                    'email': 'a@example.com',
+                    'active': 'true'
+                },
+                'unknown': 'ignored',
+            })
+        self.assertEqual(3, message.count)
+        self.assertEqual(1704067201000000, message.created)
+        self.assertEqual(['x', 'y'], list(message.labels))
+        self.assertTrue(message.owner.active)
+
+    def test_committed_stream(self):
+        with mock.patch.object(bigquery_output, 'DEFAULT_STREAM_INFLIGHT', 2):
+            self.run_output(
+                {
+                    'rowsExpr': 'rows',
+                    'batchSize': 10,
+                    'streamType': 'committed'
+                },
+                rows=({
+                    'name': 'row-%d' % i,
+                    'count': i
+                } for i in range(95)))
+        self.assertEqual(95, len(self.write_client.rows))
+        self.assertEqual(10, len(self.write_client.requests))
+        self.assertEqual('row-94', self.write_client.rows[94].name)
+        stream_name = self.write_client.requests[0].write_stream
+        self.assertEqual(
+            'projects/example-project/datasets/dataset/tables/table/streams/stream-0',
+            stream_name)
+        self.assertEqual([stream_name], self.write_client.finalized)
+        self.assertEqual([], self.write_client.committed)
+
+    def test_pending_stream(self):
+        rows = [{'name': 'a'}, {'name': 'b'}]
+        # Pending streams are the default
+        self.run_output({'rows': json.dumps(rows)})
+        self.assertEqual(2, len(self.write_client.rows))
+        self.assertEqual(1, len(self.write_client.committed))
+        self.assertEqual(self.write_client.finalized,
+                         self.write_client.committed)
+
+        self.write_client = FakeWriteClient()
+        rows.append({'name': 'invalid'})
+        with self.assertRaisesRegex(StreamingWriteException,
+                                    'rejected 1 batches'):
+            self.run_output({'rows': json.dumps(rows), 'streamType': 'pending'})
+        self.assertEqual([], self.write_client.committed)
+
+    def test_default_stream_errors(self):
+        rows = [{'name': 'invalid' if i % 7 == 0 else 'ok'} for i in range(20)]
+        with self.assertRaisesRegex(StreamingWriteException,
+                                    'rejected 3 batches \\(5 rows appended'):
+            self.run_output(
+                {
+                    'rowsExpr': 'rows',
+                    'batchSize': 5,
+                    'streamType': 'default'
+                },
+                rows=rows)
+        self.assertTrue(self.write_client.requests[0].write_stream.endswith(
+            '/streams/_default'))
+        self.assertEqual([], self.write_client.finalized)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,156 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import json
+import unittest
+from unittest import mock
+import pyarrow
+from google.cloud import bigquery
+from helpers.bigquery import QueryResults, QueryResultCache, get_query_result_cache
+from processors.bigquery import BigqueryProcessor
+from main import get_jinja_environment
+
+SCHEMA = [
+    bigquery.SchemaField('project', 'STRING'),
+    bigquery.SchemaField('cost', 'FLOAT'),
+]
+TOTAL_ROWS = 2500
+BATCH_SIZE = 1000
+
+
+class FakeRowIterator:
+    """Serves TOTAL_ROWS generated rows, as Row objects or Arrow record
+    batches."""
+
+    def __init__(self, selected_fields=None):
+        self.schema = SCHEMA
+        self.total_rows = TOTAL_ROWS
+        self.selected_fields = selected_fields
+
+    def __iter__(self):
+        for i in range(TOTAL_ROWS):
+            yield bigquery.Row(('project-%d' % i, float(i)), {
+                'project': 0,
+                'cost': 1
+            })
+
+    def to_arrow_iterable(self, bqstorage_client=None):
+        names = [field.name for field in self.selected_fields or SCHEMA]
+        for start in range(0, TOTAL_ROWS, BATCH_SIZE):
+            indexes = range(start, min(start + BATCH_SIZE, TOTAL_ROWS))
+            columns = {
+                'project': ['project-%d' % i for i in indexes],
+                'cost': [float(i) for i in indexes]
+            }
+            yield pyarrow.RecordBatch.from_pydict(
+                dict([(name, columns[name]) for name in names]))
+
+
+class FakeBigqueryClient:
+
+    def __init__(self):
+        self.queries = []
+        self.list_rows_calls = []
+
+    def query(self, query, job_config=None):
+        self.queries.append(query)
+        query_job = mock.MagicMock()
+        query_job.destination = 'example-project._anonymous.results'
+        query_job.result.return_value = FakeRowIterator()
+        return query_job
+
+    def list_rows(self, table, selected_fields=None):
+        self.list_rows_calls.append((table, selected_fields))
+        return FakeRowIterator(selected_fields)
+
+
+class TestBigqueryProcessor(unittest.TestCase):
+
+    def setUp(self):
+        get_query_result_cache().clear()
+        self.client = FakeBigqueryClient()
+
+    def tearDown(self):
+        get_query_result_cache().clear()
+
+    def process(self, config):
+        processor = BigqueryProcessor(
+            dict(config, query='SELECT * FROM costs WHERE month = {{ month }}'),
+            get_jinja_environment(), json.dumps({'month': 5}), None, None)
+        with mock.patch.object(processor,
+                               '_get_bigquery_client',
+                               return_value=self.client):
+            with mock.patch.object(processor, '_get_read_client'):
+                return processor.process()['records']
+
+    def test_records(self):
+        records = self.process({'maxRows': 10, 'columns': ['cost']})
+        self.assertEqual(10, len(records))
+        self.assertEqual({'cost': 9.0}, records[9])
+        self.assertEqual(['SELECT * FROM costs WHERE month = 5'],
+                         self.client.queries)
+
+    def test_streaming(self):
+        records = self.process({
+            'streaming': True,
+            'maxRows': 1500,
+            'columns': '["project"]'
+        })
+        self.assertIsInstance(records, QueryResults)
+        self.assertEqual(1500, len(records))
+        self.assertEqual([], self.client.list_rows_calls)
+
+        rows = iter(records)
+        self.assertEqual({'project': 'project-0'}, next(rows))
+        self.assertEqual(['project'],
+                         [f.name for f in self.client.list_rows_calls[0][1]])
+        self.assertEqual(1499, len(list(rows)))
+
+        batches = list(records.batches())
+        self.assertEqual([1000, 500], [b.num_rows for b in batches])
+
+        template = get_jinja_environment().from_string(
+            '{% for row in records %}{% if loop.last %}{{ row.project }}'
+            '{% endif %}{% endfor %}')
+        self.assertEqual('project-1499', template.render(records=records))
+
+    def test_cache(self):
+        first = self.process({'streaming': True, 'cacheTtl': 60})
+        second = self.process({'streaming': True, 'cacheTtl': 60})
+        self.assertIs(first, second)
+        self.assertEqual(1, len(self.client.queries))
+
+        self.process({'cacheTtl': 60})
+        self.assertEqual(2, len(self.client.queries))
+
+    def test_cache_expiry(self):
+        now = [0]
+        cache = QueryResultCache(max_size=2, now=lambda: now[0])
+        cache.put('a', [1], 10)
+        cache.put('b', [2], 100)
+        self.assertEqual([1], cache.get('a'))
+        now[0] = 10
+        self.assertIsNone(cache.get('a'))
+        cache.put('c', [3], 100)
+        cache.put('d', [4], 100)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual({
+            'size': 2,
+            'max_size': 2,
+            'hits': 1,
+            'misses': 2
+        }, cache.stats())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,247 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import io
+import os
+import json
+import logging
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+from contextlib import redirect_stdout
+import main
+from processors import cai
+from processors.cai import CaiProcessor, AssetStream
+from processors.shellscript import CommandFailedException
+from main import get_jinja_environment
+from .helpers import fixture_to_pubsub
+
+
+def make_asset(i):
+    return {
+        'name': '//storage.googleapis.com/bucket-%d' % i,
+        'asset_type': 'storage.googleapis.com/Bucket',
+        'resource': {
+            'discovery_name': 'Bucket',
+            'location': 'us' if i % 2 == 0 else 'eu',
+            'data': {
+                'labels': {
+                    'team': 'team-%d' % (i % 3)
+                },
+                'storage_class': 'STANDARD'
+            }
+        },
+        'ancestors': ['projects/%d' % (i % 4), 'organizations/1'],
+        'update_time': '2024-01-0%dT00:00:00.123456789Z' % (1 + i % 5),
+    }
+
+
+class FakeCloudAsset:
+    """Cloud Asset Inventory v1 client: lists assets in pages and exports
+    them to local files."""
+
+    def __init__(self, assets):
+        self.inventory = assets
+        self.list_calls = []
+        self.polls = 0
+
+    def assets(self):
+        return self
+
+    def list(self, **kwargs):
+        self.list_calls.append(kwargs)
+        start = int(kwargs.get('pageToken', 0))
+        response = {
+            'assets': [
+                cai.normalize_asset(asset)
+                for asset in self.inventory[start:start + 4]
+            ]
+        }
+        if start + 4 < len(self.inventory):
+            response['nextPageToken'] = str(start + 4)
+        request = MagicMock()
+        request.execute.return_value = response
+        return request
+
+    def v1(self):
+        return self
+
+    def exportAssets(self, parent, body):
+        with open(body['outputConfig']['gcsDestination']['uri'], 'w') as f:
+            for asset in self.inventory:
+                f.write(json.dumps(asset) + '\n')
+        request = MagicMock()
+        request.execute.return_value = {'name': 'operations/export-1'}
+        return request
+
+    def operations(self):
+        return self
+
+    def get(self, name):
+        self.polls += 1
+        request = MagicMock()
+        request.execute.return_value = {'name': name, 'done': True}
+        return request
+
+
+class TestCaiProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeCloudAsset([make_asset(i) for i in range(10)])
+        self.tempdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def process(self, config):
+        processor = CaiProcessor(dict(config, parent='organizations/1'),
+                                 get_jinja_environment(), '{}', None, None)
+        with mock.patch.object(processor,
+                               '_get_discovery_client',
+                               return_value=self.service):
+            with mock.patch.object(cai.time, 'sleep'):
+                return processor.process()
+
+    def test_list(self):
+        ret = self.process({'indexes': ['name', 'assetType']})
+        self.assertEqual(10,
+                         len(ret['assets']['storage.googleapis.com/Bucket']))
+        self.assertEqual(3, len(self.service.list_calls))
+        self.assertEqual(
+            'us', ret['assets_by_name']['//storage.googleapis.com/bucket-4']
+            ['resource']['location'])
+        self.assertEqual(
+            10,
+            len(ret['assets_by_asset_type']['storage.googleapis.com/Bucket']))
+
+    def test_export_and_indexes(self):
+        ret = self.process({
+            'exportUri': os.path.join(self.tempdir.name, 'assets.json'),
+            'indexing': 'stream',
+            'indexes': ['project', 'ancestor', 'label', 'location'],
+        })
+        self.assertEqual(1, self.service.polls)
+        self.assertEqual([], self.service.list_calls)
+        self.assertIsInstance(ret['assets'], AssetStream)
+        assets = list(ret['assets'])
+        self.assertEqual(10, len(assets))
+        self.assertEqual(assets, list(ret['assets']))
+        self.assertEqual('storage.googleapis.com/Bucket',
+                         assets[0]['assetType'])
+        self.assertEqual('Bucket', assets[0]['resource']['discoveryName'])
+        self.assertIn('storage_class', assets[0]['resource']['data'])
+
+        self.assertEqual(3, len(ret['assets_by_project']['projects/1']))
+        self.assertEqual(10, len(ret['assets_by_ancestor']['organizations/1']))
+        self.assertEqual(4, len(ret['assets_by_label']['team=team-0']))
+        self.assertEqual(10, len(ret['assets_by_label']['team']))
+        self.assertEqual(5, len(ret['assets_by_location']['eu']))
+
+        template = get_jinja_environment().from_string(
+            '{{ assets_by_name["//storage.googleapis.com/bucket-1"] is '
+            'not defined }}')
+        self.assertEqual('True', template.render(assets_by_name={}))
+
+    def test_incremental(self):
+        state_file = os.path.join(self.tempdir.name, 'state.json')
+        with open(state_file, 'w') as f:
+            f.write(json.dumps({'readTime': '2024-01-03T00:00:00Z'}))
+        config = {
+            'assetsFile': os.path.join(self.tempdir.name, 'assets.json'),
+            'indexing': 'list',
+            'incremental': True,
+            'stateFile': state_file,
+            'readTime': '2024-02-01T00:00:00Z',
+        }
+        with open(config['assetsFile'], 'w') as f:
+            for asset in self.service.inventory:
+                f.write(json.dumps(asset) + '\n')
+
+        processor = CaiProcessor(config, get_jinja_environment(), '{}', None,
+                                 None)
+        ret = processor.process()
+        self.assertEqual([
+            'bucket-2', 'bucket-3', 'bucket-4', 'bucket-7', 'bucket-8',
+            'bucket-9'
+        ], [a['name'].split('/')[-1] for a in ret['assets']])
+        self.assertEqual('2024-01-03T00:00:00Z', ret['assets_since'])
+        self.assertEqual('2024-02-01T00:00:00Z', ret['assets_read_time'])
+
+        # The read time is saved once the pipeline has succeeded
+        with open(state_file) as f:
+            self.assertEqual({'readTime': '2024-01-03T00:00:00Z'}, json.load(f))
+        processor._run_success_callbacks()
+        with open(state_file) as f:
+            self.assertEqual({'readTime': '2024-02-01T00:00:00Z'}, json.load(f))
+
+        os.unlink(state_file)
+        self.assertEqual(10, len(self.process(config)['assets']))
+
+    def test_incremental_retry(self):
+        state_file = os.path.join(self.tempdir.name, 'state.json')
+        with open(state_file, 'w') as f:
+            f.write(json.dumps({'readTime': '2024-01-04T12:00:00Z'}))
+        assets_file = os.path.join(self.tempdir.name, 'assets.json')
+        with open(assets_file, 'w') as f:
+            for asset in self.service.inventory:
+                f.write(json.dumps(asset) + '\n')
+
+        def run_pipeline(exit_code):
+            config = {
+                'maximumMessageAge':
+                    'skip',
+                'pipeline': [{
+                    'type': 'processor.cai',
+                    'config': {
+                        'assetsFile': assets_file,
+                        'indexing': 'stream',
+                        'incremental': True,
+                        'stateFile': state_file,
+                    }
+                }, {
+                    'type': 'output.logger',
+                    'config': {
+                        'stdout': True,
+                        'message': '{% for a in assets %}'
+                                   '{{ a.name.split("/")[-1] }} {% endfor %}'
+                    }
+                }, {
+                    'type': 'processor.shellscript',
+                    'config': {
+                        'command': '/bin/bash',
+                        'args': ['-c', 'exit %d' % (exit_code)]
+                    }
+                }]
+            }
+            event, context = fixture_to_pubsub('generic')
+            buf = io.StringIO()
+            with redirect_stdout(buf):
+                main.decode_and_process(logging.getLogger('test'), config,
+                                        event, context)
+            return buf.getvalue().strip()
+
+        with self.assertRaises(CommandFailedException):
+            run_pipeline(1)
+        with open(state_file) as f:
+            self.assertEqual('2024-01-04T12:00:00Z', json.load(f)['readTime'])
+
+        # The retried message returns the same assets and saves the state
+        self.assertEqual('bucket-4 bucket-9', run_pipeline(0))
+        with open(state_file) as f:
+            self.assertNotEqual('2024-01-04T12:00:00Z',
+                                json.load(f)['readTime'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,106 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import unittest
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from google.auth.credentials import AnonymousCredentials
+from google.oauth2.credentials import Credentials
+from helpers.base import ClientRegistry, get_client_registry, get_credentials_key, get_discovery_client
+from helpers.tokens import AccessTokenCredentials
+
+
+class TestClientRegistry(unittest.TestCase):
+
+    def test_discovery_client_is_reused(self):
+        registry = get_client_registry()
+        registry.clear()
+
+        first = get_discovery_client('cloudasset', 'v1', AnonymousCredentials())
+        second = get_discovery_client('cloudasset', 'v1',
+                                      AnonymousCredentials())
+        self.assertIs(first, second)
+        self.assertEqual(1, registry.stats()['misses'])
+        self.assertEqual(1, registry.stats()['hits'])
+
+        other_version = get_discovery_client('cloudasset', 'v1p1beta1',
+                                             AnonymousCredentials())
+        self.assertIsNot(first, other_version)
+
+        other_thread = []
+        thread = threading.Thread(target=lambda: other_thread.append(
+            get_discovery_client('cloudasset', 'v1', AnonymousCredentials())))
+        thread.start()
+        thread.join()
+        self.assertIsNot(first, other_thread[0])
+
+    def test_thread_local_clients_are_reused(self):
+        registry = ClientRegistry()
+        built = []
+
+        def get_client(_):
+            return registry.get_client(
+                'client', lambda: built.append(object()) or built[-1], True)
+
+        for _ in range(5):
+            with ThreadPoolExecutor(max_workers=4) as executor:
+                clients = list(executor.map(get_client, range(20)))
+            self.assertTrue(set(clients) <= set(built))
+        # Clients of exited pool threads are handed to later threads,
+        # but never used by two threads at once
+        self.assertLessEqual(len(built), 4)
+        self.assertEqual(len(built), registry.stats()['size'])
+
+        mine = get_client(None)
+        self.assertIs(mine, get_client(None))
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertIsNot(mine, executor.submit(get_client, None).result())
+
+        registry.clear()
+        self.assertEqual(0, registry.stats()['size'])
+        self.assertIsNot(mine, get_client(None))
+
+    def test_credentials_key(self):
+        self.assertIsNone(get_credentials_key(None))
+        self.assertEqual(get_credentials_key(Credentials('token-a')),
+                         get_credentials_key(Credentials('token-a')))
+        self.assertNotEqual(get_credentials_key(Credentials('token-a')),
+                            get_credentials_key(Credentials('token-b')))
+
+        fetch = lambda: ('token', 0)
+        self.assertEqual(
+            get_credentials_key(
+                AccessTokenCredentials('sa@example.com', ['b', 'a'], fetch)),
+            get_credentials_key(
+                AccessTokenCredentials('sa@example.com', ['a', 'b'], fetch)))
+        self.assertNotEqual(
+            get_credentials_key(
+                AccessTokenCredentials('sa@example.com', ['a'], fetch)),
+            get_credentials_key(
+                AccessTokenCredentials('other@example.com', ['a'], fetch)))
+
+    def test_thread_local_clients_are_bounded(self):
+        registry = ClientRegistry(max_size=4)
+        for i in range(1000):
+            key = ('discovery',
+                   get_credentials_key(Credentials('token-%d' % i)))
+            registry.get_client(key, object, True)
+        self.assertEqual(4, len(registry._get_thread_holder().clients))
+        self.assertEqual(4, registry.stats()['size'])
+
+        registry.clear()
+        self.assertEqual(0, registry.stats()['size'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import unittest
+from datetime import datetime, timedelta
+from helpers.dedup import DedupBackend, MemoryDedupBackend, UnknownDedupBackendException, check_and_mark, get_dedup_backend, get_dedup_cache, DEDUP_NEW, DEDUP_CACHED, DEDUP_NOT_ELAPSED, DEDUP_ELAPSED, DEDUP_IN_PROGRESS
+
+
+class CountingDedupBackend(MemoryDedupBackend):
+    calls = 0
+
+    def get(self, key):
+        CountingDedupBackend.calls += 1
+        return super().get(key)
+
+
+class TestDedup(unittest.TestCase):
+
+    def setUp(self):
+        get_dedup_cache().clear()
+        MemoryDedupBackend._markers.clear()
+        CountingDedupBackend.calls = 0
+
+    def test_repeat_hits_are_cached(self):
+        backend = get_dedup_backend(
+            {'backend': 'test.test_dedup.CountingDedupBackend'})
+
+        self.assertEqual(DEDUP_NEW,
+                         check_and_mark(backend, 'key', '1 hour').status)
+        self.assertEqual(1, CountingDedupBackend.calls)
+        for i in range(10):
+            result = check_and_mark(backend, 'key', '1 hour')
+            self.assertEqual(DEDUP_CACHED, result.status)
+            self.assertFalse(result.proceed)
+        self.assertEqual(1, CountingDedupBackend.calls)
+
+    def test_backend_is_source_of_truth(self):
+        backend = get_dedup_backend({'backend': 'memory'})
+        self.assertTrue(check_and_mark(backend, 'key', '1 hour').proceed)
+
+        # Another instance only sees the marker in the backend
+        get_dedup_cache().clear()
+        self.assertEqual(DEDUP_NOT_ELAPSED,
+                         check_and_mark(backend, 'key', '1 hour').status)
+
+        # Period elapsed
+        get_dedup_cache().clear()
+        later = datetime.utcnow() + timedelta(hours=2)
+        result = check_and_mark(backend, 'key', '1 hour', now=lambda: later)
+        self.assertEqual(DEDUP_ELAPSED, result.status)
+        self.assertTrue(result.proceed)
+
+    def test_concurrent_create(self):
+        backend = get_dedup_backend({'backend': 'memory'})
+        backend.create('key')
+        # Marker created between the check and the creation
+        backend.get = lambda key: None
+        self.assertEqual(DEDUP_IN_PROGRESS,
+                         check_and_mark(backend, 'key', '1 hour').status)
+
+    def test_unknown_backend(self):
+        for backend in ['nonexistent', 'nonexistent.Backend']:
+            with self.assertRaises(UnknownDedupBackendException):
+                get_dedup_backend({'backend': backend})
+
+    def test_incomplete_backend(self):
+
+        class IncompleteBackend(DedupBackend):
+
+            def get(self, key):
+                return None
+
+        with self.assertRaises(TypeError):
+            IncompleteBackend({})
+
+
+if __name__ == '__main__':
+    unittest.main()
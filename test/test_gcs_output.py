@@ -0,0 +1,142 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import io
+import json
+import base64
+import hashlib
+import threading
+import unittest
+from unittest import mock
+from output import gcs
+from output.gcs import GcsOutput, UploadFailedException
+from main import get_jinja_environment
+
+
+class FakeBlob:
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.size = None
+        self.md5_hash = None
+        self.crc32c = None
+
+    def _store(self, contents, method):
+        with self.bucket.lock:
+            if self.name == 'fail':
+                raise RuntimeError('upload failed')
+            self.bucket.objects[self.name] = contents
+            self.bucket.uploads.append((self.name, method))
+
+    def upload_from_string(self, contents, content_type=None):
+        self._store(contents, 'simple')
+
+    def upload_from_file(self, fileobj, size=None, content_type=None):
+        self._store(fileobj.read(), 'file')
+
+    def open(self, mode, **kwargs):
+        blob = self
+        writer = io.BytesIO()
+        writer.close = lambda: blob._store(writer.getvalue(), 'resumable')
+        return writer
+
+
+class FakeBucket:
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+        self.lock = threading.Lock()
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name):
+        if name not in self.objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob.size = len(self.objects[name])
+        blob.md5_hash = base64.b64encode(
+            hashlib.md5(self.objects[name]).digest()).decode('ascii')
+        return blob
+
+
+class TestGcsOutput(unittest.TestCase):
+
+    def setUp(self):
+        self.bucket = FakeBucket()
+        self.storage_client = mock.MagicMock()
+        self.storage_client.bucket.return_value = self.bucket
+
+    def run_output(self, output_config):
+        output = GcsOutput({}, dict(output_config, bucket='bucket'),
+                           get_jinja_environment(), None, None, None)
+        with mock.patch.object(output,
+                               '_get_storage_client',
+                               return_value=self.storage_client):
+            output.output()
+
+    def test_objects(self):
+        objects = {'report-%d.txt' % i: 'project-%d' % i for i in range(50)}
+        config = {
+            'objects': json.dumps(objects),
+            'contents': 'Report for {{ key }} in {{ filename }}',
+            'concurrency': 4,
+            'skipUnchanged': True,
+        }
+        self.run_output(config)
+        self.assertEqual(50, len(self.bucket.uploads))
+        self.assertEqual(b'Report for project-7 in report-7.txt',
+                         self.bucket.objects['report-7.txt'])
+
+        self.bucket.uploads = []
+        objects['report-7.txt'] = 'project-77'
+        self.run_output(dict(config, objects=json.dumps(objects)))
+        self.assertEqual([('report-7.txt', 'file')], self.bucket.uploads)
+
+        objects['fail'] = 'project'
+        with self.assertRaisesRegex(UploadFailedException,
+                                    'Failed to write 1 of 51 objects'):
+            self.run_output(
+                dict(config, objects=json.dumps(objects), skipUnchanged=False))
+
+    def test_streaming(self):
+        with mock.patch.object(gcs, 'STREAMING_CHUNK_SIZE', 1000):
+            self.run_output({
+                'object':
+                    'large.txt',
+                'contents':
+                    '{% for i in range(500) %}line {{ i }}\n{% endfor %}',
+            })
+            self.run_output({
+                'object': 'small.bin',
+                'contents': base64.b64encode(b'small contents').decode(),
+                'base64decode': True,
+            })
+        self.assertEqual([('large.txt', 'resumable'), ('small.bin', 'simple')],
+                         self.bucket.uploads)
+        self.assertEqual(
+            ''.join(['line %d\n' % i for i in range(500)]).encode('utf-8'),
+            self.bucket.objects['large.txt'])
+        self.assertEqual(b'small contents', self.bucket.objects['small.bin'])
+
+    def test_base64_decode(self):
+        contents = bytes(range(256)) * 3
+        encoded = base64.encodebytes(contents)
+        chunks = [encoded[i:i + 7] for i in range(0, len(encoded), 7)]
+        self.assertEqual(contents, b''.join(gcs._base64_decode(chunks)))
+
+
+if __name__ == '__main__':
+    unittest.main()
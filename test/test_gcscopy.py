@@ -0,0 +1,137 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import fnmatch
+import threading
+import unittest
+from unittest import mock
+from output.gcscopy import GcscopyOutput, CopyFailedException, glob_prefix
+from main import get_jinja_environment
+
+
+class FakeBlob:
+
+    def __init__(self, storage, bucket, name, size=None, md5_hash=None):
+        self.storage = storage
+        self.bucket = mock.MagicMock()
+        self.bucket.name = bucket
+        self.name = name
+        self.size = size
+        self.md5_hash = md5_hash
+        self.crc32c = None
+
+    def rewrite(self, source, token=None):
+        """Copies in two calls to exercise the rewrite token loop."""
+        if source.name.endswith('fail'):
+            raise RuntimeError('rewrite failed')
+        if token is None:
+            return ('token', 0, source.size)
+        self.storage.copy(source, self)
+        return (None, source.size, source.size)
+
+
+class FakeStorageClient:
+
+    def __init__(self, objects):
+        # (bucket, name) -> (size, md5)
+        self.objects = objects
+        self.copied = []
+        self.lock = threading.Lock()
+
+    def copy(self, source, destination):
+        with self.lock:
+            self.objects[(destination.bucket.name, destination.name)] = \
+                self.objects[(source.bucket.name, source.name)]
+            self.copied.append(destination.name)
+
+    def bucket(self, name):
+        bucket = mock.MagicMock()
+        bucket.blob = lambda object_name: FakeBlob(self, name, object_name)
+        return bucket
+
+    def list_blobs(self, bucket, prefix=None, match_glob=None, fields=None):
+        for (blob_bucket, name), (size, md5) in sorted(self.objects.items()):
+            if blob_bucket != bucket or not name.startswith(prefix):
+                continue
+            if match_glob and not fnmatch.fnmatch(name, match_glob):
+                continue
+            yield FakeBlob(self, bucket, name, size, md5)
+
+
+class TestGcscopyOutput(unittest.TestCase):
+
+    def setUp(self):
+        objects = {}
+        for i in range(20):
+            objects[('source', 'exports/file-%02d.json' % i)] = (100,
+                                                                 'md5-%d' % i)
+        objects[('source', 'exports/file.csv')] = (10, 'md5-csv')
+        objects[('source', 'exports/')] = (0, 'md5-folder')
+        # Already mirrored, and mirrored but since changed
+        objects[('mirror', 'nightly/file-00.json')] = (100, 'md5-0')
+        objects[('mirror', 'nightly/file-01.json')] = (100, 'md5-old')
+        self.storage_client = FakeStorageClient(objects)
+
+    def run_output(self, output_config):
+        output = GcscopyOutput({},
+                               dict(output_config,
+                                    sourceBucket='source',
+                                    destinationBucket='mirror'),
+                               get_jinja_environment(), None, None, None)
+        with mock.patch.object(output,
+                               '_get_storage_client',
+                               return_value=self.storage_client):
+            output.output()
+
+    def test_glob_prefix(self):
+        self.assertEqual('exports/', glob_prefix('exports/**.json'))
+        self.assertEqual('exports/file-0', glob_prefix('exports/file-0?.json'))
+        self.assertEqual('exports/', glob_prefix('exports/'))
+
+    def test_copy_prefix(self):
+        self.run_output({
+            'sourceGlob': 'exports/*.json',
+            'destinationPrefix': 'nightly/',
+            'concurrency': 3,
+        })
+        self.assertEqual(19, len(self.storage_client.copied))
+        self.assertNotIn('nightly/file-00.json', self.storage_client.copied)
+        self.assertEqual(
+            (100, 'md5-1'),
+            self.storage_client.objects[('mirror', 'nightly/file-01.json')])
+
+        self.storage_client.copied = []
+        self.run_output({'sourcePrefix': 'exports/'})
+        self.assertEqual(21, len(self.storage_client.copied))
+        self.assertIn('exports/file.csv', self.storage_client.copied)
+
+    def test_failures(self):
+        self.storage_client.objects[('source', 'exports/fail')] = (1, 'x')
+        with self.assertRaisesRegex(CopyFailedException,
+                                    'Failed to copy 1 of 22 objects'):
+            self.run_output({
+                'sourcePrefix': 'exports/',
+                'skipUnchanged': False
+            })
+        self.assertEqual(21, len(self.storage_client.copied))
+
+    def test_single_object(self):
+        self.run_output({
+            'sourceObject': 'exports/file.csv',
+            'destinationObject': 'latest.csv'
+        })
+        self.assertEqual(['latest.csv'], self.storage_client.copied)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import io
+import time
+import logging
+from contextlib import redirect_stdout
+from .helpers import fixture_to_pubsub, load_config
+import unittest
+from helpers.lock import DistributedLock, MemoryLockBackend, get_lock_backend, parse_duration
+
+
+class TestLock(unittest.TestCase):
+
+    def setUp(self):
+        MemoryLockBackend._locks.clear()
+
+    def test_fencing(self):
+        backend = get_lock_backend({'backend': 'memory'})
+        first = DistributedLock(backend, 'lock', 0.2, heartbeat=False)
+        second = DistributedLock(backend, 'lock', 0.2, heartbeat=False)
+
+        self.assertTrue(first.acquire())
+        self.assertFalse(second.acquire())
+        self.assertIsNone(second.token)
+        retry_after = second.get_retry_after()
+        self.assertTrue(0.5 <= retry_after <= 1.5)
+
+        # Lease expires, the lock is taken over with a higher token
+        time.sleep(0.3)
+        self.assertTrue(second.acquire())
+        self.assertGreater(second.token, first.lease.token)
+
+        # Releasing a lost lock does not release the new holder's lock
+        self.assertFalse(backend.release(first.lease))
+        self.assertFalse(backend.renew(first.lease, 0.2))
+        self.assertFalse(first.acquire())
+        second.release()
+        self.assertTrue(first.acquire())
+        first.release()
+
+    def test_heartbeat(self):
+        backend = get_lock_backend({'backend': 'memory'})
+        holder = DistributedLock(backend, 'lock', 0.3)
+        self.assertTrue(holder.acquire())
+        time.sleep(0.6)
+        self.assertFalse(DistributedLock(backend, 'lock', 0.3).acquire())
+        holder.release()
+        self.assertTrue(DistributedLock(backend, 'lock', 0.3).acquire())
+
+    def test_parse_duration(self):
+        self.assertEqual(30.0, parse_duration(30))
+        self.assertEqual(30.0, parse_duration('30'))
+        self.assertEqual(120.0, parse_duration('2 minutes'))
+
+    def test_pipeline_lock(self):
+        logger = logging.getLogger('test')
+        config = load_config('concurrency')
+        event, context = fixture_to_pubsub('generic')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            main.decode_and_process(logger, config, event, context)
+        self.assertTrue(buf.getvalue().startswith('TOKEN '))
+        # The lock is released after processing
+        self.assertEqual({}, MemoryLockBackend._locks)
+
+        holder = DistributedLock(get_lock_backend({'backend': 'memory'}),
+                                 'test-lock')
+        holder.acquire()
+        with self.assertRaises(main.ConcurrencyRetryException) as cre:
+            main.decode_and_process(logger, config, event, context)
+        self.assertTrue(1 <= cre.exception.retry_after <= 3)
+        holder.release()
+
+
+if __name__ == '__main__':
+    unittest.main()
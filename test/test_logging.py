@@ -0,0 +1,143 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import re
+import json
+import threading
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+from processors.logging import LoggingProcessor
+from main import get_jinja_environment
+
+
+class FakeLoggingService:
+    """Cloud Logging v2 client serving one entry per minute of 2024-01-01,
+    honouring timestamp filters, page sizes and ordering."""
+
+    def __init__(self):
+        self.entries_list = [{
+            'timestamp': '2024-01-01T%02d:%02d:00Z' % (i // 60, i % 60),
+            'receiveTimestamp': '2024-01-01T%02d:%02d:01Z' % (i // 60, i % 60),
+            'textPayload': 'entry %d' % i
+        } for i in range(600)]
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def entries(self):
+        return self
+
+    def list(self, body):
+        with self.lock:
+            self.requests.append(dict(body))
+        entries = self.entries_list
+        times = re.findall(r'timestamp ([<>]=?) "([^"]+)"', body['filter'])
+        for op, value in times:
+            value = value.replace('+00:00', 'Z')
+            if op == '>=':
+                entries = [e for e in entries if e['timestamp'] >= value]
+            else:
+                entries = [e for e in entries if e['timestamp'] < value]
+        if 'desc' in body['orderBy']:
+            entries = list(reversed(entries))
+        start = int(body.get('pageToken', 0))
+        response = {'entries': entries[start:start + body['pageSize']]}
+        if start + body['pageSize'] < len(entries):
+            response['nextPageToken'] = str(start + body['pageSize'])
+        request = MagicMock()
+        request.execute.return_value = response
+        return request
+
+
+class TestLoggingProcessor(unittest.TestCase):
+
+    def setUp(self):
+        self.service = FakeLoggingService()
+
+    def process(self, config):
+        processor = LoggingProcessor(
+            dict(config,
+                 mode='logging.entries',
+                 resourceNames=['projects/example-project']),
+            get_jinja_environment(), '{}', None, None)
+        with mock.patch('google.auth.default',
+                        return_value=(MagicMock(), 'example-project')):
+            with mock.patch.object(processor,
+                                   '_get_discovery_client',
+                                   return_value=self.service):
+                ret = processor.process()
+        processor._clean_tempdir()
+        return ret['logging']
+
+    def test_max_entries(self):
+        entries = self.process({'maxEntries': 250, 'pageSize': 100})
+        self.assertEqual(250, len(entries))
+        self.assertEqual([100, 100, 50],
+                         [r['pageSize'] for r in self.service.requests])
+
+    def test_max_entries_text_only(self):
+        for i in range(0, 600, 2):
+            del self.service.entries_list[i]['textPayload']
+        entries = self.process({
+            'maxEntries': 250,
+            'pageSize': 100,
+            'format': 'text-only'
+        })
+        self.assertEqual(['entry %d' % i for i in range(1, 500, 2)], entries)
+
+    def test_slices(self):
+        entries = self.process({
+            'startTime': '2024-01-01T01:00:00Z',
+            'endTime': '2024-01-01T09:00:00Z',
+            'slices': 4,
+            'orderBy': 'timestamp desc',
+            'format': 'text-only',
+            'filter': 'severity >= DEFAULT',
+            'maxEntries': 150,
+        })
+        self.assertEqual(['entry %d' % i for i in range(539, 389, -1)], entries)
+        self.assertEqual(4, len(self.service.requests))
+        self.assertIn(
+            '(severity >= DEFAULT) AND timestamp >= "2024-01-01T01:00:00Z" '
+            'AND timestamp < "2024-01-01T03:00:00Z"',
+            [r['filter'] for r in self.service.requests])
+
+    def test_output_file(self):
+        processor = LoggingProcessor(
+            {
+                'mode': 'logging.entries',
+                'resourceNames': ['projects/example-project'],
+                'startTime': '2024-01-01T00:00:00Z',
+                'endTime': '2024-01-01T10:00:00Z',
+                'slices': 3,
+                'outputFile': 'entries.json',
+            }, get_jinja_environment(), '{}', None, None)
+        with mock.patch('google.auth.default',
+                        return_value=(MagicMock(), 'example-project')):
+            with mock.patch.object(processor,
+                                   '_get_discovery_client',
+                                   return_value=self.service):
+                ret = processor.process()['logging']
+        try:
+            self.assertEqual(600, ret['count'])
+            with open(processor._get_path(ret['filename'])) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(self.service.entries_list, lines)
+            self.assertEqual(ret['size'],
+                             sum([len(json.dumps(e)) + 1 for e in lines]))
+        finally:
+            processor._clean_tempdir()
+
+
+if __name__ == '__main__':
+    unittest.main()
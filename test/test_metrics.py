@@ -0,0 +1,118 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import io
+import logging
+import unittest
+from contextlib import redirect_stdout
+from falcon import testing
+from unittest.mock import MagicMock
+from .helpers import fixture_to_pubsub, load_config
+from helpers.metrics import Counter, Histogram, MetricsLogger, MetricsRegistry, MESSAGES, TASK_DURATION, TEMPLATE_RENDER_DURATION, get_metrics_registry
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        get_metrics_registry().clear()
+
+    def test_render(self):
+        registry = MetricsRegistry()
+        counter = registry.register(
+            Counter('test_total', 'Test counter.', ['result']))
+        histogram = registry.register(
+            Histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1.0)))
+        counter.inc(result='a"b')
+        counter.inc(2, result='a"b')
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(5)
+
+        self.assertEqual(
+            '\n'.join([
+                '# HELP test_total Test counter.',
+                '# TYPE test_total counter',
+                'test_total{result="a\\"b"} 3',
+                '# HELP test_seconds Test histogram.',
+                '# TYPE test_seconds histogram',
+                'test_seconds_bucket{le="0.1"} 1',
+                'test_seconds_bucket{le="1"} 2',
+                'test_seconds_bucket{le="+Inf"} 3',
+                'test_seconds_sum 5.6',
+                'test_seconds_count 3',
+            ]) + '\n', registry.render())
+        self.assertEqual({'result=a"b': 3}, registry.summarize()['test_total'])
+
+    def test_pipeline_metrics(self):
+        logger = logging.getLogger('test')
+        config = load_config('message-handling')
+        data, context = fixture_to_pubsub('message-handling')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            main.decode_and_process(logger, config, data, context)
+
+        self.assertEqual(1, MESSAGES.get(outcome='stopped'))
+        self.assertEqual(
+            1,
+            TASK_DURATION.get(task='#1',
+                              type='processor',
+                              handler='genericjson',
+                              status='ok')[0])
+        self.assertEqual(
+            1,
+            TEMPLATE_RENDER_DURATION.get(handler='logger',
+                                         template='message')[0])
+        self.assertEqual(
+            0,
+            TASK_DURATION.get(task='#2',
+                              type='output',
+                              handler='logger',
+                              status='ok')[0])
+
+        with redirect_stdout(buf):
+            with self.assertRaises(main.MessageTooOldException):
+                context.timestamp = '2000-01-01T00:00:00.000Z'
+                main.decode_and_process(logger, load_config('budget'), data,
+                                        context)
+        self.assertEqual(1, MESSAGES.get(outcome='too_old'))
+
+    def test_metrics_endpoint(self):
+        MESSAGES.inc(outcome='processed')
+        client = testing.TestClient(main.run_webserver())
+        result = client.simulate_get('/metrics')
+        self.assertEqual(200, result.status_code)
+        self.assertIn('text/plain', result.headers['content-type'])
+        self.assertIn('pubsub2inbox_messages_total{outcome="processed"} 1',
+                      result.text)
+        self.assertIn('pubsub2inbox_template_cache_size', result.text)
+
+    def test_metrics_logger(self):
+        logger = MagicMock()
+        self.assertFalse(MetricsLogger(0).maybe_log(logger))
+        self.assertFalse(MetricsLogger(300).maybe_log(logger))
+
+        metrics_logger = MetricsLogger(300)
+        metrics_logger.last_logged -= 301
+        MESSAGES.inc(outcome='processed')
+        self.assertTrue(metrics_logger.maybe_log(logger))
+        summary = logger.info.call_args[1]['extra']['metrics']
+        self.assertEqual(
+            {'outcome=processed': 1},
+            summary['pubsub2inbox_messages_total'],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
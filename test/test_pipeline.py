@@ -0,0 +1,140 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import io
+import time
+import asyncio
+import logging
+from contextlib import redirect_stdout
+from concurrent.futures import ThreadPoolExecutor
+from .helpers import fixture_to_pubsub, load_config
+import unittest
+from jinja2 import TemplateSyntaxError
+from output.logger import LoggerOutput
+from processors.genericjson import GenericjsonProcessor
+from processors.shellscript import CommandFailedException
+
+
+class TestPipelinePlan(unittest.TestCase):
+
+    def test_plan(self):
+        config = load_config('message-handling')
+        plan = main.get_pipeline_plan(config)
+
+        self.assertIs(plan, main.get_pipeline_plan(config))
+        self.assertEqual(5, len(plan.tasks))
+        self.assertIs(GenericjsonProcessor, plan.tasks[0].handler_class)
+        self.assertIs(LoggerOutput, plan.tasks[1].handler_class)
+        self.assertEqual('test_message', plan.tasks[0].output)
+        self.assertIsNotNone(plan.tasks[1].run_if)
+        self.assertIsNotNone(plan.tasks[3].stop_if)
+
+    def test_plan_threads(self):
+        configs = [{
+            'pipeline': [{
+                'type': 'output.logger',
+                'config': {
+                    'message': 'config %d' % (i)
+                }
+            }]
+        } for i in range(main._PIPELINE_PLANS_MAX * 2)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            plans = list(
+                executor.map(main.get_pipeline_plan, configs * 4, chunksize=1))
+        for config, plan in zip(configs * 4, plans):
+            self.assertIs(config['pipeline'][0]['config'], plan.tasks[0].config)
+        self.assertLessEqual(len(main._PIPELINE_PLANS),
+                             main._PIPELINE_PLANS_MAX)
+
+    def test_malformed_type(self):
+        for task_type in ['processor', 'processors.genericjson', 'a.b.c', '']:
+            with self.assertRaises(main.NoTypeInPipelineException):
+                main.PipelinePlan({'pipeline': [{'type': task_type}]})
+
+    def test_unknown_handler(self):
+        with self.assertRaises(main.MalformedTypeInPipelineException):
+            main.PipelinePlan({'pipeline': [{'type': 'processor.nonexistent'}]})
+
+    def test_empty_pipeline(self):
+        with self.assertRaises(main.NoPipelineConfiguredException):
+            main.PipelinePlan({'pipeline': []})
+
+    def test_template_syntax_error(self):
+        with self.assertRaises(TemplateSyntaxError):
+            main.get_pipeline_plan(
+                {'pipeline': [{
+                    'type': 'output.logger',
+                    'runIf': '{% if %}'
+                }]})
+
+
+class TestParallelTasks(unittest.TestCase):
+
+    def _process(self, config, use_async=False, buf=None):
+        logger = logging.getLogger('test')
+        event, context = fixture_to_pubsub('generic')
+        if buf is None:
+            buf = io.StringIO()
+        with redirect_stdout(buf):
+            if use_async:
+                asyncio.run(
+                    main.decode_and_process_async(logger, config, event,
+                                                  context))
+            else:
+                main.decode_and_process(logger, config, event, context)
+        return buf.getvalue().rstrip()
+
+    def test_plan(self):
+        plan = main.get_pipeline_plan(
+            load_config('parallel', {'PARALLEL_EXIT_CODE': '1'}))
+        group = plan.tasks[1]
+        self.assertEqual('parallel', group.task_type)
+        self.assertEqual(4, len(group.tasks))
+        self.assertEqual('#2.3', group.tasks[2].name)
+        self.assertTrue(group.tasks[3].can_fail)
+
+        for unsupported in ['stopIf', 'ignoreOn', 'parallel']:
+            with self.assertRaises(main.MalformedParallelTaskException):
+                main.PipelinePlan({
+                    'pipeline': [{
+                        'parallel': [{
+                            'type': 'output.logger',
+                            unsupported: '1'
+                        }]
+                    }]
+                })
+        with self.assertRaises(main.MalformedParallelTaskException):
+            main.PipelinePlan({'pipeline': [{'parallel': []}]})
+
+    def test_parallel(self):
+        for use_async in [False, True]:
+            config = load_config('parallel', {'PARALLEL_EXIT_CODE': '1'})
+            started = time.monotonic()
+            self.assertEqual('first second', self._process(config, use_async))
+            self.assertLess(time.monotonic() - started, 0.9)
+
+    def test_parallel_failure(self):
+        for use_async in [False, True]:
+            config = load_config('parallel', {
+                'PARALLEL_EXIT_CODE': '1',
+                'canFail: true': 'canFail: false'
+            })
+            buf = io.StringIO()
+            with self.assertRaises(CommandFailedException):
+                self._process(config, use_async, buf)
+            self.assertEqual('ERROR', buf.getvalue().rstrip())
+
+
+if __name__ == '__main__':
+    unittest.main()
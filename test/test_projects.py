@@ -0,0 +1,162 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import tempfile
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from helpers import projects
+from helpers.projects import ProjectCache
+from processors.base import UnknownProjectException
+from processors.genericjson import GenericjsonProcessor
+
+PROJECTS = {
+    'project-a': {
+        'projectId': 'project-a',
+        'projectNumber': '111',
+        'name': 'Project A',
+        'labels': {
+            'team': 'a'
+        }
+    },
+    'project-b': {
+        'projectId': 'project-b',
+        'projectNumber': '222',
+        'name': 'Project B'
+    },
+}
+
+
+class FakeResourceManager:
+    """Cloud Resource Manager v1 client serving PROJECTS."""
+
+    def __init__(self):
+        self.gets = []
+        self.lists = 0
+
+    def projects(self):
+        return self
+
+    def get(self, projectId):
+        self.gets.append(projectId)
+        request = MagicMock()
+        for project in PROJECTS.values():
+            if projectId in [project['projectId'], project['projectNumber']]:
+                request.execute.return_value = project
+                return request
+        request.execute.side_effect = HttpError(MagicMock(status=403), b'')
+        return request
+
+    def list(self):
+        self.lists += 1
+        request = MagicMock()
+        request.execute.return_value = {'projects': list(PROJECTS.values())}
+        return request
+
+    def list_next(self, request, response):
+        return None
+
+
+class TestProjectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        self.service = FakeResourceManager()
+
+    def get_cache(self, **kwargs):
+        return ProjectCache(now=lambda: self.now, **kwargs)
+
+    def get_projects(self, cache, keys):
+        return cache.get_projects(keys, lambda: self.service)
+
+    def test_targeted_get_and_ttl(self):
+        cache = self.get_cache(ttl=60)
+        self.assertEqual([('project-a', '111', 'Project A', {
+            'team': 'a'
+        }), ('project-b', '222', 'Project B', {})],
+                         self.get_projects(cache, ['111', 'project-b']))
+        self.assertEqual(['111', 'project-b'], self.service.gets)
+        self.assertEqual(0, self.service.lists)
+
+        # Cached by both ID and number
+        self.get_projects(cache, ['project-a', '222'])
+        self.assertEqual(2, len(self.service.gets))
+
+        self.now += 61
+        self.get_projects(cache, ['project-a'])
+        self.assertEqual(3, len(self.service.gets))
+
+    def test_negative_caching(self):
+        cache = self.get_cache(negative_ttl=30)
+        self.assertEqual([None], self.get_projects(cache, ['999']))
+        self.assertEqual([None], self.get_projects(cache, ['999']))
+        self.assertEqual(1, len(self.service.gets))
+
+        self.now += 31
+        self.get_projects(cache, ['999'])
+        self.assertEqual(2, len(self.service.gets))
+
+    def test_list_threshold(self):
+        cache = self.get_cache(list_threshold=2)
+        self.assertEqual(['project-a', 'project-b', None], [
+            p[0] if p else None
+            for p in self.get_projects(cache, ['111', '222', '999'])
+        ])
+        self.assertEqual(1, self.service.lists)
+        self.assertEqual([], self.service.gets)
+        self.assertEqual([None], self.get_projects(cache, ['999']))
+        self.assertEqual([], self.service.gets)
+
+    def test_snapshot(self):
+        with tempfile.TemporaryDirectory() as tempdir:
+            snapshot = os.path.join(tempdir, 'projects.json')
+            cache = self.get_cache(snapshot=snapshot, snapshot_interval=60)
+            self.assertFalse(cache.load_snapshot())
+            self.get_projects(cache, ['111'])
+            self.assertTrue(os.path.exists(snapshot))
+
+            # Not saved again until the interval has passed
+            self.get_projects(cache, ['222'])
+            self.assertFalse(cache.maybe_save_snapshot())
+            self.now += 61
+            self.assertTrue(cache.maybe_save_snapshot())
+
+            warm_cache = self.get_cache(snapshot=snapshot)
+            self.assertTrue(warm_cache.load_snapshot())
+            self.assertEqual((True, ('project-b', '222', 'Project B', {})),
+                             warm_cache.get('project-b'))
+
+            self.now += 3600
+            expired_cache = self.get_cache(snapshot=snapshot)
+            expired_cache.load_snapshot()
+            self.assertEqual((False, None), expired_cache.get('project-b'))
+
+    def test_expand_projects(self):
+        processor = GenericjsonProcessor({}, None, None, None, None)
+        with mock.patch.object(projects, '_PROJECT_CACHE', self.get_cache()), \
+                mock.patch.object(processor, '_get_discovery_client',
+                                  return_value=self.service):
+            self.assertEqual(['project-a', 'project-b'], [
+                p[0] for p in processor.expand_projects(
+                    ['projects/111', 'project-b/'])
+            ])
+            self.assertEqual(222, processor.get_project_number('project-b'))
+            with self.assertRaises(UnknownProjectException):
+                processor.expand_projects(['projects/999'])
+        self.assertEqual(['111', 'project-b', '999'], self.service.gets)
+
+
+if __name__ == '__main__':
+    unittest.main()
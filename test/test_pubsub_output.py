@@ -0,0 +1,149 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import os
+import json
+import tempfile
+import unittest
+from unittest import mock
+from concurrent import futures
+from helpers.base import get_client_registry
+from output.pubsub import PubsubOutput, PublishFailedException
+from main import get_jinja_environment
+
+TOPIC = 'projects/example-project/topics/assets'
+
+
+class FakePublisherClient:
+    """Records published messages, failing messages containing "fail"."""
+
+    instances = []
+
+    def __init__(self, batch_settings=None, publisher_options=None, **kwargs):
+        self.batch_settings = batch_settings
+        self.publisher_options = publisher_options
+        self.published = []
+        self.resumed = []
+        FakePublisherClient.instances.append(self)
+
+    def publish(self, topic, data, ordering_key=None, **attrs):
+        future = futures.Future()
+        if b'fail' in data:
+            future.set_exception(RuntimeError('publish failed'))
+        else:
+            self.published.append((topic, data, ordering_key, attrs))
+            future.set_result(str(len(self.published)))
+        return future
+
+    def resume_publish(self, topic, ordering_key):
+        self.resumed.append(ordering_key)
+
+
+class TestPubsubOutput(unittest.TestCase):
+
+    def setUp(self):
+        get_client_registry().clear()
+        FakePublisherClient.instances = []
+        self.patcher = mock.patch('google.cloud.pubsub_v1.PublisherClient',
+                                  FakePublisherClient)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+        get_client_registry().clear()
+
+    def get_output(self, output_config, assets=None):
+        jinja_environment = get_jinja_environment()
+        jinja_environment.globals['assets'] = assets
+        return PubsubOutput({}, dict(output_config, topic=TOPIC),
+                            jinja_environment, None, None, None)
+
+    def test_messages(self):
+        output = self.get_output(
+            {
+                'messages': '{{ assets|json_encode }}',
+                'content': '{{ value.name }}',
+                'attributes': '{"key": "{{ key }}"}',
+                'batchMaxMessages': 500,
+                'batchMaxLatency': 1,
+            },
+            assets=[{
+                'name': 'a'
+            }, {
+                'name': 'b'
+            }, {
+                'name': 'a'
+            }])
+        output.output()
+
+        publisher = FakePublisherClient.instances[0]
+        self.assertEqual(500, publisher.batch_settings.max_messages)
+        self.assertEqual(1.0, publisher.batch_settings.max_latency)
+        # Identical list items are only published once
+        self.assertEqual([b'a', b'b'], [m[1] for m in publisher.published])
+        self.assertEqual(32, len(publisher.published[0][3]['key']))
+
+        # The publisher is reused by later messages
+        output.output()
+        self.assertEqual(1, len(FakePublisherClient.instances))
+
+    def test_generator_and_file(self):
+        output = self.get_output(
+            {
+                'messagesExpr': 'assets',
+                'content': '{{ value.name }}',
+                'ordering_key': '{{ value.name }}',
+            },
+            assets=({
+                'name': 'asset-%d' % i
+            } for i in range(1000)))
+        output.output()
+        publisher = FakePublisherClient.instances[0]
+        self.assertTrue(publisher.publisher_options.enable_message_ordering)
+        self.assertEqual(1000, len(publisher.published))
+        self.assertEqual('asset-999', publisher.published[999][2])
+
+        with tempfile.NamedTemporaryFile('w', suffix='.jsonl',
+                                         delete=False) as messages_file:
+            for i in [0, 1, 1, 2]:
+                messages_file.write(json.dumps({'name': 'line-%d' % i}) + '\n')
+        try:
+            output = self.get_output({
+                'messagesFile': messages_file.name,
+                'content': '{{ value.name }}',
+            })
+            output.output()
+        finally:
+            os.unlink(messages_file.name)
+        publisher = FakePublisherClient.instances[1]
+        self.assertEqual([b'line-0', b'line-1', b'line-2'],
+                         [m[1] for m in publisher.published])
+
+    def test_errors(self):
+        output = self.get_output(
+            {
+                'messagesExpr': 'assets',
+                'content': '{{ value }}',
+                'ordering_key': 'key-{{ value }}',
+            },
+            assets=['ok', 'fail', 'ok-2', 'fail-2'])
+        with self.assertRaisesRegex(PublishFailedException,
+                                    'Failed to publish 2 of 4 messages'):
+            output.output()
+        publisher = FakePublisherClient.instances[0]
+        self.assertEqual(2, len(publisher.published))
+        self.assertEqual(['key-fail', 'key-fail-2'], publisher.resumed)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import io
+import base64
+import json
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from dateutil import parser
+from .helpers import load_config
+import unittest
+from unittest.mock import MagicMock
+from helpers.lock import DistributedLock, get_lock_backend
+
+
+def fixture_to_pulled_message(fixture, publish_time=None):
+    with open('test/fixtures/%s.json' % fixture, 'r') as file:
+        data = json.loads(file.read())
+
+    message = MagicMock()
+    message.data = base64.b64decode(data[0]['message']['data'])
+    message.attributes = data[0]['message']['attributes']
+    message.message_id = data[0]['message']['messageId']
+    message.publish_time = publish_time if publish_time else parser.parse(
+        data[0]['message']['publishTime'])
+    return message
+
+
+class TestPullWorker(unittest.TestCase):
+
+    def test_processed_message_is_acked(self):
+        config = load_config('message-handling')
+        message = fixture_to_pulled_message('message-handling')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            main.process_pulled_message(config, message)
+
+        self.assertEqual('OK1', buf.getvalue().rstrip())
+        message.ack.assert_called_once()
+        message.nack.assert_not_called()
+
+    def test_too_old_message_is_acked(self):
+        config = load_config('budget')
+        message = fixture_to_pulled_message('budget')
+
+        main.process_pulled_message(config, message)
+
+        message.ack.assert_called_once()
+        message.nack.assert_not_called()
+
+    def test_failed_message_is_nacked(self):
+        config = load_config('shellscript-fail')
+        message = fixture_to_pulled_message('generic',
+                                            datetime.now(timezone.utc))
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            main.process_pulled_message(config, message)
+
+        message.nack.assert_called_once()
+        message.ack.assert_not_called()
+
+    def test_deferred_message_is_nacked_later(self):
+        config = load_config('concurrency')
+        message = fixture_to_pulled_message('generic')
+        holder = DistributedLock(get_lock_backend({'backend': 'memory'}),
+                                 'test-lock')
+        holder.acquire()
+        try:
+            main.process_pulled_message(config, message)
+        finally:
+            holder.release()
+
+        message.ack.assert_not_called()
+        message.nack.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import threading
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+from googleapiclient.errors import HttpError
+from helpers import recipients
+from helpers.recipients import RecipientCache, RecipientExpander
+from output.mail import MailOutput, GroupNotFoundException
+from main import get_jinja_environment
+
+# Group members as (address, type), oncall is paginated two members a page
+GROUPS = {
+    'oncall@example.com': [('alice@example.com', 'USER'),
+                           ('bob@example.com', 'USER'),
+                           ('sre@example.com', 'GROUP'),
+                           ('carol@example.com', 'USER')],
+    'sre@example.com': [('dave@example.com', 'USER'),
+                        ('oncall@example.com', 'GROUP')],
+    'empty@example.com': [],
+}
+USERS = ['alice@example.com', 'erin@example.com']
+
+
+class FakeDirectory:
+    """Cloud Identity and Directory API client serving GROUPS and USERS."""
+
+    def __init__(self):
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def _call(self, *args):
+        with self._lock:
+            self.calls.append(args)
+
+    def _request(self, response=None, status=None):
+        request = MagicMock()
+        request.uri = 'https://cloudidentity.googleapis.com/v1beta1/groups:lookup?alt=json'
+        if status:
+            request.execute.side_effect = HttpError(MagicMock(status=status),
+                                                    b'')
+        else:
+            request.execute.return_value = response
+        return request
+
+    def groups(self):
+        return self
+
+    def memberships(self):
+        return self
+
+    def users(self):
+        return self
+
+    def lookup(self):
+        directory = self
+        request = self._request()
+
+        def execute():
+            group = request.uri.split('groupKey.id=')[1]
+            directory._call('lookup', group)
+            if group not in GROUPS:
+                raise HttpError(MagicMock(status=403), b'')
+            return {'name': 'groups/%s' % group}
+
+        request.execute.side_effect = execute
+        return request
+
+    def list(self, parent, pageSize, pageToken=None):
+        group = parent[7:]
+        self._call('list', group, pageToken)
+        page = int(pageToken) if pageToken else 0
+        members = GROUPS[group][page * 2:page * 2 + 2]
+        response = {}
+        if members:
+            response['memberships'] = [{
+                'memberKey': {
+                    'id': member
+                },
+                'type': member_type
+            } for member, member_type in members]
+        if len(GROUPS[group]) > page * 2 + 2:
+            response['nextPageToken'] = str(page + 1)
+        request = self._request(response)
+        request.parent = parent
+        return request
+
+    def list_next(self, request, response):
+        if 'nextPageToken' not in response:
+            return None
+        return self.list(request.parent, 2, response['nextPageToken'])
+
+    def get(self, userKey):
+        self._call('get', userKey)
+        if userKey in USERS:
+            return self._request({'primaryEmail': userKey})
+        if userKey == 'flaky@example.com':
+            return self._request(status=503)
+        return self._request(status=404)
+
+
+class TestRecipientExpander(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = FakeDirectory()
+        self.cache = RecipientCache()
+
+    def get_expander(self, **kwargs):
+        return RecipientExpander(lambda: self.directory,
+                                 lambda: self.directory,
+                                 cache=self.cache,
+                                 **kwargs)
+
+    def test_expand(self):
+        expander = self.get_expander()
+        self.assertEqual([
+            ('oncall@example.com', 'group', [
+                'alice@example.com', 'bob@example.com', 'sre@example.com',
+                'carol@example.com'
+            ]),
+            ('erin@example.com', 'user', ['erin@example.com']),
+            ('nobody@example.com', 'missing', []),
+            ('empty@example.com', 'group', []),
+        ],
+                         expander.expand([
+                             'oncall@example.com', 'erin@example.com',
+                             'nobody@example.com', 'empty@example.com'
+                         ]))
+        # All membership pages were fetched
+        self.assertIn(('list', 'oncall@example.com', '1'), self.directory.calls)
+
+        calls = len(self.directory.calls)
+        expander.expand(['oncall@example.com', 'nobody@example.com'])
+        self.assertEqual(calls, len(self.directory.calls))
+
+    def test_transient_errors(self):
+        expander = self.get_expander()
+        with self.assertRaises(HttpError):
+            expander.expand(['flaky@example.com'])
+        self.assertIsNone(self.cache.get((None, 'flaky@example.com')))
+
+        USERS.append('flaky@example.com')
+        try:
+            self.assertEqual(
+                [('flaky@example.com', 'user', ['flaky@example.com'])],
+                expander.expand(['flaky@example.com']))
+        finally:
+            USERS.remove('flaky@example.com')
+
+    def test_nested_groups(self):
+        expander = self.get_expander(nested=True, max_workers=1)
+        self.assertEqual([
+            ('oncall@example.com', 'group', [
+                'alice@example.com', 'bob@example.com', 'carol@example.com',
+                'dave@example.com'
+            ]),
+        ], expander.expand(['oncall@example.com']))
+
+    def test_limit(self):
+        expander = self.get_expander(max_recipients=2)
+        self.assertEqual(['a@example.com', 'b@example.com'],
+                         expander.limit([
+                             'a@example.com', 'A@example.com', 'b@example.com',
+                             'c@example.com'
+                         ]))
+
+    def test_mail_output(self):
+        output = MailOutput({}, {}, get_jinja_environment(), None, None, None)
+        mail = {
+            'mail_to':
+                'oncall@example.com, erin@example.com, nobody@example.com'
+        }
+        with mock.patch.object(recipients, '_RECIPIENT_CACHE', self.cache), \
+                mock.patch.object(output, 'get_credentials_for_scopes'), \
+                mock.patch.object(output, '_get_discovery_client',
+                                  return_value=self.directory):
+            with self.assertRaises(GroupNotFoundException):
+                output.expand_recipients(dict(mail), {})
+
+            result = output.expand_recipients(
+                dict(mail), {
+                    'ignoreNonexistentGroups': True,
+                    'expandNestedGroups': True,
+                    'maxRecipients': '{{ 5 }}',
+                })
+        self.assertEqual(
+            'alice@example.com, bob@example.com, carol@example.com, dave@example.com, erin@example.com',
+            result['mail_to'])
+
+
+if __name__ == '__main__':
+    unittest.main()
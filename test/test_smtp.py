@@ -0,0 +1,132 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import smtplib
+import unittest
+from unittest import mock
+from unittest.mock import MagicMock
+from helpers import smtp
+from helpers.metrics import SMTP_CONNECTIONS, get_metrics_registry
+from helpers.smtp import SmtpConnectionPool
+from output.mail import MailOutput
+from main import get_jinja_environment
+
+MESSAGE = ('from@example.com', ['to@example.com'], 'Subject: test\n\ntest')
+
+
+class TestSmtpConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        get_metrics_registry().clear()
+        self.now = 1000.0
+        self.pool = SmtpConnectionPool(max_size=1,
+                                       idle_timeout=60,
+                                       now=lambda: self.now)
+        self.servers = []
+
+    def connect(self):
+        server = MagicMock()
+        server.noop.return_value = (250, b'OK')
+        self.servers.append(server)
+        return server
+
+    def test_reuse(self):
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.pool.send('key', self.connect, [MESSAGE, MESSAGE])
+        self.assertEqual(1, len(self.servers))
+        self.assertEqual(3, self.servers[0].sendmail.call_count)
+        self.servers[0].quit.assert_not_called()
+        self.assertEqual(1, SMTP_CONNECTIONS.get(result='reused'))
+
+        self.pool.send('other', self.connect, [MESSAGE])
+        self.assertEqual(2, len(self.servers))
+
+    def test_idle_connections(self):
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.now += 10
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.servers[0].noop.assert_called_once()
+
+        self.servers[0].noop.side_effect = smtplib.SMTPServerDisconnected()
+        self.now += 10
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.assertEqual(2, len(self.servers))
+
+        self.now += 61
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.assertEqual(3, len(self.servers))
+        self.servers[1].quit.assert_called_once()
+        self.servers[1].noop.assert_not_called()
+
+    def test_reconnect(self):
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.servers[0].sendmail.side_effect = smtplib.SMTPServerDisconnected()
+        self.pool.send('key', self.connect, [MESSAGE])
+        self.assertEqual(2, len(self.servers))
+        self.servers[1].sendmail.assert_called_once_with(*MESSAGE)
+        self.assertEqual(1, SMTP_CONNECTIONS.get(result='reconnect'))
+
+        # Session limit reached in the middle of a batch
+        self.servers[1].sendmail.side_effect = [{},
+                                                smtplib.SMTPSenderRefused(
+                                                    421, b'Too many messages',
+                                                    'from@example.com')]
+        self.pool.send('key', self.connect, [MESSAGE, MESSAGE])
+        self.assertEqual(3, len(self.servers))
+
+    def test_failure_on_new_connection(self):
+
+        def connect():
+            server = self.connect()
+            server.sendmail.side_effect = smtplib.SMTPServerDisconnected()
+            return server
+
+        with self.assertRaises(smtplib.SMTPServerDisconnected):
+            self.pool.send('key', connect, [MESSAGE])
+        self.servers[0].quit.assert_called_once()
+        self.assertEqual(0, self.pool.stats()['size'])
+
+        self.servers[0].sendmail.side_effect = smtplib.SMTPRecipientsRefused({})
+        with self.assertRaises(smtplib.SMTPRecipientsRefused):
+            self.pool.send('key', lambda: self.servers[0], [MESSAGE])
+
+    def test_mail_per_recipient(self):
+        output = MailOutput({}, {}, get_jinja_environment(), None, None, None)
+        mail = {
+            'mail_from': 'from@example.com',
+            'mail_to': 'a@example.com, B <b@example.com>',
+            'mail_subject': 'Test',
+            'text_body': 'Test',
+            'html_body': '',
+        }
+        transport = {'host': 'smtp.example.com', 'port': 587}
+        with mock.patch.object(smtp, '_SMTP_POOL', self.pool), \
+                mock.patch('output.mail.smtplib.SMTP',
+                           side_effect=lambda host, port: self.connect()):
+            output.send_via_smtp(transport, mail, {}, {
+                'body': {},
+                'perRecipient': True
+            })
+            output.send_via_smtp(transport, mail, {}, {'body': {}})
+
+        self.assertEqual(1, len(self.servers))
+        calls = self.servers[0].sendmail.call_args_list
+        self.assertEqual(['a@example.com'], calls[0][0][1])
+        self.assertIn('To: a@example.com\n', calls[0][0][2])
+        self.assertEqual(['b@example.com'], calls[1][0][1])
+        self.assertIn('To: B <b@example.com>\n', calls[1][0][2])
+        self.assertEqual(['a@example.com', 'b@example.com'], calls[2][0][1])
+
+
+if __name__ == '__main__':
+    unittest.main()
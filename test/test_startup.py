@@ -0,0 +1,67 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import unittest
+from .helpers import load_config
+from filters import LazyFilters, FILTERS, get_jinja_filters
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_filters_are_loaded_on_use(self):
+        filters = LazyFilters(FILTERS)
+        self.assertEqual(0, len(filters))
+        self.assertIn('split', filters)
+        self.assertEqual(0, len(filters))
+
+        self.assertIs(get_jinja_filters()['split'], filters['split'])
+        self.assertEqual(['split'], list(filters.keys()))
+        self.assertNotIn('nonexistent', filters)
+        self.assertIsNone(filters.get('nonexistent'))
+        with self.assertRaises(KeyError):
+            filters['nonexistent']
+
+    def test_templates_use_lazy_filters(self):
+        env = main.get_jinja_environment()
+        template = env.from_string(
+            "{{ 'a,b'|split(',')|join('-') }} {{ ['a'] is contains('a') }}")
+        self.assertEqual('a-b True', template.render())
+
+    def test_prewarm_loads_handlers(self):
+        main.configuration = load_config('legacy/shellscript-success')
+        try:
+            self.assertTrue(main.prewarm())
+            self.assertIn(('processors', 'shellscript'), main._HANDLER_CLASSES)
+            self.assertIn(('output', 'test'), main._HANDLER_CLASSES)
+        finally:
+            main.configuration = None
+
+    def test_parse_import_profile(self):
+        output = '\n'.join([
+            'import time: self [us] | cumulative | imported package',
+            'import time:       100 |        100 |     yaml.error',
+            'import time:       200 |        300 |   yaml',
+            'import time:       500 |       1500 | main',
+            'import time:      2000 |       2000 | sendgrid',
+        ])
+        self.assertEqual([('sendgrid', 2000, 2000), ('main', 1500, 500),
+                          ('yaml', 300, 200)],
+                         main.parse_import_profile(output))
+        self.assertEqual(
+            ['sendgrid', 'main'],
+            [module[0] for module in main.parse_import_profile(output, 0)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import os
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from helpers.base import BaseHelper
+
+
+def process_in_tempdir(name):
+    jinja_environment = main.get_jinja_environment()
+    helper = BaseHelper(jinja_environment)
+    tempdir = helper._init_tempdir()
+    with open(helper._get_path('message.txt'), 'w') as f:
+        f.write(name)
+    contents = jinja_environment.from_string(
+        '{{ "message.txt"|read_file }}').render()
+    helper._clean_tempdir()
+    return tempdir, contents
+
+
+class TestMessageTempdir(unittest.TestCase):
+
+    def test_concurrent_tempdirs(self):
+        cwd = os.getcwd()
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            results = list(
+                executor.map(process_in_tempdir,
+                             ['message-%d' % i for i in range(8)]))
+
+        self.assertEqual(cwd, os.getcwd())
+        self.assertEqual(8, len(set([tempdir for tempdir, _ in results])))
+        for i, (tempdir, contents) in enumerate(results):
+            self.assertEqual('message-%d' % i, contents)
+            self.assertFalse(os.path.exists(tempdir))
+
+    def test_absolute_paths_are_kept(self):
+        helper = BaseHelper(main.get_jinja_environment())
+        self.assertEqual('relative.txt', helper._get_path('relative.txt'))
+        tempdir = helper._init_tempdir()
+        self.assertEqual(os.path.join(tempdir, 'relative.txt'),
+                         helper._get_path('relative.txt'))
+        self.assertEqual('/tmp/absolute.txt',
+                         helper._get_path('/tmp/absolute.txt'))
+        helper._clean_tempdir()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,55 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import unittest
+from helpers.base import TemplateCache, get_template_cache
+
+
+class TestTemplateCache(unittest.TestCase):
+
+    def test_cached_template_uses_request_globals(self):
+        cache = get_template_cache()
+        cache.clear()
+
+        first_env = main.get_jinja_environment()
+        first_env.globals['name'] = 'first'
+        second_env = main.get_jinja_environment()
+        second_env.globals['name'] = 'second'
+
+        source = 'Hello {{ name }} ({{ req_random_uuid_hex }})'
+        first = first_env.from_string(source).render()
+        second = second_env.from_string(source).render()
+
+        self.assertTrue(first.startswith('Hello first ('))
+        self.assertTrue(second.startswith('Hello second ('))
+        self.assertNotEqual(first[13:], second[14:])
+        stats = cache.stats()
+        self.assertEqual(1, stats['misses'])
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['size'])
+
+    def test_lru_eviction(self):
+        cache = TemplateCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(1, cache.get('a'))
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(1, cache.get('a'))
+        self.assertEqual(3, cache.get('c'))
+        self.assertEqual(1, cache.stats()['evictions'])
+
+
+if __name__ == '__main__':
+    unittest.main()
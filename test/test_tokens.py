@@ -0,0 +1,135 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import threading
+import unittest
+from datetime import datetime, timezone
+from unittest import mock
+from unittest.mock import MagicMock
+from helpers import tokens
+from helpers.base import BaseHelper, get_client_registry
+from helpers.metrics import ACCESS_TOKENS, get_metrics_registry
+from helpers.tokens import AccessTokenCache
+
+
+class TestAccessTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        get_metrics_registry().clear()
+        self.now = 1000.0
+        self.cache = AccessTokenCache(refresh_margin=300, now=lambda: self.now)
+        self.fetches = 0
+
+    def fetch(self):
+        self.fetches += 1
+        return 'token-%d' % self.fetches, self.now + 3600
+
+    def test_refresh_before_expiry(self):
+        key = AccessTokenCache.get_key('sa@example.com', ['b', 'a'])
+        self.assertEqual(key,
+                         AccessTokenCache.get_key('sa@example.com', ['a', 'b']))
+
+        self.assertEqual('token-1', self.cache.get_token(key, self.fetch))
+        self.assertEqual('token-1', self.cache.get_token(key, self.fetch))
+        self.now += 3300
+        self.assertEqual('token-2', self.cache.get_token(key, self.fetch))
+        self.assertEqual(1, ACCESS_TOKENS.get(result='hit'))
+        self.assertEqual(1, ACCESS_TOKENS.get(result='miss'))
+        self.assertEqual(1, ACCESS_TOKENS.get(result='refresh'))
+
+    def test_single_flight(self):
+        key = ('sa@example.com', ('scope',))
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_fetch():
+            started.set()
+            release.wait(5)
+            return self.fetch()
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(
+            self.cache.get_token(key, slow_fetch)))
+        leader.start()
+        started.wait(5)
+        followers = [
+            threading.Thread(target=lambda: results.append(
+                self.cache.get_token(key, self.fetch))) for i in range(4)
+        ]
+        for follower in followers:
+            follower.start()
+        release.set()
+        for thread in [leader] + followers:
+            thread.join(5)
+
+        self.assertEqual(['token-1'] * 5, results)
+        self.assertEqual(1, self.fetches)
+
+    def test_stale_token_during_refresh(self):
+        key = ('sa@example.com', ('scope',))
+        self.cache.get_token(key, self.fetch)
+        self.now += 3400
+
+        def refresh():
+            # Other threads get the current token meanwhile
+            self.assertEqual('token-1', self.cache.get_token(key, self.fetch))
+            return self.fetch()
+
+        self.assertEqual('token-2', self.cache.get_token(key, refresh))
+        self.assertEqual(1, ACCESS_TOKENS.get(result='stale'))
+
+    def test_get_token_for_scopes(self):
+        client = MagicMock()
+        client.generate_access_token.return_value = MagicMock(
+            access_token='iam-token',
+            expire_time=datetime(2100, 1, 1, tzinfo=timezone.utc))
+        get_client_registry().clear()
+        with mock.patch.object(tokens, '_TOKEN_CACHE', AccessTokenCache()), \
+                mock.patch('google.cloud.iam_credentials_v1.IAMCredentialsClient',
+                           return_value=client):
+            helper = BaseHelper(None)
+            for i in range(3):
+                self.assertEqual(
+                    'iam-token',
+                    helper.get_token_for_scopes(
+                        ['scope'], service_account='sa@example.com'))
+        get_client_registry().clear()
+        client.generate_access_token.assert_called_once_with(
+            name='projects/-/serviceAccounts/sa@example.com', scope=['scope'])
+
+    def test_credentials_for_scopes(self):
+        fetches = []
+
+        def fetch(service_account, scopes):
+            fetches.append(service_account)
+            return 'token-%d' % len(fetches), 0
+
+        cache = AccessTokenCache(refresh_margin=300, now=lambda: -1000)
+        with mock.patch.object(tokens, '_TOKEN_CACHE', cache), \
+                mock.patch('helpers.base._generate_access_token', fetch):
+            credentials = BaseHelper(None).get_credentials_for_scopes(
+                ['scope'], service_account='sa@example.com')
+            headers = {}
+            credentials.before_request(None, 'GET', 'https://example.com',
+                                       headers)
+            self.assertEqual('Bearer token-1', headers['authorization'])
+            # Tokens are taken from the cache on each request
+            cache.clear()
+            credentials.before_request(None, 'GET', 'https://example.com',
+                                       headers)
+            self.assertEqual('Bearer token-2', headers['authorization'])
+        self.assertEqual(['sa@example.com', 'sa@example.com'], fetches)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,163 @@
+#   Copyright 2024 Google LLC
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#       http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+import main
+import io
+import asyncio
+import logging
+import unittest
+import requests
+import responses
+from contextlib import redirect_stdout
+from unittest.mock import MagicMock
+from opentelemetry.sdk.trace.export import SimpleSpanProcessor
+from opentelemetry.sdk.trace.export.in_memory_span_exporter import InMemorySpanExporter
+from opentelemetry.trace import SpanKind, StatusCode
+from .helpers import fixture_to_pubsub, load_config
+from helpers.metrics import instrument_http
+from helpers.tracing import setup_tracing, shutdown_tracing, start_span, tracing_enabled
+from processors import shellscript
+
+TRACEPARENT = '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'
+
+
+class TestTracing(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = InMemorySpanExporter()
+        setup_tracing(sample_ratio=1.0,
+                      span_processor=SimpleSpanProcessor(self.exporter))
+
+    def tearDown(self):
+        shutdown_tracing()
+
+    def get_spans(self):
+        return {span.name: span for span in self.exporter.get_finished_spans()}
+
+    def test_disabled(self):
+        shutdown_tracing()
+        self.assertFalse(tracing_enabled())
+        with start_span('test') as span:
+            self.assertIsNone(span)
+
+    def test_pipeline_spans(self):
+        logger = logging.getLogger('test')
+        config = load_config('message-handling')
+        event, context = fixture_to_pubsub('message-handling')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            main.decode_and_process(logger, config, event, context)
+
+        spans = self.get_spans()
+        root = spans['pubsub2inbox process']
+        self.assertIsNone(root.parent)
+        self.assertEqual(SpanKind.CONSUMER, root.kind)
+        self.assertEqual(context.event_id,
+                         root.attributes['messaging.message.id'])
+        self.assertEqual('stopped', root.attributes['pubsub2inbox.outcome'])
+
+        task = spans['processor genericjson']
+        self.assertEqual(root.context.span_id, task.parent.span_id)
+        self.assertEqual('#1', task.attributes['pubsub2inbox.task.name'])
+        self.assertEqual(
+            1,
+            len([
+                span for span in self.exporter.get_finished_spans()
+                if span.name == 'output logger'
+            ]))
+
+    def test_async_pipeline_failure(self):
+        logger = logging.getLogger('test')
+        config = load_config('shellscript-fail')
+        event, context = fixture_to_pubsub('generic')
+        event['attributes'] = {'googclient_traceparent': TRACEPARENT}
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            with self.assertRaises(shellscript.CommandFailedException):
+                asyncio.run(
+                    main.decode_and_process_async(logger, config, event,
+                                                  context))
+
+        spans = self.get_spans()
+        root = spans['pubsub2inbox process']
+        self.assertEqual(0x0af7651916cd43dd8448eb211c80319c,
+                         root.context.trace_id)
+        self.assertEqual(0xb7ad6b7169203331, root.parent.span_id)
+        self.assertEqual(StatusCode.ERROR, root.status.status_code)
+        self.assertEqual('failed', root.attributes['pubsub2inbox.outcome'])
+
+        task = spans['processor shellscript']
+        self.assertEqual(root.context.span_id, task.parent.span_id)
+        self.assertEqual(StatusCode.ERROR, task.status.status_code)
+
+    def test_legacy_spans(self):
+        logger = logging.getLogger('test')
+        config = load_config('legacy/shellscript-success')
+        event, context = fixture_to_pubsub('generic')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            main.decode_and_process(logger, config, event, context)
+
+        spans = self.get_spans()
+        root = spans['pubsub2inbox process']
+        for name in ['processor genericjson', 'processor shellscript']:
+            self.assertEqual(root.context.span_id, spans[name].parent.span_id)
+
+    def test_client_spans(self):
+        http = MagicMock()
+        http.request.return_value = (MagicMock(status=404), b'')
+        http = instrument_http(http)
+
+        with start_span('parent') as parent:
+            http.request(
+                'https://cloudresourcemanager.googleapis.com/v3/projects/foo?key=secret'
+            )
+
+        spans = self.get_spans()
+        client = spans['GET cloudresourcemanager.googleapis.com']
+        self.assertEqual(SpanKind.CLIENT, client.kind)
+        self.assertEqual(parent.get_span_context().span_id,
+                         client.parent.span_id)
+        self.assertEqual(
+            'https://cloudresourcemanager.googleapis.com/v3/projects/foo',
+            client.attributes['url.full'])
+        self.assertEqual(404, client.attributes['http.response.status_code'])
+        self.assertEqual(StatusCode.ERROR, client.status.status_code)
+
+    @responses.activate
+    def test_requests_spans(self):
+        responses.add(responses.POST, 'https://api.opsgenie.com/v2/alerts')
+        with start_span('parent') as parent:
+            requests.post('https://api.opsgenie.com/v2/alerts', json={})
+
+        client = self.get_spans()['POST api.opsgenie.com']
+        self.assertEqual(parent.get_span_context().span_id,
+                         client.parent.span_id)
+        self.assertEqual(200, client.attributes['http.response.status_code'])
+
+    def test_sampling(self):
+        self.exporter = InMemorySpanExporter()
+        setup_tracing(sample_ratio=0.0,
+                      span_processor=SimpleSpanProcessor(self.exporter))
+        with start_span('unsampled'):
+            pass
+        with start_span('sampled', carrier={'traceparent': TRACEPARENT}):
+            pass
+        self.assertEqual(['sampled'], list(self.get_spans().keys()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -134,6 +134,12 @@ variable "available_cpu" {
   default     = null
 }
 
+variable "function_concurrency" {
+  type        = number
+  description = "Concurrent requests per Cloud Functions v2 instance (values above 1 require at least 1 CPU)"
+  default     = 1
+}
+
 variable "container_concurrency" {
   type        = number
   description = "Concurrency of requests to the container"